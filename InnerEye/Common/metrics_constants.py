@@ -23,6 +23,7 @@ class MetricsFileColumns(Enum):
     Dice = "Dice"
     DiceNumeric = "DiceNumeric"
     HausdorffDistanceMM = "HausdorffDistance_mm"
+    HausdorffDistance95MM = "HausdorffDistance95_mm"
     MeanDistanceMM = "MeanDistance_mm"
 
 
@@ -79,6 +80,7 @@ class MetricType(Enum):
     # Metrics for segmentation
     DICE = "Dice"
     HAUSDORFF_mm = "HausdorffDistance_millimeters"
+    HAUSDORFF_95_mm = "HausdorffDistance95_millimeters"
     MEAN_SURFACE_DIST_mm = "MeanSurfaceDistance_millimeters"
     VOXEL_COUNT = "VoxelCount"
     PROPORTION_FOREGROUND_VOXELS = "ProportionForegroundVoxels"
@@ -0,0 +1,187 @@
+#  ------------------------------------------------------------------------------------------
+#  Copyright (c) Microsoft Corporation. All rights reserved.
+#  Licensed under the MIT License (MIT). See LICENSE in the repo root for license information.
+#  ------------------------------------------------------------------------------------------
+
+"""On-disk cache of transformed bags. Each bag is stored in its own folder, named by the bag ID and a hash of all of the
+bag's rows in the source tiles dataset: the tensors of the transformed bag are written as `.npy` files, which are memory
+mapped when the bag is loaded, and all other values are pickled into a small metadata file. Entries are thus loaded
+lazily and their pages are shared by all processes that read them, e.g. DDP processes and data loader workers. The
+entries hold full bags, and random subsets of tiles are drawn after loading, such that the key of a slide does not
+change across epochs. A slide whose tiles change gets a new key, and its previous entry is removed, such that only new
+or modified slides are computed when the tiles dataset changes.
+"""
+
+import glob
+import hashlib
+import pickle
+import shutil
+import tempfile
+from pathlib import Path
+from typing import Any, Callable, Dict, Mapping, Optional, Sequence, Union
+
+import numpy as np
+import torch
+from monai.data.dataset import Dataset
+from monai.transforms import apply_transform
+
+METADATA_FILENAME = "metadata.pkl"
+# The number of hexadecimal digits of the hash in the names of cache entries.
+KEY_HASH_LENGTH = 16
+
+
+def _update_hash(hasher: Any, value: Any) -> None:
+    if isinstance(value, torch.Tensor):
+        value = value.detach().cpu().numpy()
+    if isinstance(value, np.ndarray):
+        hasher.update(repr((value.dtype.str, value.shape)).encode())
+        hasher.update(np.ascontiguousarray(value).tobytes())
+    elif isinstance(value, (list, tuple)):
+        hasher.update(f"{type(value).__name__}{len(value)}".encode())
+        for item in value:
+            _update_hash(hasher, item)
+    else:
+        hasher.update(repr(value).encode())
+
+
+def get_bag_key(bag: Mapping[str, Any], bag_id_key: str) -> str:
+    """Get the name of the cache entry of a bag, made of the bag ID and a hash of all values of the untransformed bag,
+    i.e. of the bag's rows in the tiles dataset. The bag must contain all rows of the slide in a fixed order, rather
+    than a random subset, otherwise the key changes every time the bag is sampled.
+
+    :param bag: The full untransformed bag, as returned by the base dataset.
+    :param bag_id_key: The key of the bag IDs in the bag, e.g. the slide ID column.
+    """
+    hasher = hashlib.sha256()
+    for key in sorted(bag):
+        hasher.update(str(key).encode())
+        _update_hash(hasher, bag[key])
+    bag_ids = bag[bag_id_key]
+    bag_id = bag_ids[0] if isinstance(bag_ids, (list, tuple)) and len(bag_ids) > 0 else bag_ids
+    if isinstance(bag_id, torch.Tensor):
+        bag_id = bag_id.flatten()[0].item()
+    return f"{bag_id}-{hasher.hexdigest()[:KEY_HASH_LENGTH]}"
+
+
+def remove_stale_entries(folder: Path) -> None:
+    """Remove the cache entries of the same bag as the given entry that have a different hash, i.e. entries that were
+    written before the bag's rows in the tiles dataset changed.
+
+    :param folder: The folder of the current cache entry of the bag.
+    """
+    bag_id = folder.name[:-(KEY_HASH_LENGTH + 1)]
+    for entry in folder.parent.glob(glob.escape(bag_id) + "-" + "?" * KEY_HASH_LENGTH):
+        if entry != folder:
+            shutil.rmtree(entry, ignore_errors=True)
+
+
+def sample_bag(bag: Mapping[str, Any], max_bag_size: int, shuffle_samples: bool,
+               generator: Optional[torch.Generator] = None) -> Dict[str, Any]:
+    """Select a subset of the tiles of a transformed bag, in the same way as `BagDataset` samples the rows of a bag: The
+    tiles are shuffled if `shuffle_samples` is set, and the first `max_bag_size` of them are kept. Tensors and lists
+    whose length is the number of tiles are indexed, all other values are kept as they are.
+
+    :param bag: The full transformed bag.
+    :param max_bag_size: Upper bound on the number of tiles in the returned bag. If 0, all tiles are returned.
+    :param shuffle_samples: Whether to shuffle the tiles.
+    :param generator: The pseudorandom number generator to shuffle with.
+    """
+    lengths = [len(value) for value in bag.values() if isinstance(value, (torch.Tensor, list, tuple))]
+    n_tiles = max(lengths) if lengths else 0
+    if shuffle_samples:
+        indices = torch.randperm(n_tiles, generator=generator)
+    else:
+        indices = torch.arange(n_tiles)
+    if max_bag_size > 0:
+        indices = indices[:max_bag_size]
+    if not shuffle_samples and len(indices) == n_tiles:
+        return dict(bag)
+    sampled_bag: Dict[str, Any] = {}
+    for key, value in bag.items():
+        if isinstance(value, torch.Tensor) and value.ndim > 0 and len(value) == n_tiles:
+            sampled_bag[key] = value[indices]
+        elif isinstance(value, (list, tuple)) and len(value) == n_tiles:
+            sampled_bag[key] = [value[i] for i in indices.tolist()]
+        else:
+            sampled_bag[key] = value
+    return sampled_bag
+
+
+def save_bag(bag: Mapping[str, Any], folder: Path) -> None:
+    """Write a transformed bag to a cache entry. The entry is written to a temporary folder first and then renamed, such
+    that readers never see an incomplete entry. If another process wrote the same entry in the meantime, it is kept.
+
+    :param bag: The transformed bag.
+    :param folder: The folder of the cache entry.
+    """
+    folder.parent.mkdir(parents=True, exist_ok=True)
+    temp_folder = Path(tempfile.mkdtemp(prefix=f".{folder.name}.", dir=folder.parent))
+    try:
+        metadata: Dict[str, Any] = {}
+        tensor_files: Dict[str, str] = {}
+        for i, (key, value) in enumerate(bag.items()):
+            if isinstance(value, torch.Tensor):
+                tensor_files[key] = f"tensor_{i}.npy"
+                np.save(temp_folder / tensor_files[key], value.detach().cpu().numpy())
+            else:
+                metadata[key] = value
+        with (temp_folder / METADATA_FILENAME).open('wb') as f:
+            pickle.dump((metadata, tensor_files), f)
+        try:
+            temp_folder.rename(folder)
+        except OSError:
+            if not folder.is_dir():
+                raise
+    finally:
+        shutil.rmtree(temp_folder, ignore_errors=True)
+
+
+def load_bag(folder: Path) -> Dict[str, Any]:
+    """Load a transformed bag from a cache entry. Tensors are memory mapped copy-on-write, such that they share pages
+    with other processes as long as they are not modified.
+
+    :param folder: The folder of the cache entry.
+    """
+    with (folder / METADATA_FILENAME).open('rb') as f:
+        metadata, tensor_files = pickle.load(f)
+    for key, filename in tensor_files.items():
+        metadata[key] = torch.from_numpy(np.load(folder / filename, mmap_mode='c'))
+    return metadata
+
+
+class BagCacheDataset(Dataset):
+    """Dataset that applies a transform to the full bags of a base dataset, and caches each transformed bag in its own
+    entry on disk, see `get_bag_key`. Random subsets of tiles are drawn from the loaded bags with `sample_bag`. As in
+    `monai.data.PersistentDataset`, the transform should not be randomised."""
+
+    def __init__(self, data: Sequence, transform: Optional[Union[Sequence[Callable], Callable]],
+                 cache_dir: Union[str, Path], bag_id_key: str, max_bag_size: int = 0,
+                 shuffle_samples: bool = False, generator: Optional[torch.Generator] = None) -> None:
+        """
+        :param data: The base dataset, which returns full untransformed bags, i.e. all rows of each slide in a fixed
+        order.
+        :param transform: The transform to apply to each bag.
+        :param cache_dir: The directory in which a folder is created for each transformed bag.
+        :param bag_id_key: The key of the bag IDs in the bags, which is used to name the cache entries.
+        :param max_bag_size: Upper bound on the number of tiles in each returned bag. If 0 (default), all tiles are
+        returned.
+        :param shuffle_samples: Whether to shuffle the tiles of each returned bag.
+        :param generator: The pseudorandom number generator to shuffle with.
+        """
+        super().__init__(data, transform)
+        self.cache_dir = Path(cache_dir)
+        self.bag_id_key = bag_id_key
+        self.max_bag_size = max_bag_size
+        self.shuffle_samples = shuffle_samples
+        self.generator = generator
+
+    def _transform(self, index: int) -> Dict[str, Any]:
+        bag = self.data[index]
+        folder = self.cache_dir / get_bag_key(bag, self.bag_id_key)
+        if (folder / METADATA_FILENAME).is_file():
+            transformed_bag = load_bag(folder)
+        else:
+            transformed_bag = apply_transform(self.transform, bag) if self.transform is not None else bag
+            save_bag(transformed_bag, folder)
+            remove_stale_entries(folder)
+        return sample_bag(transformed_bag, self.max_bag_size, self.shuffle_samples, self.generator)
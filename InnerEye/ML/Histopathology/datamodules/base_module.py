@@ -14,14 +14,18 @@ from torch.utils.data import DataLoader
 
 from health_ml.utils.bag_utils import BagDataset, multibag_collate
 from health_ml.utils.common_utils import _create_generator
+from InnerEye.ML.Histopathology.datamodules.bag_cache import BagCacheDataset
 from InnerEye.ML.Histopathology.datasets.base_dataset import TilesDataset
-from InnerEye.ML.Histopathology.models.transforms import LoadTilesBatchd
+from InnerEye.ML.Histopathology.models.tile_embeddings import LoadTileEmbeddingsBatchd, TileEmbeddingStore
+from InnerEye.ML.Histopathology.models.transforms import LoadTileShardsBatchd, LoadTilesBatchd
+from InnerEye.ML.Histopathology.preprocessing.tile_shards import is_sharded_dataset
 
 
 class CacheMode(Enum):
     NONE = 'none'
     MEMORY = 'memory'
     DISK = 'disk'
+    BAGS = 'bags'
 
 
 class TilesDataModule(LightningDataModule):
@@ -32,7 +36,8 @@ class TilesDataModule(LightningDataModule):
                  cache_mode: CacheMode = CacheMode.NONE, save_precache: bool = False,
                  cache_dir: Optional[Path] = None,
                  number_of_cross_validation_splits: int = 0,
-                 cross_validation_split_index: int = 0) -> None:
+                 cross_validation_split_index: int = 0,
+                 embeddings_store: Optional[TileEmbeddingStore] = None) -> None:
         """
         :param root_path: Root directory of the source dataset.
         :param max_bag_size: Upper bound on number of tiles in each loaded bag. If 0 (default),
@@ -42,12 +47,17 @@ class TilesDataModule(LightningDataModule):
         :param seed: pseudorandom number generator seed to use for shuffling instances and bags. Note that randomness in
         train/val/test splits is handled independently in `get_splits()`. (default: `None`)
         :param transform: A transform to apply to the source tiles dataset, or a composition of
-        transforms using `monai.transforms.Compose`. By default (`None`), applies `LoadTilesBatchd`.
+        transforms using `monai.transforms.Compose`. By default (`None`), applies `LoadTilesBatchd`, or
+        `LoadTileShardsBatchd` if the dataset stores its tiles in shards.
         :param cache_mode: The type of caching to perform, i.e. whether the results of all
         transforms up to the first randomised one should be computed only once and reused in
         subsequent iterations:
           - `MEMORY`: the entire transformed dataset is kept in memory for fastest access;
           - `DISK`: each transformed sample is saved to disk and loaded on-demand;
+          - `BAGS`: each full transformed bag is saved to disk in its own entry, keyed by the slide's rows in the
+            tiles dataset, and memory mapped on-demand, such that processes share the loaded pages and only new or
+            changed slides are computed when the dataset changes, see `BagCacheDataset`. Random subsets of
+            `max_bag_size` tiles are drawn after loading. No dataset pickle is written;
           - `NONE` (default): no caching is performed.
         :param save_precache: Whether to pre-cache the entire transformed dataset upfront and save
         it to disk. This is done once in `prepare_data()` only on the local rank-0 process, so
@@ -55,12 +65,17 @@ class TilesDataModule(LightningDataModule):
         :param cache_dir: The directory onto which to cache data if caching is enabled.
         :param number_of_cross_validation_splits: Number of folds to perform.
         :param cross_validation_split_index: Index of the cross validation split to be performed.
+        :param embeddings_store: If given, the tiles of all splits are encoded once with the store's encoder in
+        `prepare_data()`, and bags are loaded as matrices of precomputed features with `LoadTileEmbeddingsBatchd`,
+        such that the model only needs to run its pooling and classifier layers. `transform` must then be `None`.
         """
+        if embeddings_store is not None and transform is not None:
+            raise ValueError("A transform cannot be used with precomputed tile embeddings")
         if save_precache and cache_mode is CacheMode.NONE:
             raise ValueError("Can only pre-cache if caching is enabled")
         if save_precache and cache_dir is None:
             raise ValueError("A cache directory is required for pre-caching")
-        if cache_mode is CacheMode.DISK and cache_dir is None:
+        if cache_mode in (CacheMode.DISK, CacheMode.BAGS) and cache_dir is None:
             raise ValueError("A cache directory is required for on-disk caching")
         super().__init__()
 
@@ -73,6 +88,7 @@ class TilesDataModule(LightningDataModule):
         self.batch_size = batch_size
         self.number_of_cross_validation_splits = number_of_cross_validation_splits
         self.cross_validation_split_index = cross_validation_split_index
+        self.embeddings_store = embeddings_store
         self.train_dataset, self.val_dataset, self.test_dataset = self.get_splits()
         self.class_weights = self.train_dataset.get_class_weights()
         self.seed = seed
@@ -82,13 +98,16 @@ class TilesDataModule(LightningDataModule):
         raise NotImplementedError
 
     def prepare_data(self) -> None:
+        if self.embeddings_store is not None:
+            for tiles_dataset in (self.train_dataset, self.val_dataset, self.test_dataset):
+                self.embeddings_store.compute(tiles_dataset)
         if self.save_precache:
             self._load_dataset(self.train_dataset, stage='train', shuffle=True)
             self._load_dataset(self.val_dataset, stage='val', shuffle=True)
             self._load_dataset(self.test_dataset, stage='test', shuffle=True)
 
     def _dataset_pickle_path(self, stage: str) -> Optional[Path]:
-        if self.cache_dir is None:
+        if self.cache_dir is None or self.cache_mode is CacheMode.BAGS:
             return None
         return self.cache_dir / f"{stage}_dataset.pkl"
 
@@ -100,16 +119,27 @@ class TilesDataModule(LightningDataModule):
                 return pickle.load(f)
 
         generator = _create_generator(self.seed)
+        # The bag cache stores full bags, and draws the random subsets of tiles after loading them
+        full_bags = self.cache_mode is CacheMode.BAGS
         bag_dataset = BagDataset(tiles_dataset,  # type: ignore
                                  bag_ids=tiles_dataset.slide_ids,
-                                 max_bag_size=self.max_bag_size,
-                                 shuffle_samples=shuffle,
+                                 max_bag_size=0 if full_bags else self.max_bag_size,
+                                 shuffle_samples=shuffle and not full_bags,
                                  generator=generator)
-        transform = self.transform or LoadTilesBatchd(tiles_dataset.IMAGE_COLUMN)
+        if self.transform is not None:
+            transform = self.transform
+        elif self.embeddings_store is not None:
+            transform = LoadTileEmbeddingsBatchd(tiles_dataset.IMAGE_COLUMN, self.embeddings_store.folder)
+        elif is_sharded_dataset(tiles_dataset):
+            transform = LoadTileShardsBatchd(tiles_dataset.IMAGE_COLUMN)
+        else:
+            transform = LoadTilesBatchd(tiles_dataset.IMAGE_COLUMN)
 
         # Save and restore PRNG state for consistency across (pre-)caching options
         generator_state = generator.get_state()
-        transformed_bag_dataset = self._get_transformed_dataset(bag_dataset, transform)  # type: ignore
+        transformed_bag_dataset = self._get_transformed_dataset(bag_dataset, transform,  # type: ignore
+                                                                bag_id_key=tiles_dataset.SLIDE_ID_COLUMN,
+                                                                shuffle_samples=shuffle)
         generator.set_state(generator_state)
 
         if dataset_pickle_path:
@@ -120,18 +150,25 @@ class TilesDataModule(LightningDataModule):
         return transformed_bag_dataset
 
     def _get_transformed_dataset(self, base_dataset: BagDataset,
-                                 transform: Union[Sequence[Callable], Callable]) -> Dataset:
+                                 transform: Union[Sequence[Callable], Callable],
+                                 bag_id_key: str = TilesDataset.SLIDE_ID_COLUMN,
+                                 shuffle_samples: bool = False) -> Dataset:
         if self.cache_mode is CacheMode.MEMORY:
             dataset = CacheDataset(base_dataset, transform, num_workers=1)  # type: ignore
         elif self.cache_mode is CacheMode.DISK:
             dataset = PersistentDataset(base_dataset, transform, cache_dir=self.cache_dir)  # type: ignore
-            if self.save_precache:
-                import tqdm  # TODO: Make optional
-
-                for i in tqdm.trange(len(dataset), desc="Loading dataset"):
-                    dataset[i]  # empty loop to pre-compute all transformed samples
+        elif self.cache_mode is CacheMode.BAGS:
+            assert self.cache_dir is not None
+            dataset = BagCacheDataset(base_dataset, transform, cache_dir=self.cache_dir / "bags",  # type: ignore
+                                      bag_id_key=bag_id_key, max_bag_size=self.max_bag_size,
+                                      shuffle_samples=shuffle_samples, generator=base_dataset.bag_sampler.generator)
         else:
             dataset = Dataset(base_dataset, transform)  # type: ignore
+        if self.save_precache and self.cache_mode in (CacheMode.DISK, CacheMode.BAGS):
+            import tqdm  # TODO: Make optional
+
+            for i in tqdm.trange(len(dataset), desc="Loading dataset"):
+                dataset[i]  # empty loop to pre-compute all transformed samples
         return dataset
 
     def _get_dataloader(self, tiles_dataset: TilesDataset, stage: str, shuffle: bool,
@@ -10,7 +10,7 @@ import pandas as pd
 from torchvision.datasets.vision import VisionDataset
 
 from InnerEye.ML.Histopathology.datasets.base_dataset import TilesDataset
-from InnerEye.ML.Histopathology.models.transforms import load_pil_image
+from InnerEye.ML.Histopathology.models.transforms import load_tile_as_pil_image
 from InnerEye.ML.SSL.datamodules_and_datasets.dataset_cls_utils import InnerEyeDataClassBaseWithReturnIndex
 
 
@@ -45,7 +45,7 @@ class PandaTilesDataset(TilesDataset):
 class PandaTilesDatasetReturnImageLabel(VisionDataset):
     """
     Any dataset used in SSL needs to return a tuple where the first element is the image and the second is a
-    class label.
+    class label. Tiles are read from PNG files or, for sharded datasets, from the tile shards.
     """
     def __init__(self,
                  root: Path,
@@ -61,7 +61,7 @@ class PandaTilesDatasetReturnImageLabel(VisionDataset):
     def __getitem__(self, index: int) -> Tuple:  # type: ignore
         sample = self.base_dataset[index]
         # TODO change to a meaningful evaluation
-        image = load_pil_image(sample[self.base_dataset.IMAGE_COLUMN])
+        image = load_tile_as_pil_image(sample, self.base_dataset.IMAGE_COLUMN)
         if self.transform:
             image = self.transform(image)
         return image, 1
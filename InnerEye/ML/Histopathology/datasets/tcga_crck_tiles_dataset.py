@@ -11,7 +11,7 @@ import pandas as pd
 from torchvision.datasets.vision import VisionDataset
 
 from InnerEye.ML.Histopathology.datasets.base_dataset import TilesDataset
-from InnerEye.ML.Histopathology.models.transforms import load_pil_image
+from InnerEye.ML.Histopathology.models.transforms import load_tile_as_pil_image
 from InnerEye.ML.SSL.datamodules_and_datasets.dataset_cls_utils import InnerEyeDataClassBaseWithReturnIndex
 
 
@@ -31,7 +31,7 @@ class TcgaCrck_TilesDataset(TilesDataset):
 class TcgaCrck_TilesDatasetReturnImageLabel(VisionDataset):
     """
     Any dataset used in SSL needs to return a tuple where the first element is the image and the second is a
-    class label.
+    class label. Tiles are read from PNG files or, for sharded datasets, from the tile shards.
     """
     def __init__(self,
                  root: Union[str, Path],
@@ -49,7 +49,7 @@ class TcgaCrck_TilesDatasetReturnImageLabel(VisionDataset):
     def __getitem__(self, index: int) -> Tuple:  # type: ignore
         sample = self.base_dataset[index]
         # TODO change to a meaningful evaluation
-        image = load_pil_image(sample[self.base_dataset.IMAGE_COLUMN])
+        image = load_tile_as_pil_image(sample, self.base_dataset.IMAGE_COLUMN)
         if self.transform:
             image = self.transform(image)
         return image, sample[self.base_dataset.LABEL_COLUMN]
@@ -14,6 +14,7 @@ from pytorch_lightning import LightningModule
 from torch import Tensor, argmax, mode, nn, no_grad, optim, round
 from torchmetrics import AUROC, F1, Accuracy, Precision, Recall
 
+from health_ml.networks.layers.attention_layers import AttentionLayer, GatedAttentionLayer
 from InnerEye.Common import fixed_paths
 from InnerEye.ML.Histopathology.datasets.base_dataset import TilesDataset
 from InnerEye.ML.Histopathology.models.encoders import TileEncoder
@@ -152,6 +153,58 @@ class DeepMILModule(LightningModule):
         Y_prob = self.classifier_fn(M)
         return Y_prob, A
 
+    def get_attention_scores(self, features: Tensor) -> Optional[Tensor]:
+        """Compute the attention scores of the pooling layer before the softmax over the tiles of a bag, for the
+        attention layers whose structure is known. Scores for the tiles of several bags can be computed at once,
+        because they do not depend on other tiles.
+
+        :param features: The encoded tiles (N x L).
+        :return: The attention scores (N x K), or `None` if the pooling layer is not supported.
+        """
+        pooling = self.aggregation_fn
+        if isinstance(pooling, GatedAttentionLayer):
+            return pooling.attention_weights(pooling.attention_V(features) * pooling.attention_U(features))
+        if isinstance(pooling, AttentionLayer):
+            return pooling.attention(features)
+        return None
+
+    def forward_bags(self, bags: List[Tensor]) -> Tuple[Tensor, List[Tensor]]:
+        """Compute the predictions for several bags of tiles of different sizes. The tiles of all bags are encoded at
+        once, and the attention softmax and pooling are computed per bag with segment reductions. For pooling layers
+        that `get_attention_scores` does not support, each bag is passed through `forward()` separately.
+
+        :param bags: The tile images of each bag.
+        :return: A tuple of the logits (B x n_classes), and the attention weights of each bag (K x N_bag).
+        """
+        bag_sizes = [bag.shape[0] for bag in bags]
+        with no_grad():
+            H = self.encoder(torch.cat(bags))                 # N x L
+        scores = self.get_attention_scores(H)                 # N x K
+        if scores is None:
+            logits_list, attention_list = [], []
+            for bag_features in H.split(bag_sizes):
+                A, M = self.aggregation_fn(bag_features)
+                logits_list.append(self.classifier_fn(M.view(-1, self.num_pooling)).view(-1))
+                attention_list.append(A)
+            return torch.stack(logits_list), attention_list
+
+        n_bags = len(bags)
+        sizes = torch.tensor(bag_sizes, device=H.device)
+        bag_index = torch.repeat_interleave(torch.arange(n_bags, device=H.device), sizes)
+        offsets = torch.cumsum(sizes, dim=0) - sizes
+        position = torch.arange(H.shape[0], device=H.device) - offsets[bag_index]
+        # Softmax over the tiles of each bag, on scores that are padded to the largest bag
+        padded_scores = scores.new_full((n_bags, max(bag_sizes), scores.shape[1]), float('-inf'))
+        padded_scores[bag_index, position] = scores
+        A = torch.softmax(padded_scores, dim=1)[bag_index, position]                   # N x K
+        # The pooling of all bags is one matrix product, with the attention weights of each bag's tiles in its rows.
+        # This is faster than index_add_ and its backward pass.
+        segment_weights = A.new_zeros(n_bags, A.shape[1], H.shape[0])
+        segment_weights[bag_index, :, torch.arange(H.shape[0], device=H.device)] = A
+        M = segment_weights.view(-1, H.shape[0]).mm(H)                                 # (B * K) x L
+        Y_prob = self.classifier_fn(M.view(n_bags, self.num_pooling))
+        return Y_prob, list(A.t().split(bag_sizes, dim=1))
+
     def configure_optimizers(self) -> optim.Optimizer:
         return optim.Adam(self.parameters(), lr=self.l_rate, weight_decay=self.weight_decay,
                           betas=self.adam_betas)
@@ -162,19 +215,10 @@ class DeepMILModule(LightningModule):
     def _shared_step(self, batch: Dict, batch_idx: int, stage: str) -> Dict[ResultsKey, Tensor]:
         # The batch dict contains lists of tensors of different sizes, for all bags in the batch.
         # This means we can't stack them along a new axis without padding to the same length.
-        # We could alternatively concatenate them, but this would require other changes (e.g. in
-        # the attention layers) to correctly split the tensors by bag/slide ID.
-        bag_labels_list = []
-        bag_logits_list = []
-        bag_attn_list = []
-        for bag_idx in range(len(batch[self.label_column])):
-            images = batch[TilesDataset.IMAGE_COLUMN][bag_idx]
-            labels = batch[self.label_column][bag_idx]
-            bag_labels_list.append(self.get_bag_label(labels))
-            logit, attn = self(images)
-            bag_logits_list.append(logit.view(-1))
-            bag_attn_list.append(attn)
-        bag_logits = torch.stack(bag_logits_list)
+        # Instead, forward_bags() concatenates them, encodes all tiles at once, and computes the attention
+        # pooling of each bag with segment reductions over the bag/slide IDs.
+        bag_labels_list = [self.get_bag_label(labels) for labels in batch[self.label_column]]
+        bag_logits, bag_attn_list = self.forward_bags(list(batch[TilesDataset.IMAGE_COLUMN]))
         bag_labels = torch.stack(bag_labels_list).view(-1)
 
         if self.n_classes > 1:
@@ -0,0 +1,211 @@
+#  ------------------------------------------------------------------------------------------
+#  Copyright (c) Microsoft Corporation. All rights reserved.
+#  Licensed under the MIT License (MIT). See LICENSE in the repo root for license information.
+#  ------------------------------------------------------------------------------------------
+
+"""Store of precomputed tile embeddings. A frozen tile encoder is run once over a tiles dataset, and the features of
+each slide are written to `<slide_id>.npy` as a float32 matrix of shape (N, num_encoding) in a folder that is specific
+to the encoder, together with the IDs of its tiles in `<slide_id>.txt`. Bags of features are then memory mapped by
+`LoadTileEmbeddingsBatchd`, such that training only runs the pooling and classifier layers.
+"""
+
+import functools
+import hashlib
+import logging
+from pathlib import Path
+from typing import Any, Dict, List, Mapping, Sequence, Union
+
+import numpy as np
+import torch
+from monai.config.type_definitions import KeysCollection
+from monai.transforms.transform import MapTransform
+from torch.utils.data import DataLoader, Dataset
+
+from InnerEye.ML.Histopathology.datasets.base_dataset import TilesDataset
+from InnerEye.ML.Histopathology.models.encoders import TileEncoder
+from InnerEye.ML.Histopathology.models.transforms import load_image_as_tensor, load_shard_tiles_as_tensor
+from InnerEye.ML.Histopathology.preprocessing.tile_shards import is_sharded_dataset
+from InnerEye.ML.Histopathology.utils.naming import TileKey
+
+FEATURES_SUFFIX = ".npy"
+TILE_IDS_SUFFIX = ".txt"
+
+
+def get_encoder_id(encoder: TileEncoder, version: str = "") -> str:
+    """Get a name that identifies an encoder, made of its class name, the given version, and a hash of its input
+    shape, output size and weights. Stores of different encoders, or of the same encoder with different weights, are
+    thus kept apart.
+
+    :param encoder: The tile encoder.
+    :param version: An optional version string, to be changed when the embeddings must be recomputed for reasons that
+    the encoder weights do not capture, e.g. a change of the tiles dataset.
+    """
+    hasher = hashlib.sha256()
+    hasher.update(repr((encoder.input_dim, int(encoder.num_encoding))).encode())
+    for name, tensor in encoder.state_dict().items():
+        hasher.update(name.encode())
+        hasher.update(tensor.detach().cpu().contiguous().numpy().tobytes())
+    name_parts = [type(encoder).__name__, version, hasher.hexdigest()[:16]]
+    return "-".join(part for part in name_parts if part)
+
+
+class _TileImagesDataset(Dataset):
+    """Dataset that loads the images of the given tiles of a tiles dataset as tensors, from PNG files or shards."""
+
+    def __init__(self, tiles_dataset: TilesDataset, positions: Sequence[int]) -> None:
+        self.tiles_dataset = tiles_dataset
+        self.positions = positions
+        self.is_sharded = is_sharded_dataset(tiles_dataset)
+
+    def __len__(self) -> int:
+        return len(self.positions)
+
+    def __getitem__(self, index: int) -> torch.Tensor:
+        sample = self.tiles_dataset[self.positions[index]]
+        image_path = sample[self.tiles_dataset.IMAGE_COLUMN]
+        if self.is_sharded:
+            return load_shard_tiles_as_tensor([image_path], [sample[TileKey.SHARD_INDEX.value]])[0]
+        return load_image_as_tensor(image_path)
+
+
+class TileEmbeddingStore:
+    """Computes the embeddings of the tiles of a dataset once, and stores them per slide in a folder that is named by
+    the encoder identity, see `get_encoder_id`."""
+
+    def __init__(self, root_dir: Union[str, Path], encoder: TileEncoder, version: str = "",
+                 batch_size: int = 256, num_workers: int = 0) -> None:
+        """
+        :param root_dir: The directory in which the store of each encoder is created.
+        :param encoder: The frozen tile encoder.
+        :param version: An optional version string that is part of the store name, see `get_encoder_id`.
+        :param batch_size: The number of tiles to encode at once.
+        :param num_workers: The number of data loader processes that load tile images.
+        """
+        self.encoder = encoder
+        self.batch_size = batch_size
+        self.num_workers = num_workers
+        self.folder = Path(root_dir) / get_encoder_id(encoder, version)
+
+    def is_slide_computed(self, slide_id: str) -> bool:
+        return (self.folder / f"{slide_id}{FEATURES_SUFFIX}").is_file()
+
+    def _write_slide(self, slide_id: str, tile_ids: Sequence[Any], features: np.ndarray) -> None:
+        """Write the features of a slide. The features file is renamed into place last, such that it marks the slide
+        as computed."""
+        (self.folder / f"{slide_id}{TILE_IDS_SUFFIX}").write_text("".join(f"{tile_id}\n" for tile_id in tile_ids))
+        features_path = self.folder / f"{slide_id}{FEATURES_SUFFIX}"
+        temp_path = features_path.with_name(features_path.name + ".tmp")
+        with temp_path.open('wb') as file:
+            np.save(file, features)
+        temp_path.replace(features_path)
+
+    @torch.no_grad()
+    def compute(self, tiles_dataset: TilesDataset) -> None:
+        """Encode the tiles of all slides of the dataset that are not in the store yet. Tiles are loaded by a data
+        loader in batches of `batch_size`, and the features of a slide are written as soon as all its tiles are
+        encoded.
+
+        :param tiles_dataset: The tiles dataset to encode.
+        """
+        self.folder.mkdir(parents=True, exist_ok=True)
+        slide_ids = tiles_dataset.slide_ids
+        tile_ids = tiles_dataset.dataset_df.index
+        # Integer positions of the tiles of each slide that is not yet computed, in the order of the dataset
+        slide_positions: Dict[str, List[int]] = {}
+        for position, slide_id in enumerate(slide_ids):
+            slide_positions.setdefault(str(slide_id), []).append(position)
+        pending = [(slide_id, positions) for slide_id, positions in slide_positions.items()
+                   if not self.is_slide_computed(slide_id)]
+        logging.info(f"Encoding the tiles of {len(pending)} of {len(slide_positions)} slides into {self.folder}")
+        if not pending:
+            return
+
+        all_positions = [position for _, positions in pending for position in positions]
+        loader = DataLoader(_TileImagesDataset(tiles_dataset, all_positions), batch_size=self.batch_size,
+                            shuffle=False, num_workers=self.num_workers)
+        parameter = next(self.encoder.parameters(), None)
+        device = parameter.device if parameter is not None else torch.device('cpu')
+        self.encoder.eval()
+        slide_index = 0
+        buffer: List[np.ndarray] = []
+        buffered = 0
+        for images in loader:
+            features = self.encoder(images.to(device)).view(images.shape[0], -1)
+            buffer.append(features.cpu().numpy().astype(np.float32))
+            buffered += len(buffer[-1])
+            # Write all slides whose tiles are complete, keeping the remaining features in the buffer
+            while slide_index < len(pending) and buffered >= len(pending[slide_index][1]):
+                slide_id, positions = pending[slide_index]
+                all_features = np.concatenate(buffer) if len(buffer) > 1 else buffer[0]
+                self._write_slide(slide_id, tile_ids[positions], all_features[:len(positions)])
+                buffer = [all_features[len(positions):]]
+                buffered -= len(positions)
+                slide_index += 1
+
+
+@functools.lru_cache(maxsize=1024)
+def _load_tile_rows(tile_ids_path: Path) -> Dict[str, int]:
+    """Read the IDs of the tiles of a slide in the store, and map them to their rows in the features file."""
+    return {tile_id: row for row, tile_id in enumerate(tile_ids_path.read_text().splitlines())}
+
+
+def load_tile_embeddings(embeddings_dir: Union[str, Path], slide_ids: Sequence[Any],
+                         tile_ids: Sequence[Any]) -> torch.Tensor:
+    """Load the embeddings of a bag of tiles from a store.
+
+    :param embeddings_dir: The folder of the store for the encoder, `TileEmbeddingStore.folder`.
+    :param slide_ids: The slide ID of each tile.
+    :param tile_ids: The ID of each tile.
+    :return: A float32 tensor of shape (N, num_encoding), in the order of `tile_ids`.
+    """
+    embeddings_dir = Path(embeddings_dir)
+    # Bag collation may have turned numeric IDs into tensors
+    if isinstance(tile_ids, torch.Tensor):
+        tile_ids = tile_ids.tolist()
+    if isinstance(slide_ids, torch.Tensor):
+        slide_ids = slide_ids.tolist()
+    slide_ids = np.asarray([str(slide_id) for slide_id in slide_ids])
+    features = None
+    for slide_id in np.unique(slide_ids):
+        in_slide = slide_ids == slide_id
+        tile_rows = _load_tile_rows(embeddings_dir / f"{slide_id}{TILE_IDS_SUFFIX}")
+        rows = np.asarray([tile_rows[str(tile_id)] for tile_id, selected in zip(tile_ids, in_slide) if selected])
+        order = np.argsort(rows, kind='stable')
+        slide_features = np.load(embeddings_dir / f"{slide_id}{FEATURES_SUFFIX}", mmap_mode='r')
+        if features is None:
+            features = np.empty((len(tile_ids), slide_features.shape[1]), dtype=np.float32)
+        # Read the rows in storage order
+        selected_features = np.empty((len(rows), slide_features.shape[1]), dtype=np.float32)
+        selected_features[order] = slide_features[rows[order]]
+        features[in_slide] = selected_features
+    if features is None:
+        raise ValueError("Cannot load the embeddings of an empty bag")
+    return torch.from_numpy(features)
+
+
+class LoadTileEmbeddingsBatchd(MapTransform):
+    """Dictionary transform to load the precomputed embeddings of a bag of tiles from a `TileEmbeddingStore`, in place
+    of loading and encoding the tile images with `LoadTilesBatchd` and `EncodeTilesBatchd`"""
+
+    def __init__(self, keys: KeysCollection, embeddings_dir: Union[str, Path],
+                 slide_id_key: str = TilesDataset.SLIDE_ID_COLUMN, tile_id_key: str = TilesDataset.TILE_ID_COLUMN,
+                 allow_missing_keys: bool = False) -> None:
+        """
+        :param keys: Key(s) for the image path(s) in the input dictionary, which are replaced by the embeddings.
+        :param embeddings_dir: The folder of the store for the encoder, `TileEmbeddingStore.folder`.
+        :param slide_id_key: Key for the slide IDs in the input dictionary.
+        :param tile_id_key: Key for the tile IDs in the input dictionary.
+        :param allow_missing_keys: If `False` (default), raises an exception when an input
+        dictionary is missing any of the specified keys.
+        """
+        super().__init__(keys, allow_missing_keys)
+        self.embeddings_dir = Path(embeddings_dir)
+        self.slide_id_key = slide_id_key
+        self.tile_id_key = tile_id_key
+
+    def __call__(self, data: Mapping) -> Mapping:
+        out_data = dict(data)  # create shallow copy
+        for key in self.key_iterator(out_data):
+            out_data[key] = load_tile_embeddings(self.embeddings_dir, data[self.slide_id_key],
+                                                 data[self.tile_id_key])
+        return out_data
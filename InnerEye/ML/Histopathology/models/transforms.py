@@ -6,6 +6,7 @@
 from pathlib import Path
 from typing import Mapping, Sequence, Union
 
+import numpy as np
 import PIL.Image
 import torch
 from monai.config.type_definitions import KeysCollection
@@ -13,6 +14,8 @@ from monai.transforms.transform import MapTransform
 from torchvision.transforms.functional import to_tensor
 
 from InnerEye.ML.Histopathology.models.encoders import TileEncoder
+from InnerEye.ML.Histopathology.preprocessing.tile_shards import read_tiles_from_shard
+from InnerEye.ML.Histopathology.utils.naming import TileKey
 
 PathOrString = Union[Path, str]
 
@@ -22,6 +25,20 @@ def load_pil_image(image_path: PathOrString) -> PIL.Image.Image:
     return PIL.Image.open(image_path).convert('RGB')
 
 
+def load_tile_as_pil_image(sample: Mapping, image_key: str) -> PIL.Image.Image:
+    """Load the image of a tile in a tiles dataset sample as a PIL image in RGB format. The image is read from its PNG
+    file, or for sharded datasets (see `preprocessing.tile_shards`) from the tile's row in the slide's shard.
+
+    :param sample: The sample returned by the tiles dataset.
+    :param image_key: The key of the image path in the sample.
+    """
+    shard_index = sample.get(TileKey.SHARD_INDEX.value)
+    if shard_index is None:
+        return load_pil_image(sample[image_key])
+    tile = read_tiles_from_shard(sample[image_key], [int(shard_index)])[0]
+    return PIL.Image.fromarray(np.moveaxis(tile, 0, -1)).convert('RGB')
+
+
 def load_image_as_tensor(image_path: PathOrString) -> torch.Tensor:
     """Load an image as a tensor from the given path"""
     pil_image = load_pil_image(image_path)
@@ -80,6 +97,51 @@ class LoadTilesBatchd(MapTransform):
         return out_data
 
 
+def load_shard_tiles_as_tensor(shard_paths: Sequence[PathOrString], indices: Sequence[int]) -> torch.Tensor:
+    """Load a batch of tiles from tile shards as a tensor, in the same format as `load_image_stack_as_tensor`.
+    Each shard is read once, for all tiles of the batch that are stored in it.
+
+    :param shard_paths: The path of the shard of each tile.
+    :param indices: The row of each tile in its shard.
+    """
+    unique_paths, shard_ids = np.unique(np.asarray([str(path) for path in shard_paths]), return_inverse=True)
+    indices = np.asarray(indices)
+    if len(unique_paths) == 1:
+        tiles = read_tiles_from_shard(unique_paths[0], indices)
+    else:
+        tiles = None
+        for shard_id, shard_path in enumerate(unique_paths):
+            in_shard = shard_ids == shard_id
+            shard_tiles = read_tiles_from_shard(shard_path, indices[in_shard])
+            if tiles is None:
+                tiles = np.empty((len(indices), *shard_tiles.shape[1:]), dtype=shard_tiles.dtype)
+            tiles[in_shard] = shard_tiles
+    # Same conversion as torchvision's to_tensor for uint8 images
+    return torch.from_numpy(tiles).float().div_(255)
+
+
+class LoadTileShardsBatchd(MapTransform):
+    """Dictionary transform to load a batch of image tiles as a tensor from tile shards, see
+    `preprocessing.tile_shards`. This is the counterpart of `LoadTilesBatchd` for sharded datasets."""
+
+    def __init__(self, keys: KeysCollection, index_key: str = TileKey.SHARD_INDEX.value,
+                 allow_missing_keys: bool = False) -> None:
+        """
+        :param keys: Key(s) for the shard path(s) in the input dictionary.
+        :param index_key: Key for the rows of the tiles in their shards in the input dictionary.
+        :param allow_missing_keys: If `False` (default), raises an exception when an input
+        dictionary is missing any of the specified keys.
+        """
+        super().__init__(keys, allow_missing_keys)
+        self.index_key = index_key
+
+    def __call__(self, data: Mapping) -> Mapping:
+        out_data = dict(data)  # create shallow copy
+        for key in self.key_iterator(out_data):
+            out_data[key] = load_shard_tiles_as_tensor(data[key], data[self.index_key])
+        return out_data
+
+
 class EncodeTilesBatchd(MapTransform):
     """Dictionary transform to extract features from a batch tensor of image tiles"""
 
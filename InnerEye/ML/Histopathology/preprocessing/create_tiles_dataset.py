@@ -5,11 +5,13 @@
 
 import functools
 import logging
+import multiprocessing
 import shutil
 import traceback
 import warnings
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from typing import Any, Dict, Iterable, Optional, Sequence, Tuple, Union
+from typing import Any, Dict, Iterable, List, Optional, Sequence, Tuple, Union
 
 import numpy as np
 import PIL
@@ -26,6 +28,10 @@ logging.basicConfig(format='%(asctime)s %(message)s', filemode='w')
 logger = logging.getLogger()
 logger.setLevel(logging.DEBUG)
 
+# The name of the dataset CSV file of each slide, and of the merged file in the dataset root.
+SLIDE_DATASET_CSV = "dataset.csv"
+FAILED_TILES_CSV = "failed_tiles.csv"
+
 
 def select_tiles(foreground_mask: np.ndarray, occupancy_threshold: float) \
         -> Tuple[np.ndarray, np.ndarray]:
@@ -132,9 +138,101 @@ def format_csv_row(tile_info: Dict[TileKey, Any], keys_to_save: Iterable[TileKey
     return dataset_row
 
 
+def write_text_atomically(path: Path, text: str) -> None:
+    """Write a text file under a temporary name first and then rename it, such that the file is either complete or
+    missing, even if the process is interrupted."""
+    temp_path = path.with_name(path.name + ".tmp")
+    temp_path.write_text(text)
+    temp_path.replace(path)
+
+
+def is_slide_processed(slide_dir: Path) -> bool:
+    """Check whether a slide has been processed completely. The slide's dataset CSV file is written last, and
+    atomically, hence its presence means that all tiles have been saved."""
+    return (slide_dir / SLIDE_DATASET_CSV).is_file()
+
+
+def save_tiles(sample: Dict[SlideKey, Any], image_tiles: np.ndarray, tile_locations: np.ndarray,
+               occupancies: np.ndarray, output_dir: Path, num_tile_writers: int = 1,
+               tile_progress: bool = False) -> Tuple[str, List[str]]:
+    """Save the tile images of a slide, encoding them on a thread pool, and format the rows of its dataset CSV file.
+
+    :param sample: Slide information dictionary, with the slide image already loaded.
+    :param image_tiles: The image tiles (N, C, H, W).
+    :param tile_locations: The tile XY coordinates in the full slide (N, 2).
+    :param occupancies: The estimated foreground occupancy of each tile (N,).
+    :param output_dir: Root directory for the output dataset.
+    :param num_tile_writers: The number of threads that encode and write PNG files. PNG compression releases the
+    Python global interpreter lock, hence tiles are encoded in parallel.
+    :param tile_progress: Whether to display a progress bar in the terminal.
+    :return: A tuple of the contents of the slide's dataset CSV file, and the descriptors of tiles that failed.
+    """
+    slide_id: str = sample[SlideKey.SLIDE_ID]
+    rel_slide_dir = Path(slide_id)
+    keys_to_save = (TileKey.SLIDE_ID, TileKey.TILE_ID, TileKey.IMAGE, TileKey.LABEL,
+                    TileKey.TILE_X, TileKey.TILE_Y, TileKey.OCCUPANCY)
+    metadata_keys = tuple(TileKey.from_slide_metadata_key(key) for key in sample[SlideKey.METADATA])
+    csv_columns: Tuple[str, ...] = (*keys_to_save, *metadata_keys)
+
+    def save_tile(i: int) -> Optional[str]:
+        try:
+            tile_info = get_tile_info(sample, occupancies[i], tile_locations[i], rel_slide_dir)
+            save_image(image_tiles[i], output_dir / tile_info[TileKey.IMAGE])
+            return format_csv_row(tile_info, keys_to_save, metadata_keys)
+        except Exception as e:
+            traceback.print_exc()
+            warnings.warn(f"An error occurred while saving tile "
+                          f"{get_tile_id(slide_id, tile_locations[i])}: {e}")
+            return None
+
+    (output_dir / rel_slide_dir).mkdir(parents=True, exist_ok=True)
+    n_tiles = image_tiles.shape[0]
+    with ThreadPoolExecutor(max_workers=num_tile_writers) as executor:
+        dataset_rows = list(tqdm(executor.map(save_tile, range(n_tiles)), f"Tiles ({slide_id[:6]}…)",
+                                 total=n_tiles, unit="img", disable=not tile_progress))
+    failed_tiles = [get_tile_descriptor(tile_locations[i]) for i, row in enumerate(dataset_rows) if row is None]
+    dataset_csv = '\n'.join([','.join(csv_columns), *(row for row in dataset_rows if row is not None)]) + '\n'
+    return dataset_csv, failed_tiles
+
+
+def tile_and_save_slide(sample: Dict[SlideKey, Any], tile_size: int, occupancy_threshold: float, output_dir: Path,
+                        num_tile_writers: int = 1, tile_progress: bool = False) -> None:
+    """Tile a loaded slide, and save the tile images and information. The slide's dataset CSV file is written last,
+    such that it marks the slide as processed.
+
+    :param sample: Slide information dictionary, with the slide image loaded by `LoadROId`.
+    :param tile_size: Lateral dimensions of each tile, in pixels.
+    :param occupancy_threshold: Threshold (between 0 and 1) to determine empty tiles to discard.
+    :param output_dir: Root directory for the output dataset; outputs for a single slide will be
+    saved inside `output_dir/slide_id/`.
+    :param num_tile_writers: The number of threads that encode and write PNG files.
+    :param tile_progress: Whether to display a progress bar in the terminal.
+    """
+    slide_id: str = sample[SlideKey.SLIDE_ID]
+    slide_dir = output_dir / slide_id
+    logging.info(f"Tiling slide {slide_id} ...")
+    image_tiles, rel_tile_locations, occupancies, _ = \
+        generate_tiles(sample[SlideKey.IMAGE], tile_size,
+                       sample[SlideKey.FOREGROUND_THRESHOLD],
+                       occupancy_threshold)
+
+    tile_locations = (sample[SlideKey.SCALE] * rel_tile_locations
+                      + sample[SlideKey.ORIGIN]).astype(int)
+
+    logging.info(f"Saving tiles for slide {slide_id} ...")
+    dataset_csv, failed_tiles = save_tiles(sample, image_tiles, tile_locations, occupancies, output_dir,
+                                           num_tile_writers=num_tile_writers, tile_progress=tile_progress)
+    write_text_atomically(slide_dir / FAILED_TILES_CSV, '\n'.join(['tile_id', *failed_tiles]) + '\n')
+    write_text_atomically(slide_dir / SLIDE_DATASET_CSV, dataset_csv)
+    if failed_tiles:
+        # TODO what we want to do with slides that have some failed tiles?
+        logging.warning(f"{slide_id} is incomplete. {len(failed_tiles)} tiles failed.")
+    logging.info(f"Finished processing slide {slide_id}")
+
+
 def process_slide(sample: Dict[SlideKey, Any], level: int, margin: int, tile_size: int,
                   foreground_threshold: Optional[float], occupancy_threshold: float, output_dir: Path,
-                  tile_progress: bool = False) -> None:
+                  tile_progress: bool = False, num_tile_writers: int = 1) -> None:
     """Load and process a slide, saving tile images and information to a CSV file.
 
     :param sample: Slide information dictionary, returned by the input slide dataset.
@@ -147,101 +245,66 @@ def process_slide(sample: Dict[SlideKey, Any], level: int, margin: int, tile_siz
     :param output_dir: Root directory for the output dataset; outputs for a single slide will be
     saved inside `output_dir/slide_id/`.
     :param tile_progress: Whether to display a progress bar in the terminal.
+    :param num_tile_writers: The number of threads that encode and write PNG files.
     """
-    slide_metadata: Dict[str, Any] = sample[SlideKey.METADATA]
-    keys_to_save = (TileKey.SLIDE_ID, TileKey.TILE_ID, TileKey.IMAGE, TileKey.LABEL,
-                    TileKey.TILE_X, TileKey.TILE_Y, TileKey.OCCUPANCY)
-    metadata_keys = tuple(TileKey.from_slide_metadata_key(key) for key in slide_metadata)
-    csv_columns: Tuple[str, ...] = (*keys_to_save, *metadata_keys)
-
     slide_id: str = sample[SlideKey.SLIDE_ID]
-    rel_slide_dir = Path(slide_id)
-    slide_dir = output_dir / rel_slide_dir
+    slide_dir = output_dir / slide_id
     logging.info(f">>> Slide dir {slide_dir}")
-    if slide_dir.exists():  # already processed slide - skip
+    if is_slide_processed(slide_dir):
         logging.info(f">>> Skipping {slide_dir} - already processed")
         return
+    try:
+        logging.info(f"Loading slide {slide_id} ...")
+        loader = LoadROId(WSIReader('cuCIM'), level=level, margin=margin,
+                          foreground_threshold=foreground_threshold)
+        sample = loader(sample)  # load 'image' from disk
+        tile_and_save_slide(sample, tile_size, occupancy_threshold, output_dir,
+                            num_tile_writers=num_tile_writers, tile_progress=tile_progress)
+    except Exception as e:
+        traceback.print_exc()
+        warnings.warn(f"An error occurred while processing slide {slide_id}: {e}")
+
+
+def merge_dataset_csv_files(dataset_dir: Path, slide_ids: Optional[Iterable[str]] = None) -> Path:
+    """Combines the dataset CSV files of all slides into a single "dataset.csv" file in the given directory.
+
+    :param dataset_dir: The root directory of the tiles dataset.
+    :param slide_ids: The IDs of the slides whose files should be merged. Listing the files of a mounted directory
+    can be slow, hence they should be given if known. If `None`, all "*/dataset.csv" files are merged.
+    :return: The path of the merged file.
+    """
+    full_csv = dataset_dir / SLIDE_DATASET_CSV
+    if slide_ids is None:
+        slide_csvs: Iterable[Path] = dataset_dir.glob(f"*/{SLIDE_DATASET_CSV}")
     else:
-        try:
-            slide_dir.mkdir(parents=True)
-
-            dataset_csv_path = slide_dir / "dataset.csv"
-            dataset_csv_file = dataset_csv_path.open('w')
-            dataset_csv_file.write(','.join(csv_columns) + '\n')  # write CSV header
-
-            n_failed_tiles = 0
-            failed_tiles_csv_path = slide_dir / "failed_tiles.csv"
-            failed_tiles_file = failed_tiles_csv_path.open('w')
-            failed_tiles_file.write('tile_id' + '\n')
-
-            logging.info(f"Loading slide {slide_id} ...")
-            loader = LoadROId(WSIReader('cuCIM'), level=level, margin=margin,
-                              foreground_threshold=foreground_threshold)
-            sample = loader(sample)  # load 'image' from disk
-
-            logging.info(f"Tiling slide {slide_id} ...")
-            image_tiles, rel_tile_locations, occupancies, _ = \
-                generate_tiles(sample[SlideKey.IMAGE], tile_size,
-                               sample[SlideKey.FOREGROUND_THRESHOLD],
-                               occupancy_threshold)
-
-            tile_locations = (sample[SlideKey.SCALE] * rel_tile_locations
-                              + sample[SlideKey.ORIGIN]).astype(int)
-
-            n_tiles = image_tiles.shape[0]
-
-            logging.info(f"Saving tiles for slide {slide_id} ...")
-            for i in tqdm(range(n_tiles), f"Tiles ({slide_id[:6]}…)", unit="img", disable=not tile_progress):
-                try:
-                    tile_info = get_tile_info(sample, occupancies[i], tile_locations[i], rel_slide_dir)
-                    save_image(image_tiles[i], output_dir / tile_info[TileKey.IMAGE])
-                    dataset_row = format_csv_row(tile_info, keys_to_save, metadata_keys)
-                    dataset_csv_file.write(dataset_row + '\n')
-                except Exception as e:
-                    n_failed_tiles += 1
-                    descriptor = get_tile_descriptor(tile_locations[i])
-                    failed_tiles_file.write(descriptor + '\n')
-                    traceback.print_exc()
-                    warnings.warn(f"An error occurred while saving tile "
-                                  f"{get_tile_id(slide_id, tile_locations[i])}: {e}")
-
-            dataset_csv_file.close()
-            failed_tiles_file.close()
-            if n_failed_tiles > 0:
-                # TODO what we want to do with slides that have some failed tiles?
-                logging.warning(f"{slide_id} is incomplete. {n_failed_tiles} tiles failed.")
-            logging.info(f"Finished processing slide {slide_id}")
-        except Exception as e:
-            traceback.print_exc()
-            warnings.warn(f"An error occurred while processing slide {slide_id}: {e}")
-
-
-def merge_dataset_csv_files(dataset_dir: Path) -> Path:
-    """Combines all "*/dataset.csv" files into a single "dataset.csv" file in the given directory."""
-    full_csv = dataset_dir / "dataset.csv"
-    # TODO change how we retrieve these filenames, probably because mounted, the operation is slow
-    #  and it seems to find many more files
-    # print("List of files")
-    # print([str(file) + '\n' for file in dataset_dir.glob("*/dataset.csv")])
-    with full_csv.open('w') as full_csv_file:
-        # full_csv_file.write(','.join(CSV_COLUMNS) + '\n')  # write CSV header
+        slide_csvs = [dataset_dir / slide_id / SLIDE_DATASET_CSV for slide_id in slide_ids]
+    temp_csv = full_csv.with_name(full_csv.name + ".tmp")
+    with temp_csv.open('w') as full_csv_file:
         first_file = True
-        for slide_csv in tqdm(dataset_dir.glob("*/dataset.csv"), desc="Merging dataset.csv", unit='file'):
+        for slide_csv in tqdm(slide_csvs, desc="Merging dataset.csv", unit='file'):
+            if not slide_csv.is_file():
+                logging.warning(f"Slide {slide_csv.parent.name} has not been processed, not merging it")
+                continue
             logging.info(f"Merging slide {slide_csv}")
             content = slide_csv.read_text()
             if not first_file:
                 content = content[content.index('\n') + 1:]  # discard header row for all but the first file
             full_csv_file.write(content)
             first_file = False
+    temp_csv.replace(full_csv)
     return full_csv
 
 
 def main(slides_dataset: SlidesDataset, root_output_dir: Union[str, Path],
          level: int, tile_size: int, margin: int, foreground_threshold: Optional[float],
-         occupancy_threshold: float, parallel: bool = False, overwrite: bool = False,
-         n_slides: Optional[int] = None) -> None:
+         occupancy_threshold: float, num_workers: int = 1, num_tile_writers: int = 4, overwrite: bool = False,
+         n_slides: Optional[int] = None, parallel: Optional[bool] = None) -> None:
     """Process a slides dataset to produce a tiles dataset.
 
+    Slides are loaded and tiled by a bounded pool of worker processes, and each worker encodes the tiles of its slide
+    on a thread pool. A slide is only marked as processed once all its tiles are saved, hence an interrupted run can
+    be resumed exactly by calling this function again with `overwrite=False`.
+
     :param slides_dataset: Input tiles dataset object.
     :param root_output_dir: The root directory of the output tiles dataset.
     :param level: Magnification level at which to process the slide.
@@ -250,11 +313,18 @@ def main(slides_dataset: SlidesDataset, root_output_dir: Union[str, Path],
     :param foreground_threshold: Luminance threshold (0 to 255) to determine tile occupancy.
     If `None` (default), an optimal threshold will be estimated automatically.
     :param occupancy_threshold: Threshold (between 0 and 1) to determine empty tiles to discard.
-    :param parallel: Whether slides should be processed in parallel with multiprocessing.
+    :param num_workers: The number of processes that load and tile slides. With 1, slides are processed in the
+    main process. Each process loads and holds one slide image in memory at a time.
+    :param num_tile_writers: The number of threads per process that encode and write tile images.
     :param overwrite: Whether to overwrite an existing output tiles dataset. If `True`, will delete
     and recreate `root_output_dir`, otherwise will resume by skipping already processed slides.
     :param n_slides: If given, limit the total number of slides for debugging.
+    :param parallel: Deprecated, use `num_workers` instead. If `True`, one process per CPU is used, if `False` slides
+    are processed in the main process.
     """
+    if parallel is not None:
+        warnings.warn("The 'parallel' argument is deprecated, use 'num_workers' instead.", DeprecationWarning)
+        num_workers = (multiprocessing.cpu_count() or 1) if parallel else 1
 
     # Ignoring some types here because mypy is getting confused with the MONAI Dataset class
     # to select a subsample use keyword n_slides
@@ -271,23 +341,19 @@ def main(slides_dataset: SlidesDataset, root_output_dir: Union[str, Path],
     func = functools.partial(process_slide, level=level, margin=margin, tile_size=tile_size,
                              foreground_threshold=foreground_threshold,
                              occupancy_threshold=occupancy_threshold, output_dir=output_dir,
-                             tile_progress=not parallel)
-
-    if parallel:
-        import multiprocessing
-
-        pool = multiprocessing.Pool()
-        map_func = pool.imap_unordered  # type: ignore
+                             tile_progress=num_workers == 1, num_tile_writers=num_tile_writers)
+
+    if num_workers > 1:
+        # The pool queues the descriptions of all slides up front, which only hold file paths. Each worker then loads
+        # and tiles one slide at a time, hence at most num_workers slide images are in memory.
+        with multiprocessing.Pool(processes=num_workers) as pool:
+            list(tqdm(pool.imap_unordered(func, dataset, chunksize=1), desc="Slides", unit="img",
+                      total=len(dataset)))
     else:
-        map_func = map  # type: ignore
-
-    list(tqdm(map_func(func, dataset), desc="Slides", unit="img", total=len(dataset)))  # type: ignore
-
-    if parallel:
-        pool.close()
+        list(tqdm(map(func, dataset), desc="Slides", unit="img", total=len(dataset)))
 
     logging.info("Merging slide files in a single file")
-    merge_dataset_csv_files(output_dir)
+    merge_dataset_csv_files(output_dir, slide_ids=[sample[SlideKey.SLIDE_ID] for sample in dataset])
 
 
 if __name__ == '__main__':
@@ -302,5 +368,5 @@ if __name__ == '__main__':
          margin=64,
          foreground_threshold=None,
          occupancy_threshold=0.05,
-         parallel=False,
+         num_workers=1,
          overwrite=True)
@@ -0,0 +1,139 @@
+#  ------------------------------------------------------------------------------------------
+#  Copyright (c) Microsoft Corporation. All rights reserved.
+#  Licensed under the MIT License (MIT). See LICENSE in the repo root for license information.
+#  ------------------------------------------------------------------------------------------
+
+"""Packed tile shards: all tiles of a slide are stored as one uncompressed uint8 array of shape (N, C, H, W) in a
+`.npy` file, rather than one PNG file per tile. The dataset CSV file keeps one row per tile, where the image column
+holds the relative path of the slide's shard and `TileKey.SHARD_INDEX` the row of the tile in the shard. A bag of tiles
+is then read from a single file with one sequential read, see `read_tiles_from_shard`.
+"""
+
+import logging
+import multiprocessing
+from pathlib import Path
+from typing import Sequence, Tuple, Union
+
+import numpy as np
+import pandas as pd
+from tqdm import tqdm
+
+from InnerEye.ML.Histopathology.datasets.base_dataset import TilesDataset
+from InnerEye.ML.Histopathology.utils.naming import TileKey
+
+SHARD_SUFFIX = ".npy"
+
+
+def get_shard_path(slide_id: str) -> str:
+    """Get the path of the shard of a slide, relative to the dataset root."""
+    return f"{slide_id}{SHARD_SUFFIX}"
+
+
+def write_tile_shard(tiles: np.ndarray, path: Path) -> None:
+    """Write the tiles of a slide to a shard file. The array is written under a temporary name first and then renamed,
+    such that an interrupted conversion does not leave an incomplete shard behind.
+
+    :param tiles: The uint8 tile images of the slide, in (N, C, H, W) format.
+    :param path: The path of the shard file.
+    """
+    if tiles.dtype != np.uint8 or tiles.ndim != 4:
+        raise ValueError(f"Expected a uint8 array of shape (N, C, H, W), but got {tiles.dtype} {tiles.shape}")
+    path.parent.mkdir(parents=True, exist_ok=True)
+    temp_path = path.with_name(path.name + ".tmp")
+    with temp_path.open('wb') as file:
+        np.save(file, tiles)
+    temp_path.replace(path)
+
+
+def read_tiles_from_shard(path: Union[str, Path], indices: Sequence[int]) -> np.ndarray:
+    """Read the given tiles from a shard file. The shard is memory mapped, and the tiles are read in the order in which
+    they are stored, such that a full bag is a single sequential read.
+
+    :param path: The path of the shard file.
+    :param indices: The rows of the tiles in the shard, in the order in which they should be returned.
+    :return: The uint8 tile images, in (N, C, H, W) format.
+    """
+    shard = np.load(path, mmap_mode='r')
+    indices = np.asarray(indices, dtype=np.int64)
+    order = np.argsort(indices, kind='stable')
+    sorted_indices = indices[order]
+    tiles = np.empty((len(indices), *shard.shape[1:]), dtype=shard.dtype)
+    if len(indices) > 0 and sorted_indices[-1] - sorted_indices[0] + 1 == len(indices):
+        # Contiguous rows, e.g. a full bag: Copy the range in one read
+        tiles[order] = shard[sorted_indices[0]:sorted_indices[-1] + 1]
+    else:
+        tiles[order] = shard[sorted_indices]
+    return tiles
+
+
+def _convert_slide(paths: Tuple[Path, Sequence[Path]]) -> None:
+    """Load the PNG tiles of a slide and write them to the slide's shard.
+
+    :param paths: A tuple of the path of the shard file, and the paths of the PNG files in the order of the shard.
+    """
+    # Imported here to avoid a circular import, because the transforms module reads shards
+    from InnerEye.ML.Histopathology.models.transforms import load_pil_image
+    shard_path, image_paths = paths
+    tiles = None
+    for i, image_path in enumerate(image_paths):
+        tile = np.moveaxis(np.asarray(load_pil_image(image_path)), -1, 0)
+        if tiles is None:
+            tiles = np.empty((len(image_paths), *tile.shape), dtype=np.uint8)
+        elif tile.shape != tiles.shape[1:]:
+            raise ValueError(f"All tiles of a slide must have the same size, but {image_path} has shape "
+                             f"{tile.shape} instead of {tiles.shape[1:]}")
+        tiles[i] = tile
+    assert tiles is not None
+    write_tile_shard(tiles, shard_path)
+
+
+def convert_tiles_dataset_to_shards(tiles_dataset: TilesDataset, output_dir: Union[str, Path],
+                                    num_workers: int = 1) -> pd.DataFrame:
+    """Convert a tiles dataset with one PNG file per tile into one shard per slide, and write the dataset CSV file for
+    the converted dataset. Slides whose shard already exists are not converted again, such that an interrupted
+    conversion can be resumed.
+
+    :param tiles_dataset: The dataset to convert.
+    :param output_dir: The root directory of the converted dataset.
+    :param num_workers: The number of processes that convert slides.
+    :return: The data frame that was written to the dataset CSV file of the converted dataset.
+    """
+    output_root = Path(output_dir)
+    output_root.mkdir(parents=True, exist_ok=True)
+    slide_column = tiles_dataset.SLIDE_ID_COLUMN
+    image_column = tiles_dataset.IMAGE_COLUMN
+    # Tiles of the same slide are stored next to each other, in the order of the dataset
+    dataset_df = tiles_dataset.dataset_df.reset_index()
+    dataset_df = dataset_df.sort_values(slide_column, kind='mergesort').reset_index(drop=True)
+
+    tasks = []
+    for slide_id, slide_df in dataset_df.groupby(slide_column, sort=False):
+        shard_path = output_root / get_shard_path(str(slide_id))
+        if not shard_path.is_file():
+            tasks.append((shard_path, [tiles_dataset.root_dir / path for path in slide_df[image_column]]))
+    logging.info(f"Converting {len(tasks)} slides to tile shards with {num_workers} processes")
+    if num_workers > 1:
+        with multiprocessing.Pool(processes=num_workers) as pool:
+            list(tqdm(pool.imap_unordered(_convert_slide, tasks), desc="Slides", unit="img", total=len(tasks)))
+    else:
+        list(tqdm(map(_convert_slide, tasks), desc="Slides", unit="img", total=len(tasks)))
+
+    dataset_df[image_column] = dataset_df[slide_column].map(lambda slide_id: get_shard_path(str(slide_id)))
+    dataset_df[TileKey.SHARD_INDEX.value] = dataset_df.groupby(slide_column).cumcount()
+    dataset_df.to_csv(output_root / tiles_dataset.DEFAULT_CSV_FILENAME, index=False)
+    return dataset_df
+
+
+def is_sharded_dataset(tiles_dataset: TilesDataset) -> bool:
+    """Check whether a tiles dataset stores its tiles in shards, i.e. whether it has a `TileKey.SHARD_INDEX`
+    column."""
+    return TileKey.SHARD_INDEX.value in tiles_dataset.dataset_df.columns
+
+
+if __name__ == '__main__':
+    from InnerEye.ML.Histopathology.datasets.tcga_crck_tiles_dataset import TcgaCrck_TilesDataset
+
+    # Example set up for an existing tiles dataset:
+    convert_tiles_dataset_to_shards(TcgaCrck_TilesDataset("/tmp/datasets/TCGA-CRCk"),
+                                    output_dir="/datadrive/TCGA-CRCk_shards",
+                                    num_workers=8)
@@ -5,9 +5,11 @@
 
 # These tiling implementations are adapted from PANDA Kaggle solutions, for example:
 # https://github.com/kentaroy47/Kaggle-PANDA-1st-place-solution/blob/master/src/data_process/a00_save_tiles.py
+from pathlib import Path
 from typing import Any, Optional, Tuple
 
 import numpy as np
+from numpy.lib.stride_tricks import as_strided
 
 
 def get_1d_padding(length: int, tile_size: int) -> Tuple[int, int]:
@@ -84,20 +86,98 @@ def tile_array_2d(array: np.ndarray, tile_size: int, channels_first: Optional[bo
     return tiles, coords
 
 
+def _get_default_dtype(tiles: np.ndarray, fill_value: Optional[float]) -> np.dtype:
+    """Assembled arrays of uint8 tiles are uint8 if the fill value is representable, and float32 otherwise."""
+    if tiles.dtype == np.uint8 and fill_value is not None and float(fill_value).is_integer() \
+            and 0 <= fill_value <= 255:
+        return np.dtype(np.uint8)
+    return np.dtype(np.float32)
+
+
+def downsample_tiles(tiles: np.ndarray, factor: int, channels_first: Optional[bool] = True) -> np.ndarray:
+    """Downsample a stack of tiles by averaging non-overlapping blocks of `factor` x `factor` pixels.
+
+    :param tiles: Stack of tiles with batch dimension first.
+    :param factor: Downsampling factor; must divide the tile size.
+    :param channels_first: Whether each tile is in CHW (`True`, default) or HWC (`False`) layout.
+    :return: The float32 downsampled tiles, in the same layout as the input.
+    """
+    if channels_first:
+        n_tiles, channels, height, width = tiles.shape
+    else:
+        n_tiles, height, width, channels = tiles.shape
+    if height % factor != 0 or width % factor != 0:
+        raise ValueError(f"The downsampling factor {factor} must divide the tile size {height}x{width}")
+    if channels_first:
+        blocks = tiles.reshape(n_tiles, channels, height // factor, factor, width // factor, factor)
+        return blocks.mean(axis=(3, 5), dtype=np.float32)
+    blocks = tiles.reshape(n_tiles, height // factor, factor, width // factor, factor, channels)
+    return blocks.mean(axis=(2, 4), dtype=np.float32)
+
+
+def create_assembly_array(coords: np.ndarray, tile_size: int, channels: int, fill_value: Optional[float] = np.nan,
+                          channels_first: Optional[bool] = True, dtype: Any = np.float32, downsample: int = 1,
+                          path: Optional[Path] = None) -> Tuple[np.ndarray, np.ndarray]:
+    """Create the array into which tiles at the given coordinates are assembled by `assemble_tiles_2d`. Tiles can then
+    be assembled in chunks, e.g. batch by batch, by passing the array and offset as `out` and `offset`. For slide-level
+    maps, the array can be a memory mapped `.npy` file, and/or be downsampled, such that the full-resolution array is
+    never held in memory. A pyramid is obtained by assembling the same tiles into arrays with increasing `downsample`.
+
+    :param coords: XY coordinates of all tiles to assemble (shape: [N, 2]).
+    :param tile_size: Width/height of each tile in pixels.
+    :param channels: The number of channels of the tiles.
+    :param fill_value: Value to assign to empty elements (default: `NaN`). `None` is the same as `NaN`.
+    :param channels_first: Whether the array is in CHW (`True`, default) or HWC (`False`) layout.
+    :param dtype: The data type of the array (default: float32).
+    :param downsample: The factor by which the array is downsampled relative to the tile coordinates; must divide the
+    tile size and the spacing of the tiles.
+    :param path: If given, the array is memory mapped to a new `.npy` file at this path.
+    :return: A tuple containing:
+        - `array`: The array with the smallest dimensions to contain all given tiles, filled with `fill_value`.
+        - `offset`: XY offset of the array. Add this to tile coordinates and divide by `downsample` to obtain
+        indices for the array.
+    """
+    if tile_size % downsample != 0:
+        raise ValueError(f"The downsampling factor {downsample} must divide the tile size {tile_size}")
+    if fill_value is None:
+        fill_value = np.nan
+    x_min, y_min = coords.min(axis=0)
+    x_max, y_max = coords.max(axis=0) + tile_size
+    height = int(y_max - y_min) // downsample
+    width = int(x_max - x_min) // downsample
+    output_shape = (channels, height, width) if channels_first else (height, width, channels)
+    if path is None:
+        array = np.full(output_shape, fill_value, dtype=dtype)
+    else:
+        array = np.lib.format.open_memmap(str(path), mode='w+', dtype=dtype, shape=output_shape)
+        if fill_value != 0:  # A new memory mapped file is already zero-filled
+            array[...] = fill_value
+    return array, np.array([-x_min, -y_min])
+
+
 def assemble_tiles_2d(tiles: np.ndarray, coords: np.ndarray, fill_value: Optional[float] = np.nan,
-                      channels_first: Optional[bool] = True) -> Tuple[np.ndarray, np.ndarray]:
+                      channels_first: Optional[bool] = True, dtype: Any = None, downsample: int = 1,
+                      out: Optional[np.ndarray] = None,
+                      offset: Optional[np.ndarray] = None) -> Tuple[np.ndarray, np.ndarray]:
     """Assembles a 2D array from sequences of tiles and coordinates.
 
+    If the tiles lie on a grid of `tile_size` spacing, all tiles are written at once with advanced indexing on a view
+    of the array as a grid of tiles; otherwise they are written one at a time.
+
     :param tiles: Stack of tiles with batch dimension first.
     :param coords: XY tile coordinates, assumed to be spaced by multiples of `tile_size` (shape: [N, 2]).
-    :param tile_size: Size of each tile; must be >0.
-    :param fill_value: Value to assign to empty elements (default: `NaN`).
+    :param fill_value: Value to assign to empty elements (default: `NaN`). `None` is the same as `NaN`.
     :param channels_first: Whether each tile is in CHW (`True`, default) or HWC (`False`) layout.
+    :param dtype: The data type of the assembled array. By default (`None`), uint8 for uint8 tiles if `fill_value` is
+    a valid uint8 value, and float32 otherwise.
+    :param downsample: The factor by which tiles are downsampled before being assembled, see `downsample_tiles`.
+    :param out: An existing array into which the tiles are written, as created by `create_assembly_array`, e.g. to
+    assemble tiles in chunks into a memory mapped array. `fill_value` and `dtype` are then ignored.
+    :param offset: The offset of `out`, as returned by `create_assembly_array`; required if `out` is given.
     :return: A tuple containing:
-        - `array`: The reassembled 2D array with the smallest dimensions to contain all given tiles.
-        - `offset`: The lowest XY coordinates.
-        - `offset`: XY offset introduced by the assembly. Add this to tile coordinates to obtain
-        indices for the assembled array.
+        - `array`: The reassembled 2D array with the smallest dimensions to contain all given tiles, or `out`.
+        - `offset`: XY offset introduced by the assembly. Add this to tile coordinates (and divide by `downsample`)
+        to obtain indices for the assembled array.
     """
     if coords.shape[0] != tiles.shape[0]:
         raise ValueError(f"Tile coordinates and values must have the same length, "
@@ -107,22 +187,50 @@ def assemble_tiles_2d(tiles: np.ndarray, coords: np.ndarray, fill_value: Optiona
         n_tiles, channels, tile_size, _ = tiles.shape
     else:
         n_tiles, tile_size, _, channels = tiles.shape
-    tile_xs, tile_ys = coords.T
 
-    x_min, x_max = min(tile_xs), max(tile_xs + tile_size)
-    y_min, y_max = min(tile_ys), max(tile_ys + tile_size)
-    width = x_max - x_min
-    height = y_max - y_min
-    output_shape = (channels, height, width) if channels_first else (height, width, channels)
-    array = np.full(output_shape, fill_value)
+    if out is None:
+        if dtype is None:
+            dtype = _get_default_dtype(tiles, fill_value)
+        array, offset = create_assembly_array(coords, tile_size, channels, fill_value=fill_value,
+                                              channels_first=channels_first, dtype=dtype, downsample=downsample)
+    elif offset is None:
+        raise ValueError("The offset of the output array is required to assemble tiles into it")
+    else:
+        array = out
+    if n_tiles == 0:
+        return array, offset
+
+    positions = coords + offset
+    if np.any(positions % downsample != 0):
+        raise ValueError(f"Tile coordinates must be spaced by multiples of the downsampling factor {downsample}")
+    positions //= downsample
+    if downsample > 1:
+        tiles = downsample_tiles(tiles, downsample, channels_first)
+        tile_size //= downsample
+    if np.issubdtype(array.dtype, np.integer) and not np.issubdtype(tiles.dtype, np.integer):
+        tiles = np.rint(tiles)
+    cols, rows = positions.T
 
-    offset = np.array([-x_min, -y_min])
-    for idx in range(n_tiles):
-        row = coords[idx, 1] + offset[1]
-        col = coords[idx, 0] + offset[0]
+    height, width = array.shape[1:] if channels_first else array.shape[:-1]
+    if height % tile_size == 0 and width % tile_size == 0 \
+            and not np.any(rows % tile_size) and not np.any(cols % tile_size):
+        # View the array as a grid of tiles, and write all tiles at once
         if channels_first:
-            array[:, row:row + tile_size, col:col + tile_size] = tiles[idx]
+            stride_c, stride_h, stride_w = array.strides
+            grid = as_strided(array, shape=(channels, height // tile_size, tile_size, width // tile_size, tile_size),
+                              strides=(stride_c, stride_h * tile_size, stride_h, stride_w * tile_size, stride_w))
+            grid[:, rows // tile_size, :, cols // tile_size, :] = tiles
         else:
-            array[row:row + tile_size, col:col + tile_size, :] = tiles[idx]
+            stride_h, stride_w, stride_c = array.strides
+            grid = as_strided(array, shape=(height // tile_size, tile_size, width // tile_size, tile_size, channels),
+                              strides=(stride_h * tile_size, stride_h, stride_w * tile_size, stride_w, stride_c))
+            grid[rows // tile_size, :, cols // tile_size, :, :] = tiles
+    else:
+        for idx in range(n_tiles):
+            row, col = rows[idx], cols[idx]
+            if channels_first:
+                array[:, row:row + tile_size, col:col + tile_size] = tiles[idx]
+            else:
+                array[row:row + tile_size, col:col + tile_size, :] = tiles[idx]
 
     return array, offset
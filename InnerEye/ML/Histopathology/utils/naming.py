@@ -34,6 +34,7 @@ class TileKey(str, Enum):
     OCCUPANCY = 'occupancy'
     FOREGROUND_THRESHOLD = 'foreground_threshold'
     SLIDE_METADATA = 'slide_metadata'
+    SHARD_INDEX = 'shard_index'
 
     @staticmethod
     def from_slide_metadata_key(slide_metadata_key: str) -> str:
@@ -2,8 +2,14 @@
 #  Copyright (c) Microsoft Corporation. All rights reserved.
 #  Licensed under the MIT License (MIT). See LICENSE in the repo root for license information.
 #  ------------------------------------------------------------------------------------------
+from __future__ import annotations
+
+import os
 import random
-from typing import List, Tuple
+from collections import OrderedDict
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
 
 import numpy as np
 
@@ -12,8 +18,146 @@ from InnerEye.Common.type_annotations import TupleInt3
 from InnerEye.ML.config import SegmentationModelBase
 from InnerEye.ML.dataset.sample import Sample
 
+FOREGROUND_INDEX_SUFFIX = "_foreground_indices.npy"
+FOREGROUND_OFFSETS_SUFFIX = "_foreground_offsets.npy"
+# The number of bytes that the foreground indices kept in memory by each process can use, not counting indices that
+# are memory mapped from a folder.
+MAX_FOREGROUND_INDEX_BYTES_IN_MEMORY = 2 ** 30
+
+
+@dataclass(frozen=True)
+class ForegroundIndex:
+    """
+    Stores, for each class, the flat indices of all voxels that belong to the class and are inside of the mask.
+    This makes sampling a crop center from a given class a constant time lookup, rather than a scan over the full
+    volume. The indices for all classes are stored in a single array, such that they can be stored in one file and
+    memory mapped.
+    """
+    # The spatial shape of the sample, Z x Y x X
+    shape: Tuple[int, ...]
+    # The flat voxel indices of all classes, concatenated
+    indices: np.ndarray
+    # The indices of class c are stored in indices[offsets[c]:offsets[c + 1]]
+    offsets: np.ndarray
+
+    @staticmethod
+    def create(labels: np.ndarray, mask: np.ndarray) -> ForegroundIndex:
+        """
+        Creates the index from the labels and the mask of a sample.
+        :param labels: The binary labels, in format Classes x Z x Y x X.
+        :param mask: The binary mask, in format Z x Y x X.
+        """
+        shape = labels.shape[1:]
+        dtype = np.int32 if np.prod(shape) <= np.iinfo(np.int32).max else np.int64
+        inside_mask = mask == 1
+        per_class = [np.flatnonzero(np.logical_and(labels[c] == 1.0, inside_mask)).astype(dtype)
+                     for c in range(labels.shape[0])]
+        offsets = np.cumsum([0] + [len(class_indices) for class_indices in per_class])
+        return ForegroundIndex(shape=shape, indices=np.concatenate(per_class), offsets=offsets)
 
-def random_select_patch_center(sample: Sample, class_weights: List[float] = None) -> np.ndarray:
+    @property
+    def num_classes(self) -> int:
+        return len(self.offsets) - 1
+
+    def get_class_indices(self, class_index: int) -> np.ndarray:
+        """
+        Gets the flat indices of the voxels of the given class that are inside of the mask.
+        """
+        return self.indices[self.offsets[class_index]:self.offsets[class_index + 1]]
+
+    def save(self, file_prefix: Path) -> None:
+        """
+        Saves the index to two .npy files, with the given path prefix. The indices are written to a temporary file
+        first, such that other processes never read incomplete files.
+        """
+        for suffix, array in [(FOREGROUND_OFFSETS_SUFFIX, np.concatenate([self.shape, self.offsets])),
+                              (FOREGROUND_INDEX_SUFFIX, self.indices)]:
+            target = file_prefix.parent / (file_prefix.name + suffix)
+            temp_file = target.parent / (target.name + f".{os.getpid()}.tmp")
+            with temp_file.open("wb") as f:
+                np.save(f, array)
+            temp_file.replace(target)
+
+    @staticmethod
+    def load(file_prefix: Path) -> Optional[ForegroundIndex]:
+        """
+        Loads an index that was saved with the given path prefix. The indices are memory mapped, such that
+        multiple processes share the same memory.
+        :return: The index, or None if there is no saved index.
+        """
+        offsets_file = file_prefix.parent / (file_prefix.name + FOREGROUND_OFFSETS_SUFFIX)
+        indices_file = file_prefix.parent / (file_prefix.name + FOREGROUND_INDEX_SUFFIX)
+        if not (offsets_file.is_file() and indices_file.is_file()):
+            return None
+        header = np.load(offsets_file)
+        return ForegroundIndex(shape=tuple(int(s) for s in header[:3]),
+                               indices=np.load(indices_file, mmap_mode="r"),
+                               offsets=header[3:])
+
+
+class ForegroundIndexCache:
+    """
+    Keeps the foreground indices of the subjects that were sampled most recently in memory, such that each index is
+    only created once per subject, rather than each time a crop is drawn. If a folder is given, the indices are also
+    stored there, and memory mapped from there by all processes. Indices that are not memory mapped are evicted, least
+    recently used first, when they use more than the given number of bytes.
+    """
+
+    def __init__(self, folder: Optional[Path] = None,
+                 max_bytes_in_memory: int = MAX_FOREGROUND_INDEX_BYTES_IN_MEMORY) -> None:
+        self.folder = folder
+        self.max_bytes_in_memory = max_bytes_in_memory
+        self.num_bytes = 0
+        self.indices: Dict[str, ForegroundIndex] = OrderedDict()
+
+    @staticmethod
+    def get_size_in_bytes(foreground_index: ForegroundIndex) -> int:
+        """
+        Gets the number of bytes that the index occupies in the memory of this process.
+        """
+        return 0 if isinstance(foreground_index.indices, np.memmap) else foreground_index.indices.nbytes
+
+    def get_or_create(self, key: str, labels: np.ndarray, mask: np.ndarray) -> ForegroundIndex:
+        """
+        Gets the index that is stored with the given key, or creates it from the labels and the mask of the sample.
+        :param key: The key of the subject, which is also the file name prefix in the folder.
+        :param labels: The binary labels, in format Classes x Z x Y x X.
+        :param mask: The binary mask, in format Z x Y x X.
+        """
+        foreground_index = self.indices.get(key)
+        if foreground_index is not None:
+            self.indices.move_to_end(key)  # type: ignore
+            return foreground_index
+        if self.folder is None:
+            foreground_index = ForegroundIndex.create(labels=labels, mask=mask)
+        else:
+            file_prefix = self.folder / key
+            foreground_index = ForegroundIndex.load(file_prefix)
+            if foreground_index is None:
+                self.folder.mkdir(parents=True, exist_ok=True)
+                ForegroundIndex.create(labels=labels, mask=mask).save(file_prefix)
+                foreground_index = ForegroundIndex.load(file_prefix)
+            assert foreground_index is not None
+        self.keep_in_memory(key, foreground_index)
+        return foreground_index
+
+    def keep_in_memory(self, key: str, foreground_index: ForegroundIndex) -> None:
+        """
+        Keeps the index in memory, and evicts the least recently used indices if they use too many bytes.
+        """
+        size = self.get_size_in_bytes(foreground_index)
+        if size > self.max_bytes_in_memory:
+            return
+        while self.num_bytes + size > self.max_bytes_in_memory:
+            _, evicted = self.indices.popitem(last=False)  # type: ignore
+            self.num_bytes -= self.get_size_in_bytes(evicted)
+        self.indices[key] = foreground_index
+        self.num_bytes += size
+
+
+def random_select_patch_center(sample: Sample,
+                               class_weights: List[float] = None,
+                               foreground_index: Optional[ForegroundIndex] = None) -> np.ndarray:
     """
     Samples a point to use as the coordinates of the patch center. First samples one
     class among the available classes then samples a center point among the pixels of the sampled
@@ -22,9 +166,22 @@ def random_select_patch_center(sample: Sample, class_weights: List[float] = None
     :param sample: A set of Image channels, ground truth labels and mask to randomly crop.
     :param class_weights: A weighting vector with values [0, 1] to influence the class the center crop
                           voxel belongs to (must sum to 1), uniform distribution assumed if none provided.
+    :param foreground_index: The index of the voxels of each class in the sample. If not provided, the voxels of
+                             the selected class are found by scanning the labels and mask.
     :return numpy int array (3x1) containing patch center spatial coordinates
     """
     num_classes = sample.labels.shape[0]
+    shape = sample.labels.shape[1:]
+    if foreground_index is not None and (foreground_index.num_classes != num_classes
+                                         or foreground_index.shape != shape):
+        raise ValueError(f"The foreground index was created for {foreground_index.num_classes} classes and shape "
+                         f"{foreground_index.shape}, but the sample has {num_classes} classes and shape {shape}")
+
+    def get_class_indices(class_index: int) -> np.ndarray:
+        if foreground_index is not None:
+            return foreground_index.get_class_indices(class_index)
+        # Check pixels where mask and label maps are both foreground
+        return np.flatnonzero(np.logical_and(sample.labels[class_index] == 1.0, sample.mask == 1))
 
     if class_weights is not None:
         if len(class_weights) != num_classes:
@@ -37,9 +194,8 @@ def random_select_patch_center(sample: Sample, class_weights: List[float] = None
     original_class_weights = class_weights
     while len(available_classes) > 0:
         selected_label_class = random.choices(population=available_classes, weights=class_weights, k=1)[0]
-        # Check pixels where mask and label maps are both foreground
-        indices = np.argwhere(np.logical_and(sample.labels[selected_label_class] == 1.0, sample.mask == 1))
-        if not np.any(indices):
+        indices = get_class_indices(selected_label_class)
+        if len(indices) == 0:
             available_classes.remove(selected_label_class)
             if class_weights is not None:
                 assert original_class_weights is not None  # for mypy
@@ -56,12 +212,13 @@ def random_select_patch_center(sample: Sample, class_weights: List[float] = None
     # noinspection PyUnboundLocalVariable
     choice = random.randint(0, len(indices) - 1)
 
-    return indices[choice].astype(int)  # Numpy usually stores as floats
+    return np.array(np.unravel_index(int(indices[choice]), shape), dtype=int)
 
 
 def slicers_for_random_crop(sample: Sample,
                             crop_size: TupleInt3,
-                            class_weights: List[float] = None) -> Tuple[List[slice], np.ndarray]:
+                            class_weights: List[float] = None,
+                            foreground_index: Optional[ForegroundIndex] = None) -> Tuple[List[slice], np.ndarray]:
     """
     Computes array slicers that produce random crops of the given crop_size.
     The selection of the center is dependant on background probability.
@@ -71,6 +228,7 @@ def slicers_for_random_crop(sample: Sample,
     :param crop_size: The size of the crop expressed as a list of 3 ints, one per spatial dimension.
     :param class_weights: A weighting vector with values [0, 1] to influence the class the center crop
                           voxel belongs to (must sum to 1), uniform distribution assumed if none provided.
+    :param foreground_index: The index of the voxels of each class in the sample, to speed up sampling the center.
     :return: Tuple element 1: The slicers that convert the input image to the chosen crop. Tuple element 2: The
     indices of the center point of the crop.
     :raises ValueError: If there are shape mismatches among the arguments or if the crop size is larger than the image.
@@ -83,7 +241,7 @@ def slicers_for_random_crop(sample: Sample,
                          .format(crop_size, shape))
 
     # Sample a center pixel location for patch extraction.
-    center = random_select_patch_center(sample, class_weights)
+    center = random_select_patch_center(sample, class_weights, foreground_index)
 
     # Verify and fix overflow for each dimension
     left = []
@@ -103,7 +261,8 @@ def slicers_for_random_crop(sample: Sample,
 
 def random_crop(sample: Sample,
                 crop_size: TupleInt3,
-                class_weights: List[float] = None) -> Tuple[Sample, np.ndarray]:
+                class_weights: List[float] = None,
+                foreground_index: Optional[ForegroundIndex] = None) -> Tuple[Sample, np.ndarray]:
     """
     Randomly crops images, mask, and labels arrays according to the crop_size argument.
     The selection of the center is dependant on background probability.
@@ -113,12 +272,13 @@ def random_crop(sample: Sample,
     :param crop_size: The size of the crop expressed as a list of 3 ints, one per spatial dimension.
     :param class_weights: A weighting vector with values [0, 1] to influence the class the center crop
                           voxel belongs to (must sum to 1), uniform distribution assumed if none provided.
+    :param foreground_index: The index of the voxels of each class in the sample, to speed up sampling the center.
     :return: Tuple item 1: The cropped images, labels, and mask. Tuple item 2: The center that was chosen for the crop,
     before shifting to be inside of the image. Tuple item 3: The slicers that convert the input image to the chosen
     crop.
     :raises ValueError: If there are shape mismatches among the arguments or if the crop size is larger than the image.
     """
-    slicers, center = slicers_for_random_crop(sample, crop_size, class_weights)
+    slicers, center = slicers_for_random_crop(sample, crop_size, class_weights, foreground_index)
     sample = Sample(
         image=sample.image[:, slicers[0], slicers[1], slicers[2]],
         labels=sample.labels[:, slicers[0], slicers[1], slicers[2]],
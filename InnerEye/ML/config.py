@@ -65,9 +65,44 @@ class PaddingMode(Enum):
     NoPadding = "no_padding"
 
 
+@unique
+class BlendingMode(Enum):
+    """
+    Supported modes for weighting the model predictions of overlapping patches during inference.
+    """
+    #: All voxels of a patch have the same weight.
+    Uniform = "Uniform"
+    #: Voxels are weighted by a Gaussian centered on the patch, with a standard deviation of 1/8 of the patch size.
+    Gaussian = "Gaussian"
+    #: Voxels are weighted by a linear ramp that increases from the patch border towards its center.
+    LinearRamp = "LinearRamp"
+
+
 @unique
 class EnsembleAggregationType(Enum):
+    """
+    Supported ways of combining the results of the models in an ensemble of segmentation models.
+    """
+    #: The posteriors of the models are averaged.
     Average = 'Average'
+    #: Each model votes for the class of its segmentation in each voxel. The posteriors are the fraction of votes.
+    MajorityVote = 'MajorityVote'
+    #: The maximum of the posteriors of the models, normalized to sum to 1 in each voxel.
+    Max = 'Max'
+    #: The minimum of the posteriors of the models, normalized to sum to 1 in each voxel.
+    Min = 'Min'
+
+
+@unique
+class EnsembleInferenceMode(Enum):
+    """
+    Supported ways of running whole image inference with an ensemble of segmentation models.
+    """
+    #: Each model runs its own sliding window inference over the image, and the posteriors are averaged afterwards.
+    PerModel = "PerModel"
+    #: The image is padded and each batch of patches is extracted only once, and then fed into all models. The mean
+    #: of the model predictions is added to a single posterior buffer.
+    SharedPatches = "SharedPatches"
 
 
 @unique
@@ -334,6 +369,18 @@ class SegmentationModelBase(ModelConfigBase):
                                                        doc="Percentile at which to trim input distribution prior "
                                                            "to normalization. Used in TrimmedNorm")
 
+    #: A folder in which to store the statistics that MriWindow and TrimmedNorm compute for each subject, for example
+    #: a folder next to the dataset. The statistics are stored as one small JSON file per subject, keyed by subject ID
+    #: and a hash of the paths, sizes and modification times of the image and mask files, and of the normalization
+    #: settings. Later loads of the same subject, in training, validation and inference, then only apply the linear
+    #: transform. The statistics are computed on the images as loaded, hence PhotometricNormalization must be the
+    #: first full image transform. SimpleNorm statistics are not stored, because they are cheap to compute.
+    normalization_statistics_folder: Optional[Path] = \
+        param.ClassSelector(class_=Path, default=None, allow_None=True, instantiate=False,
+                            doc="A folder in which to store the image statistics that photometric normalization "
+                                "computes for each subject, such that they are computed only once. If not set, "
+                                "statistics are computed every time an image is loaded.")
+
     #: Padding mode to use for training and inference. See :attr:`PaddingMode` for valid options.
     padding_mode: PaddingMode = param.ClassSelector(default=PaddingMode.Edge, class_=PaddingMode,
                                                     instantiate=False,
@@ -343,6 +390,14 @@ class SegmentationModelBase(ModelConfigBase):
     inference_batch_size: int = param.Integer(8, bounds=(1, None),
                                               doc="The batch size to use for inference forward pass")
 
+    #: How the model predictions of overlapping patches are weighted during inference. With
+    #: :attr:`BlendingMode.Gaussian` or :attr:`BlendingMode.LinearRamp`, predictions at the patch borders are
+    #: down-weighted, which suppresses seam artefacts at larger inference strides.
+    inference_blending_mode: BlendingMode = param.ClassSelector(default=BlendingMode.Uniform, class_=BlendingMode,
+                                                                instantiate=False,
+                                                                doc="How the model predictions of overlapping "
+                                                                    "patches are weighted during inference.")
+
     #: The crop size to use for model testing. If nothing is specified, crop_size parameter is used instead,
     #: i.e. training and testing crop size will be the same.
     test_crop_size: Optional[TupleInt3] = IntTuple(None, length=3, allow_None=True,
@@ -358,6 +413,47 @@ class SegmentationModelBase(ModelConfigBase):
                                                       doc="The per-class probabilities for picking a center point of "
                                                           "a crop.")
 
+    #: A folder in which to store, for each training subject, the voxels of each class that can be picked as crop
+    #: centers. The index is created once per subject, and then memory mapped by all data loader workers in all epochs.
+    #: If not set, each data loader worker creates the index when it first loads a subject, and keeps it in memory.
+    #: The folder must be cleared if the labels or masks change, or if full image transforms modify labels or masks.
+    foreground_index_cache_folder: Optional[Path] = \
+        param.ClassSelector(class_=Path, default=None, allow_None=True, instantiate=False,
+                            doc="A folder in which to store, for each training subject, the voxels of each class "
+                                "that can be picked as crop centers, such that all data loader workers share them. "
+                                "If not set, each worker keeps the voxels of the subjects it loaded most recently in "
+                                "memory, up to 1GB.")
+
+    #: The number of crops to draw from each full image sample that is loaded for training and validation. The crops
+    #: of one sample are drawn independently, and are all part of the same minibatch. train_batch_size remains the
+    #: number of crops in a minibatch, and must be a multiple of crops_per_volume.
+    crops_per_volume: int = param.Integer(1, bounds=(1, None),
+                                          doc="The number of crops to draw from each full image sample that is "
+                                              "loaded for training and validation. train_batch_size must be a "
+                                              "multiple of this value.")
+
+    #: A folder in which to store the preprocessed (normalized and padded) full image samples for training and
+    #: validation, as memory mapped arrays. Samples are then loaded and normalized only once, and later epochs only
+    #: read the crops. The cached samples are identified by the subject, the normalization settings, and the types
+    #: and parameters of the full image transforms. The folder must be cleared if the data or the code of the full image
+    #: transforms change. Full image transforms must be deterministic for the cache to be used. This is the
+    #: recommended way of caching samples, because all data loader workers share the cache.
+    sample_cache_folder: Optional[Path] = \
+        param.ClassSelector(class_=Path, default=None, allow_None=True, instantiate=False,
+                            doc="A folder in which to store the preprocessed full image samples for training and "
+                                "validation, such that they are only loaded and normalized once.")
+    #: The amount of memory in GB that each data loader worker can use to keep preprocessed full image samples for
+    #: training and validation, evicting the least recently used samples. The cache is not shared between workers,
+    #: such that each sample may be held once per worker, and the total memory use is up to num_dataload_workers times
+    #: this size. Data loader workers are restarted in each epoch, and with them their cache, unless
+    #: avoid_process_spawn_in_data_loaders is set or num_dataload_workers is 0. Not used if sample_cache_folder is set,
+    #: which is the recommended way of caching samples.
+    sample_cache_size_gb: float = param.Number(0.0, bounds=(0, None),
+                                               doc="The amount of memory in GB that each data loader worker can use "
+                                                   "to keep preprocessed full image samples. Workers only keep their "
+                                                   "cache across epochs if avoid_process_spawn_in_data_loaders is set. "
+                                                   "Set to 0 to turn off caching in memory.")
+
     #: Layer name hierarchy (parent, child recursive) as by model definition. If None, no activation maps will be saved
     activation_map_layers: Optional[List[str]] = param.List(None, class_=str, allow_None=True, bounds=(1, None),
                                                             instantiate=False,
@@ -372,6 +468,26 @@ class SegmentationModelBase(ModelConfigBase):
                                                                              doc="The aggregation method to use when"
                                                                                  "testing ensemble models.")
 
+    #: If True, compute the variance of the posteriors of each class across the models of an ensemble, and store it
+    #: next to the ensemble posteriors when testing.
+    ensemble_posterior_variance: bool = param.Boolean(False, doc="If True, compute the variance of the posteriors of "
+                                                                 "each class across the models of an ensemble, and "
+                                                                 "store it when testing.")
+
+    #: How whole image inference is run for ensemble models. See :attr:`EnsembleInferenceMode` for options.
+    ensemble_inference_mode: EnsembleInferenceMode = \
+        param.ClassSelector(default=EnsembleInferenceMode.PerModel, class_=EnsembleInferenceMode, instantiate=False,
+                            doc="How whole image inference is run for ensemble models. With 'SharedPatches', patches "
+                                "are extracted once and fed into all models, rather than once per model.")
+
+    #: The number of threads that feed the same batch of patches into the models of an ensemble in parallel, when
+    #: ensemble_inference_mode is SharedPatches. With 1, the models are run one after the other. PyTorch releases the
+    #: Python global interpreter lock during the forward pass, hence threads can run models concurrently.
+    ensemble_inference_threads: int = param.Integer(1, bounds=(1, None),
+                                                    doc="The number of threads that run the models of an ensemble "
+                                                        "on the same batch of patches in parallel, when "
+                                                        "ensemble_inference_mode is SharedPatches.")
+
     #: The size of the smoothing kernel in mm to be used for smoothing posteriors before computing the final
     #: segmentations. No smoothing is performed if set to None.
     posterior_smoothing_mm: Optional[TupleInt3] = param.NumericTuple(None, length=3, allow_None=True,
@@ -475,6 +591,14 @@ class SegmentationModelBase(ModelConfigBase):
                                                         "during model evaluation. Set to False if you see "
                                                         "non-deterministic pull request build failures.")
 
+    #: If true, the predictions and images of each test subject are handed over to the worker processes that compute
+    #: the metrics via files on a RAM disk, rather than being pickled through a pipe.
+    evaluation_shared_memory: bool = param.Boolean(False, doc="If true, the predictions and images of each test "
+                                                               "subject are handed over to the worker processes that "
+                                                               "compute the metrics via files on a RAM disk "
+                                                               "(/dev/shm if available), rather than being pickled "
+                                                               "through a pipe.")
+
     show_patch_sampling: int = param.Integer(1, bounds=(0, None),
                                              doc="Number of patients from the training set for which the effect of"
                                                  "patch sampling will be shown. Nifti images and thumbnails for each"
@@ -550,6 +674,9 @@ class SegmentationModelBase(ModelConfigBase):
         if self.class_weights is None:
             raise ValueError("class_weights must be set.")
         SegmentationModelBase.validate_class_weights(self.class_weights)
+        if self.train_batch_size % self.crops_per_volume != 0:
+            raise ValueError(f"train_batch_size ({self.train_batch_size}) must be a multiple of crops_per_volume "
+                             f"({self.crops_per_volume})")
         if self.ground_truth_ids is None:
             raise ValueError("ground_truth_ids is None")
         if len(self.ground_truth_ids_display_names) != len(self.ground_truth_ids):
@@ -9,9 +9,11 @@ their datamodules and configure experiment-specific parameters.
 """
 import os
 from pathlib import Path
-from typing import Type
+from typing import Callable, Optional, Type
 
 import param
+from monai.transforms import Compose
+from monai.transforms.transform import MapTransform
 from torch import nn
 from torchvision.models.resnet import resnet18
 
@@ -24,6 +26,8 @@ from InnerEye.ML.Histopathology.models.deepmil import DeepMILModule
 from InnerEye.ML.Histopathology.models.encoders import (HistoSSLEncoder, IdentityEncoder,
                                                         ImageNetEncoder, ImageNetSimCLREncoder,
                                                         InnerEyeSSLEncoder, TileEncoder)
+from InnerEye.ML.Histopathology.models.tile_embeddings import TileEmbeddingStore
+from InnerEye.ML.Histopathology.models.transforms import EncodeTilesBatchd, LoadTileShardsBatchd, LoadTilesBatchd
 
 
 class BaseMIL(LightningContainer):
@@ -45,9 +49,20 @@ class BaseMIL(LightningContainer):
                                           "random subsets of instances.")
     cache_mode: CacheMode = param.ClassSelector(default=CacheMode.MEMORY, class_=CacheMode,
                                                 doc="The type of caching to perform: "
-                                                    "'memory' (default), 'disk', or 'none'.")
+                                                    "'memory' (default), 'disk', 'bags', or 'none'.")
     save_precache: bool = param.Boolean(True, doc="Whether to pre-cache the entire transformed "
                                                   "dataset upfront and save it to disk.")
+    use_tile_shards: bool = param.Boolean(False, doc="Whether the dataset stores the tiles of each slide in a single "
+                                                     "shard file, as written by "
+                                                     "`preprocessing.tile_shards.convert_tiles_dataset_to_shards`, "
+                                                     "rather than one PNG file per tile.")
+    precompute_tile_embeddings: bool = param.Boolean(False, doc="Whether to encode all tiles once before training and "
+                                                                "store the features in `cache_dir`, such that "
+                                                                "training loads features instead of tile images.")
+    embedding_batch_size: int = param.Integer(256, bounds=(1, None), doc="Number of tiles to encode at once when "
+                                                                         "precomputing tile embeddings.")
+    embedding_num_workers: int = param.Integer(4, bounds=(0, None), doc="Number of data loader processes that load "
+                                                                        "tiles when precomputing tile embeddings.")
     # local_dataset (used as data module root_path) is declared in DatasetParams superclass
 
     @property
@@ -87,6 +102,24 @@ class BaseMIL(LightningContainer):
         else:
             raise ValueError(f"Unsupported encoder type: {self.encoder_type}")
 
+    def get_tiles_load_transform(self, image_key: str) -> MapTransform:
+        if self.use_tile_shards:
+            return LoadTileShardsBatchd(image_key)
+        return LoadTilesBatchd(image_key, progress=True)
+
+    def get_tiles_transform(self, image_key: str) -> Optional[Callable]:
+        """Get the transform that loads and encodes the tiles of a bag, or `None` when the data module loads
+        precomputed tile embeddings."""
+        if self.precompute_tile_embeddings:
+            return None
+        return Compose([self.get_tiles_load_transform(image_key), EncodeTilesBatchd(image_key, self.encoder)])
+
+    def get_embeddings_store(self) -> Optional[TileEmbeddingStore]:
+        if not self.precompute_tile_embeddings:
+            return None
+        return TileEmbeddingStore(self.cache_dir / "tile_embeddings", self.encoder,
+                                  batch_size=self.embedding_batch_size, num_workers=self.embedding_num_workers)
+
     def get_pooling_layer(self) -> Type[nn.Module]:
         if self.pooling_type == AttentionLayer.__name__:
             return AttentionLayer
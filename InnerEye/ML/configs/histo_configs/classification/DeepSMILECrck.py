@@ -16,7 +16,6 @@ damage response defect classification directly from H&E whole-slide images. arXi
 from pathlib import Path
 from typing import Any, Dict
 
-from monai.transforms import Compose
 from pytorch_lightning.callbacks.model_checkpoint import ModelCheckpoint
 
 from health_ml.networks.layers.attention_layers import GatedAttentionLayer
@@ -32,10 +31,6 @@ from InnerEye.ML.Histopathology.models.encoders import (
     ImageNetSimCLREncoder,
     InnerEyeSSLEncoder,
 )
-from InnerEye.ML.Histopathology.models.transforms import (
-    EncodeTilesBatchd,
-    LoadTilesBatchd,
-)
 from InnerEye.ML.Histopathology.datasets.tcga_crck_tiles_dataset import (
     TcgaCrck_TilesDataset,
 )
@@ -89,22 +84,17 @@ class DeepSMILECrck(BaseMIL):
 
     def get_data_module(self) -> TilesDataModule:
         image_key = TcgaCrck_TilesDataset.IMAGE_COLUMN
-        transform = Compose(
-            [
-                LoadTilesBatchd(image_key, progress=True),
-                EncodeTilesBatchd(image_key, self.encoder),
-            ]
-        )
         return TcgaCrckTilesDataModule(
             root_path=self.local_dataset,
             max_bag_size=self.max_bag_size,
             batch_size=self.batch_size,
-            transform=transform,
+            transform=self.get_tiles_transform(image_key),
             cache_mode=self.cache_mode,
             save_precache=self.save_precache,
             cache_dir=self.cache_dir,
             number_of_cross_validation_splits=self.number_of_cross_validation_splits,
             cross_validation_split_index=self.cross_validation_split_index,
+            embeddings_store=self.get_embeddings_store(),
         )
 
     def get_trainer_arguments(self) -> Dict[str, Any]:
@@ -6,7 +6,6 @@
 from typing import Any, Dict
 from pathlib import Path
 import os
-from monai.transforms import Compose
 from pytorch_lightning.callbacks.model_checkpoint import ModelCheckpoint
 
 from health_azure.utils import CheckpointDownloader
@@ -16,10 +15,6 @@ from InnerEye.Common import fixed_paths
 from InnerEye.ML.Histopathology.datamodules.panda_module import PandaTilesDataModule
 from InnerEye.ML.Histopathology.datasets.panda_tiles_dataset import PandaTilesDataset
 
-from InnerEye.ML.Histopathology.models.transforms import (
-    EncodeTilesBatchd,
-    LoadTilesBatchd,
-)
 from InnerEye.ML.Histopathology.models.encoders import (
     HistoSSLEncoder,
     ImageNetEncoder,
@@ -90,22 +85,17 @@ class DeepSMILEPanda(BaseMIL):
 
     def get_data_module(self) -> PandaTilesDataModule:
         image_key = PandaTilesDataset.IMAGE_COLUMN
-        transform = Compose(
-            [
-                LoadTilesBatchd(image_key, progress=True),
-                EncodeTilesBatchd(image_key, self.encoder),
-            ]
-        )
         return PandaTilesDataModule(
             root_path=self.local_dataset,
             max_bag_size=self.max_bag_size,
             batch_size=self.batch_size,
-            transform=transform,
+            transform=self.get_tiles_transform(image_key),
             cache_mode=self.cache_mode,
             save_precache=self.save_precache,
             cache_dir=self.cache_dir,
             number_of_cross_validation_splits=self.number_of_cross_validation_splits,
             cross_validation_split_index=self.cross_validation_split_index,
+            embeddings_store=self.get_embeddings_store(),
         )
 
     def get_trainer_arguments(self) -> Dict[str, Any]:
@@ -2,18 +2,22 @@
 #  Copyright (c) Microsoft Corporation. All rights reserved.
 #  Licensed under the MIT License (MIT). See LICENSE in the repo root for license information.
 #  ------------------------------------------------------------------------------------------
+import hashlib
 import logging
-from typing import Any, Dict, List, Optional
+from typing import Any, Dict, List, Optional, Union
 
 import numpy as np
 import pandas as pd
+from torch.utils.data import DataLoader
 
-from InnerEye.ML.augmentations.augmentation_for_segmentation_utils import random_crop
+from InnerEye.ML.augmentations.augmentation_for_segmentation_utils import ForegroundIndex, ForegroundIndexCache, \
+    random_crop
 from InnerEye.Common.common_util import any_pairwise_larger
 from InnerEye.Common.type_annotations import TupleInt3
 from InnerEye.ML.config import PaddingMode, SegmentationModelBase
 from InnerEye.ML.dataset.full_image_dataset import FullImageDataset
 from InnerEye.ML.dataset.sample import CroppedSample, Sample
+from InnerEye.ML.dataset.sample_cache import MemorySampleCache, SampleCache, create_sample_cache
 from InnerEye.ML.utils import image_util
 from InnerEye.ML.utils.image_util import pad_images
 from InnerEye.ML.utils.io_util import ImageDataType
@@ -33,22 +37,110 @@ class CroppingDataset(FullImageDataset):
                  full_image_sample_transforms: Optional[Compose3D[Sample]] = None):
         super().__init__(args, data_frame, full_image_sample_transforms)
         self.cropped_sample_transforms = cropped_sample_transforms
+        self.foreground_indices = ForegroundIndexCache(folder=args.foreground_index_cache_folder)
+        self.sample_cache: Optional[SampleCache] = create_sample_cache(cache_folder=args.sample_cache_folder,
+                                                                       cache_size_gb=args.sample_cache_size_gb)
+        if isinstance(self.sample_cache, MemorySampleCache) and args.num_dataload_workers > 0 \
+                and not args.avoid_process_spawn_in_data_loaders:
+            logging.warning("Each data loader worker keeps its own sample cache in memory, and the workers are "
+                            "restarted in each epoch. Set avoid_process_spawn_in_data_loaders to keep the cache "
+                            "across epochs, or use sample_cache_folder instead of sample_cache_size_gb.")
 
-    def __getitem__(self, i: int) -> Dict[str, Any]:
-        sample = CroppingDataset.create_possibly_padded_sample_for_cropping(
-            sample=super().get_samples_at_index(index=i)[0],
-            crop_size=self.args.crop_size,
-            padding_mode=self.args.padding_mode
-        )
+    def __getitem__(self, i: int) -> Union[Dict[str, Any], List[Dict[str, Any]]]:
+        sample = self.get_padded_sample(index=i)
+        foreground_index = self.get_foreground_index(index=i, sample=sample)
 
-        sample = self.create_random_cropped_sample(
-            sample=sample,
+        cropped_samples = []
+        for _ in range(self.args.crops_per_volume):
+            cropped_sample = self.create_random_cropped_sample(
+                sample=sample,
+                crop_size=self.args.crop_size,
+                center_size=self.args.center_size,
+                class_weights=self.args.class_weights,
+                foreground_index=foreground_index
+            )
+            if self.sample_cache is not None:
+                # The crops are views into the cached arrays, which the cropped sample transforms must not modify.
+                cropped_sample = cropped_sample.clone_with_overrides(
+                    **{field: np.array(getattr(cropped_sample, field))
+                       for field in ["image", "mask", "labels", "mask_center_crop", "labels_center_crop"]})
+            cropped_samples.append(Compose3D.apply(self.cropped_sample_transforms, cropped_sample).get_dict())
+
+        # Multiple crops are returned as a list, which collate_with_metadata flattens into the batch.
+        return cropped_samples[0] if self.args.crops_per_volume == 1 else cropped_samples
+
+    def as_data_loader(self,
+                       shuffle: bool,
+                       batch_size: Optional[int] = None,
+                       num_dataload_workers: Optional[int] = None,
+                       use_imbalanced_sampler: bool = False,
+                       drop_last_batch: bool = False,
+                       max_repeats: Optional[int] = None) -> DataLoader:
+        """
+        Creates a data loader for the dataset. The batch size is the number of crops in a minibatch, hence the data
+        loader loads batch_size / crops_per_volume full image samples per minibatch.
+        """
+        batch_size = batch_size or self.args.train_batch_size
+        return super().as_data_loader(shuffle=shuffle,
+                                      batch_size=max(1, batch_size // self.args.crops_per_volume),
+                                      num_dataload_workers=num_dataload_workers,
+                                      use_imbalanced_sampler=use_imbalanced_sampler,
+                                      drop_last_batch=drop_last_batch,
+                                      max_repeats=max_repeats)
+
+    def get_cache_key(self, index: int) -> str:
+        """
+        Gets a string that identifies the subject at the given index, and the settings that its preprocessed full
+        image sample depends on: The normalization settings, the full image transforms and their parameters, and the
+        padding for cropping. The key is used as a file name prefix for data that is cached on disk.
+        """
+        subject_id = self.dataset_indices[index]
+        source = self.dataset_sources[subject_id]
+        args = self.args
+        transforms = [] if self.full_image_sample_transforms is None else self.full_image_sample_transforms.transforms
+        settings = [(type(transform).__name__,
+                     [(name, value) for name, value in transform.param.get_param_values() if name != "name"])
+                    for transform in transforms]
+        key = repr((source.image_channels, source.ground_truth_channels, source.mask_channel,
+                    args.norm_method.value, args.window, args.level, args.output_range, args.sharpen, args.tail,
+                    args.trim_percentiles, settings, args.crop_size, args.padding_mode))
+        return f"{subject_id}_{hashlib.sha1(key.encode()).hexdigest()[:16]}"
+
+    def get_padded_sample(self, index: int) -> Sample:
+        """
+        Gets the full image sample at the given index, after applying the full image transforms and padding it to
+        at least the crop size. If a sample cache is configured, the sample is only loaded when it is not yet in the
+        cache, and the returned arrays must not be modified.
+        :param index: The index of the subject in the dataset.
+        """
+        if self.sample_cache is not None:
+            key = self.get_cache_key(index)
+            sample = self.sample_cache.get(key)
+            if sample is None:
+                sample = self.sample_cache.put(key, self.load_padded_sample(index))
+            return sample
+        return self.load_padded_sample(index)
+
+    def load_padded_sample(self, index: int) -> Sample:
+        """
+        Loads the full image sample at the given index, applies the full image transforms, and pads it to at least
+        the crop size.
+        """
+        return CroppingDataset.create_possibly_padded_sample_for_cropping(
+            sample=super().get_samples_at_index(index=index)[0],
             crop_size=self.args.crop_size,
-            center_size=self.args.center_size,
-            class_weights=self.args.class_weights
+            padding_mode=self.args.padding_mode
         )
 
-        return Compose3D.apply(self.cropped_sample_transforms, sample).get_dict()
+    def get_foreground_index(self, index: int, sample: Sample) -> ForegroundIndex:
+        """
+        Gets the index of the voxels of each class of the subject at the given index, that are used to pick crop
+        centers. The index is created once from the sample and kept in memory, and, if foreground_index_cache_folder
+        is set in the model config, stored in that folder, from which it is memory mapped.
+        :param index: The index of the subject in the dataset.
+        :param sample: The (possibly padded) full image sample for the subject.
+        """
+        return self.foreground_indices.get_or_create(self.get_cache_key(index), labels=sample.labels, mask=sample.mask)
 
     @staticmethod
     def create_possibly_padded_sample_for_cropping(sample: Sample,
@@ -86,7 +178,8 @@ class CroppingDataset(FullImageDataset):
     def create_random_cropped_sample(sample: Sample,
                                      crop_size: TupleInt3,
                                      center_size: TupleInt3,
-                                     class_weights: Optional[List[float]] = None) -> CroppedSample:
+                                     class_weights: Optional[List[float]] = None,
+                                     foreground_index: Optional[ForegroundIndex] = None) -> CroppedSample:
         """
         Creates an instance of a cropped sample extracted from full 3D images.
         :param sample: the full size 3D sample to use for extracting a cropped sample.
@@ -94,13 +187,15 @@ class CroppingDataset(FullImageDataset):
         :param center_size: the size of the center of the crop (this should be the same as the spatial dimensions
                             of the posteriors that the model produces)
         :param class_weights: the distribution to use for the crop center class.
+        :param foreground_index: the index of the voxels of each class in the sample, to speed up picking the center.
         :return: CroppedSample
         """
         # crop the original raw sample
         sample, center_point = random_crop(
             sample=sample,
             crop_size=crop_size,
-            class_weights=class_weights
+            class_weights=class_weights,
+            foreground_index=foreground_index
         )
 
         # crop the mask and label centers if required
@@ -0,0 +1,204 @@
+#  ------------------------------------------------------------------------------------------
+#  Copyright (c) Microsoft Corporation. All rights reserved.
+#  Licensed under the MIT License (MIT). See LICENSE in the repo root for license information.
+#  ------------------------------------------------------------------------------------------
+import functools
+import hashlib
+import logging
+import os
+import pickle
+import types
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+import pandas as pd
+import torch
+
+from InnerEye.ML.common import OneHotEncoderBase
+from InnerEye.ML.dataset.sample import GeneralSampleMetadata
+from InnerEye.ML.dataset.scalar_sample import ScalarDataSource, SequenceDataSource
+
+# Increase when the way data sources are read from a data frame, or the file format, changes.
+CACHE_FORMAT_VERSION = 1
+
+StringTable = Tuple[List[Any], np.ndarray]
+
+
+def get_callable_identity(function: Any) -> str:
+    """
+    Gets a string that identifies a function, or a list of functions, across processes: The qualified name, the
+    bytecode and constants, and the values that the function has captured from enclosing scopes. For example, the
+    scaling functions that LabelTransformation.get_scaling_transform returns for different values are distinguished.
+    """
+    if isinstance(function, (list, tuple)):
+        return "[" + ", ".join(get_callable_identity(f) for f in function) + "]"
+    if isinstance(function, functools.partial):
+        return f"partial({get_callable_identity(function.func)}, {function.args!r}, " \
+               f"{sorted(function.keywords.items())!r})"
+    parts = [getattr(function, "__module__", ""), getattr(function, "__qualname__", type(function).__qualname__)]
+    code = getattr(function, "__code__", None)
+    if code is None:
+        parts.append(repr(function))
+    else:
+        parts.append(_get_code_identity(code))
+        parts.append(repr(getattr(function, "__defaults__", None)))
+        parts.extend(repr(cell.cell_contents) for cell in getattr(function, "__closure__", None) or [])
+    return ":".join(parts)
+
+
+def _get_code_identity(code: types.CodeType) -> str:
+    # The representation of nested code objects contains their memory address, hence use their bytecode instead
+    constants = [_get_code_identity(c) if isinstance(c, types.CodeType) else repr(c) for c in code.co_consts]
+    return code.co_code.hex() + repr(constants)
+
+
+def _get_value_identity(value: Any) -> str:
+    if isinstance(value, OneHotEncoderBase):
+        # The encoded features depend on the categories that the encoder was created with
+        return hashlib.sha256(pickle.dumps(value)).hexdigest()
+    if callable(value) or (isinstance(value, (list, tuple)) and any(callable(v) for v in value)):
+        return get_callable_identity(value)
+    if isinstance(value, (set, frozenset)):
+        # Sets of strings are ordered differently in each process
+        return repr(sorted(value, key=repr))
+    if isinstance(value, dict):
+        return repr(sorted(((k, _get_value_identity(v)) for k, v in value.items()), key=repr))
+    return repr(value)
+
+
+def get_data_sources_cache_key(data_frame: pd.DataFrame, settings: Dict[str, Any]) -> str:
+    """
+    Computes the key under which the data sources that are read from a data frame are cached: A hash of the column
+    names and contents of the data frame, and of all settings that the reader uses.
+    :param data_frame: The data frame that the data sources are read from.
+    :param settings: The settings of the reader, for example the channels, columns, label transforms and encoders.
+    :return: A hexadecimal string.
+    """
+    hasher = hashlib.sha256()
+    hasher.update(f"{CACHE_FORMAT_VERSION}:{list(data_frame.columns)!r}".encode())
+    hasher.update(pd.util.hash_pandas_object(data_frame, index=False).values.tobytes())
+    for name in sorted(settings):
+        hasher.update(f"{name}={_get_value_identity(settings[name])};".encode())
+    return hasher.hexdigest()
+
+
+def _to_string_table(values: Sequence[Any]) -> StringTable:
+    """
+    Converts a sequence of (mostly repeated) values to a table of the distinct values, and the index of each value in
+    the table. None is stored as index -1.
+    """
+    codes, uniques = pd.factorize(np.array(values, dtype=object))
+    return list(uniques), codes.astype(np.int32)
+
+
+def _from_string_table(table: StringTable) -> List[Any]:
+    uniques, codes = table
+    values = np.array(list(uniques) + [None], dtype=object)
+    # Index -1 selects the trailing None
+    return values[codes].tolist()
+
+
+def data_sources_to_columns(data_sources: List[ScalarDataSource]) -> Dict[str, Any]:
+    """
+    Converts data sources to a columnar form, where labels and features of all data sources are stacked into arrays,
+    and string fields are stored as string tables.
+    :raises ValueError: If the labels or features of the data sources have different shapes.
+    """
+    source_types = {type(source) for source in data_sources}
+    if not source_types <= {ScalarDataSource, SequenceDataSource} or len(source_types) > 1:
+        raise ValueError(f"Only lists of ScalarDataSource or SequenceDataSource can be cached, got {source_types}")
+
+    def stack(field: str) -> np.ndarray:
+        return np.stack([getattr(source, field).numpy() for source in data_sources]) if data_sources \
+            else np.zeros((0,), dtype=np.float32)
+
+    props_keys = sorted({key for source in data_sources for key in source.metadata.props}, key=repr)
+    channel_files = [source.channel_files for source in data_sources]
+    return {
+        "is_sequence": source_types == {SequenceDataSource},
+        "label": stack("label"),
+        "numerical_non_image_features": stack("numerical_non_image_features"),
+        "categorical_non_image_features": stack("categorical_non_image_features"),
+        "id": _to_string_table([source.metadata.id for source in data_sources]),
+        "sequence_position": np.array([source.metadata.sequence_position for source in data_sources],
+                                      dtype=np.int64),
+        "props": {key: _to_string_table([source.metadata.props.get(key) for source in data_sources])
+                  for key in props_keys},
+        "has_props": {key: np.array([key in source.metadata.props for source in data_sources], dtype=bool)
+                      for key in props_keys},
+        "channel_files": _to_string_table([file for files in channel_files for file in files]),
+        "channel_files_offsets": np.cumsum([0] + [len(files) for files in channel_files]).astype(np.int64),
+    }
+
+
+def data_sources_from_columns(columns: Dict[str, Any]) -> List[ScalarDataSource]:
+    """
+    Converts data sources from the columnar form of `data_sources_to_columns` back to a list of objects. The tensors
+    of the data sources share memory with the arrays in the columnar form.
+    """
+    source_type = SequenceDataSource if columns["is_sequence"] else ScalarDataSource
+    ids = _from_string_table(columns["id"])
+    props = {key: _from_string_table(table) for key, table in columns["props"].items()}
+    channel_files = _from_string_table(columns["channel_files"])
+    offsets = columns["channel_files_offsets"].tolist()
+    # Splitting the stacked tensors into views once is much faster than indexing them for each data source
+    labels = torch.from_numpy(columns["label"]).unbind(0)
+    numerical = torch.from_numpy(columns["numerical_non_image_features"]).unbind(0)
+    categorical = torch.from_numpy(columns["categorical_non_image_features"]).unbind(0)
+    has_props = {key: values.tolist() for key, values in columns["has_props"].items()}
+    data_sources = []
+    for i, (subject_id, sequence_position) in enumerate(zip(ids, columns["sequence_position"].tolist())):
+        metadata = GeneralSampleMetadata(id=subject_id,
+                                         props={key: values[i] for key, values in props.items()
+                                                if has_props[key][i]},
+                                         sequence_position=sequence_position)
+        data_sources.append(source_type(metadata=metadata,
+                                        label=labels[i],
+                                        numerical_non_image_features=numerical[i],
+                                        categorical_non_image_features=categorical[i],
+                                        channel_files=channel_files[offsets[i]:offsets[i + 1]]))
+    return data_sources
+
+
+class DataSourcesCache:
+    """
+    Stores the data sources that are read from a dataset data frame in a folder, as one pickle file per data frame
+    and reader settings that holds the data sources in columnar form. Training, inference and cross validation runs
+    that read the same data with the same settings then only read the file.
+    """
+
+    def __init__(self, folder: Path) -> None:
+        self.folder = folder
+
+    def get_file(self, key: str) -> Path:
+        return self.folder / f"{key}.pkl"
+
+    def get(self, key: str) -> Optional[List[ScalarDataSource]]:
+        """
+        Gets the data sources that were stored with the given key, or None if there are none.
+        """
+        file = self.get_file(key)
+        if not file.is_file():
+            return None
+        with file.open("rb") as f:
+            columns = pickle.load(f)
+        return data_sources_from_columns(columns)
+
+    def put(self, key: str, data_sources: List[ScalarDataSource]) -> None:
+        """
+        Stores the data sources with the given key. The file is written under a temporary name first and then
+        renamed, such that other processes never read incomplete files. Data sources with labels or features of
+        different shapes are not stored.
+        """
+        try:
+            columns = data_sources_to_columns(data_sources)
+        except ValueError as ex:
+            logging.warning(f"The data sources can not be cached: {ex}")
+            return
+        self.folder.mkdir(parents=True, exist_ok=True)
+        file = self.get_file(key)
+        temp_file = file.parent / (file.name + f".{os.getpid()}.tmp")
+        with temp_file.open("wb") as f:
+            pickle.dump(columns, f, protocol=pickle.HIGHEST_PROTOCOL)
+        temp_file.replace(file)
@@ -0,0 +1,155 @@
+#  ------------------------------------------------------------------------------------------
+#  Copyright (c) Microsoft Corporation. All rights reserved.
+#  Licensed under the MIT License (MIT). See LICENSE in the repo root for license information.
+#  ------------------------------------------------------------------------------------------
+import logging
+import os
+import pickle
+import time
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional, Tuple
+
+# Increase when the format of the index file changes.
+INDEX_FORMAT_VERSION = 1
+# The default number of threads that list directories. Listing is I/O bound, in particular on mounted blob storage.
+DEFAULT_NUM_THREADS = 16
+# Directories that were modified less than this number of seconds before they were listed are listed again in the
+# next run, because files that are added in the same file system time step would not change the modification time.
+RECENT_MODIFICATION_SECONDS = 2.0
+
+
+@dataclass(frozen=True)
+class DirectoryEntry:
+    """
+    The contents of a single directory in a DirectoryIndex.
+    """
+    #: The modification time of the directory when it was listed, or -1 if it must be listed again.
+    mtime_ns: int
+    #: The names of the files in the directory, sorted.
+    files: List[str]
+    #: The names of the subdirectories, sorted. Symbolic links to directories are not followed.
+    subdirs: List[str]
+
+
+def _scan_directory(path: str, previous: Optional[DirectoryEntry]) -> Optional[DirectoryEntry]:
+    """
+    Lists a directory, or returns the previous listing if the directory was not modified since. Returns None if the
+    directory does not exist any more or can not be read.
+    """
+    try:
+        mtime_ns = os.stat(path).st_mtime_ns
+        if previous is not None and previous.mtime_ns == mtime_ns:
+            return previous
+        files = []
+        subdirs = []
+        with os.scandir(path) as entries:
+            for entry in entries:
+                if entry.is_dir() and not entry.is_symlink():
+                    subdirs.append(entry.name)
+                elif entry.is_file():
+                    files.append(entry.name)
+    except (FileNotFoundError, NotADirectoryError, PermissionError):
+        return None
+    if time.time_ns() - mtime_ns < RECENT_MODIFICATION_SECONDS * 1e9:
+        mtime_ns = -1
+    return DirectoryEntry(mtime_ns=mtime_ns, files=sorted(files), subdirs=sorted(subdirs))
+
+
+class DirectoryIndex:
+    """
+    An index of all files under a root directory, which lists the directories with a pool of threads. The index can
+    be saved to a file, and updated incrementally: Directories whose modification time did not change since the
+    previous listing are not listed again, because adding, removing or renaming files and subdirectories changes the
+    modification time of their parent directory.
+    """
+
+    def __init__(self, root_path: Path, directories: Optional[Dict[str, DirectoryEntry]] = None) -> None:
+        """
+        :param root_path: The root directory of the index.
+        :param directories: A mapping from the path of each directory relative to the root directory, in POSIX
+        format and "" for the root directory itself, to its contents.
+        """
+        self.root_path = root_path
+        self.directories = directories or {}
+
+    def update(self, num_threads: int = DEFAULT_NUM_THREADS) -> None:
+        """
+        Updates the index with the current contents of the root directory and all its subdirectories, recursively.
+        :param num_threads: The number of threads that list directories in parallel.
+        """
+        previous = self.directories
+        directories: Dict[str, DirectoryEntry] = {}
+        num_listed = 0
+        with ThreadPoolExecutor(max_workers=num_threads) as executor:
+            def submit(relative_path: str) -> Tuple[Future, str]:
+                path = os.path.join(self.root_path, relative_path) if relative_path else str(self.root_path)
+                return executor.submit(_scan_directory, path, previous.get(relative_path)), relative_path
+
+            pending = dict([submit("")])
+            while pending:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    relative_path = pending.pop(future)
+                    entry = future.result()
+                    if entry is None:
+                        continue
+                    if entry is not previous.get(relative_path):
+                        num_listed += 1
+                    directories[relative_path] = entry
+                    pending.update(submit(f"{relative_path}/{name}" if relative_path else name)
+                                   for name in entry.subdirs)
+        logging.info(f"Indexed {len(directories)} directories under {self.root_path}, of which {num_listed} were "
+                     f"listed and {len(directories) - num_listed} were unchanged.")
+        self.directories = directories
+
+    def iterate_files(self) -> Iterator[Path]:
+        """
+        Iterates over the full paths of all files in the index, sorted by directory and file name.
+        """
+        for relative_path in sorted(self.directories):
+            folder = self.root_path / relative_path if relative_path else self.root_path
+            for name in self.directories[relative_path].files:
+                yield folder / name
+
+    def save(self, file: Path) -> None:
+        """
+        Saves the index to a file. The file is written under a temporary name first and then renamed, such that other
+        processes never read incomplete files.
+        """
+        file.parent.mkdir(parents=True, exist_ok=True)
+        temp_file = file.parent / (file.name + f".{os.getpid()}.tmp")
+        with temp_file.open("wb") as f:
+            pickle.dump((INDEX_FORMAT_VERSION, str(self.root_path), self.directories), f,
+                        protocol=pickle.HIGHEST_PROTOCOL)
+        temp_file.replace(file)
+
+    @staticmethod
+    def load(file: Path, root_path: Path) -> "DirectoryIndex":
+        """
+        Loads an index of the given root directory from a file. If the file does not exist, or was written for a
+        different root directory or index format, an empty index is returned.
+        """
+        if file.is_file():
+            with file.open("rb") as f:
+                version, stored_root_path, directories = pickle.load(f)
+            if version == INDEX_FORMAT_VERSION and stored_root_path == str(root_path):
+                return DirectoryIndex(root_path, directories)
+        return DirectoryIndex(root_path)
+
+    @staticmethod
+    def create(root_path: Path, index_file: Optional[Path] = None,
+               num_threads: int = DEFAULT_NUM_THREADS) -> "DirectoryIndex":
+        """
+        Creates an up-to-date index of the given root directory. If an index file is given, the index that was saved
+        there is updated incrementally, and the updated index is saved again.
+        :param root_path: The root directory of the index.
+        :param index_file: The file that stores the index between runs.
+        :param num_threads: The number of threads that list directories in parallel.
+        """
+        index = DirectoryIndex(root_path) if index_file is None else DirectoryIndex.load(index_file, root_path)
+        index.update(num_threads=num_threads)
+        if index_file is not None:
+            index.save(index_file)
+        return index
@@ -26,15 +26,20 @@ from InnerEye.ML.utils.transforms import Compose3D
 COMPRESSION_EXTENSIONS = ['sz', 'gz']
 
 
-def collate_with_metadata(batch: List[Dict[str, Any]]) -> Dict[str, Any]:
+def collate_with_metadata(batch: List[Any]) -> Dict[str, Any]:
     """
     The collate function that the dataloader workers should use. It does the same thing for all "normal" fields
     (all fields are put into tensors with outer dimension batch_size), except for the special "metadata" field.
     Those metadata objects are collated into a simple list.
+    Datasets can also return a list of samples per item (see crops_per_volume in CroppingDataset). The samples of all
+    items are then collated as one batch, with outer dimension batch_size times the number of samples per item.
     :param batch: A list of samples that should be collated.
     :return: collated result
     """
     elem = batch[0]
+    if isinstance(elem, list):
+        batch = [sample for item in batch for sample in item]
+        elem = batch[0]
     if isinstance(elem, Mapping):
         result = dict()
         for key in elem:
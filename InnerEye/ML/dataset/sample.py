@@ -32,6 +32,8 @@ class PatientMetadata:
     institution: Optional[str] = None
     series: Optional[str] = None
     tags_str: Optional[str] = None
+    # Identifies the files that the image and mask of the sample were loaded from, set when the sample is loaded.
+    source_files_key: Optional[str] = None
 
     @staticmethod
     def from_dataframe(dataframe: pd.DataFrame, patient_id: str) -> PatientMetadata:
@@ -0,0 +1,137 @@
+#  ------------------------------------------------------------------------------------------
+#  Copyright (c) Microsoft Corporation. All rights reserved.
+#  Licensed under the MIT License (MIT). See LICENSE in the repo root for license information.
+#  ------------------------------------------------------------------------------------------
+import os
+import pickle
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from pathlib import Path
+from typing import BinaryIO, Callable, Dict, Optional
+
+import numpy as np
+
+from InnerEye.ML.dataset.sample import Sample
+
+SAMPLE_ARRAY_FIELDS = ["image", "mask", "labels"]
+METADATA_FILE_NAME = "metadata.pkl"
+
+
+def get_sample_size_in_bytes(sample: Sample) -> int:
+    """
+    Gets the number of bytes that the image, mask and labels arrays of the sample occupy.
+    """
+    return sum(np.asarray(getattr(sample, field)).nbytes for field in SAMPLE_ARRAY_FIELDS)
+
+
+class SampleCache(ABC):
+    """
+    A cache for preprocessed full image samples, such that they only need to be loaded and normalized once, rather
+    than once per epoch. Samples that are returned by the cache must not be modified in place.
+    """
+
+    @abstractmethod
+    def get(self, key: str) -> Optional[Sample]:
+        """
+        Gets the sample that was stored with the given key, or None if the sample is not in the cache.
+        """
+        raise NotImplementedError("get must be implemented by subclasses")
+
+    @abstractmethod
+    def put(self, key: str, sample: Sample) -> Sample:
+        """
+        Stores the sample with the given key.
+        :return: The sample to use in place of the argument, which may share memory with the cache.
+        """
+        raise NotImplementedError("put must be implemented by subclasses")
+
+
+class MemorySampleCache(SampleCache):
+    """
+    Keeps samples in memory, and evicts the least recently used samples when the total size of the cached arrays
+    exceeds the given number of bytes. Each data loader worker process has its own cache.
+    """
+
+    def __init__(self, max_bytes: int) -> None:
+        self.max_bytes = max_bytes
+        self.num_bytes = 0
+        self.samples: Dict[str, Sample] = OrderedDict()
+
+    def get(self, key: str) -> Optional[Sample]:
+        sample = self.samples.get(key)
+        if sample is not None:
+            self.samples.move_to_end(key)  # type: ignore
+        return sample
+
+    def put(self, key: str, sample: Sample) -> Sample:
+        size = get_sample_size_in_bytes(sample)
+        if size > self.max_bytes:
+            return sample
+        if key in self.samples:
+            self.num_bytes -= get_sample_size_in_bytes(self.samples.pop(key))
+        while self.num_bytes + size > self.max_bytes:
+            _, evicted = self.samples.popitem(last=False)  # type: ignore
+            self.num_bytes -= get_sample_size_in_bytes(evicted)
+        self.samples[key] = sample
+        self.num_bytes += size
+        return sample
+
+
+class DiskSampleCache(SampleCache):
+    """
+    Stores the arrays of each sample as .npy files in a folder, and the metadata as a pickle file. The arrays are
+    memory mapped when reading, such that only the crops are read from disk, and all data loader workers share the
+    operating system's page cache.
+    """
+
+    def __init__(self, folder: Path) -> None:
+        self.folder = folder
+
+    def get_file(self, key: str, name: str) -> Path:
+        return self.folder / f"{key}_{name}"
+
+    def get(self, key: str) -> Optional[Sample]:
+        # The metadata file is written last, hence its presence indicates that all arrays are complete.
+        metadata_file = self.get_file(key, METADATA_FILE_NAME)
+        if not metadata_file.is_file():
+            return None
+        arrays = {field: np.load(self.get_file(key, f"{field}.npy"), mmap_mode="r") for field in SAMPLE_ARRAY_FIELDS}
+        with metadata_file.open("rb") as f:
+            metadata = pickle.load(f)
+        return Sample(metadata=metadata, **arrays)
+
+    def put(self, key: str, sample: Sample) -> Sample:
+        self.folder.mkdir(parents=True, exist_ok=True)
+        for field in SAMPLE_ARRAY_FIELDS:
+            array = np.asarray(getattr(sample, field))
+            self._write_atomically(self.get_file(key, f"{field}.npy"), lambda f, a=array: np.save(f, a))
+        self._write_atomically(self.get_file(key, METADATA_FILE_NAME),
+                               lambda f: pickle.dump(sample.metadata, f))
+        cached = self.get(key)
+        assert cached is not None
+        return cached
+
+    @staticmethod
+    def _write_atomically(file: Path, write_fn: Callable[[BinaryIO], None]) -> None:
+        """
+        Writes to a temporary file first, and then renames it, such that other processes never read incomplete files.
+        """
+        temp_file = file.parent / (file.name + f".{os.getpid()}.tmp")
+        with temp_file.open("wb") as f:
+            write_fn(f)
+        temp_file.replace(file)
+
+
+def create_sample_cache(cache_folder: Optional[Path], cache_size_gb: float) -> Optional[SampleCache]:
+    """
+    Creates a cache for preprocessed samples from the model config settings.
+    :param cache_folder: If given, samples are stored on disk in this folder.
+    :param cache_size_gb: If larger than zero and no folder is given, samples are cached in memory, up to this
+                          size per data loader worker.
+    :return: The cache, or None if caching is turned off.
+    """
+    if cache_folder is not None:
+        return DiskSampleCache(cache_folder)
+    if cache_size_gb > 0:
+        return MemorySampleCache(max_bytes=int(cache_size_gb * 2 ** 30))
+    return None
@@ -2,6 +2,7 @@
 #  Copyright (c) Microsoft Corporation. All rights reserved.
 #  Licensed under the MIT License (MIT). See LICENSE in the repo root for license information.
 #  ------------------------------------------------------------------------------------------
+import hashlib
 import logging
 import math
 import sys
@@ -10,7 +11,8 @@ from abc import abstractmethod
 from collections import Counter, defaultdict
 from multiprocessing import cpu_count
 from pathlib import Path
-from typing import Any, Callable, Dict, Generic, Iterable, List, Optional, Sequence, Set, TypeVar, Union
+from typing import Any, Callable, Dict, Generic, Iterable, Iterator, List, Mapping, Optional, Sequence, Set, TypeVar, \
+    Union
 
 import numpy as np
 import pandas as pd
@@ -18,6 +20,8 @@ import torch
 from joblib import Parallel, delayed
 from more_itertools import flatten
 
+from InnerEye.ML.dataset.data_source_cache import DataSourcesCache, get_data_sources_cache_key
+from InnerEye.ML.dataset.directory_index import DEFAULT_NUM_THREADS, DirectoryIndex
 from InnerEye.ML.dataset.full_image_dataset import GeneralDataset
 from InnerEye.ML.dataset.sample import GeneralSampleMetadata
 from InnerEye.ML.dataset.scalar_sample import ScalarDataSource, ScalarItem, SequenceDataSource
@@ -166,6 +170,42 @@ def _string_to_float(text: Union[str, float], error_message_prefix: str = None)
         return math.nan
 
 
+def _strings_to_floats(values: np.ndarray, error_message_prefix: str = None) -> np.ndarray:
+    """
+    Converts all elements of a column of a dataset.csv file to floating point numbers, like `_string_to_float` does
+    for a single element, but with vectorized conversions. Elements that cannot be parsed are logged and become NaN.
+    :param values: The elements of the column.
+    :param error_message_prefix: A prefix string that will go into the error message if the conversion fails.
+    :return: A float64 array with the same length as the input.
+    """
+    texts = pd.Series(values, dtype=object)
+    try:
+        # Elements that are not strings, for example numbers, give NaN
+        stripped = texts.str.strip()
+    except AttributeError:
+        # The .str accessor is not available if no element is a string
+        stripped = pd.Series(math.nan, index=texts.index, dtype=object)
+    is_string = stripped.notna().to_numpy()
+    result = np.full(len(texts), math.nan)
+    not_string = ~is_string
+    if not_string.any():
+        result[not_string] = texts[not_string].to_numpy().astype(np.float64)
+    strings = stripped.to_numpy()[is_string]
+    non_empty = strings != ''
+    string_positions = np.flatnonzero(is_string)[non_empty]
+    strings = strings[non_empty]
+    try:
+        result[string_positions] = strings.astype(np.float64)
+    except ValueError:
+        # At least one element is not a number: Convert elements one by one, to find out which
+        for position, text in zip(string_positions, strings):
+            try:
+                result[position] = float(text)
+            except ValueError:
+                logging.warning(f"{error_message_prefix}: Unable to parse value '{text}'")
+    return result
+
+
 def load_single_data_source(subject_rows: pd.DataFrame,
                             subject_id: str,
                             label_value_column: str,
@@ -206,12 +246,51 @@ def load_single_data_source(subject_rows: pd.DataFrame,
     a non-sequential dataset item if None provided (default).
     :return:
     """
+    subject_rows = subject_rows.fillna('')
 
-    def _get_row_for_channel(channel: Optional[str]) -> Dict[str, str]:
+    def _get_row_for_channel(channel: Optional[str]) -> Dict[str, Any]:
         return _get_single_channel_row(subject_rows, channel, subject_id, channel_column)
 
+    return _create_data_source(get_row_for_channel=_get_row_for_channel,
+                               subject_id=subject_id,
+                               label_value_column=label_value_column,
+                               image_channels=image_channels,
+                               image_file_column=image_file_column,
+                               label_channels=label_channels,
+                               transform_labels=transform_labels,
+                               non_image_feature_channels=non_image_feature_channels,
+                               numerical_columns=numerical_columns,
+                               categorical_data_encoder=categorical_data_encoder,
+                               metadata_columns=metadata_columns,
+                               is_classification_dataset=is_classification_dataset,
+                               num_classes=num_classes,
+                               sequence_position_numeric=sequence_position_numeric)
+
+
+def _create_data_source(get_row_for_channel: Callable[[Optional[str]], Mapping[str, Any]],
+                        subject_id: str,
+                        label_value_column: str,
+                        image_channels: Optional[List[str]] = None,
+                        image_file_column: Optional[str] = None,
+                        label_channels: Optional[List[str]] = None,
+                        transform_labels: Union[Callable, List[Callable]] = LabelTransformation.identity,
+                        non_image_feature_channels: Optional[Dict] = None,
+                        numerical_columns: Optional[List[str]] = None,
+                        categorical_data_encoder: Optional[CategoricalToOneHotEncoder] = None,
+                        metadata_columns: Optional[Set[str]] = None,
+                        is_classification_dataset: bool = True,
+                        num_classes: int = 1,
+                        sequence_position_numeric: Optional[int] = None) -> T:
+    """
+    Creates a ScalarDataSource or SequenceDataSource instance for a single subject, reading the rows of the subject
+    via the given function. All other arguments are as in `load_single_data_source`.
+    :param get_row_for_channel: A function that returns the unique row of the subject for the given channel (or the
+    only row of the subject if the channel is None) as a mapping from column names to values, where missing
+    values are empty strings. It raises a ValueError if there is no or more than one such row.
+    """
+
     def _get_label_as_tensor(channel: Optional[str]) -> torch.Tensor:
-        label_row = _get_row_for_channel(channel)
+        label_row = get_row_for_channel(channel)
         label_string = label_row[label_value_column]
         return torch.tensor(
             extract_label_classification(label_string=label_string, sample_id=subject_id, num_classes=num_classes,
@@ -253,7 +332,6 @@ def load_single_data_source(subject_rows: pd.DataFrame,
         # If the CSV contains missing values they turn into NaN here, but mark them as None rather.
         return None if isinstance(x, float) and np.isnan(x) else x
 
-    subject_rows = subject_rows.fillna('')
     labels = []
     if label_channels:
         for channel in label_channels:
@@ -264,7 +342,7 @@ def load_single_data_source(subject_rows: pd.DataFrame,
     label = _apply_label_transforms(labels)
 
     channel_for_metadata = label_channels[0] if label_channels else None
-    label_row = _get_row_for_channel(channel_for_metadata)
+    label_row = get_row_for_channel(channel_for_metadata)
     metadata = GeneralSampleMetadata(id=subject_id, props={key: none_if_missing_in_csv(label_row[key])
                                                            for key in metadata_columns or set()})
 
@@ -272,7 +350,7 @@ def load_single_data_source(subject_rows: pd.DataFrame,
     if image_file_column:
         for image_channel in create_none_list(image_channels):
             # Alternative: restrict rows to given channels first, then read out the relevant columns.
-            file_path = _get_row_for_channel(image_channel)[image_file_column]
+            file_path = get_row_for_channel(image_channel)[image_file_column]
             image_files.append(none_if_missing_in_csv(file_path))
 
     numerical_columns = numerical_columns or []
@@ -292,7 +370,7 @@ def load_single_data_source(subject_rows: pd.DataFrame,
                                                                                       column)
             numerical_col, categorical_col = [], []
             for channel in list_channels:  # type: ignore
-                row = _get_row_for_channel(channel)
+                row = get_row_for_channel(channel)
                 prefix = f"Channel {channel}, column {column}"
                 if column in numerical_columns:
                     numerical_col.append(_string_to_float(row[column], error_message_prefix=prefix))
@@ -440,7 +518,7 @@ class DataSourceReader(Generic[T]):
         if isinstance(args, SequenceModelBase):
             sequence_column = args.sequence_column
 
-        return DataSourceReader[T](
+        reader = DataSourceReader[T](
             data_frame=data_frame,
             image_channels=args.image_channels,
             image_file_column=args.image_file_column,
@@ -455,7 +533,18 @@ class DataSourceReader(Generic[T]):
             channel_column=args.channel_column,
             num_classes=len(args.class_names),
             is_classification_dataset=args.is_classification_model
-        ).load_data_sources(num_dataset_reader_workers=args.num_dataset_reader_workers)
+        )
+        if args.data_sources_cache_folder is None:
+            return reader.load_data_sources(num_dataset_reader_workers=args.num_dataset_reader_workers)
+        cache = DataSourcesCache(args.data_sources_cache_folder)
+        key = get_data_sources_cache_key(data_frame, reader.get_settings())
+        data_sources = cache.get(key)
+        if data_sources is not None:
+            logging.info(f"Loaded {len(data_sources)} data sources from {cache.get_file(key)}")
+            return data_sources  # type: ignore
+        data_sources = reader.load_data_sources(num_dataset_reader_workers=args.num_dataset_reader_workers)
+        cache.put(key, data_sources)
+        return data_sources
 
     def load_data_sources(self, num_dataset_reader_workers: int = 0) -> List[T]:
         """
@@ -465,11 +554,12 @@ class DataSourceReader(Generic[T]):
         the CSV_CHANNEL_HEADER column. The result contains paths to image files, a label vector, and a matrix of
         additional values that are specified by rows and columns given in non_image_feature_channels and
         numerical_columns.
+        The rows are grouped by subject in a single sorting pass, and numerical columns are converted to floats for
+        all rows at once. Each worker then reads the subjects of a contiguous range of rows.
         :param num_dataset_reader_workers: Number of worker processes to use, if 0 then single threaded execution,
         otherwise if -1 then multiprocessing with all available cpus will be used.
         :return: A list of ScalarDataSource or SequenceDataSource instances
         """
-        subject_ids = self.data_frame[self.subject_column].unique()
         _backend: Optional[str] = None
         if num_dataset_reader_workers == 0:
             _n_jobs = 1
@@ -479,58 +569,181 @@ class DataSourceReader(Generic[T]):
         else:
             _n_jobs = max(1, num_dataset_reader_workers)
 
-        results = Parallel(n_jobs=_n_jobs, backend=_backend)(
-            delayed(self.load_datasources_for_subject)(subject_id) for subject_id in subject_ids)
-
-        return list(flatten(filter(None, results)))
-
-    def load_datasources_for_subject(self, subject_id: str) -> Optional[List[T]]:
-
-        rows = self.data_frame[np.in1d(self.data_frame[self.subject_column].values, [subject_id])]
-
-        def _load_single_data_source(_rows: pd.DataFrame,
-                                     _sequence_position_numeric: Optional[int] = None) -> T:
-            return load_single_data_source(
-                subject_rows=_rows,
-                subject_id=subject_id,
-                image_channels=self.image_channels,
-                image_file_column=self.image_file_column,
-                label_channels=self.label_channels,
-                label_value_column=self.label_value_column,
-                transform_labels=self.transform_labels,
-                non_image_feature_channels=self.non_image_feature_channels,
-                numerical_columns=self.numerical_columns,
-                categorical_data_encoder=self.categorical_data_encoder,
-                metadata_columns=self.metadata_columns,
+        # Sort the rows by subject in a single pass, keeping the order of first appearance of the subjects and the
+        # order of the rows of each subject. The rows of subject i are then rows subject_starts[i]:subject_starts[i+1]
+        subject_codes, subject_ids = pd.factorize(self.data_frame[self.subject_column])
+        order = np.argsort(subject_codes, kind='stable')
+        num_missing_subjects = np.count_nonzero(subject_codes < 0)
+        if num_missing_subjects > 0:
+            logging.warning(f"{num_missing_subjects} rows will be skipped because they have no subject.")
+            order = order[num_missing_subjects:]
+        subject_starts = np.concatenate([[0], np.cumsum(np.bincount(subject_codes[order],
+                                                                    minlength=len(subject_ids)))])
+        sorted_rows = self.data_frame.iloc[order].fillna('')
+        columns = {column: sorted_rows[column].astype(object).to_numpy() for column in sorted_rows.columns}
+        for column in self.numerical_columns or []:
+            columns[column] = _strings_to_floats(columns[column], error_message_prefix=f"Column {column}")
+
+        # Each worker gets the columns of a contiguous range of rows, which hold the rows of a range of subjects
+        num_chunks = 1 if _n_jobs == 1 else min(len(subject_ids), 4 * _n_jobs)
+        chunk_starts = np.linspace(0, len(subject_ids), num_chunks + 1).astype(int)
+        readers = []
+        for first_subject, end_subject in zip(chunk_starts[:-1], chunk_starts[1:]):
+            first_row, end_row = subject_starts[first_subject], subject_starts[end_subject]
+            readers.append(_SubjectRangeReader[T](
+                columns={column: values[first_row:end_row] for column, values in columns.items()},
+                row_index=sorted_rows.index[first_row:end_row],
+                subject_ids=subject_ids[first_subject:end_subject],
+                subject_starts=subject_starts[first_subject:end_subject + 1] - first_row,
                 channel_column=self.channel_column,
-                is_classification_dataset=self.is_classification_dataset,
-                num_classes=self.num_classes,
-                sequence_position_numeric=_sequence_position_numeric
-            )
-
-        def _load_sequence_data_source(_sequence_position: Any) -> T:
-            _sequence_position_numeric = int(_sequence_position)
-            if _sequence_position_numeric < 0:
-                raise ValueError(
-                    f"Sequence positions must be non-negative integers, but got: {_sequence_position}")
-            else:
-                seq_rows = rows[np.in1d(rows[self.sequence_column].values, [_sequence_position])]
-                return _load_single_data_source(seq_rows, _sequence_position_numeric)
+                sequence_column=self.sequence_column,
+                expected_channels=self.expected_channels,
+                data_source_kwargs=self._get_data_source_kwargs()))
 
-        if self.sequence_column:
-            seq_positions = rows[self.sequence_column].unique()
-            return list(map(_load_sequence_data_source, seq_positions))
-        else:
-            if len(self.expected_channels) > 0:
-                missing_channels = self.expected_channels - set(rows[self.channel_column])
-                if len(missing_channels) > 0:
-                    logging.warning(f"Subject {subject_id} will be skipped completely because the following "
-                                    f"channels are missing: {','.join(missing_channels)}.")
-                    return None
-            return [_load_single_data_source(rows)]
+        results = Parallel(n_jobs=_n_jobs, backend=_backend)(delayed(reader.load)() for reader in readers)
+
+        return list(flatten(filter(None, flatten(results))))
 
+    def get_settings(self) -> Dict[str, Any]:
+        """
+        Returns all settings that determine which data sources are read from the data frame.
+        """
+        return dict(**self._get_data_source_kwargs(),
+                    sequence_column=self.sequence_column,
+                    subject_column=self.subject_column,
+                    channel_column=self.channel_column)
 
-def files_by_stem(root_path: Path) -> Dict[str, Path]:
+    def _get_data_source_kwargs(self) -> Dict[str, Any]:
+        """
+        Returns the arguments to create the data source of a subject, which do not depend on the subject.
+        """
+        return dict(image_channels=self.image_channels,
+                    image_file_column=self.image_file_column,
+                    label_channels=self.label_channels,
+                    label_value_column=self.label_value_column,
+                    transform_labels=self.transform_labels,
+                    non_image_feature_channels=self.non_image_feature_channels,
+                    numerical_columns=self.numerical_columns,
+                    categorical_data_encoder=self.categorical_data_encoder,
+                    metadata_columns=self.metadata_columns,
+                    is_classification_dataset=self.is_classification_dataset,
+                    num_classes=self.num_classes)
+
+
+class _ColumnarRow(Mapping[str, Any]):
+    """
+    A read-only view of a single row of a set of columns, as a mapping from column names to values.
+    """
+
+    def __init__(self, columns: Dict[str, np.ndarray], row: int):
+        self.columns = columns
+        self.row = row
+
+    def __getitem__(self, column: str) -> Any:
+        return self.columns[column][self.row]
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self.columns)
+
+    def __len__(self) -> int:
+        return len(self.columns)
+
+
+class _SubjectRangeReader(Generic[T]):
+    """
+    Reads the data sources of a range of subjects from the columns of their dataset rows, where the rows of each
+    subject are contiguous. Instances only hold the columns of their own rows, such that they are cheap to send to
+    worker processes.
+    """
+
+    def __init__(self,
+                 columns: Dict[str, np.ndarray],
+                 row_index: pd.Index,
+                 subject_ids: np.ndarray,
+                 subject_starts: np.ndarray,
+                 channel_column: str,
+                 sequence_column: Optional[str],
+                 expected_channels: Union[List[None], Set[str]],
+                 data_source_kwargs: Dict[str, Any]):
+        """
+        :param columns: A mapping from column names to the values of the rows, where missing values are empty
+        strings, and numerical columns are already converted to floats.
+        :param row_index: The data frame index of the rows, only used for error reporting.
+        :param subject_ids: The identifiers of the subjects.
+        :param subject_starts: The first row of each subject, followed by the number of rows.
+        :param channel_column: The name of the column that contains the row identifier ("channels").
+        :param sequence_column: The name of the column that contains the sequence index, if any.
+        :param expected_channels: The channels that each subject must have, if it is not a sequence.
+        :param data_source_kwargs: The arguments for `_create_data_source` that do not depend on the subject.
+        """
+        self.columns = columns
+        self.row_index = row_index
+        self.subject_ids = subject_ids
+        self.subject_starts = subject_starts
+        self.channel_column = channel_column
+        self.sequence_column = sequence_column
+        self.expected_channels = expected_channels
+        self.data_source_kwargs = data_source_kwargs
+
+    def load(self) -> List[Optional[List[T]]]:
+        """
+        Returns the data sources of each subject, or None for subjects that are skipped.
+        """
+        return [self._load_subject(index) for index in range(len(self.subject_ids))]
+
+    def _load_subject(self, index: int) -> Optional[List[T]]:
+        subject_id = self.subject_ids[index]
+        rows = list(range(self.subject_starts[index], self.subject_starts[index + 1]))
+        if self.sequence_column:
+            sequence_positions = self.columns[self.sequence_column]
+            rows_by_position: Dict[Any, List[int]] = defaultdict(list)
+            for row in rows:
+                rows_by_position[sequence_positions[row]].append(row)
+            data_sources = []
+            for sequence_position, sequence_rows in rows_by_position.items():
+                sequence_position_numeric = int(sequence_position)
+                if sequence_position_numeric < 0:
+                    raise ValueError(
+                        f"Sequence positions must be non-negative integers, but got: {sequence_position}")
+                data_sources.append(self._create_data_source(subject_id, sequence_rows, sequence_position_numeric))
+            return data_sources
+        if len(self.expected_channels) > 0:
+            channels = self.columns[self.channel_column]
+            missing_channels = self.expected_channels - {channels[row] for row in rows}
+            if len(missing_channels) > 0:
+                logging.warning(f"Subject {subject_id} will be skipped completely because the following "
+                                f"channels are missing: {','.join(missing_channels)}.")
+                return None
+        return [self._create_data_source(subject_id, rows, None)]
+
+    def _create_data_source(self, subject_id: str, rows: List[int], sequence_position_numeric: Optional[int]) -> T:
+        rows_by_channel: Dict[Any, List[int]] = defaultdict(list)
+        if self.channel_column in self.columns:
+            channels = self.columns[self.channel_column]
+            for row in rows:
+                rows_by_channel[channels[row]].append(row)
+
+        def _get_row_for_channel(channel: Optional[str]) -> Mapping[str, Any]:
+            channel_rows = rows_by_channel.get(channel, []) if channel else rows
+            if len(channel_rows) != 1:
+                subject_rows = pd.DataFrame({column: values[channel_rows] for column, values in self.columns.items()},
+                                            index=self.row_index[channel_rows])
+                with pd.option_context('display.max_columns', None,
+                                       'display.max_rows', 30,
+                                       'display.expand_frame_repr', False):
+                    logging.error(f"Invalid subject data: {subject_rows}")
+                raise ValueError(f"Subject {subject_id}: There should be exactly "
+                                 f"one row to read from, but got {len(channel_rows)} rows.")
+            return _ColumnarRow(self.columns, channel_rows[0])
+
+        return _create_data_source(get_row_for_channel=_get_row_for_channel,
+                                   subject_id=subject_id,
+                                   sequence_position_numeric=sequence_position_numeric,
+                                   **self.data_source_kwargs)
+
+
+def files_by_stem(root_path: Path, index_file: Optional[Path] = None,
+                  num_threads: int = DEFAULT_NUM_THREADS) -> Dict[str, Path]:
     """
     Lists all files under the given root directory recursively, and returns a mapping from file name stem to full path.
     The file name stem is computed more restrictively than what Path.stem returns: file.nii.gz will use "file" as the
@@ -538,22 +751,24 @@ def files_by_stem(root_path: Path) -> Dict[str, Path]:
     Only actual files are returned in the mapping, no directories.
     If there are multiple files that map to the same stem, the function raises a ValueError.
     :param root_path: The root directory from which the file search should start.
+    :param index_file: If given, the directory listings are stored in this file, and only directories that were
+    modified since the previous call are listed again.
+    :param num_threads: The number of threads that list directories in parallel.
     :return: A dictionary mapping from file name stem to the full path to where the file is found.
     """
     if not root_path.exists() or not root_path.is_dir():
         raise ValueError("The root_path must be a directory that exists.")
     result: Dict[str, Path] = dict()
     duplicates: Dict[str, List[Path]] = defaultdict(list)
-    for item in root_path.rglob("*"):
-        if item.is_file():
-            key = item.name
-            i = key.find('.')
-            if 0 < i < len(key) - 1:
-                key = key[:i]
-            if key in result:
-                duplicates[key].append(item)
-            else:
-                result[key] = item
+    for item in DirectoryIndex.create(root_path, index_file=index_file, num_threads=num_threads).iterate_files():
+        key = item.name
+        i = key.find('.')
+        if 0 < i < len(key) - 1:
+            key = key[:i]
+        if key in result:
+            duplicates[key].append(item)
+        else:
+            result[key] = item
     if len(duplicates) > 0:
         for key, files in duplicates.items():
             logging.info(f"{key} maps to {len(files) + 1} locations: ")
@@ -707,7 +922,12 @@ class ScalarDatasetBase(GeneralDataset[ScalarModelBase], Generic[T]):
             if args.local_dataset is None:
                 raise ValueError("Unable to load dataset because no `local_dataset` property is set.")
             logging.info(f"Starting to traverse folder {args.local_dataset} to locate image files.")
-            self.file_to_full_path = files_by_stem(args.local_dataset)
+            index_file = None
+            if args.data_sources_cache_folder is not None:
+                # The listings of different dataset folders are stored in different files
+                folder_hash = hashlib.sha256(str(args.local_dataset.absolute()).encode()).hexdigest()[:16]
+                index_file = args.data_sources_cache_folder / f"directory_index_{folder_hash}.pkl"
+            self.file_to_full_path = files_by_stem(args.local_dataset, index_file=index_file)
             logging.info("Finished traversing folder.")
 
     def load_all_data_sources(self) -> List[T]:
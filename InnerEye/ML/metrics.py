@@ -5,11 +5,9 @@
 from __future__ import annotations
 
 import logging
-import math
 from dataclasses import dataclass
 from typing import List, Optional, Sequence
 
-import SimpleITK as sitk
 import numpy as np
 import torch
 import torch.nn.functional as F
@@ -23,12 +21,12 @@ from InnerEye.ML.config import BACKGROUND_CLASS_NAME
 from InnerEye.ML.metrics_dict import (DataframeLogger, INTERNAL_TO_LOGGING_COLUMN_NAMES, MetricsDict,
                                       ScalarMetricsDict)
 from InnerEye.ML.scalar_config import ScalarLoss
-from InnerEye.ML.utils.image_util import binaries_from_multi_label_array, is_binary_array
-from InnerEye.ML.utils.io_util import reverse_tuple_float3
+from InnerEye.ML.utils.image_util import is_binary_array
 from InnerEye.ML.utils.metrics_util import (binary_classification_accuracy, is_missing_ground_truth,
                                             mean_absolute_error, r2_score)
 from InnerEye.ML.utils.ml_util import check_size_matches
 from InnerEye.ML.utils.sequence_utils import get_masked_model_outputs_and_labels
+from InnerEye.ML.utils.surface_metrics import NAN_METRICS, compute_segmentation_metrics_per_class
 
 
 @dataclass(frozen=True)
@@ -75,58 +73,6 @@ class InferenceMetricsForSegmentation(InferenceMetrics):
         })
 
 
-def surface_distance(seg: sitk.Image, reference_segmentation: sitk.Image) -> float:
-    """
-    Symmetric surface distances taking into account the image spacing
-    https://github.com/InsightSoftwareConsortium/SimpleITK-Notebooks/blob/master/Python/34_Segmentation_Evaluation.ipynb
-    :param seg: mask 1
-    :param reference_segmentation: mask 2
-    :return: mean distance
-    """
-    statistics_image_filter = sitk.StatisticsImageFilter()
-    # Get the number of pixels in the reference surface by counting all pixels that are 1.
-    reference_surface = sitk.LabelContour(reference_segmentation)
-    statistics_image_filter.Execute(reference_surface)
-    num_reference_surface_pixels = int(statistics_image_filter.GetSum())
-
-    reference_distance_map = sitk.Abs(
-        sitk.SignedMaurerDistanceMap(reference_segmentation, squaredDistance=False, useImageSpacing=True))
-    reference_surface = sitk.LabelContour(reference_segmentation)
-
-    # Symmetric surface distance measures
-    segmented_distance_map = sitk.Abs(sitk.SignedMaurerDistanceMap(seg, squaredDistance=False, useImageSpacing=True))
-    segmented_surface = sitk.LabelContour(seg)
-
-    # Multiply the binary surface segmentations with the distance maps. The resulting distance
-    # maps contain non-zero values only on the surface (they can also contain zero on the surface)
-    seg2ref_distance_map = reference_distance_map * sitk.Cast(segmented_surface, sitk.sitkFloat32)
-    ref2seg_distance_map = segmented_distance_map * sitk.Cast(reference_surface, sitk.sitkFloat32)
-
-    # Get the number of pixels in the reference surface by counting all pixels that are 1.
-    statistics_image_filter.Execute(segmented_surface)
-    num_segmented_surface_pixels = int(statistics_image_filter.GetSum())
-
-    seg2ref_distance_map_arr = sitk.GetArrayViewFromImage(seg2ref_distance_map)
-    seg2ref_distances = _add_zero_distances(num_segmented_surface_pixels, seg2ref_distance_map_arr)
-    ref2seg_distance_map_arr = sitk.GetArrayViewFromImage(ref2seg_distance_map)
-    ref2seg_distances = _add_zero_distances(num_reference_surface_pixels, ref2seg_distance_map_arr)
-
-    all_surface_distances = seg2ref_distances + ref2seg_distances
-    return np.mean(all_surface_distances).item()
-
-
-def _add_zero_distances(num_segmented_surface_pixels: int, seg2ref_distance_map_arr: np.ndarray) -> List[float]:
-    """
-    # Get all non-zero distances and then add zero distances if required.
-    :param num_segmented_surface_pixels:
-    :param seg2ref_distance_map_arr:
-    :return: list of distances, augmented with zeros.
-    """
-    seg2ref_distances = list(seg2ref_distance_map_arr[seg2ref_distance_map_arr != 0])
-    seg2ref_distances = seg2ref_distances + list(np.zeros(num_segmented_surface_pixels - len(seg2ref_distances)))
-    return seg2ref_distances
-
-
 def calculate_metrics_per_class(segmentation: np.ndarray,
                                 ground_truth: np.ndarray,
                                 ground_truth_ids: List[str],
@@ -147,7 +93,7 @@ def calculate_metrics_per_class(segmentation: np.ndarray,
     if len(ground_truth_ids) != (number_of_classes - 1):
         raise ValueError(f"Received {len(ground_truth_ids)} foreground class names, but "
                          f"the label tensor indicates that there are {number_of_classes - 1} classes.")
-    binaries = binaries_from_multi_label_array(segmentation, number_of_classes)
+    check_size_matches(segmentation, ground_truth[0], arg1_name="prediction", arg2_name="ground_truth")
 
     binary_classes = [is_binary_array(ground_truth[label_id]) for label_id in range(ground_truth.shape[0])]
 
@@ -160,55 +106,24 @@ def calculate_metrics_per_class(segmentation: np.ndarray,
     #  Validates that all binary images should be 0 or 1
     if not np.all(np.array(binary_classes)[~np.array(nan_images)]):
         raise ValueError("Ground truth values should be 0 or 1")
-    overlap_measures_filter = sitk.LabelOverlapMeasuresImageFilter()
-    hausdorff_distance_filter = sitk.HausdorffDistanceImageFilter()
+    # Dice is NaN if both ground truth and prediction are all zeros. Distances are infinite if only one of them is
+    # all zeros.
+    metrics_per_class = compute_segmentation_metrics_per_class(
+        segmentation,
+        ground_truth,
+        class_indices=[i for i in range(1, number_of_classes) if not nan_images[i]],
+        voxel_spacing=voxel_spacing,
+        patient_id=patient_id)
     metrics = MetricsDict(hues=ground_truth_ids)
-
-    def add_metric(metric_type: MetricType, value: float) -> None:
-        metrics.add_metric(metric_type, value, skip_nan_when_averaging=True, hue=ground_truth_ids[i - 1])
-
-    for i, prediction in enumerate(binaries):
-        # Skip if background image
-        if i == 0:
-            continue
-        # Skip but record if nan_image
-        elif nan_images[i]:
-            add_metric(MetricType.DICE, np.nan)
-            add_metric(MetricType.HAUSDORFF_mm, np.nan)
-            add_metric(MetricType.MEAN_SURFACE_DIST_mm, np.nan)
-            continue
-        check_size_matches(prediction, ground_truth[i], arg1_name="prediction", arg2_name="ground_truth")
-        if not is_binary_array(prediction):
-            raise ValueError("Predictions values should be 0 or 1")
-        # simpleitk returns a Dice score of 0 if both ground truth and prediction are all zeros.
-        # We want to be able to fish out those cases, and treat them specially later.
-        prediction_zero = np.all(prediction == 0)
-        gt_zero = np.all(ground_truth[i] == 0)
-        dice = mean_surface_distance = hausdorff_distance = math.nan
-        if not (prediction_zero and gt_zero):
-            prediction_image = sitk.GetImageFromArray(prediction.astype(np.uint8))
-            prediction_image.SetSpacing(sitk.VectorDouble(reverse_tuple_float3(voxel_spacing)))
-            ground_truth_image = sitk.GetImageFromArray(ground_truth[i].astype(np.uint8))
-            ground_truth_image.SetSpacing(sitk.VectorDouble(reverse_tuple_float3(voxel_spacing)))
-            overlap_measures_filter.Execute(prediction_image, ground_truth_image)
-            dice = overlap_measures_filter.GetDiceCoefficient()
-            if prediction_zero or gt_zero:
-                hausdorff_distance = mean_surface_distance = math.inf
-            else:
-                try:
-                    hausdorff_distance_filter.Execute(prediction_image, ground_truth_image)
-                    hausdorff_distance = hausdorff_distance_filter.GetHausdorffDistance()
-                except Exception as e:
-                    logging.warning("Cannot calculate Hausdorff distance for "
-                                    f"structure {i} of patient {patient_id}: {e}")
-                try:
-                    mean_surface_distance = surface_distance(prediction_image, ground_truth_image)
-                except Exception as e:
-                    logging.warning(f"Cannot calculate mean distance for structure {i} of patient {patient_id}: {e}")
-            logging.debug(f"Patient {patient_id}, class {i} has Dice score {dice}")
-        add_metric(MetricType.DICE, dice)
-        add_metric(MetricType.HAUSDORFF_mm, hausdorff_distance)
-        add_metric(MetricType.MEAN_SURFACE_DIST_mm, mean_surface_distance)
+    for i in range(1, number_of_classes):
+        # Record NaN for classes with missing ground truth
+        class_metrics = metrics_per_class.get(i, NAN_METRICS)
+        logging.debug(f"Patient {patient_id}, class {i} has Dice score {class_metrics.dice}")
+        for metric_type, value in [(MetricType.DICE, class_metrics.dice),
+                                   (MetricType.HAUSDORFF_mm, class_metrics.hausdorff_distance_mm),
+                                   (MetricType.HAUSDORFF_95_mm, class_metrics.hausdorff_distance_95_mm),
+                                   (MetricType.MEAN_SURFACE_DIST_mm, class_metrics.mean_surface_distance_mm)]:
+            metrics.add_metric(metric_type, value, skip_nan_when_averaging=True, hue=ground_truth_ids[i - 1])
     return metrics
 
 
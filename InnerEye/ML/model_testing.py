@@ -5,10 +5,15 @@
 import copy
 import logging
 import os
-from functools import partial
-from multiprocessing import Pool, cpu_count
+import tempfile
+import uuid
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import ExitStack
+from multiprocessing import Pool
+from multiprocessing.pool import AsyncResult
 from pathlib import Path
-from typing import List, Optional, Tuple, Union
+from typing import Any, Callable, Deque, Dict, Iterator, List, Optional, Tuple, TypeVar, Union
 
 import matplotlib.pyplot as plt
 import numpy as np
@@ -42,6 +47,18 @@ from InnerEye.ML.utils.metrics_util import MetricsPerPatientWriter
 BOXPLOT_FILE = "metrics_boxplot.png"
 THUMBNAILS_FOLDER = "thumbnails"
 MODEL_OUTPUT_CSV = "model_outputs.csv"
+# The variance of values in [0, 1] is in this range.
+POSTERIOR_VARIANCE_RANGE = (0.0, 0.25)
+
+# A folder on a RAM disk, used to hand over arrays to worker processes.
+SHARED_MEMORY_FOLDER = "/dev/shm"
+# The maximum number of inference results that are held in memory while waiting for evaluation. Each result holds
+# the posteriors of a whole image, hence this does not grow with the number of CPUs.
+MAX_PENDING_EVALUATIONS = 2
+# The number of samples that are loaded ahead of the sample that the model runs on. Each holds a whole image.
+PREFETCH_SAMPLES = 1
+
+T = TypeVar('T')
 
 
 def model_test(config: ModelConfigBase,
@@ -155,30 +172,46 @@ def segmentation_model_test_epoch(config: SegmentationModelBase,
     # for mypy
     assert isinstance(inference_pipeline, FullImageInferencePipelineBase)
 
-    # Deploy the trained model on a set of images and store output arrays.
-    for sample_index, sample in enumerate(ds, 1):
-        logging.info(f"Predicting for image {sample_index} of {len(ds)}...")
-        sample = Sample.from_dict(sample=sample)
-        inference_result = inference_pipeline.predict_and_post_process_whole_image(
-            image_channels=sample.image,
-            mask=sample.mask,
-            patient_id=sample.patient_id,
-            voxel_spacing_mm=sample.metadata.image_header.spacing
-        )
-        store_inference_results(inference_result=inference_result,
-                                config=config,
-                                results_folder=results_folder,
-                                image_header=sample.metadata.image_header)
-
-    # Evaluate model generated segmentation maps.
-    num_workers = min(cpu_count(), len(ds))
-    with Pool(processes=num_workers) as pool:
-        pool_outputs = pool.map(
-            partial(evaluate_model_predictions,
-                    config=config,
-                    dataset=ds,
-                    results_folder=results_folder),
-            range(len(ds)))
+    # Deploy the trained model on a set of images. Loading of the next samples, inference on the current sample,
+    # and writing and evaluating the results of previous samples run concurrently.
+    # At most MAX_PENDING_EVALUATIONS + 1 evaluations are in flight, hence more worker processes would only idle.
+    num_workers = max(1, min(MAX_PENDING_EVALUATIONS + 1, len(ds)))
+    pending_evaluations: Deque[AsyncResult] = deque()
+    pool_outputs: List[Tuple[PatientMetadata, MetricsDict]] = []
+    with Pool(processes=num_workers) as pool, ExitStack() as exit_stack:
+        handoff_folder: Optional[Path] = None
+        if config.evaluation_shared_memory:
+            handoff_folder = Path(exit_stack.enter_context(
+                tempfile.TemporaryDirectory(dir=get_shared_memory_folder())))
+        samples = iterate_with_prefetch(lambda index: Sample.from_dict(sample=ds[index]),
+                                        num_items=len(ds),
+                                        num_workers=PREFETCH_SAMPLES)
+        for sample_index, sample in enumerate(samples):
+            logging.info(f"Predicting for image {sample_index + 1} of {len(ds)}...")
+            inference_result = inference_pipeline.predict_and_post_process_whole_image(
+                image_channels=sample.image,
+                mask=sample.mask,
+                patient_id=sample.patient_id,
+                voxel_spacing_mm=sample.metadata.image_header.spacing
+            )
+            # The segmentation and the sample are passed on in memory, such that the evaluation neither needs to
+            # read back the segmentation from disk, nor load the sample again.
+            result_to_evaluate: Union[InferencePipeline.Result, SharedMemoryHandoff] = inference_result
+            sample_to_evaluate: Union[Sample, SharedMemoryHandoff] = sample
+            if handoff_folder is not None:
+                result_to_evaluate = SharedMemoryHandoff(inference_result, handoff_folder)
+                sample_to_evaluate = SharedMemoryHandoff(sample, handoff_folder)
+            pending_evaluations.append(pool.apply_async(
+                store_and_evaluate_inference_results,
+                (sample_index,),
+                dict(inference_result=result_to_evaluate,
+                     sample=sample_to_evaluate,
+                     config=config,
+                     results_folder=results_folder)))
+            # Limit the number of inference results that are held in memory waiting for evaluation.
+            while len(pending_evaluations) > MAX_PENDING_EVALUATIONS:
+                pool_outputs.append(pending_evaluations.popleft().get())
+        pool_outputs.extend(evaluation.get() for evaluation in pending_evaluations)
 
     metrics_writer, average_dice = populate_metrics_writer(pool_outputs, config)
     metrics_writer.to_csv(results_folder / SUBJECT_METRICS_FILE_NAME)
@@ -197,25 +230,135 @@ def segmentation_model_test_epoch(config: SegmentationModelBase,
     return average_dice
 
 
+def iterate_with_prefetch(load_item: Callable[[int], T],
+                          num_items: int,
+                          num_workers: int) -> Iterator[T]:
+    """
+    Loads items in background threads, and returns them in order. While the caller processes an item, the next
+    items are already being loaded.
+    :param load_item: The function that loads the item at a given index.
+    :param num_items: The number of items to load, with indices 0 to num_items - 1.
+    :param num_workers: The number of items that are loaded concurrently in background threads.
+    :return: An iterator over the loaded items.
+    """
+    with ThreadPoolExecutor(max_workers=num_workers) as executor:
+        pending: Deque[Future] = deque()
+        for index in range(num_items):
+            pending.append(executor.submit(load_item, index))
+            if len(pending) > num_workers:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+def get_shared_memory_folder() -> Optional[str]:
+    """
+    Gets the folder on a RAM disk that is used to hand over arrays to worker processes, or None if there is
+    no RAM disk, in which case the default temporary folder is used.
+    """
+    return SHARED_MEMORY_FOLDER if os.path.isdir(SHARED_MEMORY_FOLDER) else None
+
+
+class SharedMemoryHandoff:
+    """
+    Hands over an object to a worker process, where the numpy arrays in the attributes of the object are written to
+    files in a folder on a RAM disk, rather than being pickled through a pipe together with the object.
+    """
+
+    def __init__(self, obj: Any, folder: Path):
+        """
+        :param obj: The object to hand over. The object itself is not modified.
+        :param folder: The folder in which the arrays are stored.
+        """
+        self.obj = copy.copy(obj)
+        self.array_files: Dict[str, Path] = {}
+        file_prefix = uuid.uuid4().hex
+        for name, value in vars(obj).items():
+            if isinstance(value, np.ndarray):
+                file_path = folder / f"{file_prefix}_{name}.npy"
+                np.save(file_path, value)
+                self.array_files[name] = file_path
+                vars(self.obj)[name] = None
+
+    def receive(self) -> Any:
+        """
+        Re-creates the object in the receiving process, with the arrays memory mapped read-only from their files,
+        such that they are not copied. The array files are deleted. On POSIX systems, the mapped data remains valid
+        until the arrays are released. Where a mapped file can't be deleted, it is removed together with the
+        handoff folder.
+        """
+        for name, file_path in self.array_files.items():
+            vars(self.obj)[name] = np.load(file_path, mmap_mode='r')
+            try:
+                file_path.unlink()
+            except OSError:
+                pass
+        return self.obj
+
+
+def store_and_evaluate_inference_results(process_id: int,
+                                         inference_result: Union[InferencePipeline.Result, SharedMemoryHandoff],
+                                         sample: Union[Sample, SharedMemoryHandoff],
+                                         config: SegmentationModelBase,
+                                         results_folder: Path) -> Tuple[PatientMetadata, MetricsDict]:
+    """
+    Stores the inference results for a single image into Nifti files, and evaluates the segmentation against
+    the ground truth. The function is intended to be run in a worker process, while inference on the next
+    images is running. The segmentation and the ground truth are used as passed in, rather than read from disk.
+    :param process_id: The index of the image in the dataset.
+    :param inference_result: The inference result for the image, possibly handed over via shared memory.
+    :param sample: The sample that the inference was run on, possibly handed over via shared memory.
+    :param config: Segmentation model config object
+    :param results_folder: Path to results folder
+    :returns: Patient metadata and the computed metrics for the image.
+    """
+    if isinstance(inference_result, SharedMemoryHandoff):
+        inference_result = inference_result.receive()
+    if isinstance(sample, SharedMemoryHandoff):
+        sample = sample.receive()
+    assert isinstance(inference_result, InferencePipeline.Result)
+    assert isinstance(sample, Sample)
+    store_inference_results(inference_result=inference_result,
+                            config=config,
+                            results_folder=results_folder,
+                            image_header=sample.metadata.image_header)
+    return evaluate_model_predictions(process_id,
+                                      config=config,
+                                      dataset=None,
+                                      results_folder=results_folder,
+                                      segmentation=inference_result.segmentation,
+                                      sample=sample)
+
+
 def evaluate_model_predictions(process_id: int,
                                config: SegmentationModelBase,
-                               dataset: FullImageDataset,
-                               results_folder: Path) -> Tuple[PatientMetadata, MetricsDict]:
+                               dataset: Optional[FullImageDataset],
+                               results_folder: Path,
+                               segmentation: Optional[np.ndarray] = None,
+                               sample: Optional[Sample] = None) -> Tuple[PatientMetadata, MetricsDict]:
     """
     Evaluates model segmentation predictions, dice scores and surface distances are computed.
     Generated contours are plotted and saved in results folder.
     The function is intended to be used in parallel for loop to process each image in parallel.
     :param process_id: Identifier for the process calling the function
     :param config: Segmentation model config object
-    :param dataset: Dataset object, it is used to load intensity image, labels, and patient metadata.
+    :param dataset: Dataset object, it is used to load intensity image, labels, and patient metadata. Only used
+    if no sample is given.
     :param results_folder: Path to results folder
+    :param segmentation: The predicted segmentation. If not given, it is read from the results folder.
+    :param sample: The sample with intensity image, labels and patient metadata. If not given, it is loaded from
+    the dataset.
     :returns [PatientMetadata, list[list]]: Patient metadata and list of computed metrics for each image.
     """
-    sample = dataset.get_samples_at_index(index=process_id)[0]
+    if sample is None:
+        if dataset is None:
+            raise ValueError("Either a dataset or a sample must be given.")
+        sample = dataset.get_samples_at_index(index=process_id)[0]
     logging.info(f"Evaluating predictions for patient {sample.patient_id}")
 
-    patient_results_folder = get_patient_results_folder(results_folder, sample.patient_id)
-    segmentation = load_nifti_image(patient_results_folder / DEFAULT_RESULT_IMAGE_NAME).image
+    if segmentation is None:
+        patient_results_folder = get_patient_results_folder(results_folder, sample.patient_id)
+        segmentation = load_nifti_image(patient_results_folder / DEFAULT_RESULT_IMAGE_NAME).image
     metrics_per_class = metrics.calculate_metrics_per_class(segmentation,
                                                             sample.labels,
                                                             ground_truth_ids=config.ground_truth_ids,
@@ -251,12 +394,14 @@ def populate_metrics_writer(
         for structure_name in config.ground_truth_ids:
             dice_for_struct = metrics_for_patient.get_single_metric(MetricType.DICE, hue=structure_name)
             hd_for_struct = metrics_for_patient.get_single_metric(MetricType.HAUSDORFF_mm, hue=structure_name)
+            hd95_for_struct = metrics_for_patient.get_single_metric(MetricType.HAUSDORFF_95_mm, hue=structure_name)
             md_for_struct = metrics_for_patient.get_single_metric(MetricType.MEAN_SURFACE_DIST_mm, hue=structure_name)
             metrics_writer.add(patient=str(patient_metadata.patient_id),
                                structure=structure_name,
                                dice=dice_for_struct,
                                hausdorff_distance_mm=hd_for_struct,
-                               mean_distance_mm=md_for_struct)
+                               mean_distance_mm=md_for_struct,
+                               hausdorff_distance_95_mm=hd95_for_struct)
     return metrics_writer, average_dice
 
 
@@ -331,6 +476,16 @@ def store_inference_results(inference_result: InferencePipeline.Result,
         header=image_header,
         file_name=str(create_file_path(patient_results_folder, "uncertainty")))
     image_paths.append(image_path)
+
+    # store the variance of the posteriors across the models of an ensemble, which is at most 0.25
+    if inference_result.posterior_variance is not None:
+        for class_name, index in class_names_and_indices:
+            image_path = io_util.store_as_scaled_ubyte_nifti(
+                image=inference_result.posterior_variance[index, ...],
+                header=image_header,
+                file_name=str(create_file_path(patient_results_folder, f"posterior_variance_{class_name}")),
+                input_range=POSTERIOR_VARIANCE_RANGE)
+            image_paths.append(image_path)
     return image_paths
 
 
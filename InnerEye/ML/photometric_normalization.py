@@ -2,8 +2,13 @@
 #  Copyright (c) Microsoft Corporation. All rights reserved.
 #  Licensed under the MIT License (MIT). See LICENSE in the repo root for license information.
 #  ------------------------------------------------------------------------------------------
+import hashlib
+import json
 import logging
-from typing import Any, List, Optional, Tuple, Union
+import os
+from collections import OrderedDict
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple, Union
 
 import matplotlib.pyplot as plt
 import numpy as np
@@ -14,7 +19,7 @@ from InnerEye.ML.config import PhotometricNormalizationMethod, SegmentationModel
 from InnerEye.ML.dataset.sample import Sample
 from InnerEye.ML.dataset.scalar_sample import ScalarItem
 from InnerEye.ML.utils.image_util import check_array_range
-from InnerEye.ML.utils.transforms import CTRange, LinearTransform, Transform3D
+from InnerEye.ML.utils.transforms import CTRange, Transform3D, get_range_for_window_level
 
 
 class WindowNormalizationForScalarItem(Transform3D[ScalarItem]):
@@ -47,9 +52,69 @@ class WindowNormalizationForScalarItem(Transform3D[ScalarItem]):
         )
 
 
+# The normalization methods for which the image statistics are cached. The statistics of SimpleNorm are only the mean
+# and standard deviation, which are cheap to compute.
+CACHED_STATISTICS_METHODS = [PhotometricNormalizationMethod.MriWindow, PhotometricNormalizationMethod.TrimmedNorm]
+# The maximum number of subjects for which statistics are kept in memory, in addition to the files.
+MAX_STATISTICS_IN_MEMORY = 1000
+
+
+class NormalizationStatisticsCache:
+    """
+    Stores the per-channel image statistics that photometric normalization computes for a subject, as one small
+    JSON file per subject in a folder. The statistics that have been read or written most recently are also kept in
+    memory.
+    """
+
+    def __init__(self, folder: Path, max_entries_in_memory: int = MAX_STATISTICS_IN_MEMORY) -> None:
+        self.folder = folder
+        self.max_entries_in_memory = max_entries_in_memory
+        self.statistics: Dict[str, List[List[float]]] = OrderedDict()
+
+    def get_file(self, key: str) -> Path:
+        return self.folder / f"{key}.json"
+
+    def get(self, key: str) -> Optional[List[List[float]]]:
+        """
+        Gets the statistics that were stored with the given key, or None if there are none.
+        """
+        statistics = self.statistics.get(key)
+        if statistics is not None:
+            self.statistics.move_to_end(key)  # type: ignore
+            return statistics
+        file = self.get_file(key)
+        if not file.is_file():
+            return None
+        statistics = json.loads(file.read_text())
+        self.keep_in_memory(key, statistics)
+        return statistics
+
+    def keep_in_memory(self, key: str, statistics: List[List[float]]) -> None:
+        """
+        Keeps the statistics in memory, and evicts the least recently used statistics if there are too many.
+        """
+        self.statistics[key] = statistics
+        self.statistics.move_to_end(key)  # type: ignore
+        while len(self.statistics) > self.max_entries_in_memory:
+            self.statistics.popitem(last=False)  # type: ignore
+
+    def put(self, key: str, statistics: List[List[float]]) -> None:
+        """
+        Stores the statistics with the given key. The file is written under a temporary name first and then renamed,
+        such that other data loader processes never read incomplete files.
+        """
+        self.keep_in_memory(key, statistics)
+        self.folder.mkdir(parents=True, exist_ok=True)
+        file = self.get_file(key)
+        temp_file = file.parent / (file.name + f".{os.getpid()}.tmp")
+        temp_file.write_text(json.dumps(statistics))
+        temp_file.replace(file)
+
+
 class PhotometricNormalization(Transform3D[Sample]):
     def __init__(self, config_args: SegmentationModelBase = None, **params: Any):
         super().__init__(**params)
+        self.statistics_cache: Optional[NormalizationStatisticsCache] = None
         if config_args is None:
             self.norm_method = PhotometricNormalizationMethod.Unchanged
             return
@@ -64,30 +129,82 @@ class PhotometricNormalization(Transform3D[Sample]):
             self.sharpen = config_args.sharpen
             self.trim_percentiles = config_args.trim_percentiles
             self.status_of_most_recent_call: Optional[str] = None
+            if config_args.normalization_statistics_folder is not None \
+                    and self.norm_method in CACHED_STATISTICS_METHODS:
+                self.statistics_cache = NormalizationStatisticsCache(config_args.normalization_statistics_folder)
 
     def __call__(self, sample: Sample) -> Sample:
         return sample.clone_with_overrides(
             image=self.transform(
                 image=sample.image,
                 mask=sample.mask,
-                patient_id=sample.patient_id
+                patient_id=sample.patient_id,
+                statistics_key=None if self.statistics_cache is None else self.get_statistics_key(sample)
             )
         )
 
+    def get_statistics_key(self, sample: Sample) -> Optional[str]:
+        """
+        Gets the key under which the normalization statistics of the sample are cached: The subject ID, and a hash
+        of the files that the sample was loaded from and of the normalization settings that the statistics depend on.
+        :return: The key, or None if the sample was not loaded from files, in which case statistics are not cached.
+        """
+        source_files_key = sample.metadata.source_files_key
+        if source_files_key is None:
+            return None
+        settings = [source_files_key, self.norm_method.value]
+        if self.norm_method == PhotometricNormalizationMethod.TrimmedNorm:
+            settings.append(str(tuple(self.trim_percentiles)))
+        return f"{sample.metadata.patient_id}_{hashlib.sha256(str(settings).encode()).hexdigest()[:32]}"
+
+    def compute_statistics(self, image: np.ndarray, mask: np.ndarray) -> Optional[List[List[float]]]:
+        """
+        Computes the per-channel image statistics that the normalization method uses, or returns None if the method
+        does not depend on the image.
+        """
+        if self.norm_method == PhotometricNormalizationMethod.SimpleNorm:
+            return simple_norm_statistics(image, mask)
+        if self.norm_method == PhotometricNormalizationMethod.MriWindow:
+            return mri_window_statistics(image)
+        if self.norm_method == PhotometricNormalizationMethod.TrimmedNorm:
+            return normalize_trim_statistics(image, mask, self.trim_percentiles)
+        return None
+
     def transform(self, image: Union[np.ndarray, torch.Tensor],
                   mask: Optional[Union[np.ndarray, torch.Tensor]] = None,
-                  patient_id: Optional[int] = None) -> Union[np.ndarray, torch.Tensor]:
+                  patient_id: Optional[int] = None,
+                  out: Optional[np.ndarray] = None,
+                  statistics_key: Optional[str] = None) -> Union[np.ndarray, torch.Tensor]:
+        """
+        Normalizes the image with the method that is set in the model config.
+        :param image: The image to normalize, size Channels x Z x Y x X.
+        :param mask: Consider only pixel values of the input image for which the mask is non-zero. Size Z x Y x X.
+        :param patient_id: The patient ID, used for logging.
+        :param out: The buffer to write the result to, if the image is a Numpy array. This can be the input image.
+                    If None, a new array is created.
+        :param statistics_key: If given, and the model config sets a normalization_statistics_folder, the image
+                               statistics are read from the cache under this key, or computed and written to it.
+        :return: The normalized image.
+        """
         if mask is None:
             if torch.is_tensor(image):
                 mask = torch.ones_like(image)
             else:
                 mask = np.ones_like(image)
 
+        statistics = None
+        if statistics_key is not None and self.statistics_cache is not None:
+            statistics = self.statistics_cache.get(statistics_key)
+            if statistics is None:
+                statistics = self.compute_statistics(image, mask)
+                if statistics is not None:
+                    self.statistics_cache.put(statistics_key, statistics)
+
         self.status_of_most_recent_call = None
         if self.norm_method == PhotometricNormalizationMethod.Unchanged:
             image_out = image
         elif self.norm_method == PhotometricNormalizationMethod.SimpleNorm:
-            image_out = simple_norm(image, mask, self.debug_mode)
+            image_out = simple_norm(image, mask, self.debug_mode, out=out, statistics=statistics)
         elif self.norm_method == PhotometricNormalizationMethod.MriWindow:
             if self.sharpen is None:
                 raise ValueError("The 'sharpen' parameter must be provided.")
@@ -96,7 +213,7 @@ class PhotometricNormalization(Transform3D[Sample]):
                     "The 'tail' parameter must be provided and set to a float value or a list of float values.")
             image_out, status = mri_window(
                 image, mask,
-                self.output_range, self.sharpen, self.tail, self.debug_mode
+                self.output_range, self.sharpen, self.tail, self.debug_mode, out=out, statistics=statistics
             )
             self.status_of_most_recent_call = status
         elif self.norm_method == PhotometricNormalizationMethod.CtWindow:
@@ -104,12 +221,16 @@ class PhotometricNormalization(Transform3D[Sample]):
                 raise ValueError("The 'level' parameter must be provided.")
             if self.window is None:
                 raise ValueError("The 'window' parameter must be provided.")
-            image_out = CTRange.transform(data=image, output_range=self.output_range,
-                                          level=self.level, window=self.window, use_gpu=self.use_gpu)
+            if torch.is_tensor(image):
+                image_out = CTRange.transform(data=image, output_range=self.output_range,
+                                              level=self.level, window=self.window, use_gpu=self.use_gpu)
+            else:
+                image_out = linear_transform_into(image, get_range_for_window_level(self.level, self.window),
+                                                  self.output_range, out=get_output_buffer(image, out))
         elif self.norm_method == PhotometricNormalizationMethod.TrimmedNorm:
             image_out, status = normalize_trim(image, mask,
                                                self.output_range, self.sharpen, self.trim_percentiles,
-                                               self.debug_mode)
+                                               self.debug_mode, out=out, statistics=statistics)
             self.status_of_most_recent_call = status
         else:
             raise ValueError("Unknown normalization method {}".format(self.norm_method))
@@ -120,47 +241,236 @@ class PhotometricNormalization(Transform3D[Sample]):
         return image_out
 
 
-def simple_norm(image_in: np.ndarray, mask: np.ndarray, debug_mode: bool = False) -> np.array:
+# Images are processed in chunks of this many voxels when building histograms, to bound temporary memory.
+HISTOGRAM_CHUNK_SIZE = 2 ** 22
+# Histograms are only used for integer valued images with at most this many distinct values between min and max.
+MAX_HISTOGRAM_BINS = 2 ** 20
+# Quartile 1 is at -0.67 of the standard normal (Excel NORMSINV(0.25))
+# Quartile 3 is at 0.67 of the standard normal (Excel NORMSINV(0.75))
+# Inter quartile range hence spans 2 * 0.67 standard deviations
+INTER_QUARTILE_RANGE_IN_STD = 2 * 0.67448975
+
+
+class OrderStatistics:
+    """
+    Answers queries for the values at given positions in the sorted order of the voxels of an image, without sorting
+    them. For integer valued images with a limited value range, like CT and most MR images, a histogram is built in
+    a single pass over the image. Otherwise, the voxel values are copied once, and partitioned around all positions
+    that are queried at once.
+    """
+
+    def __init__(self, image: np.ndarray, mask: Optional[np.ndarray] = None) -> None:
+        """
+        :param image: The image, of any shape.
+        :param mask: A boolean mask of the same shape as the image. If given, only voxels where the mask is True are
+                     considered.
+        """
+        flat = image.ravel()
+        flat_mask = None if mask is None else mask.ravel()
+        self.min_value = 0
+        self.cumulative_counts: Optional[np.ndarray] = self._create_cumulative_histogram(flat, flat_mask)
+        self.values: Optional[np.ndarray] = None
+        if self.cumulative_counts is not None:
+            self.count = int(self.cumulative_counts[-1])
+        else:
+            self.values = flat[flat_mask] if flat_mask is not None else flat.copy()
+            self.count = len(self.values)
+
+    def _create_cumulative_histogram(self, flat: np.ndarray, flat_mask: Optional[np.ndarray]) -> Optional[np.ndarray]:
+        """
+        Creates the cumulative histogram of the voxel values, with one bin per integer from the minimum to the maximum
+        of the image. Returns None if the image is not integer valued or has too large a value range.
+        """
+        if flat.size == 0:
+            return None
+        min_value, max_value = flat.min(), flat.max()
+        if not (np.isfinite(min_value) and np.isfinite(max_value)) or max_value - min_value >= MAX_HISTOGRAM_BINS:
+            return None
+        self.min_value = int(min_value)
+        num_bins = int(max_value) - self.min_value + 1
+        counts = np.zeros(num_bins, dtype=np.int64)
+        for start in range(0, flat.size, HISTOGRAM_CHUNK_SIZE):
+            chunk = flat[start:start + HISTOGRAM_CHUNK_SIZE]
+            if flat_mask is not None:
+                chunk = chunk[flat_mask[start:start + HISTOGRAM_CHUNK_SIZE]]
+            bins = chunk.astype(np.int64)
+            if not np.issubdtype(chunk.dtype, np.integer) and not np.array_equal(bins, chunk):
+                return None
+            bins -= self.min_value
+            counts += np.bincount(bins, minlength=num_bins)
+        return np.cumsum(counts)
+
+    def get_values(self, positions: np.ndarray) -> np.ndarray:
+        """
+        Gets the values at the given positions in the sorted order of the voxels.
+        """
+        positions = np.asarray(positions, dtype=np.int64)
+        if self.cumulative_counts is not None:
+            return self.min_value + np.searchsorted(self.cumulative_counts, positions, side="right")
+        assert self.values is not None
+        self.values.partition(np.unique(positions))
+        return self.values[positions]
+
+    def count_less_or_equal(self, value: float) -> int:
+        """
+        Gets the number of voxels with values that are less than or equal to the given value.
+        """
+        if self.cumulative_counts is not None:
+            index = int(np.floor(value)) - self.min_value
+            if index < 0:
+                return 0
+            return int(self.cumulative_counts[min(index, len(self.cumulative_counts) - 1)])
+        return int(np.count_nonzero(self.values <= value))
+
+    def count_less(self, value: float) -> int:
+        """
+        Gets the number of voxels with values that are strictly less than the given value.
+        """
+        if self.cumulative_counts is not None:
+            return self.count_less_or_equal(np.ceil(value) - 1)
+        return int(np.count_nonzero(self.values < value))
+
+    def get_percentiles(self, percentiles: Any, start: int = 0, stop: Optional[int] = None) -> np.ndarray:
+        """
+        Computes percentiles like np.percentile with interpolation='midpoint', for the voxels at positions start to
+        stop (exclusive) in the sorted order.
+        :param percentiles: The percentiles to compute, in the range 0 to 100.
+        :param start: The first position in the sorted order to consider.
+        :param stop: The position after the last position to consider. If None, use all voxels after start.
+        """
+        stop = self.count if stop is None else stop
+        if stop <= start:
+            raise ValueError("Can't compute percentiles of an empty set of voxels.")
+        indices = np.asarray(percentiles, dtype=np.float64) / 100 * (stop - start - 1)
+        lower = start + np.floor(indices).astype(np.int64)
+        upper = start + np.ceil(indices).astype(np.int64)
+        values = self.get_values(np.concatenate([lower, upper])).astype(np.float64)
+        return (values[:len(lower)] + values[len(lower):]) / 2
+
+    def get_robust_mean_std(self, start: int = 0, stop: Optional[int] = None) -> Tuple[float, float, float, float]:
+        """
+        Computes the same statistics as robust_mean_std, for the voxels at positions start to stop (exclusive) in
+        the sorted order.
+        """
+        min_value, quart25, median, quart75, max_value = self.get_percentiles((0, 25, 50, 75, 100), start, stop)
+        return median, (quart75 - quart25) / INTER_QUARTILE_RANGE_IN_STD, min_value, max_value
+
+
+def linear_transform_into(data: np.ndarray,
+                          input_range: Tuple[float, float],
+                          output_range: Tuple[float, float],
+                          out: np.ndarray) -> np.ndarray:
+    """
+    Applies the same transformation as LinearTransform to a Numpy array, but writes the result into the given buffer
+    without creating temporary arrays. The computation is done in the data type of the buffer.
+    :param data: The data to transform.
+    :param input_range: The range of input values that is mapped linearly to the output range.
+    :param output_range: The output range. Results are clipped to this range.
+    :param out: The buffer to write the result to, with the same shape as the data. This can be the data itself.
+    :return: The buffer.
+    """
+    gradient = float((output_range[1] - output_range[0]) / (input_range[1] - input_range[0]))
+    offset = float(output_range[1] - gradient * input_range[1])
+    np.multiply(data, gradient, out=out, casting="unsafe")
+    out += out.dtype.type(offset)
+    np.clip(out, output_range[0], output_range[1], out=out)
+    return out
+
+
+def get_output_buffer(image: np.ndarray, out: Optional[np.ndarray]) -> np.ndarray:
+    """
+    Gets the buffer that a normalization function should write its result to: The buffer provided by the caller,
+    or a new array of the same shape as the image. New arrays are float32 for images that are not floating point.
+    """
+    if out is None:
+        return np.empty(image.shape, dtype=image.dtype if np.issubdtype(image.dtype, np.floating) else np.float32)
+    if out.shape != image.shape:
+        raise ValueError(f"The output buffer has shape {out.shape}, but the image has shape {image.shape}")
+    return out
+
+
+def simple_norm_statistics(image_in: np.ndarray, mask: np.ndarray) -> List[List[float]]:
+    """
+    Computes the statistics that simple_norm uses, for each channel of the image.
+    :return: A list with one entry per channel, containing mean and standard deviation inside the mask.
+    """
+    in_mask = mask == 1
+    statistics = []
+    for ichannel in range(image_in.shape[0]):
+        pixels_inside_mask = image_in[ichannel][in_mask]
+        statistics.append([float(np.mean(pixels_inside_mask)), float(np.std(pixels_inside_mask))])
+    return statistics
+
+
+def simple_norm(image_in: np.ndarray, mask: np.ndarray, debug_mode: bool = False,
+                out: Optional[np.ndarray] = None,
+                statistics: Optional[List[List[float]]] = None) -> np.array:
     """
     Normalizes a single image to have mean 0 and standard deviation 1
 
     :param image_in: image to normalize
     :param mask: image, has W x H x D
     :param debug_mode: whether to log means and SDs
+    :param out: The buffer to write the result to. If None, a new array is created. This can be the input image.
+    :param statistics: The result of simple_norm_statistics for the image and mask. If None, they are computed.
     :return: normalized image
     """
     if not np.issubdtype(image_in.dtype, np.floating):
         raise Exception("normalize::simple_norm: Input image is not a floating type")
 
-    image_shape = np.shape(image_in)
-    nchannel = image_shape[0]
-    iout = np.zeros(image_shape, dtype=image_in.dtype)
+    iout = get_output_buffer(image_in, out)
+    in_mask = mask == 1
+    if statistics is None:
+        statistics = simple_norm_statistics(image_in, mask)
 
-    for ichannel in range(nchannel):
-
-        i = image_in[ichannel, ...].flatten()
-        m = mask.flatten()
+    for ichannel in range(image_in.shape[0]):
+        mean_i, std_i = statistics[ichannel]
         if debug_mode:
-            logging.info(" In norm before:  Standard Deviation, Mean ,{0: 4.1f}, {1: 4.1f}".format(np.std(i[m == 1]),
-                                                                                                   np.mean(i[m == 1])))
-        mean_i = np.mean(i[m == 1])
-        std_i = np.std(i[m == 1])
-        i = i - mean_i
-        i = i / std_i
-        iout[ichannel, ...] = i.reshape(image_shape[1:])
+            logging.info(" In norm before:  Standard Deviation, Mean ,{0: 4.1f}, {1: 4.1f}".format(std_i, mean_i))
+        channel_out = iout[ichannel]
+        np.subtract(image_in[ichannel], mean_i, out=channel_out)
+        channel_out /= std_i
         if debug_mode:
-            logging.info(" In norm after:  Standard Deviation, Mean ,{0: 4.1f}, {1: 4.1f}".format(np.std(i[m == 1]),
-                                                                                                  np.mean(i[m == 1])))
+            logging.info(" In norm after:  Standard Deviation, Mean ,{0: 4.1f}, {1: 4.1f}"
+                         .format(np.std(channel_out[in_mask]), np.mean(channel_out[in_mask])))
 
     return iout
 
 
+def normalize_trim_statistics(image: np.ndarray,
+                              mask: np.ndarray,
+                              trim_percentiles: Tuple[float, float] = (2.0, 98.0)) -> List[List[float]]:
+    """
+    Computes the statistics that normalize_trim uses, for each channel of the image.
+    :param image: The image, size Channels x Z x Y x X
+    :param mask: Consider only pixel values of the input image for which the mask is non-zero. Size Z x Y x X
+    :param trim_percentiles: Only consider voxel values between those two percentiles when computing mean and std.
+    :return: A list with one entry per channel, containing the lower and upper trim thresholds, and the median,
+    robust standard deviation, minimum and maximum of the voxel values between the thresholds.
+    """
+    in_mask = mask > 0.5
+    statistics = []
+    for ichannel in range(image.shape[0]):
+        order_statistics = OrderStatistics(image[ichannel, ...], in_mask)
+        # First remove all values that fall outside the trim_percentiles
+        lower_threshold, upper_threshold = order_statistics.get_percentiles(trim_percentiles)
+        # Compute robust statistics off the pixel values that are inside the trim values. Those are a contiguous
+        # range in the sorted order of the pixel values inside the mask.
+        robust_statistics = order_statistics.get_robust_mean_std(
+            start=order_statistics.count_less_or_equal(lower_threshold),
+            stop=order_statistics.count_less(upper_threshold))
+        statistics.append([float(value) for value in (lower_threshold, upper_threshold, *robust_statistics)])
+    return statistics
+
+
 def normalize_trim(image: np.ndarray,
                    mask: np.ndarray,
                    output_range: Tuple[float, float] = (-1.0, 1.0),
                    sharpen: float = 1.9,
                    trim_percentiles: Tuple[float, float] = (2.0, 98.0),
-                   debug_mode: bool = False) -> np.array:
+                   debug_mode: bool = False,
+                   out: Optional[np.ndarray] = None,
+                   statistics: Optional[List[List[float]]] = None) -> np.array:
     """
     Normalizes a single image to have mean 0 and standard deviation 1
     Normalising occurs after percentile thresholds have been applied to strip out extreme values
@@ -171,40 +481,29 @@ def normalize_trim(image: np.ndarray,
     :param sharpen: number of standard deviation either side of mean to include in the window.
     :param trim_percentiles: Only consider voxel values between those two percentiles when computing mean and std.
     :param debug_mode: If true, create a diagnostic plot (interactive)
+    :param out: The buffer to write the result to. If None, a new array is created. This can be the input image.
+    :param statistics: The result of normalize_trim_statistics for the image, mask and trim_percentiles. If None,
+    they are computed.
     :return: trimmed-normalized image
     """
 
-    image_shape = image.shape
-    imout = np.zeros_like(image)
+    imout = get_output_buffer(image, out)
     in_mask = mask > 0.5
+    if statistics is None:
+        statistics = normalize_trim_statistics(image, mask, trim_percentiles)
     status = ""
-    for ichannel in range(image_shape[0]):
+    for ichannel in range(image.shape[0]):
         if ichannel > 0:
             status += "Channel {}: ".format(ichannel)
         channel_image = image[ichannel, ...]
-        pixels_inside_mask = channel_image[in_mask].flatten().astype(float)
-        # First remove all values that fall outside the trim_percentiles
-        thresholds = np.percentile(pixels_inside_mask, trim_percentiles, interpolation='midpoint')
-        lower_threshold = thresholds[0]
-        upper_threshold = thresholds[1]
-        above_lower = pixels_inside_mask > lower_threshold
-        below_upper = pixels_inside_mask < upper_threshold
-        inside_thresholds = np.logical_and(above_lower, below_upper)
-        # Compute robust statistics off the pixel values that are inside the trim values
-        median, estimated_std, min_value, max_value = robust_mean_std(pixels_inside_mask[inside_thresholds])
+        lower_threshold, upper_threshold, median, estimated_std, min_value, max_value = statistics[ichannel]
         # Compute an input value range from median and robust std, going as many standard deviations
         # as specified by the sharpen parameter
         input_range = (max(median - estimated_std * sharpen, min_value),
                        min(median + estimated_std * sharpen, max_value))
-        # Use Polynomial transform function to convert data to output range. This also sets values outside
-        # the input_range to the boundary values.
-        channel_output = LinearTransform.transform(
-            data=channel_image,
-            input_range=input_range,
-            output_range=output_range
-        )
+        # Convert data to output range. This also sets values outside the input_range to the boundary values.
+        channel_output = linear_transform_into(channel_image, input_range, output_range, out=imout[ichannel])
         channel_output[np.logical_not(in_mask)] = output_range[0]
-        imout[ichannel, ...] = channel_output
         status += "Range ({0:0.0f}, {1:0.0f}) ".format(input_range[0], input_range[1])
         logging.info(status)
         if debug_mode:
@@ -245,20 +544,38 @@ def robust_mean_std(data: np.ndarray) -> Tuple[float, float, float, float]:
     median = quartiles[2]
     quart75 = quartiles[3]
     max_value = quartiles[4]
-    # Estimate standard deviation from inter quartile range:
-    # Quartile 1 is at -0.67 of the standard normal (Excel NORMSINV(0.25))
-    # Quartile 3 is at 0.67 of the standard normal (Excel NORMSINV(0.75))
-    # Inter quartile range hence spans 2 * 0.67 standard deviations
-    std = (quart75 - quart25) / (2 * 0.67448975)
+    # Estimate standard deviation from inter quartile range
+    std = (quart75 - quart25) / INTER_QUARTILE_RANGE_IN_STD
     return median, std, min_value, max_value
 
 
+def mri_window_statistics(image_in: np.ndarray) -> List[List[float]]:
+    """
+    Computes the statistics that mri_window uses, for each channel of the image.
+    :return: A list with one entry per channel, containing Otsu's threshold, and the median, robust standard
+    deviation and maximum of the voxel values above the threshold.
+    """
+    statistics = []
+    for ichannel in range(image_in.shape[0]):
+        channel_image = image_in[ichannel, ...]
+        # Find Otsu's threshold for the values of the input image
+        threshold = threshold_otsu(channel_image.ravel())
+        # Find window level from the values above the threshold, which are at the end of the sorted order
+        order_statistics = OrderStatistics(channel_image)
+        level, std_i, _, max_foreground = order_statistics.get_robust_mean_std(
+            start=order_statistics.count_less_or_equal(threshold))
+        statistics.append([float(value) for value in (threshold, level, std_i, max_foreground)])
+    return statistics
+
+
 def mri_window(image_in: np.ndarray,
                mask: Optional[np.ndarray],
                output_range: Tuple[float, float] = (-1.0, 1.0),
                sharpen: float = 1.9,
                tail: Union[List[float], float] = 1.0,
-               debug_mode: bool = False) -> Tuple[np.array, str]:
+               debug_mode: bool = False,
+               out: Optional[np.ndarray] = None,
+               statistics: Optional[List[List[float]]] = None) -> Tuple[np.array, str]:
     """
     This function takes an MRI Image,  removes to first peak of values (air). Then a window range is found centered
     around the mean of the remaining values and with a range controlled by the standard deviation and the sharpen
@@ -271,10 +588,14 @@ def mri_window(image_in: np.ndarray,
     :param sharpen: number of standard deviation either side of mean to include in the window
     :param tail: Default 1, allow window range to include more of tail of distribution.
     :param debug_mode: If true, create diagnostic plots.
+    :param out: The buffer to write the result to. If None, a new array is created. This can be the input image.
+    :param statistics: The result of mri_window_statistics for the image. If None, they are computed.
     :return: normalized image
     """
     nchannel = image_in.shape[0]
-    imout = np.zeros_like(image_in)
+    imout = get_output_buffer(image_in, out)
+    if statistics is None:
+        statistics = mri_window_statistics(image_in)
     if isinstance(tail, int):
         tail = float(tail)
     if isinstance(tail, float):
@@ -283,25 +604,23 @@ def mri_window(image_in: np.ndarray,
     for ichannel in range(nchannel):
         if ichannel > 0:
             status += "Channel {}: ".format(ichannel)
-        # Flatten to apply Otsu_thresholding
-        imflat = image_in[ichannel, ...].flatten()
+        channel_image = image_in[ichannel, ...]
+        imflat = channel_image.ravel()
         if mask is None:
             maflat = None
             in_mask = False
         else:
             maflat = mask.flatten()
             in_mask = mask > 0
-        # Find Otsu's threshold for the values of the input image
-        threshold = threshold_otsu(imflat)
-        # Find window level
-        level, std_i, _, max_foreground = robust_mean_std(imflat[imflat > threshold])
+        threshold, level, std_i, max_foreground = statistics[ichannel]
         # If lower value of window is below threshold replace lower value with threshold
         input_range = (max(level - std_i * sharpen, threshold),
                        min(max_foreground, level + tail[ichannel] * std_i * sharpen))
-        im_thresh = image_in[ichannel, ...]
-        im_thresh[image_in[ichannel, ...] < threshold] = 0
-        # Use Polynomial transform function to convert data to output range
-        imout[ichannel, ...] = LinearTransform.transform(im_thresh, input_range, output_range)
+        # Convert data to output range. Values below the threshold are treated as zero.
+        below_threshold = channel_image < threshold
+        channel_output = linear_transform_into(channel_image, input_range, output_range, out=imout[ichannel])
+        channel_output[below_threshold] = linear_transform_into(np.zeros(1, dtype=imout.dtype), input_range,
+                                                                output_range, out=np.empty(1, dtype=imout.dtype))
         status += f"Otsu {threshold:0.0f}, level {level:0.0f}, range ({input_range[0]:0.0f}, {input_range[1]:0.0f}) "
         logging.debug(status)
         if debug_mode:
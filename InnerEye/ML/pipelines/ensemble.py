@@ -5,17 +5,72 @@
 from __future__ import annotations
 
 import logging
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from typing import Iterable, List, Optional
+from typing import Iterable, List, Optional, Tuple
 
 import numpy as np
 
 from InnerEye.Common.type_annotations import TupleFloat3
-from InnerEye.ML.config import EnsembleAggregationType, SegmentationModelBase
+from InnerEye.ML.config import EnsembleAggregationType, EnsembleInferenceMode, SegmentationModelBase
 from InnerEye.ML.pipelines.inference import FullImageInferencePipelineBase, InferencePipeline
 from InnerEye.ML.utils.image_util import posteriors_to_segmentation
 
 
+SUPPORTED_AGGREGATION_TYPES = [EnsembleAggregationType.Average, EnsembleAggregationType.MajorityVote,
+                               EnsembleAggregationType.Max, EnsembleAggregationType.Min]
+
+
+class VarianceAccumulator:
+    """
+    Computes the element-wise mean and variance of a sequence of arrays in a single pass, with Welford's algorithm.
+    Only the running mean, the running sum of squared differences and one scratch buffer are kept, however many
+    arrays are added.
+    """
+
+    def __init__(self, shape: Tuple[int, ...]) -> None:
+        self.count = 0
+        self.mean = np.zeros(shape, dtype=np.float32)
+        self.sum_of_squares = np.zeros(shape, dtype=np.float32)
+        self.delta = np.empty(shape, dtype=np.float32)
+
+    def add(self, array: np.ndarray) -> None:
+        """
+        Updates the mean and variance with the given array, which must have the shape that the accumulator was
+        created with.
+        """
+        self.count += 1
+        # With delta = (array - old mean) / count, the new mean is old mean + delta. The sum of squares is increased
+        # by (array - old mean) * (array - new mean) = count * (count - 1) * delta ** 2.
+        np.subtract(array, self.mean, out=self.delta)
+        self.delta /= self.count
+        self.mean += self.delta
+        np.square(self.delta, out=self.delta)
+        self.delta *= self.count * (self.count - 1)
+        self.sum_of_squares += self.delta
+
+    def get_variance(self) -> np.ndarray:
+        """
+        Gets the population variance of the arrays that have been added so far, as a new array.
+        """
+        if self.count == 0:
+            raise ValueError("No arrays have been added")
+        return self.sum_of_squares / self.count
+
+
+def normalize_posteriors(posteriors: np.ndarray) -> None:
+    """
+    Scales the posteriors in place, such that they sum to 1 in the class dimension. Voxels where all posteriors are
+    zero get a uniform distribution.
+    :param posteriors: The posteriors in format Class x Z x Y x X.
+    """
+    total = posteriors.sum(axis=0)
+    is_zero = total == 0
+    posteriors[:, is_zero] = 1
+    total[is_zero] = posteriors.shape[0]
+    posteriors /= total
+
+
 class EnsemblePipeline(FullImageInferencePipelineBase):
     """
     Pipeline for ensembling model predictions for whole image inference
@@ -46,30 +101,72 @@ class EnsemblePipeline(FullImageInferencePipelineBase):
 
     @staticmethod
     def aggregate_results(results: Iterable[InferencePipeline.Result],
-                          aggregation_type: EnsembleAggregationType) -> InferencePipeline.Result:
+                          aggregation_type: EnsembleAggregationType,
+                          compute_variance: bool = False) -> InferencePipeline.Result:
         """
         Helper method to aggregate results from multiple inference pipelines, based on the aggregation type provided.
+        Results are aggregated as they arrive, such that the number of full size buffers does not depend on the
+        number of results.
         :param results: inference pipeline results to aggregate. This may be a Generator to prevent multiple large
-        posterior arrays being held at the same time. The first element of the sequence is modified in place to
-        minimize memory use.
+        posterior arrays being held at the same time. The posteriors of the first element of the sequence are
+        modified in place to minimize memory use.
         :param aggregation_type: aggregation function to use to combine the results.
+        :param compute_variance: If True, compute the variance of the posteriors of each class across the results.
         :return: InferenceResult: contains a Segmentation for each of the classes and their posterior
         probabilities.
         """
-        if aggregation_type != EnsembleAggregationType.Average:
+        if aggregation_type not in SUPPORTED_AGGREGATION_TYPES:
             raise NotImplementedError(f"Ensembling is not implemented for aggregation type: {aggregation_type}")
-        aggregate: Optional[InferencePipeline.Result] = None
+        # Only the metadata of the first result is kept, such that results can be released after aggregation.
+        first_result_metadata: Optional[Tuple[int, TupleFloat3, np.dtype]] = None
+        # For Average, Max and Min: The aggregated posteriors. For MajorityVote: The number of votes for each class.
+        aggregate: Optional[np.ndarray] = None
+        variance: Optional[VarianceAccumulator] = None
         n_results = 0
         for result in results:
-            if aggregate is None:
-                aggregate = result
-            else:
-                aggregate.posteriors += result.posteriors
             n_results += 1
-        assert aggregate is not None
-        aggregate.posteriors /= n_results
-        aggregate.segmentation = posteriors_to_segmentation(aggregate.posteriors)
-        return aggregate
+            if compute_variance:
+                if variance is None:
+                    variance = VarianceAccumulator(result.posteriors.shape)
+                variance.add(result.posteriors)
+            if first_result_metadata is None:
+                first_result_metadata = (result.patient_id, result.voxel_spacing_mm, result.segmentation.dtype)
+            if aggregation_type == EnsembleAggregationType.MajorityVote:
+                if n_results > np.iinfo(np.uint8).max:
+                    raise ValueError(f"MajorityVote supports at most {np.iinfo(np.uint8).max} results")
+                if aggregate is None:
+                    aggregate = np.zeros(result.posteriors.shape, dtype=np.uint8)
+                for class_index in range(aggregate.shape[0]):
+                    aggregate[class_index] += result.segmentation == class_index
+            elif aggregate is None:
+                aggregate = result.posteriors
+            elif aggregation_type == EnsembleAggregationType.Average:
+                aggregate += result.posteriors
+            elif aggregation_type == EnsembleAggregationType.Max:
+                np.maximum(aggregate, result.posteriors, out=aggregate)
+            else:
+                np.minimum(aggregate, result.posteriors, out=aggregate)
+            # Release the result before the next one is computed.
+            del result
+        assert first_result_metadata is not None and aggregate is not None
+        patient_id, voxel_spacing_mm, segmentation_dtype = first_result_metadata
+        if aggregation_type == EnsembleAggregationType.MajorityVote:
+            # Ties are broken in favour of the class with the lowest index.
+            segmentation = aggregate.argmax(axis=0).astype(segmentation_dtype)
+            posteriors = aggregate.astype(np.float32)
+            posteriors /= n_results
+        else:
+            posteriors = aggregate
+            if aggregation_type == EnsembleAggregationType.Average:
+                posteriors /= n_results
+            else:
+                normalize_posteriors(posteriors)
+            segmentation = posteriors_to_segmentation(posteriors)
+        return InferencePipeline.Result(patient_id=patient_id,
+                                        segmentation=segmentation,
+                                        posteriors=posteriors,
+                                        voxel_spacing_mm=voxel_spacing_mm,
+                                        posterior_variance=None if variance is None else variance.get_variance())
 
     def predict_whole_image(self, image_channels: np.ndarray,
                             voxel_spacing_mm: TupleFloat3,
@@ -88,9 +185,63 @@ class EnsemblePipeline(FullImageInferencePipelineBase):
         logging.info(f"Ensembling inference pipelines ({self._get_pipeline_ids()}) "
                      f"predictions for patient: {patient_id}, "
                      f"Aggregation type: {self.model_config.ensemble_aggregation_type.value}")
+        if self.model_config.ensemble_inference_mode == EnsembleInferenceMode.SharedPatches:
+            return self.predict_whole_image_with_shared_patches(image_channels, voxel_spacing_mm, mask, patient_id)
         results = (p.predict_whole_image(image_channels, voxel_spacing_mm, mask, patient_id) for p in
                    self._inference_pipelines)
-        return EnsemblePipeline.aggregate_results(results, self.model_config.ensemble_aggregation_type)
+        return EnsemblePipeline.aggregate_results(results, self.model_config.ensemble_aggregation_type,
+                                                  compute_variance=self.model_config.ensemble_posterior_variance)
+
+    def predict_whole_image_with_shared_patches(self, image_channels: np.ndarray,
+                                                voxel_spacing_mm: TupleFloat3,
+                                                mask: np.ndarray = None,
+                                                patient_id: int = 0) -> InferencePipeline.Result:
+        """
+        Performs inference with all models of the ensemble in a single sliding window pass: The image is padded and
+        each batch of patches is extracted once, and fed into all models. The mean of the model predictions for the
+        batch is added to a single posterior buffer. Averaging before or after stitching the patches gives the same
+        posteriors, because stitching is linear. The models are run on up to ensemble_inference_threads threads.
+        Arguments are the same as for predict_whole_image.
+        """
+        if self.model_config.ensemble_aggregation_type != EnsembleAggregationType.Average:
+            raise NotImplementedError(f"Ensembling with shared patches is not implemented for aggregation type: "
+                                      f"{self.model_config.ensemble_aggregation_type}")
+        if self.model_config.ensemble_posterior_variance:
+            raise NotImplementedError("Ensembling with shared patches can't compute the posterior variance")
+        pipelines = self._inference_pipelines
+        pipelines[0].check_whole_image_inputs(image_channels, mask)
+        for pipeline in pipelines:
+            pipeline.model.eval()
+        # All models of an ensemble share the architecture, and hence the crop size constraints.
+        engine = pipelines[0].create_sliding_window_engine(image_size=image_channels.shape[1:])
+        num_threads = min(self.model_config.ensemble_inference_threads, len(pipelines))
+        executor = ThreadPoolExecutor(max_workers=num_threads) if num_threads > 1 else None
+
+        def model_fn(patches: np.ndarray) -> np.ndarray:
+            if executor is None:
+                predictions: Iterable[np.ndarray] = (p._model_fn(patches) for p in pipelines)
+            else:
+                predictions = executor.map(lambda p: p._model_fn(patches), pipelines)
+            mean: Optional[np.ndarray] = None
+            for prediction in predictions:
+                if mean is None:
+                    mean = prediction
+                else:
+                    mean += prediction
+            assert mean is not None
+            mean /= len(pipelines)
+            return mean
+
+        try:
+            posteriors = engine.predict(model_fn=model_fn,
+                                        image_channels=image_channels,
+                                        num_classes=self.model_config.number_of_classes,
+                                        batch_size=self.model_config.inference_batch_size,
+                                        padding_mode=self.model_config.padding_mode)
+        finally:
+            if executor is not None:
+                executor.shutdown()
+        return InferencePipeline.create_result(posteriors, voxel_spacing_mm, mask, patient_id)
 
     def _get_pipeline_ids(self) -> List[int]:
         return list(range(len(self._inference_pipelines)))
@@ -0,0 +1,214 @@
+#  ------------------------------------------------------------------------------------------
+#  Copyright (c) Microsoft Corporation. All rights reserved.
+#  Licensed under the MIT License (MIT). See LICENSE in the repo root for license information.
+#  ------------------------------------------------------------------------------------------
+from __future__ import annotations
+
+from functools import lru_cache
+from typing import Callable
+
+import numpy as np
+from numpy.lib.stride_tricks import as_strided
+
+from InnerEye.Common.common_util import any_pairwise_larger
+from InnerEye.Common.type_annotations import TupleInt3
+from InnerEye.ML.config import BlendingMode, PaddingMode
+from InnerEye.ML.utils import image_util
+
+# Padding modes for which padding an image twice gives the same result as padding it once by the summed amounts.
+COMPOSABLE_PADDING_MODES = [PaddingMode.Zero, PaddingMode.Edge]
+
+
+@lru_cache(maxsize=None)
+def get_blending_weights(size: int, blending_mode: BlendingMode) -> np.ndarray:
+    """
+    Computes the weights that the voxels along one axis of a patch get when blending overlapping patches.
+    The result is cached, and hence read-only.
+    :param size: The size of the patch along the axis.
+    :param blending_mode: The blending mode.
+    :return: A float32 vector of the given size with weights in (0, 1], that is largest at the patch center.
+    """
+    positions = np.arange(size)
+    if blending_mode == BlendingMode.Uniform:
+        weights = np.ones(size)
+    elif blending_mode == BlendingMode.Gaussian:
+        sigma = size / 8.0
+        weights = np.exp(-0.5 * ((positions - (size - 1) / 2.0) / sigma) ** 2)
+    elif blending_mode == BlendingMode.LinearRamp:
+        weights = np.minimum(positions + 1, size - positions).astype(float)
+    else:
+        raise ValueError(f"Unsupported blending mode: {blending_mode}")
+    weights = (weights / weights.max()).astype(np.float32)
+    weights.setflags(write=False)
+    return weights
+
+
+@lru_cache(maxsize=None)
+def get_blending_weight_map(patch_size: TupleInt3, blending_mode: BlendingMode) -> np.ndarray:
+    """
+    Computes the Z x Y x X weights for the voxels of a patch when blending overlapping patches, as the outer product
+    of the per axis weights. The result is cached, such that it is computed only once per patch size.
+    """
+    weights = [get_blending_weights(size, blending_mode) for size in patch_size]
+    weight_map = weights[0][:, None, None] * weights[1][None, :, None] * weights[2][None, None, :]
+    weight_map.setflags(write=False)
+    return weight_map
+
+
+class SlidingWindowEngine:
+    """
+    Extracts patches from an image with a sliding window, and stitches the model predictions for those patches back
+    into whole image posteriors. The window coordinates are computed once per image. Patches are gathered from a
+    strided view of the padded image, and predictions for all classes are scatter-added into the posteriors with
+    vectorized indexing. Overlapping predictions are averaged, optionally weighted by their position in the patch.
+    """
+
+    def __init__(self,
+                 image_shape: TupleInt3,
+                 crop_size: TupleInt3,
+                 output_size: TupleInt3,
+                 stride: TupleInt3,
+                 blending_mode: BlendingMode = BlendingMode.Uniform):
+        """
+        :param image_shape: The shape of the image to run inference on, and of the resulting posteriors, in Z x Y x X.
+        :param crop_size: The shape of the patches that are fed into the model.
+        :param output_size: The shape of the model output for a single patch. The model output is expected to be
+        the center of the patch.
+        :param stride: The stride between patches.
+        :param blending_mode: How predictions of overlapping patches are weighted.
+        """
+        if any_pairwise_larger(output_size, crop_size):
+            raise ValueError(f"crop_size must be >= output_size, found crop_size:{crop_size}, "
+                             f"output_size:{output_size}")
+        if any_pairwise_larger(stride, output_size):
+            raise ValueError(f"stride must be <= output_size, otherwise the patches do not cover the image. "
+                             f"Found stride:{stride}, output_size:{output_size}")
+        self.image_shape = tuple(image_shape)
+        self.crop_size = tuple(crop_size)
+        self.output_size = tuple(output_size)
+        self.stride = tuple(stride)
+        self.blending_mode = blending_mode
+        # Padding that makes the model output of a patch located at the same coordinates as the patch itself.
+        diff = np.subtract(crop_size, output_size)
+        before = np.ceil(diff / 2.0).astype(int)
+        self.inference_padding = tuple((int(b), int(d - b)) for b, d in zip(before, diff))
+        # Padding such that the patches tile the whole image.
+        self.tiling_padding = image_util.get_sliding_window_padding(self.image_shape, self.output_size, self.stride)
+        self.padded_shape: TupleInt3 = tuple(s + before + after  # type: ignore
+                                             for s, (before, after) in zip(self.image_shape, self.tiling_padding))
+        self.grid_shape: TupleInt3 = tuple((p - o) // s + 1  # type: ignore
+                                           for p, o, s in zip(self.padded_shape, self.output_size, self.stride))
+        # Position of each window on the grid, 3 x Num windows, in the order of get_sliding_window_starts
+        self.window_indices = np.indices(self.grid_shape).reshape(3, -1)
+        # Windows whose grid positions are equal modulo the overlap factor do not overlap
+        self.overlap_factor = tuple(-(-o // s) for o, s in zip(self.output_size, self.stride))
+
+    @property
+    def num_windows(self) -> int:
+        return self.window_indices.shape[1]
+
+    def pad_image(self, image_channels: np.ndarray, padding_mode: PaddingMode) -> np.ndarray:
+        """
+        Pads the image such that patches of crop_size tile it completely, and such that the model output of each
+        patch covers the original image.
+        :param image_channels: The image in format Channels x Z x Y x X.
+        :param padding_mode: The padding mode to use.
+        :return: The padded image.
+        """
+        if padding_mode in COMPOSABLE_PADDING_MODES:
+            padding = tuple((i_before + t_before, i_after + t_after)
+                            for (i_before, i_after), (t_before, t_after)
+                            in zip(self.inference_padding, self.tiling_padding))
+            return np.pad(image_channels, ((0, 0),) + padding, mode=padding_mode.value)
+        image_channels = image_util.pad_images_for_inference(images=image_channels,
+                                                            crop_size=self.crop_size,
+                                                            output_size=self.output_size,
+                                                            padding_mode=padding_mode)
+        return np.pad(image_channels, ((0, 0),) + self.tiling_padding, mode=padding_mode.value)
+
+    def windows_view(self, array: np.ndarray, window_size: TupleInt3) -> np.ndarray:
+        """
+        Creates a view of all windows of the given size in the array, without copying any data. Windows overlap
+        in memory if the stride is smaller than the window size.
+        :param array: An array in format Channels x Z x Y x X.
+        :param window_size: The size of the windows.
+        :return: A view of shape Grid Z x Grid Y x Grid X x Channels x Z x Y x X
+        """
+        c, z, y, x = array.strides
+        return as_strided(array,
+                          shape=self.grid_shape + (array.shape[0],) + tuple(window_size),
+                          strides=(z * self.stride[0], y * self.stride[1], x * self.stride[2], c, z, y, x))
+
+    def get_patches(self, patches_view: np.ndarray, start: int, end: int) -> np.ndarray:
+        """
+        Gathers the patches for the windows in range [start, end).
+        :param patches_view: The view created by windows_view on the padded image.
+        :return: The patches in format Patches x Channels x Z x Y x X.
+        """
+        z, y, x = self.window_indices[:, start:end]
+        return patches_view[z, y, x]
+
+    def create_accumulator(self, num_classes: int) -> np.ndarray:
+        """
+        Creates an empty Class x Z x Y x X float32 buffer to add predictions to, covering the padded image.
+        """
+        return np.zeros((num_classes,) + self.padded_shape, dtype=np.float32)
+
+    def add_predictions(self, accumulator: np.ndarray, predictions: np.ndarray, start: int) -> None:
+        """
+        Adds the model predictions for consecutive windows into the accumulator, for all classes at once.
+        :param accumulator: A buffer created by create_accumulator.
+        :param predictions: Predictions in format Patches x Class x Z x Y x X, for the windows starting at index start.
+        :param start: The index of the window for the first prediction.
+        """
+        indices = self.window_indices[:, start:start + len(predictions)]
+        accumulator_view = self.windows_view(accumulator, self.output_size)
+        # Within each phase, windows are disjoint, hence they can be added with a single fancy indexing operation.
+        phases = np.ravel_multi_index(indices % np.array(self.overlap_factor)[:, None], self.overlap_factor)
+        for phase in np.unique(phases):
+            in_phase = phases == phase
+            z, y, x = indices[:, in_phase]
+            if self.blending_mode == BlendingMode.Uniform:
+                accumulator_view[z, y, x] += predictions[in_phase]
+            else:
+                accumulator_view[z, y, x] += predictions[in_phase] * get_blending_weight_map(self.output_size,
+                                                                                             self.blending_mode)
+
+    def normalize(self, accumulator: np.ndarray) -> np.ndarray:
+        """
+        Divides the accumulated predictions by the (weighted) number of windows that cover each voxel, and removes
+        the padding.
+        :param accumulator: A buffer created by create_accumulator, after all predictions have been added.
+        :return: The posteriors in format Class x Z x Y x X, with the shape of the original image.
+        """
+        weights_per_axis = None if self.blending_mode == BlendingMode.Uniform \
+            else [get_blending_weights(size, self.blending_mode) for size in self.output_size]
+        accumulator /= image_util.get_sliding_window_coverage(self.padded_shape, self.output_size, self.stride,
+                                                              weights_per_axis=weights_per_axis)
+        return accumulator[(slice(None),) + tuple(slice(before, before + s)
+                                                  for s, (before, _) in zip(self.image_shape, self.tiling_padding))]
+
+    def predict(self,
+                model_fn: Callable[[np.ndarray], np.ndarray],
+                image_channels: np.ndarray,
+                num_classes: int,
+                batch_size: int,
+                padding_mode: PaddingMode = PaddingMode.Edge) -> np.ndarray:
+        """
+        Runs sliding window inference over the whole image. Patches are gathered one batch at a time, and the
+        predictions for each batch are added to the posteriors straight away, such that peak memory does not grow
+        with the number of patches.
+        :param model_fn: A function that takes patches in format Patches x Channels x Z x Y x X, and returns
+        the model predictions in format Patches x Class x Z x Y x X.
+        :param image_channels: The image in format Channels x Z x Y x X.
+        :param num_classes: The number of classes in the model output.
+        :param batch_size: The number of patches to feed into the model at once.
+        :param padding_mode: The padding mode to use at the image boundaries.
+        :return: The posteriors in format Class x Z x Y x X.
+        """
+        patches_view = self.windows_view(self.pad_image(image_channels, padding_mode), self.crop_size)
+        accumulator = self.create_accumulator(num_classes)
+        for start in range(0, self.num_windows, batch_size):
+            batch_predictions = model_fn(self.get_patches(patches_view, start, start + batch_size))
+            self.add_predictions(accumulator, batch_predictions, start)
+        return self.normalize(accumulator)
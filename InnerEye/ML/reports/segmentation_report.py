@@ -18,7 +18,8 @@ from InnerEye.ML.utils.csv_util import mark_outliers
 def plot_scores_for_csv(path_csv: str, outlier_range: float, max_row_count: int) -> None:
     """
     Displays all the tables and figures given a csv file with segmentation metrics
-    Columns expected: Patient,Structure,Dice,HausdorffDistance_mm,MeanDistance_mm
+    Columns expected: Patient,Structure,Dice,HausdorffDistance_mm,MeanDistance_mm, and optionally
+    HausdorffDistance95_mm, which is missing in files written by earlier versions.
     """
     # For diagnostics, it is nice to see whether the metrics were read from the correct file. In AzureML,
     # those paths contain the run ID, meaning that the output is different for each run, and hence can't have
@@ -33,6 +34,9 @@ def plot_scores_for_csv(path_csv: str, outlier_range: float, max_row_count: int)
         display_metric(df, MetricsFileColumns.Dice.value, outlier_range, max_row_count, high_values_are_good=True)
         display_metric(df, MetricsFileColumns.HausdorffDistanceMM.value, outlier_range, max_row_count,
                        high_values_are_good=False)
+        if MetricsFileColumns.HausdorffDistance95MM.value in df:
+            display_metric(df, MetricsFileColumns.HausdorffDistance95MM.value, outlier_range, max_row_count,
+                           high_values_are_good=False)
         display_metric(df, MetricsFileColumns.MeanDistanceMM.value, outlier_range, max_row_count,
                        high_values_are_good=False)
 
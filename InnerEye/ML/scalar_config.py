@@ -4,6 +4,7 @@
 #  ------------------------------------------------------------------------------------------
 import logging
 from enum import Enum, unique
+from pathlib import Path
 from typing import Any, Callable, Dict, List, Optional, Tuple, Union
 
 import pandas as pd
@@ -215,6 +216,16 @@ class ScalarModelBase(ModelConfigBase):
                                                     doc="Number of workers (processes) to use for dataset "
                                                         "reading. Default is 0 which means only the main thread "
                                                         "will be used. Set to -1 for maximum parallelism level.")
+    #: A folder in which to store the data sources that are read from the dataset, for example a folder next to the
+    #: dataset. They are stored in columnar form, keyed by a hash of the dataset contents and of the columns, channels,
+    #: label transforms and encoders that the reader uses, such that later training, inference and cross validation
+    #: runs with the same data and settings only load a single file. If traverse_dirs_when_loading is set, the
+    #: listing of the dataset folder is stored there as well, and only modified directories are listed again.
+    data_sources_cache_folder: Optional[Path] = \
+        param.ClassSelector(class_=Path, default=None, allow_None=True, instantiate=False,
+                            doc="A folder in which to store the data sources that are read from the dataset, such "
+                                "that they are read only once for the same data and settings. If not set, the "
+                                "data sources are read from the dataset each time.")
 
     ensemble_aggregation_type: EnsembleAggregationType = param.ClassSelector(default=EnsembleAggregationType.Average,
                                                                              class_=EnsembleAggregationType,
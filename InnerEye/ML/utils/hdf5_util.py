@@ -5,11 +5,12 @@
 from datetime import datetime
 from enum import Enum
 from pathlib import Path
-from typing import Optional, Type, TypeVar, Union
+from typing import Callable, Optional, Tuple, Type, TypeVar, Union
 
 import h5py
 import numpy as np
 
+from InnerEye.Common.type_annotations import TupleInt3
 from InnerEye.ML.utils.image_util import ImageDataType
 
 DATE_FORMAT = "%Y-%m-%dT%H:%M:%S"
@@ -87,42 +88,65 @@ class HDF5Object:
         return root_path + data_field.value
 
     @staticmethod
-    def _load_image(hdf5_data: h5py.File, data_field: HDF5Field) -> np.ndarray:
+    def _load_image(hdf5_data: h5py.File, data_field: HDF5Field,
+                    center_crop_size: Optional[TupleInt3] = None,
+                    get_slices: Optional[Callable[[TupleInt3], Tuple[slice, ...]]] = None) -> np.ndarray:
         """
         Load the volume from the HDF5 file.
         :param hdf5_data: path to the hdf5 file
         :param data_field: field of the hdf5 file containing the data
+        :param center_crop_size: If given, only the center crop of this size (N x H x W) is read from the file, as in
+        get_center_crop. If the crop is larger than the image, the whole image is read.
+        :param get_slices: If given, and center_crop_size is not, a function that maps the shape of the image (N x H x
+        W) to the slices along these dimensions that are read from the file.
         :return: image as numpy array
         """
-        img = hdf5_data[HDF5Object._hdf5_data_path(data_field)][()]  # N x C x H x W
+        dataset = hdf5_data[HDF5Object._hdf5_data_path(data_field)]  # N x C x H x W
         # ensure a 4D image is loaded
-        if img.ndim != 4:
-            raise ValueError(f"The loaded image should be 4D (image.shape: {img.shape})")
-        n_channels = img.shape[1]
+        if dataset.ndim != 4:
+            raise ValueError(f"The loaded image should be 4D (image.shape: {dataset.shape})")
+        n_channels = dataset.shape[1]
         if n_channels != 1:
             raise ValueError(f"Expected number of channels to be 1 but instead found {n_channels}")
+        image_shape = (dataset.shape[0],) + dataset.shape[2:]
+        if center_crop_size is not None and all(c <= s for c, s in zip(center_crop_size, image_shape)):
+            # Read only the hyperslab of the crop, and squeeze the channels dim
+            starts = [s // 2 - c // 2 for s, c in zip(image_shape, center_crop_size)]
+            return dataset[starts[0]:starts[0] + center_crop_size[0],
+                           0,
+                           starts[1]:starts[1] + center_crop_size[1],
+                           starts[2]:starts[2] + center_crop_size[2]]
+        if center_crop_size is None and get_slices is not None:
+            slices = get_slices(image_shape)  # type: ignore
+            return dataset[slices[0], 0, slices[1], slices[2]]
         # squeeze channels dim (N == 1) - return N x H x W
-        return np.squeeze(img, axis=1)
+        return np.squeeze(dataset[()], axis=1)
 
     @classmethod
-    def from_file(cls: Type[T], hdf5_path: Path, load_segmentation: bool) -> T:
+    def from_file(cls: Type[T], hdf5_path: Path, load_segmentation: bool,
+                  center_crop_size: Optional[TupleInt3] = None,
+                  get_slices: Optional[Callable[[TupleInt3], Tuple[slice, ...]]] = None) -> T:
         """
         Load HDF5 object from file
 
         :param hdf5_path: Path to an HDF5 file
         :param load_segmentation: If True it loads segmentation (if present on the same file as the image).
+        :param center_crop_size: If given, only the center crop of this size is read from the volume and segmentation.
+        :param get_slices: If given, and center_crop_size is not, a function that maps the shape of the volume and of
+        the segmentation to the slices that are read from them.
         :return: HDF5 object
         """
-        hdf5_data = h5py.File(str(hdf5_path), 'r')
-        expected_keys = set([k.value for k in HDF5Field])
-        act_keys = list(hdf5_data.keys())
-        if not expected_keys.issubset(act_keys):
-            raise ValueError(f"HDF5 group should at least have the datasets: {expected_keys} but found {act_keys}")
-
-        patient_id = hdf5_data[cls._hdf5_data_path(HDF5Field.PATIENT_ID)][()]
-        volume = cls._load_image(hdf5_data, HDF5Field.VOLUME)
-        segmentation = cls._load_image(hdf5_data, HDF5Field.SEGMENTATION) if load_segmentation else None
-        acquisition_date = hdf5_data[cls._hdf5_data_path(HDF5Field.DATE)][()]
+        with h5py.File(str(hdf5_path), 'r') as hdf5_data:
+            expected_keys = set([k.value for k in HDF5Field])
+            act_keys = list(hdf5_data.keys())
+            if not expected_keys.issubset(act_keys):
+                raise ValueError(f"HDF5 group should at least have the datasets: {expected_keys} but found {act_keys}")
+
+            patient_id = hdf5_data[cls._hdf5_data_path(HDF5Field.PATIENT_ID)][()]
+            volume = cls._load_image(hdf5_data, HDF5Field.VOLUME, center_crop_size, get_slices)
+            segmentation = cls._load_image(hdf5_data, HDF5Field.SEGMENTATION, center_crop_size, get_slices) \
+                if load_segmentation else None
+            acquisition_date = hdf5_data[cls._hdf5_data_path(HDF5Field.DATE)][()]
         return cls(patient_id=patient_id,
                    volume=volume,
                    segmentation=segmentation,
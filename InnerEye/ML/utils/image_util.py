@@ -2,6 +2,7 @@
 #  Copyright (c) Microsoft Corporation. All rights reserved.
 #  Licensed under the MIT License (MIT). See LICENSE in the repo root for license information.
 #  ------------------------------------------------------------------------------------------
+import itertools
 import logging
 from dataclasses import dataclass
 from enum import Enum
@@ -203,6 +204,64 @@ def _pad_images(images: np.ndarray,
     return images
 
 
+def get_sliding_window_padding(image_shape: TupleInt3,
+                               patch_shape: TupleInt3,
+                               stride: TupleInt3) -> Tuple[TupleInt2, TupleInt2, TupleInt2]:
+    """
+    Computes the padding that is required such that patches of the given shape, taken at the given stride,
+    tile the image completely. The padding is split evenly before and after the image, with the odd voxel going after.
+    This is the same padding that is applied when extracting patches and stitching them back together.
+
+    :param image_shape: The shape of the image in Z x Y x X.
+    :param patch_shape: The shape of the patches in Z x Y x X.
+    :param stride: The stride between patches in Z x Y x X.
+    :return: Padding before and after in each dimension.
+    """
+    overshoot = np.mod(np.subtract(image_shape, patch_shape) + stride, stride)
+    pad = [0 if o == 0 else s - o for o, s in zip(overshoot.tolist(), stride)]
+    return (pad[0] // 2, pad[0] - pad[0] // 2), (pad[1] // 2, pad[1] - pad[1] // 2), (pad[2] // 2, pad[2] - pad[2] // 2)
+
+
+def get_sliding_window_starts(image_shape: TupleInt3,
+                              patch_shape: TupleInt3,
+                              stride: TupleInt3) -> List[TupleInt3]:
+    """
+    Computes the start coordinates of all patches of the given shape, taken at the given stride, in an image
+    that has already been padded via :func:`get_sliding_window_padding`. Patches are ordered with X varying fastest.
+
+    :param image_shape: The shape of the (padded) image in Z x Y x X.
+    :param patch_shape: The shape of the patches in Z x Y x X.
+    :param stride: The stride between patches in Z x Y x X.
+    :return: The list of Z x Y x X start coordinates.
+    """
+    ranges = [range(0, i - p + 1, s) for i, p, s in zip(image_shape, patch_shape, stride)]
+    return list(itertools.product(*ranges))  # type: ignore
+
+
+def get_sliding_window_coverage(image_shape: TupleInt3,
+                                patch_shape: TupleInt3,
+                                stride: TupleInt3,
+                                weights_per_axis: Optional[List[np.ndarray]] = None) -> np.ndarray:
+    """
+    Computes how many of the patches returned by :func:`get_sliding_window_starts` cover each voxel. The count is
+    separable along the axes, hence it is computed per axis and combined with an outer product.
+
+    :param image_shape: The shape of the (padded) image in Z x Y x X.
+    :param patch_shape: The shape of the patches in Z x Y x X.
+    :param stride: The stride between patches in Z x Y x X.
+    :param weights_per_axis: If provided, each voxel of a patch contributes the product of these per axis weights
+    rather than 1, and the result is the summed weight of all patches at each voxel.
+    :return: The number of patches covering each voxel, as a float32 array of shape Z x Y x X.
+    """
+    counts_per_axis = []
+    for axis, (i, p, s) in enumerate(zip(image_shape, patch_shape, stride)):
+        counts = np.zeros(i, dtype=np.float32)
+        for start in range(0, i - p + 1, s):
+            counts[start:start + p] += 1 if weights_per_axis is None else weights_per_axis[axis]
+        counts_per_axis.append(counts)
+    return counts_per_axis[0][:, None, None] * counts_per_axis[1][None, :, None] * counts_per_axis[2][None, None, :]
+
+
 def posteriors_to_segmentation(posteriors: NumpyOrTorch) -> NumpyOrTorch:
     """
     Perform argmax on the class dimension.
@@ -2,13 +2,18 @@
 #  Copyright (c) Microsoft Corporation. All rights reserved.
 #  Licensed under the MIT License (MIT). See LICENSE in the repo root for license information.
 #  ------------------------------------------------------------------------------------------
+import hashlib
+import json
+import os
 import shutil
+import threading
 import uuid
+from concurrent.futures import ThreadPoolExecutor
 from copy import copy
 from dataclasses import dataclass
 from enum import Enum
 from pathlib import Path
-from typing import Dict, Generic, Iterable, List, Optional, Tuple, Type, TypeVar, Union
+from typing import Callable, Dict, Generic, Iterable, List, Optional, Tuple, Type, TypeVar, Union
 
 import SimpleITK as sitk
 import h5py
@@ -34,7 +39,13 @@ from InnerEye.ML.utils.transforms import LinearTransform, get_range_for_window_l
 
 RESULTS_POSTERIOR_FILE_NAME_PREFIX = "posterior_"
 RESULTS_SEGMENTATION_FILE_NAME_PREFIX = "segmentation"
+# The suffix of the file that stores the image header for an image in a .npy file.
+NUMPY_HEADER_FILE_SUFFIX = ".header.json"
 TensorOrNumpyArray = TypeVar('TensorOrNumpyArray', torch.Tensor, np.ndarray)
+# The default number of threads that load the channels of a sample in the main process. Decompressing and resizing
+# images mostly releases the GIL. Inside data loader worker processes, which already load samples in parallel, the
+# channels are loaded one after another.
+DEFAULT_IMAGE_LOADING_THREADS = 8
 
 
 class PhotometricInterpretation(Enum):
@@ -255,6 +266,55 @@ def load_numpy_image(path: PathOrString, image_type: Optional[Type] = None) -> n
     return image
 
 
+def get_numpy_header_path(path: PathOrString) -> Path:
+    """
+    Gets the path of the header file that stores spacing, origin and direction for an image in a .npy file.
+    :param path: The path to the .npy file.
+    """
+    return Path(str(path) + NUMPY_HEADER_FILE_SUFFIX)
+
+
+def store_image_as_numpy(image: np.ndarray, header: ImageHeader, file_name: PathOrString) -> Path:
+    """
+    Saves a 3D image as an uncompressed .npy file, that can be memory mapped when loading, and writes the image header
+    to a JSON file next to it.
+    :param image: 3D image in shape: Z x Y x X.
+    :param header: The image header.
+    :param file_name: The name of the .npy file for the image.
+    :return: the path to the saved image
+    """
+    if image.ndim != 3:
+        raise ValueError(f"Image must have 3 dimensions, found: {image.ndim}")
+    path = Path(file_name)
+    np.save(path, np.ascontiguousarray(image), allow_pickle=False)
+    get_numpy_header_path(path).write_text(json.dumps({"spacing": header.spacing,
+                                                       "origin": header.origin,
+                                                       "direction": header.direction}))
+    return path
+
+
+def load_memory_mapped_image(path: PathOrString, image_type: Optional[Type] = None) -> ImageWithHeader:
+    """
+    Loads an image that was written by store_image_as_numpy. The image is memory mapped, such that reading a crop
+    only reads the pages of the file that the crop covers. The image is mapped copy-on-write, hence it can be modified
+    without changing the file. The image must be stored in the requested image_type for the memory mapping to be
+    preserved, otherwise the image is read and converted in full.
+    :param path: The path to the .npy file.
+    :param image_type: The type to load the image in, set to None to not cast.
+    :return: The image and its header, read from the JSON file next to the image.
+    """
+    image = np.load(path, mmap_mode="c", allow_pickle=False)
+    if image.ndim != 3:
+        raise ValueError(f"The loaded image should be 3D (image.shape: {image.shape})")
+    if image_type is not None and image.dtype != image_type:
+        image = np.asarray(image, dtype=image_type)
+    header = json.loads(get_numpy_header_path(path).read_text())
+    return ImageWithHeader(image=image,
+                           header=ImageHeader(spacing=tuple(header["spacing"]),  # type: ignore
+                                              origin=tuple(header["origin"]),  # type: ignore
+                                              direction=tuple(header["direction"])))  # type: ignore
+
+
 def load_dicom_image(path: PathOrString) -> np.ndarray:
     """
     Loads an array from a single dicom file.
@@ -289,12 +349,17 @@ def load_hdf5_dataset_from_file(path_str: Path, dataset_name: str) -> np.ndarray
     raise ValueError(f"File '{path_str}' does not contain dataset '{dataset_name}'")
 
 
-def load_hdf5_file(path_str: Union[str, Path], load_segmentation: bool = False) -> HDF5Object:
+def load_hdf5_file(path_str: Union[str, Path], load_segmentation: bool = False,
+                   center_crop_size: Optional[TupleInt3] = None,
+                   get_slices: Optional[Callable[[TupleInt3], Tuple[slice, ...]]] = None) -> HDF5Object:
     """
     Loads a single HDF5 file.
     :param path_str: The path of the HDF5 file that should be loaded.
     :param load_segmentation: If True, the `segmentation` field of the result object will be populated. If
     False, the field will be set to None.
+    :param center_crop_size: If given, only the center crop of this size is read from the volume and segmentation.
+    :param get_slices: If given, and center_crop_size is not, a function that maps the shape of the volume and of
+    the segmentation to the slices that are read from them.
     :return: HDF5Object
     """
 
@@ -311,7 +376,8 @@ def load_hdf5_file(path_str: Union[str, Path], load_segmentation: bool = False)
     if path is None or not _is_valid_hdf5_path(path):
         raise ValueError(f"Invalid path: {path}")
 
-    return HDF5Object.from_file(path, load_segmentation=load_segmentation)
+    return HDF5Object.from_file(path, load_segmentation=load_segmentation, center_crop_size=center_crop_size,
+                                get_slices=get_slices)
 
 
 @dataclass(frozen=True)
@@ -320,14 +386,62 @@ class ImageAndSegmentations(Generic[TensorOrNumpyArray]):
     segmentations: Optional[TensorOrNumpyArray] = None
 
 
+def _get_resize_and_crop_slices(input_shape: TupleInt3, image_size: TupleInt3,
+                                center_crop_size: TupleInt3) -> Tuple[Tuple[slice, ...], TupleInt3, Tuple[slice, ...]]:
+    """
+    Gets the region of an image that needs to be resized to compute the center crop of the resized image. Along axes
+    where the image is downsampled by an integer factor, or not resized, each resized voxel is computed from a fixed
+    window of input voxels: The anti-aliasing filter of skimage's resize, plus the linear interpolation. Resizing only
+    the input voxels that the crop depends on, plus a margin for these windows, then gives the same values as resizing
+    the whole image. Along other axes, the whole axis is resized.
+
+    :param input_shape: The shape of the image before resizing.
+    :param image_size: The shape to resize the image to.
+    :param center_crop_size: The shape of the center crop of the resized image.
+    :return: A tuple with the slices of the image to resize, the shape to resize these to, and the slices of the
+    resized region that give the center crop.
+    """
+    input_slices = []
+    resized_shape = []
+    output_slices = []
+    for input_length, resized_length, crop_length in zip(input_shape, image_size, center_crop_size):
+        # The start of the center crop, as computed in get_center_crop
+        crop_start = resized_length // 2 - crop_length // 2
+        if input_length % resized_length == 0:
+            factor = input_length // resized_length
+            # Radius of the Gaussian filter with the default anti-aliasing sigma and truncation of skimage
+            filter_radius = int(4 * max(0, (factor - 1) / 2) + 0.5)
+            margin = -(-filter_radius // factor) + 1
+            start = max(0, crop_start - margin)
+            stop = min(resized_length, crop_start + crop_length + margin)
+            input_slices.append(slice(start * factor, stop * factor))
+            resized_shape.append(stop - start)
+            output_slices.append(slice(crop_start - start, crop_start - start + crop_length))
+        else:
+            input_slices.append(slice(None))
+            resized_shape.append(resized_length)
+            output_slices.append(slice(crop_start, crop_start + crop_length))
+    return tuple(input_slices), tuple(resized_shape), tuple(output_slices)  # type: ignore
+
+
+def get_default_image_loading_threads() -> int:
+    """
+    Gets the number of threads that load the channels of a sample: DEFAULT_IMAGE_LOADING_THREADS in the main process,
+    and 1 in a data loader worker process, such that the workers together do not use more threads than CPUs.
+    """
+    return 1 if torch.utils.data.get_worker_info() is not None else DEFAULT_IMAGE_LOADING_THREADS
+
+
 def load_images_and_stack(files: Iterable[Path],
                           load_segmentation: bool,
                           center_crop_size: Optional[TupleInt3] = None,
-                          image_size: Optional[TupleInt3] = None) -> ImageAndSegmentations[torch.Tensor]:
+                          image_size: Optional[TupleInt3] = None,
+                          num_threads: Optional[int] = None) -> ImageAndSegmentations[torch.Tensor]:
     """
     Attempts to load a set of files, all of which are expected to contain 3D images of the same size (Z, X, Y)
     They are all stacked along dimension 0 and returned as a torch tensor of size (B, Z, X, Y)
     Images are returned as torch.float32 tensors, segmentations are returned as torch.uint8 tensors (multimaps).
+    The files are loaded concurrently, and each image is written directly into the stacked tensor.
 
     :param files: The paths of the files to load.
     :param load_segmentation: If True it loads segmentation if present on the same file as the image. This is only
@@ -335,30 +449,71 @@ def load_images_and_stack(files: Iterable[Path],
     :param center_crop_size: If supplied, all loaded images will be cropped to the size given here. The crop will be
     taken from the center of the image.
     :param image_size: If supplied, all loaded images will be resized immediately after loading.
+    :param num_threads: The maximum number of threads that load files concurrently. If 1, files are loaded one after
+    another in the calling thread. If None, get_default_image_loading_threads() is used.
     :return: A wrapper class that contains the loaded images, and if load_segmentation is True, also the segmentations
     that were present in the files.
     """
-    images = []
-    segmentations = []
+    files = list(files)
+    if num_threads is None:
+        num_threads = get_default_image_loading_threads()
+    stacked: Dict[str, torch.Tensor] = {}
+    lock = threading.Lock()
 
-    def from_numpy_crop_and_resize(array: np.ndarray) -> torch.Tensor:
+    def crop_and_resize(array: np.ndarray, input_shape: Optional[TupleInt3] = None) -> np.ndarray:
+        # If input_shape is given, the array only contains the region of an image of that shape that the center crop
+        # of the resized image depends on
         if image_size:
             if not issubclass(array.dtype.type, np.floating):
                 raise ValueError("Array must be of type float.")
             if array.shape[0] == 1 and not image_size[0] == 1:
                 raise ValueError(f"Input image is 2D with singleton dimension {array.shape}, but parameter "
                                  f"image_shape has non-singleton first dimension {image_size}")
+            if center_crop_size and all(c <= s for c, s in zip(center_crop_size, image_size)):
+                if image_size[0] == 1 and not center_crop_size[0] == 1:
+                    raise ValueError(f"Input image is 2D with singleton dimension {tuple(image_size)}, but "
+                                     f"parameter center_crop_size has non-singleton first dimension {center_crop_size}")
+                input_slices, resized_shape, output_slices = _get_resize_and_crop_slices(
+                    input_shape or array.shape, image_size, center_crop_size)  # type: ignore
+                if input_shape is None:
+                    array = array[input_slices]
+                return resize(array, resized_shape, anti_aliasing=True)[output_slices]
             array = resize(array, image_size, anti_aliasing=True)
-        t = torch.from_numpy(array)
         if center_crop_size:
             if array.shape[0] == 1 and not center_crop_size[0] == 1:
                 raise ValueError(f"Input image is 2D with singleton dimension {array.shape}, but parameter "
                                  f"center_crop_size has non-singleton first dimension {center_crop_size}")
-            return get_center_crop(t, center_crop_size)
-        return t
-
-    for file_path in files:
-        image_and_segmentation = load_image_in_known_formats(file_path, load_segmentation)
+            return get_center_crop(array, center_crop_size)
+        return array
+
+    def write_channel(name: str, index: int, array: np.ndarray, file_path: Path) -> None:
+        channel = torch.from_numpy(np.ascontiguousarray(array))
+        with lock:
+            if name not in stacked:
+                stacked[name] = torch.empty((len(files),) + tuple(channel.shape), dtype=channel.dtype)
+        if stacked[name].shape[1:] != channel.shape or stacked[name].dtype != channel.dtype:
+            raise ValueError(f"All files must contain {name} of the same size and data type, but {file_path} "
+                             f"contains {tuple(channel.shape)} {channel.dtype}, and another file contains "
+                             f"{tuple(stacked[name].shape[1:])} {stacked[name].dtype}")
+        stacked[name][index].copy_(channel)
+
+    def load_channel(index: int, file_path: Path) -> None:
+        # Without resizing, the crop of the loaded image is the final crop, and only that is read from HDF5 files.
+        # With resizing, only the region of the image that the crop of the resized image depends on is read.
+        input_shapes: List[TupleInt3] = []
+
+        def get_input_slices(shape: TupleInt3) -> Tuple[slice, ...]:
+            input_shapes.append(shape)
+            return _get_resize_and_crop_slices(shape, image_size, center_crop_size)[0]  # type: ignore
+
+        read_input_slices = bool(image_size and center_crop_size and is_hdf5_file_path(file_path)
+                                 and all(c <= s for c, s in zip(center_crop_size, image_size)))
+        image_and_segmentation = load_image_in_known_formats(file_path, load_segmentation,
+                                                             center_crop_size=None if image_size else center_crop_size,
+                                                             get_slices=get_input_slices if read_input_slices else None)
+        # The volume is read first, then the segmentation
+        image_shape = input_shapes[0] if input_shapes else None
+        segmentation_shape = input_shapes[-1] if input_shapes else None
         image_numpy = image_and_segmentation.images
 
         if image_numpy.ndim == 4 and image_numpy.shape[0] == 1:
@@ -368,15 +523,22 @@ def load_images_and_stack(files: Iterable[Path],
         elif image_numpy.ndim != 3:
             raise ValueError(f"Image {file_path} has unsupported shape: {image_numpy.shape}")
 
-        images.append(from_numpy_crop_and_resize(image_numpy))
+        write_channel("images", index, crop_and_resize(image_numpy, image_shape), file_path)
         if load_segmentation:
             # Segmentations are loaded as UInt8. Convert to one-hot encoding as late as possible,
             # that is only before feeding into the model
-            segmentations.append(from_numpy_crop_and_resize(image_and_segmentation.segmentations))
+            write_channel("segmentations", index,
+                          crop_and_resize(image_and_segmentation.segmentations, segmentation_shape), file_path)
 
-    image_tensor = torch.stack(images, dim=0) if len(images) > 0 else torch.empty(0)
-    segmentation_tensor = torch.stack(segmentations, dim=0) if len(segmentations) > 0 else torch.empty(0)
-    return ImageAndSegmentations(images=image_tensor, segmentations=segmentation_tensor)
+    if num_threads <= 1 or len(files) <= 1:
+        for index, file_path in enumerate(files):
+            load_channel(index, file_path)
+    else:
+        with ThreadPoolExecutor(max_workers=min(num_threads, len(files))) as executor:
+            # Consume the results to raise the exceptions of the loading threads
+            list(executor.map(load_channel, range(len(files)), files))
+    return ImageAndSegmentations(images=stacked.get("images", torch.empty(0)),
+                                 segmentations=stacked.get("segmentations", torch.empty(0)))
 
 
 def is_png(file: PathOrString) -> bool:
@@ -387,17 +549,26 @@ def is_png(file: PathOrString) -> bool:
 
 
 def load_image_in_known_formats(file: Path,
-                                load_segmentation: bool) -> ImageAndSegmentations[np.ndarray]:
+                                load_segmentation: bool,
+                                center_crop_size: Optional[TupleInt3] = None,
+                                get_slices: Optional[Callable[[TupleInt3], Tuple[slice, ...]]] = None) \
+        -> ImageAndSegmentations[np.ndarray]:
     """
     Loads an image from a file in the given path. At the moment, this supports Nifti, HDF5, numpy and dicom files.
 
     :param file: The path of the file to load.
     :param load_segmentation: If True it loads segmentation if present on the same file as the image.
+    :param center_crop_size: If given, only the center crop of this size is read from HDF5 files, rather than the
+    whole image. Images in other formats are always loaded in full.
+    :param get_slices: If given, and center_crop_size is not, a function that maps the shape of an image in an HDF5
+    file to the slices that are read from it. Images in other formats are always loaded in full.
     :return: a wrapper class that contains the images and segmentation if present
     """
     if is_hdf5_file_path(file):
         hdf5_object = load_hdf5_file(path_str=file,
-                                     load_segmentation=load_segmentation)
+                                     load_segmentation=load_segmentation,
+                                     center_crop_size=center_crop_size,
+                                     get_slices=get_slices)
         return ImageAndSegmentations(images=hdf5_object.volume,
                                      segmentations=hdf5_object.segmentation if load_segmentation else None)
     elif is_nifti_file_path(file):
@@ -467,12 +638,15 @@ def load_image(path: PathOrString, image_type: Optional[Type] = float) -> ImageW
         For segmentation binary |<dataset_name>|<channel index>
         For segmentation multimap |<dataset_name>|<channel index>|<multimap value>
         The expected dimensions to be (channel, Z, Y, X)
+    Numpy files that have a header file next to them (see store_image_as_numpy) are memory mapped.
     :param path: The path to the file
     :param image_type: The type of the image
     """
     SEPARATOR = '|'
     if is_nifti_file_path(path):
         return load_nifti_image(path, image_type)
+    elif is_numpy_file_path(path) and get_numpy_header_path(path).is_file():
+        return load_memory_mapped_image(path, image_type)
     elif is_numpy_file_path(path):
         image = load_numpy_image(path, image_type)
         header = get_unit_image_header()
@@ -503,6 +677,20 @@ def load_image(path: PathOrString, image_type: Optional[Type] = float) -> ImageW
     raise ValueError(f"Invalid file type {path}")
 
 
+def get_source_files_key(files: Iterable[PathOrString]) -> str:
+    """
+    Gets a string that identifies the contents of the given files by their paths, sizes and modification times,
+    without reading them.
+    :param files: The paths of the files to identify, with the HDF5 dataset suffix that load_image accepts.
+    """
+    files_hash = hashlib.sha256()
+    for path in files:
+        file, *hdf5_dataset = str(path).split("|")
+        stat = os.stat(file)
+        files_hash.update(repr((str(Path(file).absolute()), hdf5_dataset, stat.st_size, stat.st_mtime_ns)).encode())
+    return files_hash.hexdigest()[:32]
+
+
 def load_images_from_dataset_source(dataset_source: PatientDatasetSource, check_exclusive: bool = True) -> Sample:
     """
     Load images. ground truth labels and masks from the provided dataset source.
@@ -513,7 +701,8 @@ def load_images_from_dataset_source(dataset_source: PatientDatasetSource, check_
     :return: a Sample object with the loaded volume (image), labels, mask and metadata.
     """
     images = [load_image(channel, ImageDataType.IMAGE.value) for channel in dataset_source.image_channels]
-    image = np.stack([image.image for image in images])
+    # Adding an axis to a single channel keeps memory mapped images mapped, rather than reading them in full.
+    image = images[0].image[np.newaxis] if len(images) == 1 else np.stack([image.image for image in images])
 
     mask = np.ones_like(image[0], ImageDataType.MASK.value) if dataset_source.mask_channel is None \
         else load_image(dataset_source.mask_channel, ImageDataType.MASK.value).image
@@ -521,6 +710,10 @@ def load_images_from_dataset_source(dataset_source: PatientDatasetSource, check_
     # create raw sample to return
     metadata = copy(dataset_source.metadata)
     metadata.image_header = images[0].header
+    source_files = list(dataset_source.image_channels)
+    if dataset_source.mask_channel is not None:
+        source_files.append(dataset_source.mask_channel)
+    metadata.source_files_key = get_source_files_key(source_files)
     labels = load_labels_from_dataset_source(dataset_source, check_exclusive=check_exclusive, image_size=image[0].shape)
 
     return Sample(image=image,
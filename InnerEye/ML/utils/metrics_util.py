@@ -2,6 +2,7 @@
 #  Copyright (c) Microsoft Corporation. All rights reserved.
 #  Licensed under the MIT License (MIT). See LICENSE in the repo root for license information.
 #  ------------------------------------------------------------------------------------------
+import math
 from functools import reduce
 from pathlib import Path
 from typing import Any, Dict, List, Tuple, Type, Union
@@ -18,7 +19,8 @@ from InnerEye.Common.type_annotations import TupleFloat3
 
 class MetricsPerPatientWriter:
     """
-    Stores information about metrics eg: Dice, Mean and Hausdorff Distances, broken down by patient and structure.
+    Stores information about metrics eg: Dice, Mean, Hausdorff and 95th percentile Hausdorff Distances, broken down by
+    patient and structure.
     """
 
     def __init__(self) -> None:
@@ -26,6 +28,7 @@ class MetricsPerPatientWriter:
                                         MetricsFileColumns.Structure.value: [],
                                         MetricsFileColumns.Dice.value: [],
                                         MetricsFileColumns.HausdorffDistanceMM.value: [],
+                                        MetricsFileColumns.HausdorffDistance95MM.value: [],
                                         MetricsFileColumns.MeanDistanceMM.value: []}
         self.float_format = "%.3f"
 
@@ -34,7 +37,8 @@ class MetricsPerPatientWriter:
             structure: str,
             dice: float,
             hausdorff_distance_mm: float,
-            mean_distance_mm: float) -> None:
+            mean_distance_mm: float,
+            hausdorff_distance_95_mm: float = math.nan) -> None:
         """
         Adds a Dice score, Mean and Hausdorff Distances for a patient + structure combination to the present object.
 
@@ -43,11 +47,13 @@ class MetricsPerPatientWriter:
         :param dice: The value of the Dice score that was achieved.
         :param hausdorff_distance_mm: The hausdorff distance in mm
         :param mean_distance_mm: The mean surface distance in mm
+        :param hausdorff_distance_95_mm: The 95th percentile hausdorff distance in mm
         """
         self.columns[MetricsFileColumns.Patient.value].append(patient)
         self.columns[MetricsFileColumns.Structure.value].append(structure)
         self.columns[MetricsFileColumns.Dice.value].append(format_metric(dice))
         self.columns[MetricsFileColumns.HausdorffDistanceMM.value].append(format_metric(hausdorff_distance_mm))
+        self.columns[MetricsFileColumns.HausdorffDistance95MM.value].append(format_metric(hausdorff_distance_95_mm))
         self.columns[MetricsFileColumns.MeanDistanceMM.value].append(format_metric(mean_distance_mm))
 
     def to_csv(self, file_name: Path) -> None:
@@ -103,8 +109,10 @@ class MetricsPerPatientWriter:
 
         df_dice = filter_rename_metric_columns(MetricsFileColumns.DiceNumeric.value, True)
         df_hd = filter_rename_metric_columns(MetricsFileColumns.HausdorffDistanceMM.value)
+        df_hd95 = filter_rename_metric_columns(MetricsFileColumns.HausdorffDistance95MM.value)
         df_md = filter_rename_metric_columns(MetricsFileColumns.MeanDistanceMM.value)
-        _merge_df(_merge_df(df_dice, df_hd), df_md).to_csv(file_path, float_format=self.float_format)
+        _merge_df(_merge_df(_merge_df(df_dice, df_hd), df_hd95), df_md).to_csv(file_path,
+                                                                             float_format=self.float_format)
 
     def to_data_frame(self) -> DataFrame:
         """
@@ -119,6 +127,7 @@ class MetricsPerPatientWriter:
         dtypes: Dict[str, Union[Type[float], Type[str]]] = {column: str for column in self.columns}
         dtypes[MetricsFileColumns.Dice.value] = float
         dtypes[MetricsFileColumns.HausdorffDistanceMM.value] = float
+        dtypes[MetricsFileColumns.HausdorffDistance95MM.value] = float
         dtypes[MetricsFileColumns.MeanDistanceMM.value] = float
         df = DataFrame(self.columns, dtype=str)
         df = df.astype(dtypes)
@@ -11,7 +11,7 @@ import numpy as np
 import param
 from azureml._restclient.constants import RunStatus
 from azureml.core import Run
-from scipy.ndimage.morphology import binary_erosion, distance_transform_edt, generate_binary_structure
+from scipy.ndimage.morphology import distance_transform_edt
 
 from InnerEye.Azure.azure_config import AzureConfig
 from InnerEye.Azure.azure_util import fetch_child_runs
@@ -21,6 +21,7 @@ from InnerEye.ML.common import ModelExecutionMode
 from InnerEye.ML.config import SegmentationModelBase
 from InnerEye.ML.utils import io_util
 from InnerEye.ML.utils.io_util import load_nifti_image
+from InnerEye.ML.utils.surface_metrics import get_contour
 
 
 class SurfaceDistanceRunType(Enum):
@@ -206,12 +207,7 @@ def extract_border(img: np.ndarray, connectivity: int = 1) -> np.ndarray:
     """
     if not np.unique(img.astype(int)).tolist() == [0, 1]:
         raise ValueError("In order to extract border, you must provide a binary image")
-    # binary structure (kernel for detecting edges)
-    structuring_element = generate_binary_structure(img.ndim, connectivity)
-    erosion = binary_erosion(img, structure=structuring_element, iterations=1)
-    # subtract eroded image from original
-    img_border = img - erosion
-    return img_border
+    return get_contour(img, connectivity, boundary_is_background=True).astype(img.dtype)
 
 
 def calculate_surface_distances(ground_truth: np.ndarray, pred: np.ndarray, voxel_spacing: Union[float, List[float]]
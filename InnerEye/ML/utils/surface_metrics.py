@@ -0,0 +1,199 @@
+#  ------------------------------------------------------------------------------------------
+#  Copyright (c) Microsoft Corporation. All rights reserved.
+#  Licensed under the MIT License (MIT). See LICENSE in the repo root for license information.
+#  ------------------------------------------------------------------------------------------
+import logging
+import math
+from dataclasses import dataclass
+from typing import Dict, Iterable, Optional, Tuple
+
+import numpy as np
+from scipy.ndimage import binary_erosion, distance_transform_edt, find_objects, generate_binary_structure
+
+from InnerEye.Common.type_annotations import TupleFloat3
+from InnerEye.ML.utils.image_util import is_binary_array
+
+BoundingBox = Tuple[slice, slice, slice]
+
+# Connectivities of the neighbourhoods to detect the surface of a structure. Voxels that touch the background at a face
+# make up the surface on which distances are measured. Distances are measured to voxels that touch the background at a
+# face, edge or corner, like in the SimpleITK SignedMaurerDistanceMap filter.
+FACE_CONNECTIVITY = 1
+FULL_CONNECTIVITY = 3
+
+
+@dataclass(frozen=True)
+class SegmentationMetrics:
+    """
+    Overlap and surface distance metrics for a single structure. Distances are in millimeters. All metrics are NaN if
+    both the prediction and the ground truth are empty. If only one of them is empty, distances are infinite.
+    """
+    dice: float
+    hausdorff_distance_mm: float
+    hausdorff_distance_95_mm: float
+    mean_surface_distance_mm: float
+
+
+# The metrics for a structure that is empty in both the prediction and the ground truth.
+NAN_METRICS = SegmentationMetrics(dice=math.nan, hausdorff_distance_mm=math.nan, hausdorff_distance_95_mm=math.nan,
+                                  mean_surface_distance_mm=math.nan)
+
+
+def get_bounding_box(mask: np.ndarray) -> Optional[BoundingBox]:
+    """
+    Gets the smallest box that contains all non-zero voxels of the mask, or None if the mask is empty.
+    """
+    boxes = find_objects((mask != 0).view(np.uint8))
+    return boxes[0] if boxes else None
+
+
+def get_union_bounding_box(box1: Optional[BoundingBox],
+                           box2: Optional[BoundingBox],
+                           shape: Tuple[int, ...],
+                           margin: int = 1) -> BoundingBox:
+    """
+    Gets the smallest box that contains both boxes, enlarged by the margin on all sides and clipped to the image.
+    At least one of the boxes must not be None.
+    """
+    boxes = [box for box in (box1, box2) if box is not None]
+    if not boxes:
+        raise ValueError("At least one bounding box must be given.")
+    return tuple(slice(max(0, min(box[axis].start for box in boxes) - margin),  # type: ignore
+                       min(shape[axis], max(box[axis].stop for box in boxes) + margin))
+                 for axis in range(3))
+
+
+def get_contour(mask: np.ndarray, connectivity: int, boundary_is_background: bool = False) -> np.ndarray:
+    """
+    Gets the voxels of the binary mask that have a background voxel in their neighbourhood.
+    :param mask: The binary mask.
+    :param connectivity: Determines which voxels are neighbours, from 1 (only voxels that share a face) to the number
+    of dimensions (all voxels that share a face, edge or corner), as in generate_binary_structure.
+    :param boundary_is_background: If True, voxels outside of the image count as background, hence mask voxels at the
+    image boundary are part of the contour.
+    :return: A boolean array with the contour voxels.
+    """
+    mask = mask.astype(bool, copy=False)
+    structure = generate_binary_structure(mask.ndim, connectivity)
+    return mask & ~binary_erosion(mask, structure=structure, border_value=0 if boundary_is_background else 1)
+
+
+def get_distance_to_surface(reference: np.ndarray, voxel_spacing: TupleFloat3) -> Optional[np.ndarray]:
+    """
+    Computes the distance of each voxel to the surface of the reference, in millimeters. Outside of the reference, this
+    is also the distance to the nearest voxel of the reference.
+    :return: The distance map, or None if the reference covers the whole image and hence has no surface.
+    """
+    reference_contour = get_contour(reference, FULL_CONNECTIVITY)
+    if not np.any(reference_contour):
+        return None
+    return distance_transform_edt(~reference_contour, sampling=voxel_spacing)
+
+
+def get_directed_distances(mask: np.ndarray,
+                           reference: np.ndarray,
+                           distance_to_reference: Optional[np.ndarray]) -> Tuple[float, np.ndarray]:
+    """
+    Gets the directed Hausdorff distance from the mask to the reference, which is the largest distance of a voxel of
+    the mask to the nearest voxel of the reference, and the distances from the surface voxels of the mask to the
+    surface of the reference.
+    :param distance_to_reference: The distance map created by get_distance_to_surface for the reference.
+    :return: A tuple of the directed Hausdorff distance, and a vector with the distance for each surface voxel.
+    """
+    mask_surface = get_contour(mask, FACE_CONNECTIVITY)
+    if distance_to_reference is None:
+        # All voxels of the mask are inside the reference, but there is no reference surface to measure distances to.
+        return 0.0, np.full(np.count_nonzero(mask_surface), math.inf)
+    outside = mask & ~reference
+    hausdorff_distance = float(distance_to_reference[outside].max()) if np.any(outside) else 0.0
+    return hausdorff_distance, distance_to_reference[mask_surface]
+
+
+def get_percentile(distances: np.ndarray, percentile: float) -> float:
+    """
+    Gets the given percentile of the distances, or 0 if there are no distances.
+    """
+    if len(distances) == 0:
+        return 0.0
+    if np.isinf(distances).any():
+        return math.inf
+    return float(np.percentile(distances, percentile))
+
+
+def compute_segmentation_metrics(prediction: np.ndarray,
+                                 ground_truth: np.ndarray,
+                                 voxel_spacing: TupleFloat3) -> SegmentationMetrics:
+    """
+    Computes Dice, Hausdorff distance, 95th percentile Hausdorff distance and mean surface distance for a single
+    structure. Both arrays should already be cropped to the region around the structure, with a margin of at least
+    one voxel unless the structure touches the image boundary.
+    :param prediction: The predicted binary mask, Z x Y x X.
+    :param ground_truth: The ground truth binary mask, Z x Y x X.
+    :param voxel_spacing: The voxel spacing in Z x Y x X, in millimeters.
+    :raises ValueError: If the prediction or the ground truth contain values other than 0 and 1.
+    """
+    if not is_binary_array(prediction):
+        raise ValueError("Predictions values should be 0 or 1")
+    if not is_binary_array(ground_truth):
+        raise ValueError("Ground truth values should be 0 or 1")
+    prediction = prediction.astype(bool, copy=False)
+    ground_truth = ground_truth.astype(bool, copy=False)
+    prediction_count = np.count_nonzero(prediction)
+    ground_truth_count = np.count_nonzero(ground_truth)
+    if prediction_count == 0 and ground_truth_count == 0:
+        return NAN_METRICS
+    dice = float(2 * np.count_nonzero(prediction & ground_truth) / (prediction_count + ground_truth_count))
+    if prediction_count == 0 or ground_truth_count == 0:
+        return SegmentationMetrics(dice=dice, hausdorff_distance_mm=math.inf, hausdorff_distance_95_mm=math.inf,
+                                   mean_surface_distance_mm=math.inf)
+    hausdorff_to_ground_truth, prediction_to_ground_truth = \
+        get_directed_distances(prediction, ground_truth, get_distance_to_surface(ground_truth, voxel_spacing))
+    hausdorff_to_prediction, ground_truth_to_prediction = \
+        get_directed_distances(ground_truth, prediction, get_distance_to_surface(prediction, voxel_spacing))
+    hausdorff_distance = max(hausdorff_to_ground_truth, hausdorff_to_prediction)
+    hausdorff_distance_95 = max(get_percentile(distances, 95)
+                                for distances in (prediction_to_ground_truth, ground_truth_to_prediction))
+    all_distances = np.concatenate([prediction_to_ground_truth, ground_truth_to_prediction])
+    mean_surface_distance = np.mean(all_distances) if len(all_distances) > 0 else math.nan
+    return SegmentationMetrics(dice=dice,
+                               hausdorff_distance_mm=hausdorff_distance,
+                               hausdorff_distance_95_mm=hausdorff_distance_95,
+                               mean_surface_distance_mm=float(mean_surface_distance))
+
+
+def compute_segmentation_metrics_per_class(segmentation: np.ndarray,
+                                           ground_truth: np.ndarray,
+                                           class_indices: Iterable[int],
+                                           voxel_spacing: TupleFloat3,
+                                           patient_id: Optional[int] = None) -> Dict[int, SegmentationMetrics]:
+    """
+    Computes the metrics for multiple structures. The bounding boxes of all predicted structures are found in a
+    single pass over the segmentation, and each structure is then evaluated only within the bounding box around
+    its prediction and ground truth. If the metrics for a structure cannot be computed, a warning is logged and all
+    its metrics are NaN, such that the other structures are still evaluated.
+    :param segmentation: The predicted segmentation with class indices, Z x Y x X.
+    :param ground_truth: The binary ground truth for each class, Classes x Z x Y x X.
+    :param class_indices: The indices of the classes to evaluate.
+    :param voxel_spacing: The voxel spacing in Z x Y x X, in millimeters.
+    :param patient_id: for logging
+    :return: A dictionary mapping from class index to the metrics for that class.
+    """
+    if not np.issubdtype(segmentation.dtype, np.integer):
+        segmentation = segmentation.astype(np.int64)
+    prediction_boxes = find_objects(segmentation)
+    result: Dict[int, SegmentationMetrics] = {}
+    for class_index in class_indices:
+        prediction_box = prediction_boxes[class_index - 1] if 0 < class_index <= len(prediction_boxes) else None
+        ground_truth_box = get_bounding_box(ground_truth[class_index])
+        if prediction_box is None and ground_truth_box is None:
+            result[class_index] = NAN_METRICS
+            continue
+        box = get_union_bounding_box(prediction_box, ground_truth_box, segmentation.shape)
+        try:
+            result[class_index] = compute_segmentation_metrics(segmentation[box] == class_index,
+                                                               ground_truth[class_index][box] != 0,
+                                                               voxel_spacing)
+        except Exception as e:
+            logging.warning(f"Cannot calculate metrics for structure {class_index} of patient {patient_id}: {e}")
+            result[class_index] = NAN_METRICS
+    return result
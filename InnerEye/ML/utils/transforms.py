@@ -50,6 +50,10 @@ class Compose3D(Generic[T]):
     def __init__(self, transforms: List[Transform3D[T]]):
         self._transforms = transforms
 
+    @property
+    def transforms(self) -> List[Transform3D[T]]:
+        return self._transforms
+
     def __call__(self, sample: T) -> T:
         # pythonic implementation of the foldl function
         # foldl (-) 0 [1,2,3] => (((0 - 1) - 2) - 3) => -6
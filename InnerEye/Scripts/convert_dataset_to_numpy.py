@@ -0,0 +1,124 @@
+#  ------------------------------------------------------------------------------------------
+#  Copyright (c) Microsoft Corporation. All rights reserved.
+#  Licensed under the MIT License (MIT). See LICENSE in the repo root for license information.
+#  ------------------------------------------------------------------------------------------
+"""
+This script converts the Nifti images of a segmentation dataset to uncompressed .npy files with a header file next to
+them, which the data loaders memory map (see io_util.load_memory_mapped_image). Loading a crop from such a file only
+reads the pages that the crop covers, rather than decompressing the full image. Invoke via
+python InnerEye/Scripts/convert_dataset_to_numpy.py --dataset_folder=<folder with dataset.csv> --output_folder=<folder>
+--image_channels=ct
+The output folder contains a dataset.csv with the same rows as the input, and paths that point to the converted files.
+Files that are not Nifti images are copied unchanged.
+"""
+import logging
+import shutil
+from multiprocessing import Pool
+from pathlib import Path
+from typing import List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+import param
+
+from InnerEye.Common.common_util import logging_to_stdout
+from InnerEye.Common.generic_parsing import GenericConfig
+from InnerEye.ML.common import DATASET_CSV_FILE_NAME
+from InnerEye.ML.utils.csv_util import CSV_CHANNEL_HEADER, CSV_PATH_HEADER
+from InnerEye.ML.utils.image_util import ImageDataType
+from InnerEye.ML.utils.io_util import MedicalImageFileType, is_nifti_file_path, load_nifti_image, \
+    store_image_as_numpy
+
+
+class ConvertDatasetConfig(GenericConfig):
+    """
+    Command line parameter class.
+    """
+    dataset_folder: Path = param.ClassSelector(class_=Path, doc="The folder that contains the dataset.csv file and "
+                                                                "the images of the dataset. Mandatory.")
+    output_folder: Path = param.ClassSelector(class_=Path, doc="The folder in which to write the converted dataset. "
+                                                               "Mandatory.")
+    image_channels: List[str] = param.List(class_=str, doc="The channels that contain images. These are stored as "
+                                                           "32bit floats, the data type that the data loaders use "
+                                                           "for images. All other channels (ground truth and "
+                                                           "masks) must be binary, and are stored as bytes.")
+    num_workers: int = param.Integer(4, bounds=(1, None), doc="The number of processes that convert images.")
+
+    def validate(self) -> None:
+        if self.dataset_folder is None or not (self.dataset_folder / DATASET_CSV_FILE_NAME).is_file():
+            raise ValueError(f"dataset_folder must contain a {DATASET_CSV_FILE_NAME} file")
+        if self.output_folder is None:
+            raise ValueError("output_folder must be set")
+        if self.output_folder.resolve() == self.dataset_folder.resolve():
+            raise ValueError("output_folder must be different from dataset_folder")
+        if not self.image_channels:
+            raise ValueError("image_channels must contain at least one channel")
+
+
+def get_numpy_file_name(file_name: str) -> str:
+    """
+    Replaces the Nifti extension of a file name with .npy.
+    """
+    for file_type in MedicalImageFileType:
+        if file_name.lower().endswith(file_type.value):
+            return file_name[:-len(file_type.value)] + ".npy"
+    raise ValueError(f"Not a Nifti file: {file_name}")
+
+
+def convert_file(source: Path, target: Path, is_image: bool) -> None:
+    """
+    Converts a single Nifti file to a .npy file and header, or copies the file if it is not a Nifti file.
+    :param source: The file to convert.
+    :param target: The path of the converted file.
+    :param is_image: If True, the file is stored in the data type for images, otherwise as a binary mask.
+    """
+    target.parent.mkdir(parents=True, exist_ok=True)
+    if not is_nifti_file_path(source):
+        shutil.copy(source, target)
+        return
+    image_with_header = load_nifti_image(source, image_type=None)
+    image = image_with_header.image
+    if is_image:
+        image = image.astype(ImageDataType.IMAGE.value)
+    else:
+        if not np.isin(image, [0, 1]).all():
+            raise ValueError(f"File {source} is not in image_channels, but is not binary")
+        image = image.astype(ImageDataType.MASK.value)
+    store_image_as_numpy(image, image_with_header.header, target)
+
+
+def convert_file_from_tuple(args: Tuple[Path, Path, bool]) -> None:
+    convert_file(*args)
+
+
+def convert_dataset(config: ConvertDatasetConfig) -> pd.DataFrame:
+    """
+    Converts all images of the dataset, and writes a dataset.csv file with the new paths to the output folder.
+    :return: The data frame that was written to the new dataset.csv file.
+    """
+    dataframe = pd.read_csv(config.dataset_folder / DATASET_CSV_FILE_NAME, dtype=str, low_memory=False)
+    tasks: List[Tuple[Path, Path, bool]] = []
+    new_paths: List[str] = []
+    for path, channel in zip(dataframe[CSV_PATH_HEADER], dataframe[CSV_CHANNEL_HEADER]):
+        new_path = get_numpy_file_name(path) if is_nifti_file_path(path) else path
+        new_paths.append(new_path)
+        tasks.append((config.dataset_folder / path, config.output_folder / new_path, channel in config.image_channels))
+    logging.info(f"Converting {len(tasks)} files with {config.num_workers} processes")
+    with Pool(processes=config.num_workers) as pool:
+        for _ in pool.imap_unordered(convert_file_from_tuple, tasks):
+            pass
+    dataframe[CSV_PATH_HEADER] = new_paths
+    dataframe.to_csv(config.output_folder / DATASET_CSV_FILE_NAME, index=False)
+    return dataframe
+
+
+def main(args: Optional[List[str]] = None) -> None:
+    """
+    Main function.
+    """
+    logging_to_stdout()
+    convert_dataset(ConvertDatasetConfig.parse_args(args))
+
+
+if __name__ == '__main__':
+    main()
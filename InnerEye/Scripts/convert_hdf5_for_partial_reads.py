@@ -0,0 +1,137 @@
+#  ------------------------------------------------------------------------------------------
+#  Copyright (c) Microsoft Corporation. All rights reserved.
+#  Licensed under the MIT License (MIT). See LICENSE in the repo root for license information.
+#  ------------------------------------------------------------------------------------------
+"""
+This script rewrites the HDF5 files of a dataset such that their images are stored in small chunks with a fast
+compression filter. When the data loaders only read a center crop of an image (see HDF5Object.from_file), only the
+chunks that the crop covers are then read and decompressed, rather than the whole image. Invoke via
+python InnerEye/Scripts/convert_hdf5_for_partial_reads.py --dataset_folder=<folder> --output_folder=<folder>
+The output folder contains all files of the dataset folder, in the same subfolders and with the same names, such that
+the dataset.csv file remains valid. Files that are not HDF5 files are copied unchanged. Compressed HDF5 files (.h5.gz
+and .h5.sz) are copied unchanged too, with a warning: They must be decompressed before they can be converted.
+"""
+import logging
+import shutil
+from multiprocessing import Pool
+from pathlib import Path
+from typing import List, Optional, Tuple
+
+import h5py
+import param
+
+from InnerEye.Common.common_util import logging_to_stdout
+from InnerEye.Common.generic_parsing import GenericConfig
+
+COMPRESSION_FILTERS = ["lzf", "gzip"]
+HDF5_SUFFIXES = [".h5", ".hdf5"]
+COMPRESSED_HDF5_SUFFIXES = [".h5.gz", ".h5.sz"]
+
+
+class ConvertHDF5Config(GenericConfig):
+    """
+    Command line parameter class.
+    """
+    dataset_folder: Path = param.ClassSelector(class_=Path, doc="The folder that contains the dataset. Mandatory.")
+    output_folder: Path = param.ClassSelector(class_=Path, doc="The folder in which to write the converted dataset. "
+                                                               "Mandatory.")
+    chunk_size: int = param.Integer(32, bounds=(1, None), doc="The size of the chunks along each image dimension. "
+                                                              "Smaller chunks make reads of small crops cheaper, "
+                                                              "larger chunks compress better.")
+    compression: str = param.String("lzf", doc="The compression filter for images, lzf or gzip. lzf is fast and "
+                                               "built into h5py, gzip gives smaller files but is slower to "
+                                               "decompress.")
+    num_workers: int = param.Integer(4, bounds=(1, None), doc="The number of processes that convert files.")
+
+    def validate(self) -> None:
+        if self.dataset_folder is None or not self.dataset_folder.is_dir():
+            raise ValueError("dataset_folder must be an existing folder")
+        if self.output_folder is None:
+            raise ValueError("output_folder must be set")
+        if self.output_folder.resolve() == self.dataset_folder.resolve():
+            raise ValueError("output_folder must be different from dataset_folder")
+        if self.compression not in COMPRESSION_FILTERS:
+            raise ValueError(f"compression must be one of {COMPRESSION_FILTERS}, but got {self.compression}")
+
+
+def get_chunk_shape(shape: Tuple[int, ...], chunk_size: int) -> Optional[Tuple[int, ...]]:
+    """
+    Gets the chunk shape for a dataset in an HDF5 file. Images in the N x C x H x W layout are chunked along N, H and
+    W, with one channel per chunk, and 3D images along all dimensions. Other datasets, for example the patient ID, are
+    not chunked.
+    :param shape: The shape of the dataset.
+    :param chunk_size: The size of the chunks along each image dimension.
+    :return: The shape of the chunks, or None if the dataset should not be chunked.
+    """
+    if len(shape) == 4:
+        return min(chunk_size, shape[0]), 1, min(chunk_size, shape[2]), min(chunk_size, shape[3])
+    if len(shape) == 3:
+        return tuple(min(chunk_size, s) for s in shape)
+    return None
+
+
+def convert_file(source: Path, target: Path, chunk_size: int, compression: str) -> None:
+    """
+    Rewrites a single HDF5 file with chunked and compressed images, or copies the file if it is not an HDF5 file.
+    Groups, attributes and all other datasets are copied unchanged.
+    :param source: The file to convert.
+    :param target: The path of the converted file.
+    :param chunk_size: The size of the chunks along each image dimension.
+    :param compression: The compression filter for images.
+    """
+    target.parent.mkdir(parents=True, exist_ok=True)
+    if source.suffix.lower() not in HDF5_SUFFIXES:
+        shutil.copy(source, target)
+        return
+    with h5py.File(str(source), 'r') as source_file, h5py.File(str(target), 'w') as target_file:
+        target_file.attrs.update(source_file.attrs)
+
+        def convert_item(name: str, item: h5py.HLObject) -> None:
+            if isinstance(item, h5py.Group):
+                target_file.require_group(name).attrs.update(item.attrs)
+                return
+            chunks = get_chunk_shape(item.shape, chunk_size) if item.dtype.kind in "biuf" else None
+            if chunks is None:
+                source_file.copy(item, target_file, name=name)
+            else:
+                dataset = target_file.create_dataset(name, data=item[()], chunks=chunks, compression=compression)
+                dataset.attrs.update(item.attrs)
+
+        source_file.visititems(convert_item)
+
+
+def convert_file_from_tuple(args: Tuple[Path, Path, int, str]) -> None:
+    convert_file(*args)
+
+
+def convert_dataset(config: ConvertHDF5Config) -> List[Path]:
+    """
+    Converts all HDF5 files in the dataset folder, and copies all other files, to the output folder.
+    :return: The paths of all files in the output folder, relative to the output folder.
+    """
+    files = sorted(path.relative_to(config.dataset_folder) for path in config.dataset_folder.rglob("*")
+                   if path.is_file())
+    tasks = [(config.dataset_folder / file, config.output_folder / file, config.chunk_size, config.compression)
+             for file in files]
+    compressed_files = [file for file in files if file.name.lower().endswith(tuple(COMPRESSED_HDF5_SUFFIXES))]
+    if compressed_files:
+        logging.warning(f"{len(compressed_files)} compressed HDF5 files are copied without conversion, and are still "
+                        f"read in full. Decompress them before the conversion to read crops partially. First file: "
+                        f"{compressed_files[0]}")
+    logging.info(f"Converting {len(tasks)} files with {config.num_workers} processes")
+    with Pool(processes=config.num_workers) as pool:
+        for _ in pool.imap_unordered(convert_file_from_tuple, tasks):
+            pass
+    return files
+
+
+def main(args: Optional[List[str]] = None) -> None:
+    """
+    Main function.
+    """
+    logging_to_stdout()
+    convert_dataset(ConvertHDF5Config.parse_args(args))
+
+
+if __name__ == '__main__':
+    main()
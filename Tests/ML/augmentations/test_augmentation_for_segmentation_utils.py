@@ -3,12 +3,14 @@
 #  Licensed under the MIT License (MIT). See LICENSE in the repo root for license information.
 #  ------------------------------------------------------------------------------------------
 
+from pathlib import Path
 from typing import Any, List
 
 import numpy as np
 import pytest
 
-from InnerEye.ML.augmentations.augmentation_for_segmentation_utils import random_crop
+from InnerEye.ML.augmentations.augmentation_for_segmentation_utils import ForegroundIndex, \
+    ForegroundIndexCache, random_crop, random_select_patch_center
 from InnerEye.ML.dataset.sample import Sample
 from InnerEye.ML.utils import ml_util
 
@@ -160,3 +162,65 @@ def test_valid_class_weights(class_weights: List[float]) -> None:
         expected_label_center_distribution = [class_weights[c] / total if c in non_empty_classes else 0.0
                                               for c in range(number_of_classes)]
     assert np.allclose(sampled_label_center_distribution, expected_label_center_distribution, atol=0.1)
+
+
+def test_foreground_index(tmp_path: Path) -> None:
+    """
+    Test that sampling crop centers from the foreground index gives the same centers as scanning the labels, and
+    that the index can be saved and loaded.
+    """
+    labels = np.zeros((3,) + image_size)
+    labels[0] = 1 - class_assignments
+    labels[1] = class_assignments
+    sample = Sample(image=valid_image_4d, labels=labels, mask=valid_mask, metadata=DummyPatientMetadata)
+    foreground_index = ForegroundIndex.create(labels=labels, mask=valid_mask)
+    assert foreground_index.num_classes == 3
+    assert len(foreground_index.get_class_indices(2)) == 0
+    file_prefix = tmp_path / "subject"
+    assert ForegroundIndex.load(file_prefix) is None
+    foreground_index.save(file_prefix)
+    loaded = ForegroundIndex.load(file_prefix)
+    assert loaded is not None
+    assert loaded.shape == image_size
+    assert np.array_equal(loaded.indices, foreground_index.indices)
+    assert np.array_equal(loaded.offsets, foreground_index.offsets)
+    for index in [None, foreground_index, loaded]:
+        ml_util.set_random_seed(1)
+        centers = [random_select_patch_center(sample, [0.2, 0.3, 0.5], foreground_index=index) for _ in range(50)]
+        if index is None:
+            expected = centers
+        assert np.array_equal(centers, expected)
+    for center in expected:
+        assert labels[(slice(None),) + tuple(center)].any() and valid_mask[tuple(center)] == 1
+    with pytest.raises(ValueError) as ex:
+        random_select_patch_center(sample, foreground_index=ForegroundIndex.create(labels[:2], valid_mask))
+    assert "foreground index was created for 2 classes" in str(ex)
+
+
+@pytest.mark.parametrize("use_folder", [True, False])
+def test_foreground_index_cache(use_folder: bool, tmp_path: Path) -> None:
+    """
+    Test that the foreground index cache creates each index once, keeps it in memory up to the byte limit, and
+    stores it in the folder if one is given.
+    """
+    labels = valid_labels[:2]
+    expected = ForegroundIndex.create(labels=labels, mask=valid_mask)
+    size = expected.indices.nbytes
+    cache = ForegroundIndexCache(folder=tmp_path if use_folder else None, max_bytes_in_memory=size)
+    first = cache.get_or_create("a", labels=labels, mask=valid_mask)
+    assert np.array_equal(first.indices, expected.indices)
+    assert np.array_equal(first.offsets, expected.offsets)
+    # The labels are not used when the index is found in memory.
+    assert cache.get_or_create("a", labels=np.zeros_like(labels), mask=valid_mask) is first
+    cache.get_or_create("b", labels=labels, mask=valid_mask)
+    assert (tmp_path / "a_foreground_indices.npy").is_file() == use_folder
+    if use_folder:
+        # Memory mapped indices do not count towards the limit.
+        assert cache.num_bytes == 0
+        assert list(cache.indices.keys()) == ["a", "b"]
+        assert ForegroundIndexCache(folder=tmp_path).get_or_create("a", labels=np.zeros_like(labels),
+                                                                   mask=valid_mask).indices.tolist() \
+            == expected.indices.tolist()
+    else:
+        assert cache.num_bytes == size
+        assert list(cache.indices.keys()) == ["b"]
@@ -0,0 +1,78 @@
+#  ------------------------------------------------------------------------------------------
+#  Copyright (c) Microsoft Corporation. All rights reserved.
+#  Licensed under the MIT License (MIT). See LICENSE in the repo root for license information.
+#  ------------------------------------------------------------------------------------------
+"""
+Compares wall time and peak memory of assembling a slide-level map from tiles, between the previous approach (a float64
+canvas filled one tile at a time) and the vectorised assembly into float32 or uint8 arrays, memory mapped arrays, and
+downsampled arrays. Peak memory does not include memory mapped files.
+Run via: python -m Tests.ML.benchmarks.benchmark_assemble_tiles
+"""
+import tempfile
+from pathlib import Path
+from typing import Any, List, Tuple
+
+import numpy as np
+
+from InnerEye.ML.Histopathology.preprocessing.tiling import assemble_tiles_2d, create_assembly_array
+from Tests.ML.benchmarks.benchmark_util import measure, print_table
+
+TILE_SIZE = 224
+GRID_SIZE = 40
+N_TILES = 1000
+CHUNK_SIZE = 100
+
+
+def create_tiles() -> Tuple[np.ndarray, np.ndarray]:
+    """Creates single channel uint8 tiles at random positions of a square grid, e.g. the attention of each tile."""
+    random_state = np.random.RandomState(0)
+    positions = random_state.choice(GRID_SIZE * GRID_SIZE, size=N_TILES, replace=False)
+    coords = TILE_SIZE * np.stack([positions % GRID_SIZE, positions // GRID_SIZE], axis=1)
+    values = random_state.randint(256, size=N_TILES).astype(np.uint8)
+    tiles = np.broadcast_to(values[:, None, None, None], (N_TILES, 1, TILE_SIZE, TILE_SIZE)).copy()
+    return tiles, coords
+
+
+def previous_assemble_tiles_2d(tiles: np.ndarray, coords: np.ndarray, fill_value: float) -> np.ndarray:
+    """Re-implementation of the previous assembly."""
+    tile_size = tiles.shape[2]
+    tile_xs, tile_ys = coords.T
+    x_min, x_max = min(tile_xs), max(tile_xs + tile_size)
+    y_min, y_max = min(tile_ys), max(tile_ys + tile_size)
+    array = np.full((tiles.shape[1], y_max - y_min, x_max - x_min), fill_value)
+    for idx in range(tiles.shape[0]):
+        row = coords[idx, 1] - y_min
+        col = coords[idx, 0] - x_min
+        array[:, row:row + tile_size, col:col + tile_size] = tiles[idx]
+    return array
+
+
+def assemble_in_chunks(tiles: np.ndarray, coords: np.ndarray, downsample: int, path: Path) -> np.ndarray:
+    out, offset = create_assembly_array(coords, TILE_SIZE, channels=1, fill_value=0, dtype=np.uint8,
+                                        downsample=downsample, path=path)
+    for start in range(0, len(tiles), CHUNK_SIZE):
+        assemble_tiles_2d(tiles[start:start + CHUNK_SIZE], coords[start:start + CHUNK_SIZE],
+                          downsample=downsample, out=out, offset=offset)
+    out.flush()
+    return out
+
+
+def main() -> None:
+    tiles, coords = create_tiles()
+    float_tiles = tiles.astype(np.float32)
+    rows: List[List[Any]] = []
+    with tempfile.TemporaryDirectory() as temp_dir:
+        path = Path(temp_dir) / "assembled.npy"
+        for method, output, fn in [
+            ("previous", "float64", lambda: previous_assemble_tiles_2d(tiles, coords, np.nan)),
+            ("vectorised", "float32", lambda: assemble_tiles_2d(float_tiles, coords)),
+            ("vectorised", "uint8", lambda: assemble_tiles_2d(tiles, coords, fill_value=0)),
+            ("chunks", "uint8 memmap", lambda: assemble_in_chunks(tiles, coords, 1, path)),
+            ("chunks", "uint8 memmap, 1/8", lambda: assemble_in_chunks(tiles, coords, 8, path))]:
+            seconds, megabytes = measure(fn, repeats=3)
+            rows.append([method, output, seconds, megabytes])
+    print_table(["Method", "Output", "Wall time (s)", "Peak memory (MB)"], rows)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,91 @@
+#  ------------------------------------------------------------------------------------------
+#  Copyright (c) Microsoft Corporation. All rights reserved.
+#  Licensed under the MIT License (MIT). See LICENSE in the repo root for license information.
+#  ------------------------------------------------------------------------------------------
+"""
+Compares Dice and the number of forward passes for the different patch blending modes at different inference
+strides. The model is simulated: It predicts the ground truth, with noise that grows towards the patch borders,
+mimicking the lack of context there that causes seam artefacts. Voxels at the image boundary are only ever seen at
+a patch border, hence Dice is computed on the image interior, where the seams between patches are.
+Run via: python -m Tests.ML.benchmarks.benchmark_blending
+"""
+from typing import Any, List
+
+import numpy as np
+
+from InnerEye.Common.type_annotations import TupleInt3
+from InnerEye.ML.config import BlendingMode, PaddingMode
+from InnerEye.ML.pipelines.sliding_window import SlidingWindowEngine
+from Tests.ML.benchmarks.benchmark_util import measure, print_table
+
+IMAGE_SHAPE = (48, 160, 160)
+PATCH_SIZE = (32, 64, 64)
+BORDER_FRACTION = 0.25
+MAX_BORDER_NOISE = 4.0
+
+
+def create_ground_truth() -> np.ndarray:
+    """
+    Creates a binary segmentation with a few ellipsoids of different size.
+    """
+    z, y, x = np.indices(IMAGE_SHAPE)
+    ground_truth = np.zeros(IMAGE_SHAPE, dtype=np.float32)
+    for center, radii in [((24, 50, 60), (12, 30, 25)), ((20, 110, 100), (10, 20, 35)), ((30, 80, 130), (8, 15, 15))]:
+        distance = sum(((axis - c) / r) ** 2 for axis, c, r in zip((z, y, x), center, radii))
+        ground_truth[distance <= 1] = 1
+    return ground_truth
+
+
+def border_noise_scale(patch_size: TupleInt3) -> np.ndarray:
+    """
+    The standard deviation of the simulated prediction noise at each voxel of a patch: Zero in the center, growing
+    linearly to MAX_BORDER_NOISE in the outer BORDER_FRACTION of the patch along each axis.
+    """
+    per_axis = []
+    for size in patch_size:
+        positions = np.arange(size)
+        distance_to_border = np.minimum(positions, size - 1 - positions)
+        per_axis.append(np.clip(1 - distance_to_border / (BORDER_FRACTION * size), 0, 1))
+    return MAX_BORDER_NOISE * np.maximum(np.maximum(per_axis[0][:, None, None], per_axis[1][None, :, None]),
+                                         per_axis[2][None, None, :])
+
+
+def simulated_model(seed: int) -> Any:
+    random_state = np.random.RandomState(seed)
+    noise_scale = border_noise_scale(PATCH_SIZE)
+
+    def model_fn(patches: np.ndarray) -> np.ndarray:
+        logits = (2 * patches[:, 0] - 1) * 2 + random_state.normal(size=patches[:, 0].shape) * noise_scale
+        foreground = 1 / (1 + np.exp(-logits))
+        return np.stack([1 - foreground, foreground], axis=1).astype(np.float32)
+
+    return model_fn
+
+
+def interior_dice(segmentation: np.ndarray, ground_truth: np.ndarray) -> float:
+    interior = tuple(slice(int(BORDER_FRACTION * size), -int(BORDER_FRACTION * size)) for size in PATCH_SIZE)
+    segmentation = segmentation[interior]
+    ground_truth = ground_truth[interior]
+    intersection = np.sum(segmentation * ground_truth)
+    return float(2 * intersection / (np.sum(segmentation) + np.sum(ground_truth)))
+
+
+def main() -> None:
+    ground_truth = create_ground_truth()
+    rows: List[List[Any]] = []
+    for blending_mode in [BlendingMode.Uniform, BlendingMode.LinearRamp, BlendingMode.Gaussian]:
+        for stride_fraction in [8, 4, 2, 1]:
+            stride = tuple(size // stride_fraction for size in PATCH_SIZE)
+            engine = SlidingWindowEngine(image_shape=IMAGE_SHAPE, crop_size=PATCH_SIZE, output_size=PATCH_SIZE,
+                                         stride=stride, blending_mode=blending_mode)
+            posteriors = engine.predict(simulated_model(seed=0), ground_truth[None], num_classes=2, batch_size=8,
+                                        padding_mode=PaddingMode.Edge)
+            seconds, _ = measure(lambda: engine.predict(simulated_model(seed=0), ground_truth[None], num_classes=2,
+                                                        batch_size=8, padding_mode=PaddingMode.Edge), repeats=1)
+            rows.append([blending_mode.value, str(stride), engine.num_windows,
+                         interior_dice(np.argmax(posteriors, axis=0), ground_truth), seconds])
+    print_table(["Blending", "Stride", "Forward passes", "Interior Dice", "Wall time (s)"], rows)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,62 @@
+#  ------------------------------------------------------------------------------------------
+#  Copyright (c) Microsoft Corporation. All rights reserved.
+#  Licensed under the MIT License (MIT). See LICENSE in the repo root for license information.
+#  ------------------------------------------------------------------------------------------
+"""
+Compares the throughput of the DeepMIL forward and backward pass on batches of bags of different sizes, between the
+previous loop that calls the model once per bag and DeepMILModule.forward_bags, which processes all bags at once.
+The bags contain precomputed tile embeddings, as when training with an IdentityEncoder.
+Run via: python -m Tests.ML.benchmarks.benchmark_deepmil_bags
+"""
+from typing import Any, List
+
+import numpy as np
+import torch
+from torch import Tensor
+
+from health_ml.networks.layers.attention_layers import GatedAttentionLayer
+from InnerEye.ML.Histopathology.models.deepmil import DeepMILModule
+from InnerEye.ML.Histopathology.models.encoders import IdentityEncoder
+from Tests.ML.benchmarks.benchmark_util import measure, print_table
+
+NUM_FEATURES = 512
+NUM_BATCHES = 20
+
+
+def create_batches(batch_size: int, max_bag_size: int, device: torch.device) -> List[List[Tensor]]:
+    random_state = np.random.RandomState(0)
+    return [[torch.randn(random_state.randint(1, max_bag_size + 1), NUM_FEATURES, device=device)
+             for _ in range(batch_size)]
+            for _ in range(NUM_BATCHES)]
+
+
+def previous_forward_bags(module: DeepMILModule, bags: List[Tensor]) -> Tensor:
+    """
+    Re-implementation of the previous loop in DeepMILModule._shared_step.
+    """
+    return torch.stack([module(bag)[0].view(-1) for bag in bags])
+
+
+def run_batches(module: DeepMILModule, batches: List[List[Tensor]], batched: bool) -> None:
+    for bags in batches:
+        logits = module.forward_bags(bags)[0] if batched else previous_forward_bags(module, bags)
+        logits.sum().backward()
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+
+
+def main() -> None:
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    module = DeepMILModule(encoder=IdentityEncoder(input_dim=(NUM_FEATURES,)), label_column="label", n_classes=1,
+                           pooling_layer=GatedAttentionLayer).to(device)
+    rows: List[List[Any]] = []
+    for batch_size, max_bag_size in [(16, 1000), (16, 100), (64, 20)]:
+        batches = create_batches(batch_size, max_bag_size, device)
+        for method, batched in [("per bag loop", False), ("forward_bags", True)]:
+            seconds, _ = measure(lambda: run_batches(module, batches, batched))
+            rows.append([batch_size, max_bag_size, method, NUM_BATCHES * batch_size / seconds])
+    print_table(["Bags per batch", "Max bag size", "Method", "Slides/s"], rows)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,73 @@
+#  ------------------------------------------------------------------------------------------
+#  Copyright (c) Microsoft Corporation. All rights reserved.
+#  Licensed under the MIT License (MIT). See LICENSE in the repo root for license information.
+#  ------------------------------------------------------------------------------------------
+"""
+Compares the time to map file name stems to paths for a dataset folder, between the previous approach (rglob and
+is_file on every entry), listing the directories with os.scandir on one or several threads, and updating a saved
+index where only one directory was modified. On a local disk the threads gain little; they hide the latency of each
+listing on mounted network storage.
+Run via: python -m Tests.ML.benchmarks.benchmark_files_by_stem
+"""
+import os
+import tempfile
+import time
+from collections import defaultdict
+from pathlib import Path
+from typing import Any, Dict, List
+
+from InnerEye.ML.dataset.scalar_dataset import files_by_stem
+from Tests.ML.benchmarks.benchmark_util import measure, print_table
+
+NUM_FOLDERS = 500
+FILES_PER_FOLDER = 100
+
+
+def create_dataset_folder(root: Path) -> None:
+    """Creates one folder per subject with one file per image, with modification times in the past."""
+    for folder in range(NUM_FOLDERS):
+        subject_folder = root / f"subject{folder}"
+        subject_folder.mkdir(parents=True)
+        for file in range(FILES_PER_FOLDER):
+            (subject_folder / f"subject{folder}_image{file}.nii.gz").touch()
+    timestamp = time.time() - 60
+    for folder in [root, *root.iterdir()]:
+        os.utime(folder, (timestamp, timestamp))
+
+
+def previous_files_by_stem(root_path: Path) -> Dict[str, Path]:
+    """Re-implementation of the previous traversal, without the check for duplicates."""
+    result: Dict[str, Path] = dict()
+    duplicates: Dict[str, List[Path]] = defaultdict(list)
+    for item in root_path.rglob("*"):
+        if item.is_file():
+            key = item.name
+            i = key.find('.')
+            if 0 < i < len(key) - 1:
+                key = key[:i]
+            if key in result:
+                duplicates[key].append(item)
+            else:
+                result[key] = item
+    return result
+
+
+def main() -> None:
+    rows: List[List[Any]] = []
+    with tempfile.TemporaryDirectory() as temp_dir:
+        root = Path(temp_dir) / "dataset"
+        index_file = Path(temp_dir) / "index.pkl"
+        create_dataset_folder(root)
+        files_by_stem(root, index_file=index_file)
+        (root / "subject0" / "new.nii.gz").touch()
+        for method, fn in [("previous", lambda: previous_files_by_stem(root)),
+                           ("scandir, 1 thread", lambda: files_by_stem(root, num_threads=1)),
+                           ("scandir, 16 threads", lambda: files_by_stem(root, num_threads=16)),
+                           ("saved index, 1 modified folder", lambda: files_by_stem(root, index_file=index_file))]:
+            seconds, megabytes = measure(fn, repeats=3)
+            rows.append([NUM_FOLDERS * FILES_PER_FOLDER, method, seconds, megabytes])
+    print_table(["Files", "Method", "Wall time (s)", "Peak memory (MB)"], rows)
+
+
+if __name__ == '__main__':
+    main()
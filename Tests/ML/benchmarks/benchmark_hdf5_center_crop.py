@@ -0,0 +1,57 @@
+#  ------------------------------------------------------------------------------------------
+#  Copyright (c) Microsoft Corporation. All rights reserved.
+#  Licensed under the MIT License (MIT). See LICENSE in the repo root for license information.
+#  ------------------------------------------------------------------------------------------
+"""
+Compares the time to load a center crop of an HDF5 image, between the previous approach (reading the whole volume and
+segmentation, then cropping) and reading only the crop, for a file written with gzip compression and h5py's automatic
+chunking, and for the same file converted with convert_hdf5_for_partial_reads.
+Run via: python -m Tests.ML.benchmarks.benchmark_hdf5_center_crop
+"""
+import tempfile
+from datetime import datetime
+from pathlib import Path
+from typing import Any, List
+
+import h5py
+import numpy as np
+
+from InnerEye.ML.utils.hdf5_util import HDF5Object
+from InnerEye.ML.utils.image_util import get_center_crop
+from InnerEye.Scripts.convert_hdf5_for_partial_reads import convert_file
+from Tests.ML.benchmarks.benchmark_util import measure, print_table
+
+IMAGE_SHAPE = (96, 256, 256)
+CENTER_CROP_SIZES = [(64, 128, 128), (32, 64, 64)]
+
+
+def create_file(path: Path) -> None:
+    """Writes an image and segmentation with gzip compression, as in the existing datasets."""
+    random_state = np.random.RandomState(0)
+    volume = random_state.normal(size=IMAGE_SHAPE).astype(np.float16)
+    with h5py.File(str(path), 'w') as hdf5_file:
+        hdf5_file.create_dataset("id", data="0001")
+        hdf5_file.create_dataset("acquisition_date", data=datetime(2018, 7, 10).isoformat())
+        hdf5_file.create_dataset("volume", data=volume[:, None], compression="gzip")
+        hdf5_file.create_dataset("segmentation", data=(volume > 1).astype(np.uint8)[:, None], compression="gzip")
+
+
+def main() -> None:
+    rows: List[List[Any]] = []
+    with tempfile.TemporaryDirectory() as temp_dir:
+        original = Path(temp_dir) / "original.h5"
+        converted = Path(temp_dir) / "converted.h5"
+        create_file(original)
+        convert_file(original, converted, chunk_size=32, compression="lzf")
+        for crop in CENTER_CROP_SIZES:
+            for method, fn in [
+                ("previous", lambda: get_center_crop(HDF5Object.from_file(original, True).volume, crop)),
+                ("crop read", lambda: HDF5Object.from_file(original, True, center_crop_size=crop)),
+                ("crop read, converted", lambda: HDF5Object.from_file(converted, True, center_crop_size=crop))]:
+                seconds, megabytes = measure(fn, repeats=3)
+                rows.append(["x".join(map(str, crop)), method, seconds, megabytes])
+    print_table(["Crop", "Method", "Wall time (s)", "Peak memory (MB)"], rows)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,68 @@
+#  ------------------------------------------------------------------------------------------
+#  Copyright (c) Microsoft Corporation. All rights reserved.
+#  Licensed under the MIT License (MIT). See LICENSE in the repo root for license information.
+#  ------------------------------------------------------------------------------------------
+"""
+Compares the time to load a multi-channel classification sample from compressed NIfTI files, resized and center
+cropped, between the previous approach (loading, resizing and cropping one channel after another, then stacking)
+and the loading into a preallocated tensor, with the crop applied before the resize, on one or several threads.
+Threads only gain if the machine has several cores.
+Run via: python -m Tests.ML.benchmarks.benchmark_load_images_and_stack
+"""
+import tempfile
+from pathlib import Path
+from typing import Any, List
+
+import SimpleITK as sitk
+import numpy as np
+import torch
+from skimage.transform import resize
+
+from InnerEye.ML.utils.image_util import get_center_crop
+from InnerEye.ML.utils.io_util import load_image_in_known_formats, load_images_and_stack
+from Tests.ML.benchmarks.benchmark_util import measure, print_table
+
+NUM_CHANNELS = 10
+INPUT_SHAPE = (64, 160, 160)
+IMAGE_SIZE = (32, 80, 80)
+CENTER_CROP_SIZE = (24, 48, 48)
+
+
+def create_files(folder: Path) -> List[Path]:
+    random_state = np.random.RandomState(0)
+    files = []
+    for channel in range(NUM_CHANNELS):
+        file = folder / f"channel{channel}.nii.gz"
+        sitk.WriteImage(sitk.GetImageFromArray(random_state.rand(*INPUT_SHAPE).astype(np.float32)), str(file),
+                        useCompression=True)
+        files.append(file)
+    return files
+
+
+def previous_load_images_and_stack(files: List[Path]) -> torch.Tensor:
+    """Re-implementation of the previous loading of images without segmentations."""
+    images = []
+    for file in files:
+        array = load_image_in_known_formats(file, load_segmentation=False).images
+        images.append(get_center_crop(torch.from_numpy(resize(array, IMAGE_SIZE, anti_aliasing=True)),
+                                      CENTER_CROP_SIZE))
+    return torch.stack(images, dim=0)
+
+
+def main() -> None:
+    rows: List[List[Any]] = []
+    with tempfile.TemporaryDirectory() as temp_dir:
+        files = create_files(Path(temp_dir))
+        for method, fn in [
+            ("previous", lambda: previous_load_images_and_stack(files)),
+            ("crop before resize, 1 thread", lambda: load_images_and_stack(files, False, CENTER_CROP_SIZE,
+                                                                             IMAGE_SIZE, num_threads=1)),
+            ("crop before resize, 8 threads", lambda: load_images_and_stack(files, False, CENTER_CROP_SIZE,
+                                                                              IMAGE_SIZE, num_threads=8))]:
+            seconds, megabytes = measure(fn, repeats=3)
+            rows.append([method, seconds, megabytes])
+    print_table(["Method", "Wall time (s)", "Peak memory (MB)"], rows)
+
+
+if __name__ == '__main__':
+    main()
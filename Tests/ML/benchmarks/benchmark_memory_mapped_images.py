@@ -0,0 +1,65 @@
+#  ------------------------------------------------------------------------------------------
+#  Copyright (c) Microsoft Corporation. All rights reserved.
+#  Licensed under the MIT License (MIT). See LICENSE in the repo root for license information.
+#  ------------------------------------------------------------------------------------------
+"""
+Compares wall time of loading full images and random crops from compressed Nifti files and from memory mapped .npy
+files, as written by InnerEye/Scripts/convert_dataset_to_numpy.py. Both files are in the operating system's page cache
+after the first run, hence this measures decompression and parsing, not disk reads.
+Run via: python -m Tests.ML.benchmarks.benchmark_memory_mapped_images
+"""
+import tempfile
+from pathlib import Path
+from typing import Any, List
+
+import numpy as np
+
+from InnerEye.ML.utils.image_util import ImageDataType, get_unit_image_header
+from InnerEye.ML.utils.io_util import load_image, store_as_nifti, store_image_as_numpy
+from Tests.ML.benchmarks.benchmark_util import measure, print_table
+
+CROP_SIZE = (64, 64, 64)
+NUM_CROPS = 10
+
+
+def create_image(shape: Any) -> np.ndarray:
+    """
+    Creates an image that resembles a CT scan: Air around a body with smoothly varying intensities, and noise.
+    """
+    random_state = np.random.RandomState(0)
+    z, y, x = np.indices(shape, sparse=True)
+    body = ((y - shape[1] / 2) / (0.4 * shape[1])) ** 2 + ((x - shape[2] / 2) / (0.45 * shape[2])) ** 2 <= 1
+    image = np.where(body, 40 + 30 * np.sin(z / 7.0) * np.cos(y / 11.0), -1000)
+    return (image + random_state.normal(scale=20, size=shape)).astype(np.int16)
+
+
+def load_crops(path: Path) -> None:
+    """
+    Loads the image, and reads random crops from it.
+    """
+    random_state = np.random.RandomState(1)
+    image = load_image(path, ImageDataType.IMAGE.value).image
+    for _ in range(NUM_CROPS):
+        start = [random_state.randint(0, size - crop + 1) for size, crop in zip(image.shape, CROP_SIZE)]
+        np.array(image[tuple(slice(s, s + c) for s, c in zip(start, CROP_SIZE))])
+
+
+def main() -> None:
+    rows: List[List[Any]] = []
+    with tempfile.TemporaryDirectory() as folder:
+        for shape in [(96, 384, 384), (200, 512, 512)]:
+            image = create_image(shape)
+            nifti_file = store_as_nifti(image, get_unit_image_header(), Path(folder) / "image.nii.gz", np.int16)
+            numpy_file = store_image_as_numpy(image.astype(ImageDataType.IMAGE.value), get_unit_image_header(),
+                                              Path(folder) / "image.npy")
+            for name, path in [("nii.gz", nifti_file), ("memory mapped npy", numpy_file)]:
+                full_load = lambda: np.array(load_image(path, ImageDataType.IMAGE.value).image)
+                for task, fn in [("full image", full_load), (f"{NUM_CROPS} random crops", lambda: load_crops(path))]:
+                    # Memory mapped pages are not traced by tracemalloc, hence only wall time is reported.
+                    seconds, _ = measure(fn, repeats=1)
+                    rows.append([str(shape), name, task, seconds])
+    print_table(["Shape", "Format", "Task", "Wall time (s)"], rows)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,101 @@
+#  ------------------------------------------------------------------------------------------
+#  Copyright (c) Microsoft Corporation. All rights reserved.
+#  Licensed under the MIT License (MIT). See LICENSE in the repo root for license information.
+#  ------------------------------------------------------------------------------------------
+"""
+Compares wall time and peak memory of the TrimmedNorm and MriWindow normalizations, between the previous approach
+(float64 copies of the voxels, sorting via np.percentile, and temporary arrays in the linear transform) and the
+order statistics based implementation that writes into a single float32 buffer.
+Run via: python -m Tests.ML.benchmarks.benchmark_photometric_normalization
+"""
+from typing import Any, List, Tuple
+
+import numpy as np
+from skimage.filters import threshold_otsu
+
+from InnerEye.Common.type_annotations import TupleInt3
+from InnerEye.ML.photometric_normalization import mri_window, normalize_trim, robust_mean_std
+from InnerEye.ML.utils.transforms import LinearTransform
+from Tests.ML.benchmarks.benchmark_util import measure, print_table
+
+SHAPE = (300, 512, 512)
+OUTPUT_RANGE = (-1.0, 1.0)
+SHARPEN = 1.9
+TRIM_PERCENTILES = (2.0, 98.0)
+
+
+def create_image(shape: TupleInt3, integer_valued: bool) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Creates a single channel image with a body that has smoothly varying intensities and noise, surrounded by
+    air, and a mask that covers the body.
+    """
+    random_state = np.random.RandomState(0)
+    _, y, x = np.indices(shape, sparse=True)
+    body = ((y - shape[1] / 2) / (0.4 * shape[1])) ** 2 + ((x - shape[2] / 2) / (0.45 * shape[2])) ** 2 <= 1
+    body = np.broadcast_to(body, shape)
+    image = np.where(body, 400 + 100 * np.cos(y / 20.0), 5).astype(np.float32)
+    image += random_state.normal(scale=30, size=shape).astype(np.float32)
+    if integer_valued:
+        np.round(image, out=image)
+    return image[np.newaxis], body.astype(np.uint8)
+
+
+def previous_normalize_trim(image: np.ndarray, mask: np.ndarray) -> np.ndarray:
+    """
+    Re-implementation of the previous TrimmedNorm normalization.
+    """
+    imout = np.zeros_like(image)
+    in_mask = mask > 0.5
+    for ichannel in range(image.shape[0]):
+        channel_image = image[ichannel, ...]
+        pixels_inside_mask = channel_image[in_mask].flatten().astype(float)
+        thresholds = np.percentile(pixels_inside_mask, TRIM_PERCENTILES, interpolation='midpoint')
+        inside_thresholds = np.logical_and(pixels_inside_mask > thresholds[0], pixels_inside_mask < thresholds[1])
+        median, estimated_std, min_value, max_value = robust_mean_std(pixels_inside_mask[inside_thresholds])
+        input_range = (max(median - estimated_std * SHARPEN, min_value),
+                       min(median + estimated_std * SHARPEN, max_value))
+        channel_output = LinearTransform.transform(data=channel_image, input_range=input_range,
+                                                   output_range=OUTPUT_RANGE)
+        channel_output[np.logical_not(in_mask)] = OUTPUT_RANGE[0]
+        imout[ichannel, ...] = channel_output
+    return imout
+
+
+def previous_mri_window(image: np.ndarray) -> np.ndarray:
+    """
+    Re-implementation of the previous MriWindow normalization, without a mask. The input image is copied first,
+    because the previous implementation modified it in place.
+    """
+    image = image.copy()
+    imout = np.zeros_like(image)
+    for ichannel in range(image.shape[0]):
+        imflat = image[ichannel, ...].flatten()
+        threshold = threshold_otsu(imflat)
+        level, std_i, _, max_foreground = robust_mean_std(imflat[imflat > threshold])
+        input_range = (max(level - std_i * SHARPEN, threshold), min(max_foreground, level + std_i * SHARPEN))
+        im_thresh = image[ichannel, ...]
+        im_thresh[image[ichannel, ...] < threshold] = 0
+        imout[ichannel, ...] = LinearTransform.transform(im_thresh, input_range, OUTPUT_RANGE)
+    return imout
+
+
+def main() -> None:
+    rows: List[List[Any]] = []
+    for integer_valued in [True, False]:
+        image, mask = create_image(SHAPE, integer_valued)
+        image_type = "integer valued" if integer_valued else "continuous"
+        for name, previous, current in [
+            ("TrimmedNorm",
+             lambda: previous_normalize_trim(image, mask),
+             lambda: normalize_trim(image, mask, OUTPUT_RANGE, SHARPEN, TRIM_PERCENTILES)),
+            ("MriWindow",
+             lambda: previous_mri_window(image),
+             lambda: mri_window(image, None, OUTPUT_RANGE, SHARPEN, 1.0))]:
+            for method, fn in [("previous", previous), ("order statistics", current)]:
+                seconds, megabytes = measure(fn, repeats=1)
+                rows.append([name, image_type, method, seconds, megabytes])
+    print_table(["Normalization", "Image", "Method", "Wall time (s)", "Peak memory (MB)"], rows)
+
+
+if __name__ == '__main__':
+    main()
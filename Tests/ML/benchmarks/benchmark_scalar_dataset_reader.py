@@ -0,0 +1,90 @@
+#  ------------------------------------------------------------------------------------------
+#  Copyright (c) Microsoft Corporation. All rights reserved.
+#  Licensed under the MIT License (MIT). See LICENSE in the repo root for license information.
+#  ------------------------------------------------------------------------------------------
+"""
+Compares the time to read the data sources of a multi-channel classification dataset, between the previous approach
+(filtering the whole data frame once per subject), the single pass over the rows sorted by subject, and loading the
+data sources from the DataSourcesCache, for increasing dataset sizes. The previous approach is only run on the smaller
+datasets, because its time grows quadratically.
+Run via: python -m Tests.ML.benchmarks.benchmark_scalar_dataset_reader
+"""
+import tempfile
+from pathlib import Path
+from typing import Any, List
+
+import numpy as np
+import pandas as pd
+from more_itertools import flatten
+
+from InnerEye.ML.dataset.data_source_cache import DataSourcesCache, get_data_sources_cache_key
+from InnerEye.ML.dataset.scalar_dataset import DataSourceReader
+from InnerEye.ML.dataset.scalar_sample import ScalarDataSource
+from Tests.ML.benchmarks.benchmark_util import load_datasources_for_subject, measure, print_table
+
+IMAGE_CHANNELS = [f"image{i}" for i in range(8)]
+NUMERICAL_COLUMNS = ["scalar1", "scalar2", "scalar3"]
+ROWS_PER_SUBJECT = len(IMAGE_CHANNELS) + 1
+DATASET_SIZES = [9_000, 36_000, 144_000]
+MAX_PREVIOUS_SIZE = 36_000
+
+
+def create_data_frame(num_rows: int) -> pd.DataFrame:
+    """
+    Creates a dataset with one row per image channel and a label row with numerical features for each subject, where
+    the rows are shuffled. All values are strings, as when reading a dataset.csv file.
+    """
+    random_state = np.random.RandomState(0)
+    num_subjects = num_rows // ROWS_PER_SUBJECT
+    subjects = np.repeat([f"S{i}" for i in range(num_subjects)], ROWS_PER_SUBJECT)
+    channels = np.tile(IMAGE_CHANNELS + ["label"], num_subjects)
+    is_label = channels == "label"
+    df = pd.DataFrame({"subject": subjects, "channel": channels})
+    df["path"] = np.where(is_label, "", np.char.add(np.char.add(subjects.astype(str), "_"), channels.astype(str)))
+    df["value"] = np.where(is_label, random_state.randint(2, size=len(df)).astype(str), "")
+    for column in NUMERICAL_COLUMNS:
+        df[column] = np.where(is_label, np.round(random_state.rand(len(df)), 4).astype(str), "")
+    return df.iloc[random_state.permutation(len(df))].reset_index(drop=True)
+
+
+def create_reader(df: pd.DataFrame) -> DataSourceReader:
+    return DataSourceReader[ScalarDataSource](
+        data_frame=df,
+        image_channels=IMAGE_CHANNELS,
+        image_file_column="path",
+        label_channels=["label"],
+        label_value_column="value",
+        non_image_feature_channels={column: ["label"] for column in NUMERICAL_COLUMNS},
+        numerical_columns=NUMERICAL_COLUMNS)
+
+
+def previous_load_data_sources(reader: DataSourceReader) -> List[ScalarDataSource]:
+    """
+    Re-implementation of the previous single threaded loading, which filters the data frame for each subject.
+    """
+    subject_ids = reader.data_frame[reader.subject_column].unique()
+    return list(flatten(filter(None, (load_datasources_for_subject(reader, subject_id)
+                                      for subject_id in subject_ids))))
+
+
+def main() -> None:
+    rows: List[List[Any]] = []
+    with tempfile.TemporaryDirectory() as temp_dir:
+        for num_rows in DATASET_SIZES:
+            reader = create_reader(create_data_frame(num_rows))
+            cache = DataSourcesCache(Path(temp_dir))
+            key = get_data_sources_cache_key(reader.data_frame, reader.get_settings())
+            cache.put(key, reader.load_data_sources())
+            methods = [("single pass", lambda: reader.load_data_sources()),
+                       ("cache key", lambda: get_data_sources_cache_key(reader.data_frame, reader.get_settings())),
+                       ("cache load", lambda: cache.get(key))]
+            if num_rows <= MAX_PREVIOUS_SIZE:
+                methods.insert(0, ("previous", lambda: previous_load_data_sources(reader)))
+            for method, fn in methods:
+                seconds, megabytes = measure(fn, repeats=1)
+                rows.append([num_rows, method, seconds, megabytes])
+    print_table(["Rows", "Method", "Wall time (s)", "Peak memory (MB)"], rows)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,84 @@
+#  ------------------------------------------------------------------------------------------
+#  Copyright (c) Microsoft Corporation. All rights reserved.
+#  Licensed under the MIT License (MIT). See LICENSE in the repo root for license information.
+#  ------------------------------------------------------------------------------------------
+"""
+Compares wall time and peak memory of sliding window inference with the SlidingWindowEngine, against the previous
+radio-based algorithm (extract all patches into one array, then stitch them back once per class).
+The model is replaced by a cheap function, such that only patch extraction and stitching are measured.
+Run via: python -m Tests.ML.benchmarks.benchmark_sliding_window
+"""
+from typing import Any, List
+
+import numpy as np
+
+from InnerEye.Common.type_annotations import TupleInt3
+from InnerEye.ML.config import PaddingMode
+from InnerEye.ML.pipelines.sliding_window import SlidingWindowEngine
+from InnerEye.ML.utils import image_util
+from Tests.ML.benchmarks.benchmark_util import measure, print_table
+
+NUM_CLASSES = 6
+BATCH_SIZE = 8
+
+
+def fake_model(num_classes: int, shrink: TupleInt3) -> Any:
+    def model_fn(patches: np.ndarray) -> np.ndarray:
+        center = patches[(slice(None), slice(0, 1)) + tuple(slice(s, patches.shape[i + 2] - s)
+                                                            for i, s in enumerate(shrink))]
+        return np.repeat(center, num_classes, axis=1).astype(np.float32)
+
+    return model_fn
+
+
+def previous_algorithm(image: np.ndarray, engine: SlidingWindowEngine, model_fn: Any) -> np.ndarray:
+    """
+    Re-implementation of the radio-based pipeline: All patches are copied into one float64 array, all predictions
+    are concatenated, and the predictions are stitched back once per class with float64 buffers.
+    """
+    padded = image_util.pad_images_for_inference(image, engine.crop_size, engine.output_size, PaddingMode.Edge)
+    padded = np.pad(padded, ((0, 0),) + engine.tiling_padding, mode="edge")
+    starts = image_util.get_sliding_window_starts(engine.padded_shape, engine.output_size, engine.stride)
+    patches = np.zeros((len(starts),) + padded.shape[:1] + engine.crop_size)
+    for i, start in enumerate(starts):
+        patches[i] = padded[(slice(None),) + tuple(slice(s, s + c) for s, c in zip(start, engine.crop_size))]
+    predictions = np.concatenate([model_fn(patches[i:i + BATCH_SIZE]) for i in range(0, len(patches), BATCH_SIZE)])
+    posteriors = np.zeros((NUM_CLASSES,) + engine.image_shape, dtype=np.float32)
+    for c in range(NUM_CLASSES):
+        stitched = np.zeros(engine.padded_shape)
+        cover = np.zeros(engine.padded_shape)
+        for i, start in enumerate(starts):
+            output_slice = tuple(slice(s, s + o) for s, o in zip(start, engine.output_size))
+            stitched[output_slice] += predictions[i, c]
+            cover[output_slice] += 1
+        stitched /= cover
+        posteriors[c] = stitched[tuple(slice(before, before + s)
+                                       for s, (before, _) in zip(engine.image_shape, engine.tiling_padding))]
+    return posteriors
+
+
+def main() -> None:
+    np.random.seed(0)
+    rows: List[List[Any]] = []
+    for image_shape, crop_size, shrink, stride in [((64, 160, 160), (32, 64, 64), (0, 0, 0), (32, 64, 64)),
+                                                   ((64, 160, 160), (32, 64, 64), (4, 8, 8), (12, 24, 24)),
+                                                   ((96, 256, 256), (48, 96, 96), (4, 8, 8), (20, 40, 40))]:
+        image = np.random.uniform(size=(1,) + image_shape).astype(np.float32)
+        output_size = tuple(c - 2 * s for c, s in zip(crop_size, shrink))
+        engine = SlidingWindowEngine(image_shape=image_shape, crop_size=crop_size, output_size=output_size,
+                                     stride=stride)
+        model_fn = fake_model(NUM_CLASSES, shrink)
+        expected = previous_algorithm(image, engine, model_fn)
+        actual = engine.predict(model_fn, image, NUM_CLASSES, BATCH_SIZE, PaddingMode.Edge)
+        assert np.allclose(actual, expected, atol=1e-5)
+        setting = f"{image_shape} stride {stride} ({engine.num_windows} patches)"
+        for name, fn in [("radio-based", lambda: previous_algorithm(image, engine, model_fn)),
+                         ("engine", lambda: engine.predict(model_fn, image, NUM_CLASSES, BATCH_SIZE,
+                                                           PaddingMode.Edge))]:
+            seconds, peak_mb = measure(fn, repeats=2)
+            rows.append([setting, name, seconds, peak_mb])
+    print_table(["Setting", "Method", "Wall time (s)", "Peak memory (MB)"], rows)
+
+
+if __name__ == '__main__':
+    main()
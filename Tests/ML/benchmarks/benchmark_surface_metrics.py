@@ -0,0 +1,94 @@
+#  ------------------------------------------------------------------------------------------
+#  Copyright (c) Microsoft Corporation. All rights reserved.
+#  Licensed under the MIT License (MIT). See LICENSE in the repo root for license information.
+#  ------------------------------------------------------------------------------------------
+"""
+Compares wall time of computing Dice, Hausdorff and mean surface distance for many structures, between the previous
+approach (SimpleITK filters and distance maps on the full image, once per structure) and the cropped NumPy engine.
+Run via: python -m Tests.ML.benchmarks.benchmark_surface_metrics
+"""
+from typing import Any, Dict, List, Tuple
+
+import SimpleITK as sitk
+import numpy as np
+
+from InnerEye.Common.type_annotations import TupleFloat3, TupleInt3
+from InnerEye.ML.utils.io_util import reverse_tuple_float3
+from InnerEye.ML.utils.surface_metrics import compute_segmentation_metrics_per_class
+from Tests.ML.benchmarks.benchmark_util import measure, print_table, surface_distance
+
+VOXEL_SPACING = (3.0, 1.0, 1.0)
+
+
+def create_structures(shape: TupleInt3, num_structures: int) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Creates a label map with non-overlapping ellipsoids as the ground truth, and a prediction where each ellipsoid
+    is slightly shifted and resized.
+    """
+    random_state = np.random.RandomState(0)
+    indices = np.indices(shape)
+    ground_truth = np.zeros(shape, dtype=np.uint8)
+    segmentation = np.zeros(shape, dtype=np.uint8)
+    for class_index in range(1, num_structures + 1):
+        center = [random_state.uniform(0.2 * size, 0.8 * size) for size in shape]
+        radii = [random_state.uniform(0.03 * size, 0.1 * size) for size in shape]
+        for labels, offset, scale in [(ground_truth, 0, 1), (segmentation, random_state.normal(size=3), 1.1)]:
+            distance = sum(((axis - c - o) / (r * scale)) ** 2 for axis, c, o, r in zip(indices, center,
+                                                                                          np.broadcast_to(offset, 3),
+                                                                                          radii))
+            labels[(distance <= 1) & (labels == 0)] = class_index
+    return segmentation, ground_truth
+
+
+def previous_algorithm(segmentation: np.ndarray, ground_truth: np.ndarray, num_classes: int,
+                       voxel_spacing: TupleFloat3) -> Dict[int, List[float]]:
+    """
+    Re-implementation of the previous metrics computation: For each class, SimpleITK images are created for the whole
+    volume, followed by the overlap, Hausdorff and surface distance filters.
+    """
+    overlap_measures_filter = sitk.LabelOverlapMeasuresImageFilter()
+    hausdorff_distance_filter = sitk.HausdorffDistanceImageFilter()
+    result = {}
+    for class_index in range(1, num_classes):
+        images = []
+        for labels in [segmentation, ground_truth]:
+            image = sitk.GetImageFromArray(np.where(labels == class_index, 1, 0).astype(np.uint8))
+            image.SetSpacing(sitk.VectorDouble(reverse_tuple_float3(voxel_spacing)))
+            images.append(image)
+        overlap_measures_filter.Execute(*images)
+        hausdorff_distance_filter.Execute(*images)
+        result[class_index] = [overlap_measures_filter.GetDiceCoefficient(),
+                               hausdorff_distance_filter.GetHausdorffDistance(),
+                               surface_distance(*images)]
+    return result
+
+
+def main() -> None:
+    rows: List[List[Any]] = []
+    for shape, num_structures in [((64, 192, 192), 5), ((96, 256, 256), 20)]:
+        segmentation, ground_truth = create_structures(shape, num_structures)
+        num_classes = num_structures + 1
+        one_hot = np.stack([ground_truth == class_index for class_index in range(num_classes)]).astype(np.uint8)
+
+        def engine() -> Dict[int, Any]:
+            return compute_segmentation_metrics_per_class(segmentation, one_hot, range(1, num_classes), VOXEL_SPACING)
+
+        expected = previous_algorithm(segmentation, ground_truth, num_classes, VOXEL_SPACING)
+        actual = engine()
+        for class_index, (dice, hausdorff_distance, mean_surface_distance) in expected.items():
+            metrics = actual[class_index]
+            assert np.isclose(metrics.dice, dice)
+            assert np.isclose(metrics.hausdorff_distance_mm, hausdorff_distance, rtol=1e-5)
+            assert np.isclose(metrics.mean_surface_distance_mm, mean_surface_distance, rtol=1e-5)
+        setting = f"{shape}, {num_structures} structures"
+        for name, fn in [("SimpleITK per class", lambda: previous_algorithm(segmentation, ground_truth, num_classes,
+                                                                            VOXEL_SPACING)),
+                         ("cropped engine", engine)]:
+            # Peak memory is not reported, because allocations inside SimpleITK are not traced.
+            seconds, _ = measure(fn, repeats=1)
+            rows.append([setting, name, seconds])
+    print_table(["Setting", "Method", "Wall time (s)"], rows)
+
+
+if __name__ == '__main__':
+    main()
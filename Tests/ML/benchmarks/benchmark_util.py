@@ -0,0 +1,160 @@
+#  ------------------------------------------------------------------------------------------
+#  Copyright (c) Microsoft Corporation. All rights reserved.
+#  Licensed under the MIT License (MIT). See LICENSE in the repo root for license information.
+#  ------------------------------------------------------------------------------------------
+"""
+Helpers for the benchmark scripts in this folder, and reference implementations of previous approaches that both the
+benchmarks and the tests compare against. The benchmarks are not collected by pytest, run them via
+python -m Tests.ML.benchmarks.<benchmark_name> from the repository root.
+"""
+import logging
+import time
+import tracemalloc
+from typing import Any, Callable, List, Optional, Tuple
+
+import SimpleITK as sitk
+import numpy as np
+import pandas as pd
+
+from InnerEye.ML.dataset.scalar_dataset import DataSourceReader, load_single_data_source
+from InnerEye.ML.dataset.scalar_sample import ScalarDataSource
+
+MEGABYTE = 1024 * 1024
+
+
+def measure(fn: Callable[[], Any], repeats: int = 3) -> Tuple[float, float]:
+    """
+    Measures the wall time and the peak memory of running the given function.
+    Peak memory is measured in a separate run via tracemalloc, which tracks all allocations that NumPy and Python
+    make (but not those that happen inside PyTorch), because tracing slows down the function.
+    :param fn: The function to benchmark.
+    :param repeats: The number of timed runs. The fastest of these is reported.
+    :return: A tuple of (wall time in seconds, peak memory in megabytes)
+    """
+    tracemalloc.start()
+    fn()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    return min(times), peak / MEGABYTE
+
+
+def print_table(header: List[str], rows: List[List[Any]]) -> None:
+    """
+    Prints benchmark results as a table with fixed width columns. Floats are printed with 3 decimals.
+    """
+    def to_str(value: Any) -> str:
+        return f"{value:.3f}" if isinstance(value, float) else str(value)
+
+    cells = [header] + [[to_str(v) for v in row] for row in rows]
+    widths = [max(len(row[i]) for row in cells) for i in range(len(header))]
+    for i, row in enumerate(cells):
+        print("  ".join(cell.rjust(width) for cell, width in zip(row, widths)))
+        if i == 0:
+            print("  ".join("-" * width for width in widths))
+
+
+def load_datasources_for_subject(reader: DataSourceReader, subject_id: str) -> Optional[List[ScalarDataSource]]:
+    """
+    Reference implementation of the previous reading of the data sources of a single subject, which filters the whole
+    data frame for the subject.
+    """
+    rows = reader.data_frame[np.in1d(reader.data_frame[reader.subject_column].values, [subject_id])]
+
+    def _load_single_data_source(_rows: pd.DataFrame,
+                                 _sequence_position_numeric: Optional[int] = None) -> ScalarDataSource:
+        return load_single_data_source(
+            subject_rows=_rows,
+            subject_id=subject_id,
+            image_channels=reader.image_channels,
+            image_file_column=reader.image_file_column,
+            label_channels=reader.label_channels,
+            label_value_column=reader.label_value_column,
+            transform_labels=reader.transform_labels,
+            non_image_feature_channels=reader.non_image_feature_channels,
+            numerical_columns=reader.numerical_columns,
+            categorical_data_encoder=reader.categorical_data_encoder,
+            metadata_columns=reader.metadata_columns,
+            channel_column=reader.channel_column,
+            is_classification_dataset=reader.is_classification_dataset,
+            num_classes=reader.num_classes,
+            sequence_position_numeric=_sequence_position_numeric
+        )
+
+    def _load_sequence_data_source(_sequence_position: Any) -> ScalarDataSource:
+        _sequence_position_numeric = int(_sequence_position)
+        if _sequence_position_numeric < 0:
+            raise ValueError(
+                f"Sequence positions must be non-negative integers, but got: {_sequence_position}")
+        else:
+            seq_rows = rows[np.in1d(rows[reader.sequence_column].values, [_sequence_position])]
+            return _load_single_data_source(seq_rows, _sequence_position_numeric)
+
+    if reader.sequence_column:
+        seq_positions = rows[reader.sequence_column].unique()
+        return list(map(_load_sequence_data_source, seq_positions))
+    else:
+        if len(reader.expected_channels) > 0:
+            missing_channels = reader.expected_channels - set(rows[reader.channel_column])
+            if len(missing_channels) > 0:
+                logging.warning(f"Subject {subject_id} will be skipped completely because the following "
+                                f"channels are missing: {','.join(missing_channels)}.")
+                return None
+        return [_load_single_data_source(rows)]
+
+
+def surface_distance(seg: sitk.Image, reference_segmentation: sitk.Image) -> float:
+    """
+    Reference implementation of the mean surface distance with SimpleITK, as previously used in model evaluation.
+    Symmetric surface distances taking into account the image spacing
+    https://github.com/InsightSoftwareConsortium/SimpleITK-Notebooks/blob/master/Python/34_Segmentation_Evaluation.ipynb
+    :param seg: mask 1
+    :param reference_segmentation: mask 2
+    :return: mean distance
+    """
+    statistics_image_filter = sitk.StatisticsImageFilter()
+    # Get the number of pixels in the reference surface by counting all pixels that are 1.
+    reference_surface = sitk.LabelContour(reference_segmentation)
+    statistics_image_filter.Execute(reference_surface)
+    num_reference_surface_pixels = int(statistics_image_filter.GetSum())
+
+    reference_distance_map = sitk.Abs(
+        sitk.SignedMaurerDistanceMap(reference_segmentation, squaredDistance=False, useImageSpacing=True))
+    reference_surface = sitk.LabelContour(reference_segmentation)
+
+    # Symmetric surface distance measures
+    segmented_distance_map = sitk.Abs(sitk.SignedMaurerDistanceMap(seg, squaredDistance=False, useImageSpacing=True))
+    segmented_surface = sitk.LabelContour(seg)
+
+    # Multiply the binary surface segmentations with the distance maps. The resulting distance
+    # maps contain non-zero values only on the surface (they can also contain zero on the surface)
+    seg2ref_distance_map = reference_distance_map * sitk.Cast(segmented_surface, sitk.sitkFloat32)
+    ref2seg_distance_map = segmented_distance_map * sitk.Cast(reference_surface, sitk.sitkFloat32)
+
+    # Get the number of pixels in the reference surface by counting all pixels that are 1.
+    statistics_image_filter.Execute(segmented_surface)
+    num_segmented_surface_pixels = int(statistics_image_filter.GetSum())
+
+    seg2ref_distance_map_arr = sitk.GetArrayViewFromImage(seg2ref_distance_map)
+    seg2ref_distances = _add_zero_distances(num_segmented_surface_pixels, seg2ref_distance_map_arr)
+    ref2seg_distance_map_arr = sitk.GetArrayViewFromImage(ref2seg_distance_map)
+    ref2seg_distances = _add_zero_distances(num_reference_surface_pixels, ref2seg_distance_map_arr)
+
+    all_surface_distances = seg2ref_distances + ref2seg_distances
+    return np.mean(all_surface_distances).item()
+
+
+def _add_zero_distances(num_segmented_surface_pixels: int, seg2ref_distance_map_arr: np.ndarray) -> List[float]:
+    """
+    # Get all non-zero distances and then add zero distances if required.
+    :param num_segmented_surface_pixels:
+    :param seg2ref_distance_map_arr:
+    :return: list of distances, augmented with zeros.
+    """
+    seg2ref_distances = list(seg2ref_distance_map_arr[seg2ref_distance_map_arr != 0])
+    seg2ref_distances = seg2ref_distances + list(np.zeros(num_segmented_surface_pixels - len(seg2ref_distances)))
+    return seg2ref_distances
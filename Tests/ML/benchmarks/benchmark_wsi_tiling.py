@@ -0,0 +1,105 @@
+#  ------------------------------------------------------------------------------------------
+#  Copyright (c) Microsoft Corporation. All rights reserved.
+#  Licensed under the MIT License (MIT). See LICENSE in the repo root for license information.
+#  ------------------------------------------------------------------------------------------
+"""
+Compares the throughput of tiling synthetic slides and saving their tiles between the previous approach (one slide at a
+time, each tile encoded and its CSV row written in a Python loop) and the pipeline in create_tiles_dataset.py (a
+bounded pool of slide processes, each of which encodes its tiles on a thread pool). Slides are generated in memory,
+hence this measures tiling and PNG encoding, not reading slides with cuCIM.
+Run via: python -m Tests.ML.benchmarks.benchmark_wsi_tiling
+"""
+import functools
+import multiprocessing
+import tempfile
+import time
+from pathlib import Path
+from typing import Any, Dict, List
+
+import numpy as np
+
+from InnerEye.ML.Histopathology.preprocessing.create_tiles_dataset import format_csv_row, generate_tiles, \
+    get_tile_info, save_image, tile_and_save_slide
+from InnerEye.ML.Histopathology.utils.naming import SlideKey, TileKey
+from Tests.ML.benchmarks.benchmark_util import print_table
+
+NUM_SLIDES = 8
+SLIDE_SIZE = (3, 4096, 4096)
+TILE_SIZE = 224
+OCCUPANCY_THRESHOLD = 0.05
+
+
+def create_slide(index: int) -> Dict[SlideKey, Any]:
+    """
+    Creates a slide dictionary as returned by LoadROId: An elliptical region of textured tissue on a white background.
+    """
+    random_state = np.random.RandomState(index)
+    _, height, width = SLIDE_SIZE
+    y, x = np.indices((height, width), sparse=True)
+    tissue = ((y - height / 2) / (0.45 * height)) ** 2 + ((x - width / 2) / (0.35 * width)) ** 2 <= 1
+    texture = 120 + 60 * np.sin(x / 13.0) * np.cos(y / 17.0)
+    image = np.where(tissue, texture, 250)[np.newaxis] + random_state.normal(scale=10, size=SLIDE_SIZE)
+    return {SlideKey.SLIDE_ID: f"slide{index}",
+            SlideKey.IMAGE: np.clip(image, 0, 255).astype(np.uint8),
+            SlideKey.LABEL: index % 2,
+            SlideKey.METADATA: {},
+            SlideKey.FOREGROUND_THRESHOLD: 200,
+            SlideKey.SCALE: 1,
+            SlideKey.ORIGIN: (0, 0)}
+
+
+def previous_tile_and_save_slide(index: int, output_dir: Path) -> None:
+    """
+    Re-implementation of the previous per-slide loop, which encoded one tile at a time and wrote the dataset CSV file
+    line by line.
+    """
+    sample = create_slide(index)
+    slide_id = sample[SlideKey.SLIDE_ID]
+    keys_to_save = (TileKey.SLIDE_ID, TileKey.TILE_ID, TileKey.IMAGE, TileKey.LABEL,
+                    TileKey.TILE_X, TileKey.TILE_Y, TileKey.OCCUPANCY)
+    slide_dir = output_dir / slide_id
+    slide_dir.mkdir(parents=True)
+    image_tiles, tile_locations, occupancies, _ = generate_tiles(sample[SlideKey.IMAGE], TILE_SIZE,
+                                                                 sample[SlideKey.FOREGROUND_THRESHOLD],
+                                                                 OCCUPANCY_THRESHOLD)
+    with (slide_dir / "dataset.csv").open('w') as dataset_csv_file:
+        dataset_csv_file.write(','.join(keys_to_save) + '\n')
+        for i in range(image_tiles.shape[0]):
+            tile_info = get_tile_info(sample, occupancies[i], tile_locations[i], Path(slide_id))
+            save_image(image_tiles[i], output_dir / tile_info[TileKey.IMAGE])
+            dataset_csv_file.write(format_csv_row(tile_info, keys_to_save, ()) + '\n')
+
+
+def pipeline_tile_and_save_slide(index: int, output_dir: Path, num_tile_writers: int) -> None:
+    tile_and_save_slide(create_slide(index), TILE_SIZE, OCCUPANCY_THRESHOLD, output_dir,
+                        num_tile_writers=num_tile_writers)
+
+
+def run_slides(fn: Any, num_workers: int) -> float:
+    """
+    Processes all slides with the given function into a new temporary folder.
+    :return: The throughput in slides per hour.
+    """
+    with tempfile.TemporaryDirectory() as folder:
+        func = functools.partial(fn, output_dir=Path(folder))
+        start = time.perf_counter()
+        if num_workers > 1:
+            with multiprocessing.Pool(processes=num_workers) as pool:
+                list(pool.imap_unordered(func, range(NUM_SLIDES), chunksize=1))
+        else:
+            list(map(func, range(NUM_SLIDES)))
+        return NUM_SLIDES / (time.perf_counter() - start) * 3600
+
+
+def main() -> None:
+    rows: List[List[Any]] = []
+    num_cpus = multiprocessing.cpu_count()
+    rows.append(["previous", 1, 1, run_slides(previous_tile_and_save_slide, num_workers=1)])
+    for num_workers, num_tile_writers in sorted({(1, 4), (max(num_cpus // 2, 1), 2), (num_cpus, 1)}):
+        fn = functools.partial(pipeline_tile_and_save_slide, num_tile_writers=num_tile_writers)
+        rows.append(["pipeline", num_workers, num_tile_writers, run_slides(fn, num_workers=num_workers)])
+    print_table(["Method", "Slide processes", "Tile writer threads", "Slides/hour"], rows)
+
+
+if __name__ == '__main__':
+    main()
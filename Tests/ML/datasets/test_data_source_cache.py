@@ -0,0 +1,128 @@
+#  ------------------------------------------------------------------------------------------
+#  Copyright (c) Microsoft Corporation. All rights reserved.
+#  Licensed under the MIT License (MIT). See LICENSE in the repo root for license information.
+#  ------------------------------------------------------------------------------------------
+from pathlib import Path
+from typing import List
+
+import pandas as pd
+import pytest
+import torch
+
+from InnerEye.ML.dataset.data_source_cache import DataSourcesCache, data_sources_from_columns, \
+    data_sources_to_columns, get_callable_identity, get_data_sources_cache_key
+from InnerEye.ML.dataset.sample import GeneralSampleMetadata
+from InnerEye.ML.dataset.scalar_dataset import DataSourceReader
+from InnerEye.ML.dataset.scalar_sample import ScalarDataSource
+from InnerEye.ML.scalar_config import LabelTransformation, ScalarModelBase
+from InnerEye.ML.utils.dataset_util import CategoricalToOneHotEncoder
+
+
+def _create_data_frame() -> pd.DataFrame:
+    rows = []
+    for subject in range(5):
+        for channel in ["image1", "image2", "label"]:
+            is_label = channel == "label"
+            rows.append([f"S{subject}", channel, "" if is_label else f"S{subject}_{channel}.nii",
+                         str(subject % 2) if is_label else "", f"{subject * 0.1:.1f}" if is_label else "",
+                         ["A", "B"][subject % 2] if is_label else ""])
+    return pd.DataFrame(rows, columns=["subject", "channel", "path", "value", "scalar1", "categorical1"])
+
+
+def _assert_data_sources_equal(actual: List[ScalarDataSource], expected: List[ScalarDataSource]) -> None:
+    assert len(actual) == len(expected)
+    for item, expected_item in zip(actual, expected):
+        assert type(item) == type(expected_item)
+        assert item.metadata == expected_item.metadata
+        assert item.channel_files == expected_item.channel_files
+        assert torch.equal(item.label, expected_item.label)
+        assert torch.allclose(item.numerical_non_image_features, expected_item.numerical_non_image_features,
+                              equal_nan=True)
+        assert torch.allclose(item.categorical_non_image_features, expected_item.categorical_non_image_features,
+                              equal_nan=True)
+
+
+@pytest.mark.parametrize("is_sequence", [True, False])
+def test_data_sources_columns_round_trip(is_sequence: bool) -> None:
+    df = _create_data_frame()
+    if is_sequence:
+        df["channel"] = df.groupby("subject").cumcount().astype(str)
+        df["value"] = "1"
+    reader = DataSourceReader[ScalarDataSource](
+        data_frame=df,
+        image_channels=None if is_sequence else ["image1", "image2"],
+        image_file_column="path",
+        label_channels=None if is_sequence else ["label"],
+        label_value_column="value",
+        non_image_feature_channels={} if is_sequence else {"scalar1": ["label"], "categorical1": ["label"]},
+        numerical_columns=["scalar1"],
+        categorical_data_encoder=CategoricalToOneHotEncoder.create_from_dataframe(df, ["categorical1"]),
+        sequence_column="channel" if is_sequence else None,
+        channel_column="unused" if is_sequence else "channel")
+    data_sources = reader.load_data_sources()
+    assert len(data_sources) == (len(df) if is_sequence else 5)
+    _assert_data_sources_equal(data_sources_from_columns(data_sources_to_columns(data_sources)), data_sources)
+
+
+def test_get_callable_identity() -> None:
+    scale_100 = LabelTransformation.get_scaling_transform(max_value=100)
+    assert get_callable_identity(scale_100) == get_callable_identity(LabelTransformation.get_scaling_transform())
+    assert get_callable_identity(scale_100) != \
+           get_callable_identity(LabelTransformation.get_scaling_transform(max_value=10))
+    assert get_callable_identity(LabelTransformation.identity) != \
+           get_callable_identity(LabelTransformation.difference)
+    assert get_callable_identity([LabelTransformation.identity]) != get_callable_identity(LabelTransformation.identity)
+
+
+def test_get_data_sources_cache_key() -> None:
+    df = _create_data_frame()
+    settings = {"label_channels": ["label"], "metadata_columns": {"a", "b"},
+                "transform_labels": LabelTransformation.identity}
+    key = get_data_sources_cache_key(df, settings)
+    assert get_data_sources_cache_key(df.copy(), dict(settings)) == key
+    changed_df = df.copy()
+    changed_df.loc[2, "value"] = "2"
+    assert get_data_sources_cache_key(changed_df, settings) != key
+    assert get_data_sources_cache_key(df.rename(columns={"scalar1": "scalar2"}), settings) != key
+    assert get_data_sources_cache_key(df, {**settings, "label_channels": ["image1"]}) != key
+    assert get_data_sources_cache_key(df, {**settings, "transform_labels": LabelTransformation.difference}) != key
+
+
+def test_load_data_sources_as_per_config_uses_cache(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    df = _create_data_frame()
+    args = ScalarModelBase(image_channels=["image1", "image2"],
+                           image_file_column="path",
+                           label_channels=["label"],
+                           label_value_column="value",
+                           non_image_feature_channels=["label"],
+                           numerical_columns=["scalar1"],
+                           categorical_columns=["categorical1"],
+                           subject_column="subject",
+                           channel_column="channel",
+                           should_validate=False,
+                           data_sources_cache_folder=tmp_path)
+    args.categorical_feature_encoder = CategoricalToOneHotEncoder.create_from_dataframe(df, ["categorical1"])
+    data_sources = DataSourceReader.load_data_sources_as_per_config(df, args)
+    assert len(list(tmp_path.iterdir())) == 1
+
+    def fail(*args: object, **kwargs: object) -> None:
+        raise AssertionError("The data sources should be loaded from the cache")
+
+    with monkeypatch.context() as m:
+        m.setattr(DataSourceReader, "load_data_sources", fail)
+        _assert_data_sources_equal(DataSourceReader.load_data_sources_as_per_config(df, args), data_sources)
+
+    # Changing the settings gives a new cache entry
+    args.numerical_columns = []
+    assert len(DataSourceReader.load_data_sources_as_per_config(df, args)) == 5
+    assert len(list(tmp_path.iterdir())) == 2
+
+
+def test_data_sources_cache_skips_different_shapes(tmp_path: Path) -> None:
+    data_sources = [ScalarDataSource(metadata=GeneralSampleMetadata(id=str(i)),
+                                     label=torch.zeros(i + 1), channel_files=[],
+                                     numerical_non_image_features=torch.zeros(0),
+                                     categorical_non_image_features=torch.zeros(0))
+                    for i in range(2)]
+    DataSourcesCache(tmp_path).put("key", data_sources)
+    assert DataSourcesCache(tmp_path).get("key") is None
@@ -2,6 +2,7 @@
 #  Copyright (c) Microsoft Corporation. All rights reserved.
 #  Licensed under the MIT License (MIT). See LICENSE in the repo root for license information.
 #  ------------------------------------------------------------------------------------------
+from pathlib import Path
 from typing import Any, Callable, List, Optional, Union
 
 import numpy as np
@@ -11,7 +12,7 @@ import torch
 from pytorch_lightning.utilities.data import extract_batch_size
 
 from InnerEye.Common import common_util
-from InnerEye.ML.config import PaddingMode, SegmentationModelBase
+from InnerEye.ML.config import PaddingMode, PhotometricNormalizationMethod, SegmentationModelBase
 from InnerEye.ML.dataset.cropping_dataset import CroppingDataset
 from InnerEye.ML.dataset.full_image_dataset import FullImageDataset, collate_with_metadata
 from InnerEye.ML.dataset.sample import CroppedSample, PatientMetadata, SAMPLE_METADATA_FIELD, Sample
@@ -261,6 +262,59 @@ def test_cropping_dataset_has_reproducible_randomness(cropping_dataset: Cropping
                 assert np.array_equal(expected_center_indices, item.center_indices)
 
 
+@pytest.mark.parametrize("cache_on_disk", [True, False])
+def test_cropping_dataset_sample_cache(default_config: SegmentationModelBase, tmp_path: Path,
+                                       cache_on_disk: bool) -> None:
+    """
+    Test that crops drawn from cached samples are the same as crops drawn from freshly loaded samples.
+    """
+    df = default_config.get_dataset_splits()
+    dataset = CroppingDataset(args=default_config, data_frame=df.train)
+    assert dataset.sample_cache is None
+    if cache_on_disk:
+        default_config.sample_cache_folder = tmp_path
+    else:
+        default_config.sample_cache_size_gb = 1.0
+    cached_dataset = CroppingDataset(args=default_config, data_frame=df.train)
+    assert cached_dataset.sample_cache is not None
+    for _ in range(2):
+        for i in range(len(cached_dataset)):
+            ml_util.set_random_seed(i)
+            expected = dataset[i]
+            ml_util.set_random_seed(i)
+            actual = cached_dataset[i]
+            for key in ["image", "mask", "labels", "center_indices"]:
+                assert np.array_equal(actual[key], expected[key])
+            assert cached_dataset.sample_cache.get(cached_dataset.get_cache_key(i)) is not None
+
+
+def test_cropping_dataset_cache_key(default_config: SegmentationModelBase) -> None:
+    """
+    Test that the key of cached samples is the same for datasets with the same settings, and changes when the
+    normalization settings or the full image transforms change.
+    """
+    df = default_config.get_dataset_splits()
+
+    def get_key() -> str:
+        transforms = default_config.get_full_image_sample_transforms().train
+        return CroppingDataset(args=default_config, data_frame=df.train,
+                               full_image_sample_transforms=transforms).get_cache_key(0)  # type: ignore
+
+    key = get_key()
+    assert get_key() == key
+    default_config.window += 1
+    assert get_key() != key
+    default_config.window -= 1
+    assert get_key() == key
+    default_config.norm_method = PhotometricNormalizationMethod.Unchanged
+    assert get_key() != key
+    dataset = CroppingDataset(args=default_config, data_frame=df.train,
+                              full_image_sample_transforms=Compose3D([PhotometricNormalization(use_gpu=False)]))
+    gpu_dataset = CroppingDataset(args=default_config, data_frame=df.train,
+                                  full_image_sample_transforms=Compose3D([PhotometricNormalization(use_gpu=True)]))
+    assert dataset.get_cache_key(0) != gpu_dataset.get_cache_key(0)
+
+
 def test_csv_dataset_as_data_loader(normalize_fn: Any,
                                     full_image_dataset: FullImageDataset, num_dataload_workers: int) -> None:
     batch_size = 2
@@ -520,6 +574,34 @@ def test_custom_collate() -> None:
     assert result[SAMPLE_METADATA_FIELD] == ["something", metadata]
     assert isinstance(result[foo], torch.Tensor)
     assert result[foo].tolist() == [1, 2]
+    # Items that contain multiple samples are flattened into a single batch
+    d3 = {foo: 3, SAMPLE_METADATA_FIELD: metadata}
+    result = collate_with_metadata([[d1, d2], [d3, d1]])
+    assert result[foo].tolist() == [1, 2, 3, 1]
+    assert result[SAMPLE_METADATA_FIELD] == ["something", metadata, metadata, "something"]
+
+
+@pytest.mark.parametrize("crops_per_volume", [1, 2])
+def test_cropping_dataset_crops_per_volume(cropping_dataset: CroppingDataset, crops_per_volume: int) -> None:
+    """
+    Test that drawing multiple crops per full image sample gives minibatches with the configured number of crops.
+    """
+    cropping_dataset.args.crops_per_volume = crops_per_volume
+    item = cropping_dataset[0]
+    if crops_per_volume == 1:
+        assert isinstance(item, dict)
+    else:
+        assert isinstance(item, list)
+        assert len(item) == crops_per_volume
+    batch_size = 4
+    loader = cropping_dataset.as_data_loader(shuffle=False, batch_size=batch_size, num_dataload_workers=0)
+    for batch in loader:
+        sample = CroppedSample.from_dict(batch)
+        assert sample.image.shape[0] == len(sample.metadata) == batch_size
+        assert sample.image.shape[2:] == cropping_dataset.args.crop_size
+        for i in range(0, batch_size, crops_per_volume):
+            assert len({m.patient_id for m in sample.metadata[i:i + crops_per_volume]}) == 1
+        break
 
 
 def test_sample_construct_copy(random_image_crop: Any, random_mask_crop: Any, random_label_crop: Any) -> None:
@@ -0,0 +1,117 @@
+#  ------------------------------------------------------------------------------------------
+#  Copyright (c) Microsoft Corporation. All rights reserved.
+#  Licensed under the MIT License (MIT). See LICENSE in the repo root for license information.
+#  ------------------------------------------------------------------------------------------
+import os
+import time
+from pathlib import Path
+from typing import Any, List
+
+import pytest
+
+from InnerEye.ML.dataset import directory_index
+from InnerEye.ML.dataset.directory_index import DirectoryIndex
+from InnerEye.ML.dataset.scalar_dataset import files_by_stem
+
+
+def _create_tree(root: Path) -> None:
+    for folder in ["a", "a/b", "c", "c/d/e"]:
+        (root / folder).mkdir(parents=True)
+        (root / folder / f"{folder.replace('/', '_')}.nii.gz").touch()
+    (root / "top.csv").touch()
+    (root / "c" / ".hidden").touch()
+
+
+def _set_old_mtimes(root: Path) -> None:
+    """Sets the modification times of all directories to one minute ago, such that they count as unmodified."""
+    timestamp = time.time() - 60
+    for folder in [root, *[path for path in root.rglob("*") if path.is_dir()]]:
+        os.utime(folder, (timestamp, timestamp))
+
+
+def _count_listings(monkeypatch: pytest.MonkeyPatch) -> List[str]:
+    listed: List[str] = []
+    scandir = os.scandir
+
+    def counting_scandir(path: Any) -> Any:
+        listed.append(str(path))
+        return scandir(path)
+
+    monkeypatch.setattr(directory_index.os, "scandir", counting_scandir)
+    return listed
+
+
+@pytest.mark.parametrize("num_threads", [1, 4])
+def test_directory_index_matches_rglob(tmp_path: Path, num_threads: int) -> None:
+    root = tmp_path / "root"
+    _create_tree(root)
+    (tmp_path / "outside").mkdir()
+    (tmp_path / "outside" / "linked.txt").touch()
+    os.symlink(tmp_path / "outside", root / "link_to_folder")
+    os.symlink(root / "top.csv", root / "link_to_file.csv")
+    index = DirectoryIndex.create(root, num_threads=num_threads)
+    assert sorted(index.iterate_files()) == sorted(path for path in root.rglob("*") if path.is_file())
+    assert list(index.iterate_files()) == sorted(index.iterate_files(), key=lambda path: (str(path.parent), path.name))
+
+
+def test_directory_index_is_updated_incrementally(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    root = tmp_path / "root"
+    index_file = tmp_path / "index.pkl"
+    _create_tree(root)
+    _set_old_mtimes(root)
+    listed = _count_listings(monkeypatch)
+    files = list(DirectoryIndex.create(root, index_file=index_file).iterate_files())
+    assert len(listed) == 6
+    assert index_file.is_file()
+
+    # Unchanged directories are not listed again
+    listed.clear()
+    assert list(DirectoryIndex.create(root, index_file=index_file).iterate_files()) == files
+    assert listed == []
+
+    # Added and removed files are found, only their directories are listed
+    (root / "c" / "d" / "new.nii.gz").touch()
+    (root / "a" / "a.nii.gz").unlink()
+    index = DirectoryIndex.create(root, index_file=index_file)
+    assert sorted(listed) == [str(root / "a"), str(root / "c" / "d")]
+    assert sorted(index.iterate_files()) == sorted(path for path in root.rglob("*") if path.is_file())
+
+    # Recently modified directories are listed again, because later changes may not modify their mtime
+    listed.clear()
+    DirectoryIndex.create(root, index_file=index_file)
+    assert sorted(listed) == [str(root / "a"), str(root / "c" / "d")]
+
+    # Removed directories are dropped from the index
+    (root / "c" / "d" / "e" / "c_d_e.nii.gz").unlink()
+    (root / "c" / "d" / "e").rmdir()
+    index = DirectoryIndex.create(root, index_file=index_file)
+    assert "c/d/e" not in index.directories
+    assert sorted(index.iterate_files()) == sorted(path for path in root.rglob("*") if path.is_file())
+
+
+def test_directory_index_ignores_other_roots(tmp_path: Path) -> None:
+    index_file = tmp_path / "index.pkl"
+    for name in ["root1", "root2"]:
+        _create_tree(tmp_path / name)
+    DirectoryIndex.create(tmp_path / "root1", index_file=index_file)
+    assert DirectoryIndex.load(index_file, tmp_path / "root2").directories == {}
+    assert DirectoryIndex.load(tmp_path / "missing.pkl", tmp_path / "root1").directories == {}
+
+
+def test_files_by_stem_with_index_file(tmp_path: Path) -> None:
+    root = tmp_path / "root"
+    index_file = tmp_path / "index.pkl"
+    _create_tree(root)
+    for _ in range(2):
+        assert files_by_stem(root, index_file=index_file) == files_by_stem(root) == {
+            "a": root / "a" / "a.nii.gz",
+            "a_b": root / "a" / "b" / "a_b.nii.gz",
+            "c": root / "c" / "c.nii.gz",
+            "c_d_e": root / "c" / "d" / "e" / "c_d_e.nii.gz",
+            "top": root / "top.csv",
+            ".hidden": root / "c" / ".hidden",
+        }
+    (root / "a" / "b" / "top.nii").touch()
+    with pytest.raises(ValueError) as ex:
+        files_by_stem(root, index_file=index_file)
+    assert "1 files have duplicates" in str(ex)
@@ -0,0 +1,64 @@
+#  ------------------------------------------------------------------------------------------
+#  Copyright (c) Microsoft Corporation. All rights reserved.
+#  Licensed under the MIT License (MIT). See LICENSE in the repo root for license information.
+#  ------------------------------------------------------------------------------------------
+from pathlib import Path
+
+import numpy as np
+
+from InnerEye.ML.dataset.sample import Sample
+from InnerEye.ML.dataset.sample_cache import DiskSampleCache, MemorySampleCache, create_sample_cache, \
+    get_sample_size_in_bytes
+from Tests.ML.util import DummyPatientMetadata
+
+
+def create_sample(size: int) -> Sample:
+    return Sample(image=np.random.uniform(size=(2, size, 3, 4)).astype(np.float32),
+                  mask=np.ones((size, 3, 4), dtype=np.uint8),
+                  labels=np.zeros((3, size, 3, 4), dtype=np.float32),
+                  metadata=DummyPatientMetadata)
+
+
+def test_memory_sample_cache() -> None:
+    samples = {key: create_sample(size) for key, size in [("a", 1), ("b", 1), ("c", 2)]}
+    sample_size = get_sample_size_in_bytes(samples["a"])
+    assert sample_size == 2 * 12 * 4 + 12 + 3 * 12 * 4
+    cache = MemorySampleCache(max_bytes=2 * sample_size)
+    assert cache.get("a") is None
+    assert cache.put("a", samples["a"]) is samples["a"]
+    cache.put("b", samples["b"])
+    assert cache.num_bytes == 2 * sample_size
+    # Reading "a" makes "b" the least recently used sample, which is evicted when "c" is added.
+    assert cache.get("a") is samples["a"]
+    cache.put("c", create_sample(1))
+    assert cache.get("b") is None
+    assert cache.get("a") is samples["a"]
+    assert cache.num_bytes == 2 * sample_size
+    # Samples that are larger than the cache are not stored, and do not evict other samples.
+    assert cache.put("d", create_sample(3)) is not None
+    assert cache.get("d") is None
+    assert list(cache.samples.keys()) == ["c", "a"]
+
+
+def test_disk_sample_cache(tmp_path: Path) -> None:
+    sample = create_sample(5)
+    cache = DiskSampleCache(tmp_path / "cache")
+    assert cache.get("subject") is None
+    cached = cache.put("subject", sample)
+    for loaded in [cached, DiskSampleCache(tmp_path / "cache").get("subject")]:
+        assert loaded is not None
+        for field in ["image", "mask", "labels"]:
+            array = getattr(loaded, field)
+            assert isinstance(array, np.memmap)
+            assert array.dtype == getattr(sample, field).dtype
+            assert np.array_equal(array, getattr(sample, field))
+        assert loaded.metadata == sample.metadata
+    assert not list((tmp_path / "cache").glob("*.tmp"))
+
+
+def test_create_sample_cache(tmp_path: Path) -> None:
+    assert create_sample_cache(None, 0) is None
+    memory_cache = create_sample_cache(None, 0.5)
+    assert isinstance(memory_cache, MemorySampleCache)
+    assert memory_cache.max_bytes == 2 ** 29
+    assert isinstance(create_sample_cache(tmp_path, 0.5), DiskSampleCache)
@@ -21,11 +21,12 @@ from InnerEye.Common.output_directories import OutputFolderForTests
 from InnerEye.Common.type_annotations import TupleInt3
 from InnerEye.ML.dataset.sample import GeneralSampleMetadata
 from InnerEye.ML.dataset.scalar_dataset import DataSourceReader, ScalarDataSource, ScalarDataset, \
-    _get_single_channel_row, _string_to_float, extract_label_classification, files_by_stem, \
+    _get_single_channel_row, _string_to_float, _strings_to_floats, extract_label_classification, files_by_stem, \
     is_valid_item_index, load_single_data_source
 from InnerEye.ML.photometric_normalization import WindowNormalizationForScalarItem, mri_window
 from InnerEye.ML.scalar_config import LabelTransformation, ScalarLoss, ScalarModelBase
 from InnerEye.ML.utils.dataset_util import CategoricalToOneHotEncoder
+from Tests.ML.benchmarks.benchmark_util import load_datasources_for_subject
 from Tests.ML.util import create_dataset_csv_file
 
 
@@ -559,6 +560,63 @@ def test_string_to_float(text: str, expected: float) -> None:
         assert actual == expected
 
 
+def test_strings_to_floats() -> None:
+    """
+    Test that the vectorized conversion gives the same results as converting elements one by one.
+    """
+    texts = [" ", "", None, "1.2", "abc", 3.4, math.nan, " -5e3 ", "inf", "1_000", 7]
+    expected = [_string_to_float(text, "foo") if not isinstance(text, int) else float(text) for text in texts]
+    actual = _strings_to_floats(np.array(texts, dtype=object), "foo")
+    assert np.array_equal(actual, np.array(expected), equal_nan=True)
+    assert np.isnan(_strings_to_floats(np.array([math.nan, None], dtype=object))).all()
+
+
+@pytest.mark.parametrize("num_dataset_reader_workers", [0, 2])
+@pytest.mark.parametrize("is_sequence", [True, False])
+def test_load_data_sources_matches_subject_loading(num_dataset_reader_workers: int, is_sequence: bool) -> None:
+    """
+    Test that loading all subjects at once gives the same data sources as loading subjects one by one, for
+    subjects whose rows are not contiguous in the file, and with a subject that misses a channel.
+    """
+    random_state = np.random.RandomState(0)
+    channels = ["0", "1", "2"] if is_sequence else ["image1", "image2", "label"]
+    rows = []
+    for subject in range(20):
+        for channel in channels:
+            if subject == 7 and channel == channels[1]:
+                continue
+            label = "" if channel != channels[-1] and not is_sequence else str(random_state.randint(2))
+            scalar = "" if random_state.rand() < 0.1 else f"{random_state.rand():.4f}"
+            rows.append([f"S{subject}", channel, f"S{subject}_{channel}.nii", label, scalar,
+                         random_state.choice(["A", "B"]), f"extra{subject}"])
+    random_state.shuffle(rows)
+    df = pd.DataFrame(rows, columns=["subject", "channel", "path", "value", "scalar1", "categorical1", "extra"])
+    if is_sequence:
+        df = df.rename(columns={"channel": "seq"})
+    reader = DataSourceReader[ScalarDataSource](
+        data_frame=df,
+        image_channels=None if is_sequence else ["image1", "image2"],
+        image_file_column="path",
+        label_channels=None if is_sequence else ["label"],
+        label_value_column="value",
+        non_image_feature_channels={} if is_sequence else _get_non_image_dict(["label"], ["scalar1"],
+                                                                               ["categorical1"]),
+        numerical_columns=["scalar1"],
+        categorical_data_encoder=CategoricalToOneHotEncoder.create_from_dataframe(df, ["categorical1"]),
+        sequence_column="seq" if is_sequence else None)
+    items = reader.load_data_sources(num_dataset_reader_workers=num_dataset_reader_workers)
+    expected_items = [item for subject_id in df["subject"].unique()
+                      for item in load_datasources_for_subject(reader, subject_id) or []]
+    assert len(items) == len(expected_items) == (len(df) if is_sequence else 19)
+    for item, expected_item in zip(items, expected_items):
+        assert item.metadata == expected_item.metadata
+        assert item.channel_files == expected_item.channel_files
+        assert torch.equal(item.label, expected_item.label)
+        assert torch.allclose(item.numerical_non_image_features, expected_item.numerical_non_image_features,
+                              equal_nan=True)
+        assert torch.equal(item.categorical_non_image_features, expected_item.categorical_non_image_features)
+
+
 def test_files_by_stem(test_output_dirs: OutputFolderForTests) -> None:
     """
     Test enumeration of files recursively.
@@ -0,0 +1,113 @@
+#  ------------------------------------------------------------------------------------------
+#  Copyright (c) Microsoft Corporation. All rights reserved.
+#  Licensed under the MIT License (MIT). See LICENSE in the repo root for license information.
+#  ------------------------------------------------------------------------------------------
+
+from pathlib import Path
+from typing import Any, Dict, List
+
+import torch
+
+from InnerEye.ML.Histopathology.datamodules.bag_cache import BagCacheDataset, get_bag_key, load_bag, sample_bag, \
+    save_bag
+
+
+class CountingTransform:
+    def __init__(self) -> None:
+        self.computed_slides: List[str] = []
+
+    def __call__(self, bag: Dict[str, Any]) -> Dict[str, Any]:
+        self.computed_slides.append(bag['slide_id'][0])
+        return {**bag, 'image': torch.tensor(bag['tile_id'], dtype=torch.float32).unsqueeze(1).repeat(1, 4)}
+
+
+def _create_bags(n_tiles_per_slide: Dict[str, int]) -> List[Dict[str, Any]]:
+    bags = []
+    first_tile = 0
+    for slide_id, n_tiles in n_tiles_per_slide.items():
+        tile_ids = list(range(first_tile, first_tile + n_tiles))
+        bags.append({'slide_id': [slide_id] * n_tiles, 'tile_id': tile_ids,
+                     'image': [f"{slide_id}/{tile_id}.png" for tile_id in tile_ids], 'label': [1] * n_tiles})
+        first_tile += n_tiles
+    return bags
+
+
+def test_get_bag_key() -> None:
+    bag = _create_bags({'slide1': 3})[0]
+    key = get_bag_key(bag, 'slide_id')
+    assert key.startswith("slide1-")
+    assert get_bag_key(dict(bag), 'slide_id') == key
+    assert get_bag_key({**bag, 'label': [0] * 3}, 'slide_id') != key
+    assert get_bag_key({**bag, 'tile_id': bag['tile_id'][:2]}, 'slide_id') != key
+
+
+def test_save_and_load_bag(tmp_path: Path) -> None:
+    bag = {'slide_id': ['slide1', 'slide1'], 'image': torch.arange(6, dtype=torch.float32).view(2, 3)}
+    folder = tmp_path / "slide1-0"
+    save_bag(bag, folder)
+    loaded_bag = load_bag(folder)
+    assert loaded_bag['slide_id'] == bag['slide_id']
+    assert torch.equal(loaded_bag['image'], bag['image'])
+    # Tensors are mapped copy-on-write, such that modifying them does not change the cache entry
+    loaded_bag['image'] += 1
+    assert torch.equal(load_bag(folder)['image'], bag['image'])
+    # Entries written concurrently by another process are kept
+    save_bag(bag, folder)
+    assert [path.name for path in tmp_path.iterdir()] == [folder.name]
+
+
+def test_bag_cache_only_computes_new_bags(tmp_path: Path) -> None:
+    bags = _create_bags({'slide1': 3, 'slide2': 2})
+    transform = CountingTransform()
+    dataset = BagCacheDataset(bags, transform, cache_dir=tmp_path, bag_id_key='slide_id')
+    expected = [transform(bag) for bag in bags]
+    transform.computed_slides.clear()
+    for _ in range(2):
+        for i in range(len(dataset)):
+            assert torch.equal(dataset[i]['image'], expected[i]['image'])
+            assert dataset[i]['tile_id'] == expected[i]['tile_id']
+    assert transform.computed_slides == ['slide1', 'slide2']
+
+    # A new slide and a changed slide are computed, the unchanged slide is loaded from the cache
+    transform.computed_slides.clear()
+    new_bags = [bags[0], {**bags[1], 'label': [0] * 2}, *_create_bags({'slide3': 4})]
+    new_dataset = BagCacheDataset(new_bags, transform, cache_dir=tmp_path, bag_id_key='slide_id')
+    for i in range(len(new_dataset)):
+        assert new_dataset[i]['label'] == new_bags[i]['label']
+    assert transform.computed_slides == ['slide2', 'slide3']
+    # The entry of the slide before its rows changed is removed
+    assert sorted(path.name for path in tmp_path.iterdir()) == sorted(get_bag_key(bag, 'slide_id')
+                                                                      for bag in new_bags)
+
+
+def test_sample_bag() -> None:
+    bag = {'slide_id': ['slide1'] * 5, 'tile_id': list(range(5)), 'label': 1,
+           'image': torch.arange(10, dtype=torch.float32).view(5, 2)}
+    assert sample_bag(bag, max_bag_size=0, shuffle_samples=False) == bag
+    first_tiles = sample_bag(bag, max_bag_size=3, shuffle_samples=False)
+    assert first_tiles['tile_id'] == [0, 1, 2]
+    assert torch.equal(first_tiles['image'], bag['image'][:3])
+    generator = torch.Generator().manual_seed(0)
+    sampled_bag = sample_bag(bag, max_bag_size=3, shuffle_samples=True, generator=generator)
+    assert len(sampled_bag['tile_id']) == 3
+    assert len(set(sampled_bag['tile_id'])) == 3
+    assert sampled_bag['slide_id'] == ['slide1'] * 3
+    assert sampled_bag['label'] == 1
+    assert torch.equal(sampled_bag['image'], bag['image'][sampled_bag['tile_id']])
+
+
+def test_bag_cache_samples_after_loading(tmp_path: Path) -> None:
+    """Test that full bags are cached once, and that each access draws a new random subset of their tiles."""
+    bags = _create_bags({'slide1': 20})
+    transform = CountingTransform()
+    dataset = BagCacheDataset(bags, transform, cache_dir=tmp_path, bag_id_key='slide_id', max_bag_size=5,
+                              shuffle_samples=True, generator=torch.Generator().manual_seed(0))
+    sampled_tile_ids = set()
+    for _ in range(4):
+        sampled_bag = dataset[0]
+        assert len(sampled_bag['tile_id']) == 5
+        assert torch.equal(sampled_bag['image'][:, 0], torch.tensor(sampled_bag['tile_id'], dtype=torch.float32))
+        sampled_tile_ids.update(sampled_bag['tile_id'])
+    assert len(sampled_tile_ids) > 5
+    assert transform.computed_slides == ['slide1']
+    assert [path.name for path in tmp_path.iterdir()] == [get_bag_key(bags[0], 'slide_id')]
@@ -28,7 +28,7 @@ from InnerEye.ML.Histopathology.datasets.default_paths import (
     PANDA_TILES_DATASET_DIR,
 )
 from InnerEye.ML.Histopathology.models.deepmil import DeepMILModule
-from InnerEye.ML.Histopathology.models.encoders import ImageNetEncoder, TileEncoder
+from InnerEye.ML.Histopathology.models.encoders import IdentityEncoder, ImageNetEncoder, TileEncoder
 from InnerEye.ML.Histopathology.utils.naming import ResultsKey
 
 
@@ -113,6 +113,30 @@ def test_lightningmodule(
             assert score >= 0 and score <= 1
 
 
+@pytest.mark.parametrize("n_classes", [1, 3])
+@pytest.mark.parametrize("pooling_layer", [AttentionLayer, GatedAttentionLayer])
+@pytest.mark.parametrize("pool_out_dim", [1, 2])
+def test_forward_bags(n_classes: int, pooling_layer: Callable[[int, int, int], nn.Module], pool_out_dim: int) -> None:
+    num_features = 8
+    module = DeepMILModule(
+        encoder=IdentityEncoder(input_dim=(num_features,)),
+        label_column="label",
+        n_classes=n_classes,
+        pooling_layer=pooling_layer,
+        pool_hidden_dim=5,
+        pool_out_dim=pool_out_dim,
+    )
+    bags = [randn(bag_size, num_features) for bag_size in [3, 1, 10, 4]]
+    logits, attentions = module.forward_bags(bags)
+    assert logits.shape == (len(bags), n_classes)
+    # All bags at once must give the same results as one bag at a time
+    for bag, bag_logits, bag_attention in zip(bags, logits, attentions):
+        expected_logits, expected_attention = module(bag)
+        assert allclose(bag_logits, expected_logits.view(-1), atol=1e-6)
+        assert bag_attention.shape == (pool_out_dim, bag.shape[0])
+        assert allclose(bag_attention, expected_attention, atol=1e-6)
+
+
 def move_batch_to_expected_device(batch: Dict[str, List], use_gpu: bool) -> Dict:
     device = "cuda" if use_gpu else "cpu"
     return {
@@ -0,0 +1,85 @@
+#  ------------------------------------------------------------------------------------------
+#  Copyright (c) Microsoft Corporation. All rights reserved.
+#  Licensed under the MIT License (MIT). See LICENSE in the repo root for license information.
+#  ------------------------------------------------------------------------------------------
+from pathlib import Path
+from typing import Callable, Tuple
+
+import numpy as np
+import pandas as pd
+import PIL
+import torch
+from torch import nn
+
+from InnerEye.ML.Histopathology.datasets.base_dataset import TilesDataset
+from InnerEye.ML.Histopathology.models.encoders import TileEncoder
+from InnerEye.ML.Histopathology.models.tile_embeddings import LoadTileEmbeddingsBatchd, TileEmbeddingStore, \
+    get_encoder_id
+from InnerEye.ML.Histopathology.models.transforms import load_image_stack_as_tensor
+
+
+class MockTilesDataset(TilesDataset):
+    SPLIT_COLUMN = None
+    TILE_X_COLUMN = TILE_Y_COLUMN = None
+
+
+class ConvolutionEncoder(TileEncoder):
+    def _get_encoder(self) -> Tuple[Callable, int]:
+        return nn.Sequential(nn.Conv2d(3, 4, kernel_size=3), nn.AdaptiveAvgPool2d(1), nn.Flatten()), 4
+
+
+def create_png_tiles_dataset(root: Path, n_slides: int, n_tiles: int) -> MockTilesDataset:
+    slide_ids = [f"slide{i % n_slides}" for i in range(n_tiles)]
+    image_paths = [f"{slide_id}/{i:03d}.png" for i, slide_id in enumerate(slide_ids)]
+    for image_path in image_paths:
+        (root / image_path).parent.mkdir(parents=True, exist_ok=True)
+        tile = np.random.randint(0, 256, size=(8, 8, 3), dtype=np.uint8)
+        PIL.Image.fromarray(tile).save(root / image_path)
+    pd.DataFrame({MockTilesDataset.TILE_ID_COLUMN: np.arange(n_tiles),
+                  MockTilesDataset.SLIDE_ID_COLUMN: slide_ids,
+                  MockTilesDataset.IMAGE_COLUMN: image_paths,
+                  MockTilesDataset.LABEL_COLUMN: [int(s[-1]) % 2 for s in slide_ids]}) \
+        .to_csv(root / MockTilesDataset.DEFAULT_CSV_FILENAME, index=False)
+    return MockTilesDataset(root)
+
+
+def test_get_encoder_id() -> None:
+    encoder = ConvolutionEncoder(tile_size=8)
+    encoder_id = get_encoder_id(encoder, version="v1")
+    assert encoder_id.startswith("ConvolutionEncoder-v1-")
+    assert get_encoder_id(encoder, version="v1") == encoder_id
+    assert get_encoder_id(encoder, version="v2") != encoder_id
+    with torch.no_grad():
+        next(encoder.parameters()).add_(1.0)
+    assert get_encoder_id(encoder, version="v1") != encoder_id
+
+
+def test_tile_embedding_store(tmp_path: Path) -> None:
+    tiles_dataset = create_png_tiles_dataset(tmp_path / "tiles", n_slides=3, n_tiles=13)
+    encoder = ConvolutionEncoder(tile_size=8)
+    # A batch size that does not divide the slide sizes, such that batches span several slides
+    store = TileEmbeddingStore(tmp_path / "embeddings", encoder, batch_size=4)
+    store.compute(tiles_dataset)
+    assert store.folder.parent == tmp_path / "embeddings"
+    assert sorted(path.name for path in store.folder.glob("*.npy")) == ["slide0.npy", "slide1.npy", "slide2.npy"]
+
+    dataset_df = tiles_dataset.dataset_df
+    image_paths = [str(tiles_dataset.root_dir / path) for path in dataset_df[MockTilesDataset.IMAGE_COLUMN]]
+    with torch.no_grad():
+        expected = encoder(load_image_stack_as_tensor(image_paths))
+    # A bag with tiles of several slides in arbitrary order, with IDs collated into a tensor
+    bag_positions = [7, 0, 12, 3, 1]
+    bag = {MockTilesDataset.IMAGE_COLUMN: [image_paths[i] for i in bag_positions],
+           MockTilesDataset.SLIDE_ID_COLUMN: [dataset_df[MockTilesDataset.SLIDE_ID_COLUMN].iloc[i]
+                                              for i in bag_positions],
+           MockTilesDataset.TILE_ID_COLUMN: torch.tensor([dataset_df.index[i] for i in bag_positions])}
+    loaded = LoadTileEmbeddingsBatchd(MockTilesDataset.IMAGE_COLUMN, store.folder)(bag)
+    assert loaded[MockTilesDataset.IMAGE_COLUMN].shape == (len(bag_positions), encoder.num_encoding)
+    assert torch.allclose(loaded[MockTilesDataset.IMAGE_COLUMN], expected[bag_positions], atol=1e-6)
+
+    # Slides that are already in the store are not encoded again
+    modified_time = (store.folder / "slide0.npy").stat().st_mtime_ns
+    (store.folder / "slide1.npy").unlink()
+    store.compute(tiles_dataset)
+    assert (store.folder / "slide0.npy").stat().st_mtime_ns == modified_time
+    assert (store.folder / "slide1.npy").is_file()
@@ -0,0 +1,77 @@
+#  ------------------------------------------------------------------------------------------
+#  Copyright (c) Microsoft Corporation. All rights reserved.
+#  Licensed under the MIT License (MIT). See LICENSE in the repo root for license information.
+#  ------------------------------------------------------------------------------------------
+from pathlib import Path
+from typing import Any, Dict, List
+
+import numpy as np
+import pandas as pd
+import PIL
+import pytest
+
+from InnerEye.ML.Histopathology.preprocessing import create_tiles_dataset
+from InnerEye.ML.Histopathology.preprocessing.create_tiles_dataset import FAILED_TILES_CSV, SLIDE_DATASET_CSV, \
+    is_slide_processed, merge_dataset_csv_files, tile_and_save_slide
+from InnerEye.ML.Histopathology.utils.naming import SlideKey, TileKey
+
+
+def _create_loaded_slide(slide_id: str, label: int) -> Dict[SlideKey, Any]:
+    """Create a slide dictionary as returned by `LoadROId`, with a dark square of tissue on a white background."""
+    image = np.full((3, 40, 48), 255, dtype=np.uint8)
+    image[:, 8:32, 8:40] = np.random.randint(0, 100, size=(3, 24, 32))
+    return {SlideKey.SLIDE_ID: slide_id,
+            SlideKey.IMAGE: image,
+            SlideKey.LABEL: label,
+            SlideKey.METADATA: {"provider": "foo"},
+            SlideKey.FOREGROUND_THRESHOLD: 200,
+            SlideKey.SCALE: 2,
+            SlideKey.ORIGIN: (100, 200)}
+
+
+def test_tile_and_save_slide(tmp_path: Path) -> None:
+    tile_size = 8
+    slide_ids = ["slide1", "slide2"]
+    for label, slide_id in enumerate(slide_ids):
+        sample = _create_loaded_slide(slide_id, label)
+        assert not is_slide_processed(tmp_path / slide_id)
+        tile_and_save_slide(sample, tile_size=tile_size, occupancy_threshold=0.5, output_dir=tmp_path,
+                            num_tile_writers=3)
+        assert is_slide_processed(tmp_path / slide_id)
+        assert (tmp_path / slide_id / FAILED_TILES_CSV).read_text() == "tile_id\n"
+        assert not list((tmp_path / slide_id).glob("*.tmp"))
+        slide_df = pd.read_csv(tmp_path / slide_id / SLIDE_DATASET_CSV)
+        # The dark square covers 3 by 4 tiles of size 8
+        assert len(slide_df) == 12
+        assert (slide_df[TileKey.SLIDE_ID] == slide_id).all()
+        assert (slide_df[TileKey.LABEL] == label).all()
+        assert (slide_df[TileKey.from_slide_metadata_key("provider")] == "foo").all()
+        for _, row in slide_df.iterrows():
+            tile = np.asarray(PIL.Image.open(tmp_path / row[TileKey.IMAGE]))
+            x = (row[TileKey.TILE_X] - 100) // 2
+            y = (row[TileKey.TILE_Y] - 200) // 2
+            expected = np.moveaxis(sample[SlideKey.IMAGE][:, y:y + tile_size, x:x + tile_size], 0, -1)
+            assert np.array_equal(tile, expected)
+
+    merged_csv = merge_dataset_csv_files(tmp_path, slide_ids=[*slide_ids, "not_processed"])
+    merged_df = pd.read_csv(merged_csv)
+    assert len(merged_df) == 24
+    assert list(merged_df[TileKey.SLIDE_ID].unique()) == slide_ids
+    globbed_df = pd.read_csv(merge_dataset_csv_files(tmp_path))
+    assert set(globbed_df[TileKey.TILE_ID]) == set(merged_df[TileKey.TILE_ID])
+
+
+def test_main_parallel_is_deprecated(tmp_path: Path, monkeypatch: Any) -> None:
+    """Test that the deprecated `parallel` argument still works, and is mapped onto `num_workers`."""
+    processed: List[str] = []
+
+    def process_slide(sample: Dict[SlideKey, Any], **kwargs: Any) -> None:
+        processed.append(sample[SlideKey.SLIDE_ID])
+        assert kwargs["tile_progress"]
+
+    monkeypatch.setattr(create_tiles_dataset, "process_slide", process_slide)
+    slides = [{SlideKey.SLIDE_ID: "slide1"}, {SlideKey.SLIDE_ID: "slide2"}]
+    with pytest.warns(DeprecationWarning):
+        create_tiles_dataset.main(slides, tmp_path, level=1, tile_size=8, margin=0,  # type: ignore
+                                  foreground_threshold=None, occupancy_threshold=0.5, parallel=False)
+    assert processed == ["slide1", "slide2"]
@@ -0,0 +1,89 @@
+#  ------------------------------------------------------------------------------------------
+#  Copyright (c) Microsoft Corporation. All rights reserved.
+#  Licensed under the MIT License (MIT). See LICENSE in the repo root for license information.
+#  ------------------------------------------------------------------------------------------
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import PIL
+import pytest
+import torch
+
+from InnerEye.ML.Histopathology.datasets.base_dataset import TilesDataset
+from InnerEye.ML.Histopathology.models.transforms import LoadTileShardsBatchd, LoadTilesBatchd, \
+    load_tile_as_pil_image
+from InnerEye.ML.Histopathology.preprocessing.tile_shards import convert_tiles_dataset_to_shards, \
+    is_sharded_dataset, read_tiles_from_shard, write_tile_shard
+from InnerEye.ML.Histopathology.utils.naming import TileKey
+
+
+class MockTilesDataset(TilesDataset):
+    SPLIT_COLUMN = None
+    TILE_X_COLUMN = TILE_Y_COLUMN = None
+
+
+def _create_png_tiles_dataset(root: Path, n_slides: int, n_tiles: int) -> pd.DataFrame:
+    slide_ids = [f"slide{i % n_slides}" for i in range(n_tiles)]
+    image_paths = [f"{slide_id}/{i:03d}.png" for i, slide_id in enumerate(slide_ids)]
+    for image_path in image_paths:
+        (root / image_path).parent.mkdir(parents=True, exist_ok=True)
+        tile = np.random.randint(0, 256, size=(6, 5, 3), dtype=np.uint8)
+        PIL.Image.fromarray(tile).save(root / image_path)
+    dataset_df = pd.DataFrame({MockTilesDataset.TILE_ID_COLUMN: [f"tile{i}" for i in range(n_tiles)],
+                               MockTilesDataset.SLIDE_ID_COLUMN: slide_ids,
+                               MockTilesDataset.IMAGE_COLUMN: image_paths,
+                               MockTilesDataset.LABEL_COLUMN: [int(s[-1]) % 2 for s in slide_ids]})
+    dataset_df.to_csv(root / MockTilesDataset.DEFAULT_CSV_FILENAME, index=False)
+    return dataset_df
+
+
+@pytest.mark.parametrize("indices", [[0, 1, 2, 3, 4], [3, 1, 2], [4, 0], []])
+def test_read_tiles_from_shard(tmp_path: Path, indices: list) -> None:
+    tiles = np.random.randint(0, 256, size=(5, 3, 4, 4), dtype=np.uint8)
+    shard_path = tmp_path / "slide.npy"
+    write_tile_shard(tiles, shard_path)
+    assert np.array_equal(read_tiles_from_shard(shard_path, indices), tiles[indices])
+    with pytest.raises(ValueError):
+        write_tile_shard(tiles.astype(np.float32), shard_path)
+
+
+def test_convert_tiles_dataset_to_shards(tmp_path: Path) -> None:
+    png_root = tmp_path / "png"
+    shard_root = tmp_path / "shards"
+    _create_png_tiles_dataset(png_root, n_slides=3, n_tiles=11)
+    png_dataset = MockTilesDataset(png_root)
+    assert not is_sharded_dataset(png_dataset)
+    converted_df = convert_tiles_dataset_to_shards(png_dataset, shard_root)
+    shard_dataset = MockTilesDataset(shard_root)
+    assert is_sharded_dataset(shard_dataset)
+    assert sorted(path.name for path in shard_root.glob("*.npy")) == ["slide0.npy", "slide1.npy", "slide2.npy"]
+    assert pd.read_csv(shard_root / MockTilesDataset.DEFAULT_CSV_FILENAME).equals(converted_df)
+
+    # Load "bags" with tiles from one or several slides, in arbitrary order, and compare with the PNG files
+    tile_ids = png_dataset.dataset_df.index
+    for bag_tile_ids in [tile_ids[[9, 0, 3]], tile_ids[::-1]]:
+        png_bag = {key: [png_dataset[tile_ids.get_loc(t)][key] for t in bag_tile_ids]
+                   for key in [MockTilesDataset.IMAGE_COLUMN, MockTilesDataset.TILE_ID_COLUMN]}
+        shard_samples = [shard_dataset[shard_dataset.dataset_df.index.get_loc(t)] for t in bag_tile_ids]
+        shard_bag = {key: [sample[key] for sample in shard_samples]
+                     for key in [MockTilesDataset.IMAGE_COLUMN, MockTilesDataset.TILE_ID_COLUMN,
+                                 TileKey.SHARD_INDEX.value]}
+        expected = LoadTilesBatchd(MockTilesDataset.IMAGE_COLUMN)(png_bag)
+        actual = LoadTileShardsBatchd(MockTilesDataset.IMAGE_COLUMN)(shard_bag)
+        assert actual[MockTilesDataset.TILE_ID_COLUMN] == list(bag_tile_ids)
+        assert actual[MockTilesDataset.IMAGE_COLUMN].dtype == torch.float32
+        assert torch.equal(actual[MockTilesDataset.IMAGE_COLUMN], expected[MockTilesDataset.IMAGE_COLUMN])
+
+    # Single tiles, as loaded by the datasets for SSL, are the same PIL images as from the PNG files
+    for index in [0, 7]:
+        png_image = load_tile_as_pil_image(png_dataset[index], MockTilesDataset.IMAGE_COLUMN)
+        shard_sample = shard_dataset[shard_dataset.dataset_df.index.get_loc(tile_ids[index])]
+        shard_image = load_tile_as_pil_image(shard_sample, MockTilesDataset.IMAGE_COLUMN)
+        assert shard_image.mode == "RGB"
+        assert np.array_equal(np.asarray(shard_image), np.asarray(png_image))
+
+    # Converting again skips the existing shards
+    modified_time = (shard_root / "slide0.npy").stat().st_mtime_ns
+    convert_tiles_dataset_to_shards(png_dataset, shard_root)
+    assert (shard_root / "slide0.npy").stat().st_mtime_ns == modified_time
@@ -3,11 +3,14 @@
 #  Licensed under the MIT License (MIT). See LICENSE in the repo root for license information.
 #  ------------------------------------------------------------------------------------------
 
+from pathlib import Path
+from typing import Optional
+
 import numpy as np
 import pytest
 
-from InnerEye.ML.Histopathology.preprocessing.tiling import assemble_tiles_2d, get_1d_padding, \
-    pad_for_tiling_2d, tile_array_2d
+from InnerEye.ML.Histopathology.preprocessing.tiling import assemble_tiles_2d, create_assembly_array, \
+    downsample_tiles, get_1d_padding, pad_for_tiling_2d, tile_array_2d
 
 
 @pytest.mark.parametrize("length,tile_size",
@@ -124,3 +127,62 @@ def test_assemble_tiles_2d(width: int, height: int, tile_size: int, channels_fir
         else:
             crop = assembled_array[row:row + tile_size, col:col + tile_size, :]
         assert np.array_equal(crop, tiles[idx])
+
+
+@pytest.mark.parametrize("fill_value,expected_dtype", [(0, np.uint8), (255, np.uint8), (np.nan, np.float32),
+                                                       (None, np.float32), (-1, np.float32)])
+def test_assemble_tiles_2d_default_dtype(fill_value: Optional[float], expected_dtype: type) -> None:
+    tiles = np.random.randint(256, size=(3, 2, 4, 4), dtype=np.uint8)
+    coords = np.array([[0, 0], [4, 0], [8, 4]])
+    assembled_array, _ = assemble_tiles_2d(tiles, coords, fill_value=fill_value)
+    assert assembled_array.dtype == expected_dtype
+    if fill_value is None:
+        # Empty elements are NaN
+        assert np.isnan(assembled_array[:, 0, 8]).all()
+    assert assemble_tiles_2d(tiles.astype(np.float64), coords)[0].dtype == np.float32
+    assert assemble_tiles_2d(tiles, coords, dtype=np.float64)[0].dtype == np.float64
+
+
+@pytest.mark.parametrize("channels_first", [True, False])
+def test_assemble_tiles_2d_unaligned(channels_first: bool) -> None:
+    tile_size = 4
+    tiles = np.random.rand(3, 2, tile_size, tile_size).astype(np.float32)
+    coords = np.array([[0, 0], [6, 1], [2, 9]])
+    input_tiles = tiles if channels_first else tiles.transpose(0, 2, 3, 1)
+    assembled_array, offset = assemble_tiles_2d(input_tiles, coords, channels_first=channels_first)
+    if not channels_first:
+        assembled_array = assembled_array.transpose(2, 0, 1)
+    assert assembled_array.shape == (2, 13, 10)
+    for idx, (x, y) in enumerate(coords + offset):
+        assert np.array_equal(assembled_array[:, y:y + tile_size, x:x + tile_size], tiles[idx])
+    assert np.isnan(assembled_array[:, 0, 4:]).all()
+
+
+@pytest.mark.parametrize("channels_first", [True, False])
+def test_assemble_tiles_2d_in_chunks(channels_first: bool, tmp_path: Path) -> None:
+    tile_size = 4
+    array = np.random.rand(3, 10, 16).astype(np.float32)
+    input_array = array if channels_first else array.transpose(1, 2, 0)
+    tiles, coords = tile_array_2d(input_array, tile_size, channels_first, constant_values=0)
+    expected_array, expected_offset = assemble_tiles_2d(tiles, coords, fill_value=0, channels_first=channels_first)
+
+    for downsample in [1, 2, 4]:
+        out, offset = create_assembly_array(coords, tile_size, channels=3, fill_value=-1,
+                                            channels_first=channels_first, downsample=downsample,
+                                            path=tmp_path / f"assembled_{downsample}.npy")
+        assert np.array_equal(offset, expected_offset)
+        for start in range(0, len(tiles), 5):
+            assemble_tiles_2d(tiles[start:start + 5], coords[start:start + 5], channels_first=channels_first,
+                              downsample=downsample, out=out, offset=offset)
+        out.flush()
+        loaded_array = np.load(tmp_path / f"assembled_{downsample}.npy")
+        expected_downsampled = downsample_tiles(expected_array[np.newaxis], downsample, channels_first)[0]
+        assert np.allclose(loaded_array, expected_downsampled)
+
+
+def test_assemble_tiles_2d_requires_offset() -> None:
+    tiles = np.zeros((1, 1, 4, 4))
+    coords = np.zeros((1, 2), dtype=int)
+    out, _ = create_assembly_array(coords, tile_size=4, channels=1)
+    with pytest.raises(ValueError):
+        assemble_tiles_2d(tiles, coords, out=out)
@@ -2,25 +2,23 @@
 #  Copyright (c) Microsoft Corporation. All rights reserved.
 #  Licensed under the MIT License (MIT). See LICENSE in the repo root for license information.
 #  ------------------------------------------------------------------------------------------
+from typing import List
+
 import numpy as np
+import pytest
 import torch
 
-from InnerEye.ML.config import EnsembleAggregationType
-from InnerEye.ML.pipelines.ensemble import EnsemblePipeline
+from InnerEye.ML.config import EnsembleAggregationType, EnsembleInferenceMode, SegmentationModelBase
+from InnerEye.ML.models.architectures.base_model import BaseSegmentationModel
+from InnerEye.ML.pipelines.ensemble import EnsemblePipeline, VarianceAccumulator
 from InnerEye.ML.pipelines.inference import InferencePipeline
 from InnerEye.ML.utils.image_util import posteriors_to_segmentation
 
 
-def test_aggregate_results() -> None:
-    """
-    Test to make sure inference results are aggregated as expected
-    """
+def create_model_results(num_models: int) -> List[InferencePipeline.Result]:
     torch.manual_seed(1)
-    num_models = 3
-    # set expected posteriors
     model_results = []
-    # create results for each model
-    for x in range(num_models):
+    for _ in range(num_models):
         posteriors = torch.nn.functional.softmax(torch.rand(3, 3, 3, 3), dim=0).numpy()
         model_results.append(InferencePipeline.Result(
             patient_id=0,
@@ -28,7 +26,14 @@ def test_aggregate_results() -> None:
             segmentation=posteriors_to_segmentation(posteriors),
             voxel_spacing_mm=(1, 1, 1)
         ))
+    return model_results
 
+
+def test_aggregate_results() -> None:
+    """
+    Test to make sure inference results are aggregated as expected
+    """
+    model_results = create_model_results(num_models=3)
     # We calculate expected_posteriors before aggregating, as aggregation modifies model_results.
     expected_posteriors = np.mean([x.posteriors for x in model_results], axis=0)
     ensemble_result = EnsemblePipeline.aggregate_results(model_results,
@@ -37,3 +42,104 @@ def test_aggregate_results() -> None:
 
     assert np.array_equal(ensemble_result.posteriors, expected_posteriors)
     assert np.array_equal(ensemble_result.segmentation, posteriors_to_segmentation(expected_posteriors))
+    assert ensemble_result.posterior_variance is None
+
+
+@pytest.mark.parametrize("aggregation_type", [EnsembleAggregationType.Average, EnsembleAggregationType.MajorityVote,
+                                              EnsembleAggregationType.Max, EnsembleAggregationType.Min])
+def test_aggregate_results_streaming(aggregation_type: EnsembleAggregationType) -> None:
+    """
+    Test that all aggregation types give the expected posteriors, segmentation and variance when the results are
+    passed in as a generator.
+    """
+    num_models = 5
+    all_posteriors = np.stack([x.posteriors for x in create_model_results(num_models)])
+    segmentations = np.stack([posteriors_to_segmentation(x) for x in all_posteriors])
+    ensemble_result = EnsemblePipeline.aggregate_results((x for x in create_model_results(num_models)),
+                                                         aggregation_type=aggregation_type,
+                                                         compute_variance=True)
+    assert ensemble_result.posterior_variance is not None
+    assert np.allclose(ensemble_result.posterior_variance, all_posteriors.var(axis=0), atol=1e-6)
+    if aggregation_type == EnsembleAggregationType.MajorityVote:
+        votes = np.stack([(segmentations == c).sum(axis=0) for c in range(all_posteriors.shape[1])])
+        expected_posteriors = votes / num_models
+        expected_segmentation = votes.argmax(axis=0)
+    else:
+        if aggregation_type == EnsembleAggregationType.Average:
+            expected_posteriors = all_posteriors.mean(axis=0)
+        else:
+            expected_posteriors = all_posteriors.max(axis=0) if aggregation_type == EnsembleAggregationType.Max \
+                else all_posteriors.min(axis=0)
+            expected_posteriors /= expected_posteriors.sum(axis=0)
+        expected_segmentation = posteriors_to_segmentation(expected_posteriors)
+    assert np.allclose(ensemble_result.posteriors, expected_posteriors, atol=1e-6)
+    assert np.array_equal(ensemble_result.segmentation, expected_segmentation)
+
+
+def test_variance_accumulator() -> None:
+    """
+    Test that the streaming variance matches the variance computed from all arrays at once.
+    """
+    np.random.seed(0)
+    arrays = np.random.uniform(size=(20, 4, 5))
+    accumulator = VarianceAccumulator((4, 5))
+    for array in arrays:
+        accumulator.add(array)
+    assert np.allclose(accumulator.mean, arrays.mean(axis=0), atol=1e-6)
+    assert np.allclose(accumulator.get_variance(), arrays.var(axis=0), atol=1e-6)
+
+
+class ConvolutionModel(BaseSegmentationModel):
+    """
+    A segmentation model with a single convolution, which shrinks the patches by 1 voxel on each side.
+    """
+
+    def __init__(self, seed: int) -> None:
+        super().__init__(input_channels=2, name="ConvolutionModel")
+        torch.manual_seed(seed)
+        self.conv = torch.nn.Conv3d(in_channels=2, out_channels=3, kernel_size=3)
+
+    def forward(self, patches: torch.Tensor) -> torch.Tensor:  # type: ignore
+        return torch.nn.functional.softmax(self.conv(patches), dim=1)
+
+    def get_all_child_layers(self) -> List[torch.nn.Module]:
+        return [self.conv]
+
+
+class ModelWrapper(torch.nn.Module):
+    """
+    Exposes a model in the same way as SegmentationLightning does, which is all that InferencePipeline uses.
+    """
+
+    def __init__(self, model: BaseSegmentationModel) -> None:
+        super().__init__()
+        self.model = model
+
+    def forward(self, patches: torch.Tensor) -> torch.Tensor:  # type: ignore
+        return self.model(patches)
+
+
+@pytest.mark.parametrize("num_threads", [1, 2])
+def test_ensemble_with_shared_patches(num_threads: int) -> None:
+    """
+    Test that extracting patches once for all models of an ensemble gives the same result as running sliding window
+    inference with each model, and averaging the posteriors.
+    """
+    config = SegmentationModelBase(image_channels=["ct", "mr"], ground_truth_ids=["a", "b"], crop_size=(5, 8, 8),
+                                   test_crop_size=(5, 8, 8), inference_stride_size=(2, 4, 4), max_num_gpus=0,
+                                   should_validate=False)
+    models = [ConvolutionModel(seed) for seed in range(3)]
+    config.set_derived_model_properties(models[0])
+    pipelines = [InferencePipeline(ModelWrapper(model), config, pipeline_id=i)  # type: ignore
+                 for i, model in enumerate(models)]
+    ensemble = EnsemblePipeline(pipelines, config)
+    np.random.seed(0)
+    image = np.random.randn(2, 7, 13, 11).astype(np.float32)
+    mask = (np.random.uniform(size=image.shape[1:]) > 0.2).astype(np.uint8)
+    expected = ensemble.predict_whole_image(image, voxel_spacing_mm=(1, 1, 1), mask=mask, patient_id=1)
+    config.ensemble_inference_mode = EnsembleInferenceMode.SharedPatches
+    config.ensemble_inference_threads = num_threads
+    actual = ensemble.predict_whole_image(image, voxel_spacing_mm=(1, 1, 1), mask=mask, patient_id=1)
+    assert actual.patient_id == 1
+    assert np.allclose(actual.posteriors, expected.posteriors, atol=1e-6)
+    assert np.array_equal(actual.segmentation, expected.segmentation)
@@ -86,6 +86,17 @@ def test_inference_smoothing(posterior_smoothing_mm: Any,
                        test_output_dirs=test_output_dirs)
 
 
+@pytest.mark.skipif(common_util.is_windows(), reason="Too slow on windows")
+@pytest.mark.parametrize("image_size", [(4, 5, 8), (9, 11, 7)])
+@pytest.mark.parametrize("shrink_by", [(0, 0, 0), (1, 0, 1)])
+def test_inference_image_larger_than_crop(image_size: Any,
+                                          shrink_by: Any,
+                                          test_output_dirs: OutputFolderForTests) -> None:
+    inference_identity(image_size=image_size,
+                       shrink_by=shrink_by,
+                       test_output_dirs=test_output_dirs)
+
+
 class InferenceIdentityModel(SegmentationModelBase):
     def __init__(self, shrink_by: Any) -> None:
         super().__init__(should_validate=False)
@@ -306,6 +317,18 @@ def test_evaluate_model_predictions() -> None:
 
         model_prediction_evaluations.append((metadata, metrics_per_class))
 
+        # Evaluating the segmentation and sample in memory must give the same metrics as reading them from disk
+        _, metrics_in_memory = evaluate_model_predictions(
+            sample_index - 1,
+            config=config,
+            dataset=None,
+            results_folder=results_folder,
+            segmentation=inference_result.segmentation,
+            sample=sample)
+        for hue_name in metrics_per_class.get_hue_names():
+            for metric_type, values in metrics_per_class.values(hue_name).items():
+                assert np.allclose(metrics_in_memory.values(hue_name)[metric_type], values, equal_nan=True)
+
         # Patient 3 has one missing ground truth channel: "region"
         if sample.metadata.patient_id == '3':
             assert 'Dice' in metrics_per_class.values('region_1').keys()
@@ -0,0 +1,108 @@
+#  ------------------------------------------------------------------------------------------
+#  Copyright (c) Microsoft Corporation. All rights reserved.
+#  Licensed under the MIT License (MIT). See LICENSE in the repo root for license information.
+#  ------------------------------------------------------------------------------------------
+from typing import Any
+
+import numpy as np
+import pytest
+
+from InnerEye.Common.type_annotations import TupleInt3
+from InnerEye.ML.config import BlendingMode, PaddingMode
+from InnerEye.ML.pipelines.sliding_window import SlidingWindowEngine, get_blending_weight_map, get_blending_weights
+from InnerEye.ML.utils import image_util
+
+
+def center_crop_model(crop_size: TupleInt3, output_size: TupleInt3) -> Any:
+    """
+    Creates a model function that returns the center of each patch, and a weighted sum of the channels as a
+    second class.
+    """
+    shrink = [(c - o) // 2 for c, o in zip(crop_size, output_size)]
+
+    def model_fn(patches: np.ndarray) -> np.ndarray:
+        center = patches[(slice(None), slice(None)) + tuple(slice(s, s + o) for s, o in zip(shrink, output_size))]
+        return np.concatenate([center, np.sum(center * np.arange(1, center.shape[1] + 1)[:, None, None, None],
+                                              axis=1, keepdims=True)], axis=1)
+
+    return model_fn
+
+
+def stitch_naively(model_fn: Any, image: np.ndarray, engine: SlidingWindowEngine,
+                   padding_mode: PaddingMode) -> np.ndarray:
+    """
+    Reference implementation that extracts and stitches one patch at a time.
+    """
+    weights = get_blending_weight_map(engine.output_size, engine.blending_mode)
+    padded = image_util.pad_images_for_inference(image, engine.crop_size, engine.output_size, padding_mode)
+    padded = np.pad(padded, ((0, 0),) + engine.tiling_padding, mode=padding_mode.value)
+    sums = None
+    counts = np.zeros(engine.padded_shape)
+    for start in image_util.get_sliding_window_starts(engine.padded_shape, engine.output_size, engine.stride):
+        patch = padded[(slice(None),) + tuple(slice(s, s + c) for s, c in zip(start, engine.crop_size))]
+        prediction = model_fn(patch[None])[0]
+        if sums is None:
+            sums = np.zeros((prediction.shape[0],) + engine.padded_shape)
+        output_slice = tuple(slice(s, s + o) for s, o in zip(start, engine.output_size))
+        sums[(slice(None),) + output_slice] += prediction * weights
+        counts[output_slice] += weights
+    assert sums is not None
+    result = sums / counts
+    return result[(slice(None),) + tuple(slice(before, before + s)
+                                         for s, (before, _) in zip(engine.image_shape, engine.tiling_padding))]
+
+
+@pytest.mark.parametrize("image_shape", [(5, 8, 9), (11, 7, 13)])
+@pytest.mark.parametrize("crop_size, output_size, stride", [((5, 5, 5), (5, 5, 5), (5, 5, 5)),
+                                                            ((5, 5, 5), (3, 5, 3), (2, 3, 1)),
+                                                            ((4, 5, 3), (2, 3, 3), (1, 2, 3))])
+@pytest.mark.parametrize("padding_mode", [PaddingMode.Edge, PaddingMode.Zero, PaddingMode.Symmetric])
+@pytest.mark.parametrize("blending_mode", [BlendingMode.Uniform, BlendingMode.Gaussian, BlendingMode.LinearRamp])
+def test_sliding_window_engine(image_shape: TupleInt3, crop_size: TupleInt3, output_size: TupleInt3,
+                               stride: TupleInt3, padding_mode: PaddingMode, blending_mode: BlendingMode) -> None:
+    """
+    Test that the sliding window engine gives the same results as extracting and stitching patches one by one.
+    """
+    np.random.seed(0)
+    image = np.random.uniform(size=(2,) + image_shape)
+    engine = SlidingWindowEngine(image_shape=image_shape, crop_size=crop_size, output_size=output_size,
+                                 stride=stride, blending_mode=blending_mode)
+    model_fn = center_crop_model(crop_size, output_size)
+    posteriors = engine.predict(model_fn, image, num_classes=3, batch_size=4, padding_mode=padding_mode)
+    assert posteriors.shape == (3,) + image_shape
+    assert posteriors.dtype == np.float32
+    expected = stitch_naively(model_fn, image, engine, padding_mode)
+    assert np.allclose(posteriors, expected, atol=1e-5)
+    # The first two classes are the center crops of the input, which must stitch back to the image itself
+    assert np.allclose(posteriors[:2], image, atol=1e-5)
+
+
+def test_sliding_window_engine_invalid() -> None:
+    with pytest.raises(ValueError) as ex:
+        SlidingWindowEngine(image_shape=(8, 8, 8), crop_size=(3, 3, 3), output_size=(4, 3, 3), stride=(1, 1, 1))
+    assert "crop_size must be >= output_size" in str(ex)
+    with pytest.raises(ValueError) as ex:
+        SlidingWindowEngine(image_shape=(8, 8, 8), crop_size=(3, 3, 3), output_size=(3, 3, 3), stride=(4, 1, 1))
+    assert "stride must be <= output_size" in str(ex)
+
+
+@pytest.mark.parametrize("size", [1, 4, 7, 64])
+def test_blending_weights(size: int) -> None:
+    assert np.array_equal(get_blending_weights(size, BlendingMode.Uniform), np.ones(size))
+    for blending_mode in [BlendingMode.Gaussian, BlendingMode.LinearRamp]:
+        weights = get_blending_weights(size, blending_mode)
+        assert weights.shape == (size,)
+        assert weights.dtype == np.float32
+        assert np.all(weights > 0)
+        assert weights.max() == 1.0
+        # Symmetric, and largest at the center
+        assert np.allclose(weights, weights[::-1])
+        assert weights[(size - 1) // 2] == 1.0
+        if size > 2:
+            assert weights[0] < weights[(size - 1) // 2]
+    # Weights are cached and must not be modified
+    assert get_blending_weights(size, BlendingMode.Gaussian) is get_blending_weights(size, BlendingMode.Gaussian)
+    assert not get_blending_weights(size, BlendingMode.Gaussian).flags.writeable
+    weight_map = get_blending_weight_map((size, 3, 5), BlendingMode.LinearRamp)
+    assert weight_map.shape == (size, 3, 5)
+    assert weight_map is get_blending_weight_map((size, 3, 5), BlendingMode.LinearRamp)
@@ -3,7 +3,8 @@
 #  Licensed under the MIT License (MIT). See LICENSE in the repo root for license information.
 #  ------------------------------------------------------------------------------------------
 import math
-from typing import List, Optional
+from typing import Any, List, Optional
+from unittest import mock
 
 import numpy as np
 import pytest
@@ -19,6 +20,7 @@ from InnerEye.ML.configs.classification.DummyClassification import DummyClassifi
 from InnerEye.ML.configs.regression.DummyRegression import DummyRegression
 from InnerEye.ML.lightning_metrics import AverageWithoutNan, MetricForMultipleStructures, ScalarMetricsBase
 from InnerEye.ML.metrics_dict import MetricsDict, get_column_name_for_logging
+from InnerEye.ML.utils.surface_metrics import compute_segmentation_metrics
 
 
 def test_calculate_dice1() -> None:
@@ -126,9 +128,37 @@ def test_calculate_hd_exact() -> None:
     g1 = "g1"
     m = metrics.calculate_metrics_per_class(prediction, ground_truth, voxel_spacing=(1, 2, 3), ground_truth_ids=[g1])
     assert m.get_single_metric(MetricType.HAUSDORFF_mm, hue=g1) == 6
+    assert m.get_single_metric(MetricType.HAUSDORFF_95_mm, hue=g1) == 6
     assert m.get_single_metric(MetricType.MEAN_SURFACE_DIST_mm, hue=g1) == 6
 
 
+def test_calculate_metrics_per_class_failing_structure() -> None:
+    """
+    Test that a structure for which the metrics cannot be computed gets NaN metrics, and that the other structures are
+    still evaluated.
+    """
+    prediction = np.array([[[1, 1, 2],
+                            [1, 1, 2],
+                            [0, 0, 2]]])
+    ground_truth = np.stack([prediction == 0, prediction == 1, prediction == 2]).astype(np.uint8)
+
+    def fail_for_structure_2(prediction: np.ndarray, ground_truth: np.ndarray, voxel_spacing: TupleFloat3) -> Any:
+        # Structure 2 is the only one with 3 voxels
+        if np.count_nonzero(prediction) == 3:
+            raise ValueError("degenerate structure")
+        return compute_segmentation_metrics(prediction, ground_truth, voxel_spacing)
+
+    with mock.patch("InnerEye.ML.utils.surface_metrics.compute_segmentation_metrics",
+                    side_effect=fail_for_structure_2):
+        m = metrics.calculate_metrics_per_class(prediction, ground_truth, voxel_spacing=(1, 1, 1),
+                                                ground_truth_ids=["g1", "g2"])
+    assert m.get_single_metric(MetricType.DICE, hue="g1") == 1
+    assert m.get_single_metric(MetricType.HAUSDORFF_95_mm, hue="g1") == 0
+    for metric_type in [MetricType.DICE, MetricType.HAUSDORFF_mm, MetricType.HAUSDORFF_95_mm,
+                        MetricType.MEAN_SURFACE_DIST_mm]:
+        assert math.isnan(m.get_single_metric(metric_type, hue="g2"))
+
+
 def test_compute_dice_across_patches() -> None:
     patches = 2
     # Ground truth has 3 classes, all entries are 1. Cardinality of each GT is 3
@@ -3,6 +3,9 @@
 #  Licensed under the MIT License (MIT). See LICENSE in the repo root for license information.
 #  ------------------------------------------------------------------------------------------
 
+import pickle
+from typing import List
+
 import numpy as np
 import pandas as pd
 import pytest
@@ -18,7 +21,8 @@ from InnerEye.ML.common import BEST_CHECKPOINT_FILE_NAME_WITH_SUFFIX, DATASET_CS
 from InnerEye.ML.config import DATASET_ID_FILE, GROUND_TRUTH_IDS_FILE, ModelArchitectureConfig
 from InnerEye.ML.dataset.full_image_dataset import FullImageDataset
 from InnerEye.ML.model_config_base import ModelConfigBase
-from InnerEye.ML.model_testing import DEFAULT_RESULT_IMAGE_NAME, create_inference_pipeline
+from InnerEye.ML.model_testing import DEFAULT_RESULT_IMAGE_NAME, SharedMemoryHandoff, create_inference_pipeline, \
+    iterate_with_prefetch
 from InnerEye.ML.pipelines.ensemble import EnsemblePipeline
 from InnerEye.ML.pipelines.inference import InferencePipeline
 from InnerEye.ML.pipelines.scalar_inference import ScalarEnsemblePipeline, ScalarInferencePipeline
@@ -212,3 +216,48 @@ def test_create_inference_pipeline(config: ModelConfigBase,
     assert isinstance(inference, expected_inference_type)
     ensemble = create_inference_pipeline(config, [checkpoint_path] * 2)
     assert isinstance(ensemble, expected_ensemble_type)
+
+
+@pytest.mark.parametrize("num_workers", [1, 3])
+def test_iterate_with_prefetch(num_workers: int) -> None:
+    """
+    Test that prefetched items are returned in order, and that at most num_workers items are loaded ahead.
+    """
+    loaded: List[int] = []
+
+    def load_item(index: int) -> int:
+        loaded.append(index)
+        return index * 2
+
+    for index, item in enumerate(iterate_with_prefetch(load_item, num_items=5, num_workers=num_workers)):
+        assert item == index * 2
+        assert len(loaded) <= min(5, index + 1 + num_workers)
+    assert sorted(loaded) == list(range(5))
+    assert list(iterate_with_prefetch(load_item, num_items=0, num_workers=num_workers)) == []
+
+
+def test_shared_memory_handoff(test_output_dirs: OutputFolderForTests) -> None:
+    """
+    Test that objects handed over via shared memory are re-created with the same arrays, memory mapped from their
+    files, and that the array files are removed afterwards.
+    """
+    posteriors = np.random.uniform(size=(3, 4, 5, 6)).astype(np.float32)
+    posteriors /= posteriors.sum(axis=0)
+    inference_result = InferencePipeline.Result(patient_id=1,
+                                                segmentation=np.argmax(posteriors, axis=0),
+                                                posteriors=posteriors,
+                                                voxel_spacing_mm=(1.0, 2.0, 3.0))
+    handoff = SharedMemoryHandoff(inference_result, test_output_dirs.root_dir)
+    assert set(handoff.array_files.keys()) == {"segmentation", "posteriors", "_uncertainty"}
+    # The original object must not be modified.
+    assert inference_result.posteriors is posteriors
+    received = pickle.loads(pickle.dumps(handoff)).receive()
+    assert received.patient_id == 1
+    assert received.voxel_spacing_mm == (1.0, 2.0, 3.0)
+    assert np.array_equal(received.posteriors, posteriors)
+    # Arrays are memory mapped rather than copied into the receiving process.
+    assert isinstance(received.posteriors, np.memmap)
+    assert not received.posteriors.flags.writeable
+    assert np.array_equal(received.segmentation, inference_result.segmentation)
+    assert np.array_equal(received.uncertainty, inference_result.uncertainty)
+    assert not any(test_output_dirs.root_dir.iterdir())
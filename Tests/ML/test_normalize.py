@@ -2,7 +2,8 @@
 #  Copyright (c) Microsoft Corporation. All rights reserved.
 #  Licensed under the MIT License (MIT). See LICENSE in the repo root for license information.
 #  ------------------------------------------------------------------------------------------
-from typing import Union
+from pathlib import Path
+from typing import Any, Union
 
 import numpy as np
 import pytest
@@ -11,9 +12,11 @@ from pytest import approx
 
 from InnerEye.Common.common_util import is_gpu_tensor
 from InnerEye.ML import photometric_normalization
+from InnerEye.ML.config import PhotometricNormalizationMethod, SegmentationModelBase
+from InnerEye.ML.dataset.sample import PatientMetadata, Sample
 from InnerEye.ML.utils.io_util import ImageDataType
 from InnerEye.ML.utils.transforms import CTRange
-from Tests.ML.util import no_gpu_available
+from Tests.ML.util import DummyPatientMetadata, no_gpu_available
 
 shape = (4, 4, 4)
 image_shape = (3, 4, 4, 4)
@@ -129,3 +132,122 @@ def test_ct_range_liver(image_rand_pos_gpu: Union[torch.Tensor, np.ndarray]) ->
 
     assert np.mean(image_out, dtype=np.float) == approx(0.9399296555978557)
     assert_image_out_datatype(image_out)
+
+
+@pytest.mark.parametrize("integer_valued", [True, False])
+@pytest.mark.parametrize("use_mask", [True, False])
+def test_order_statistics(integer_valued: bool, use_mask: bool) -> None:
+    """
+    Test that percentiles computed from the histogram (for integer valued images) or by partitioning the voxels
+    are the same as the percentiles that Numpy computes by sorting.
+    """
+    np.random.seed(0)
+    image = np.random.normal(scale=1000, size=(5, 6, 7))
+    if integer_valued:
+        image = np.round(image)
+    image = image.astype(ImageDataType.IMAGE.value)
+    mask = (np.random.uniform(size=image.shape) > 0.5) if use_mask else None
+    voxels = image[mask] if use_mask else image.ravel()
+    order_statistics = photometric_normalization.OrderStatistics(image, mask)
+    assert (order_statistics.cumulative_counts is not None) == integer_valued
+    assert order_statistics.count == len(voxels)
+    percentiles = [0, 1, 2.5, 25, 50, 75, 98, 99, 100]
+    expected = np.percentile(voxels.astype(np.float64), percentiles, interpolation='midpoint')
+    assert np.array_equal(order_statistics.get_percentiles(percentiles), expected)
+    threshold = np.median(voxels)
+    assert order_statistics.count_less_or_equal(threshold) == np.count_nonzero(voxels <= threshold)
+    assert order_statistics.count_less(threshold) == np.count_nonzero(voxels < threshold)
+    start, stop = order_statistics.count_less(threshold), len(voxels) - 3
+    expected_range = np.percentile(np.sort(voxels)[start:stop].astype(np.float64), percentiles,
+                                   interpolation='midpoint')
+    assert np.array_equal(order_statistics.get_percentiles(percentiles, start, stop), expected_range)
+
+
+def test_normalize_in_place(image_rand_pos: Union[torch.Tensor, np.ndarray]) -> None:
+    """
+    Test that writing the normalized image into the input image gives the same result as allocating a new array,
+    and that the input image is not modified otherwise.
+    """
+    original = image_rand_pos.copy()
+    expected, _ = photometric_normalization.normalize_trim(image_rand_pos, mask_half, output_range=(-1, 1),
+                                                           sharpen=1, trim_percentiles=(1, 99))
+    expected_mri, _ = photometric_normalization.mri_window(image_rand_pos, mask_half, (0, 1), sharpen, tail)
+    assert np.array_equal(image_rand_pos, original)
+    image_out, _ = photometric_normalization.normalize_trim(image_rand_pos, mask_half, output_range=(-1, 1),
+                                                            sharpen=1, trim_percentiles=(1, 99), out=image_rand_pos)
+    assert image_out is image_rand_pos
+    assert np.array_equal(image_out, expected)
+    image_mri = original.copy()
+    image_out, _ = photometric_normalization.mri_window(image_mri, mask_half, (0, 1), sharpen, tail, out=image_mri)
+    assert image_out is image_mri
+    assert np.array_equal(image_out, expected_mri)
+    with pytest.raises(ValueError):
+        photometric_normalization.simple_norm(original, mask_half, out=np.empty(shape, dtype=np.float32))
+
+
+@pytest.mark.parametrize("norm_method", [PhotometricNormalizationMethod.MriWindow,
+                                         PhotometricNormalizationMethod.TrimmedNorm])
+def test_normalization_statistics_cache(norm_method: PhotometricNormalizationMethod,
+                                        image_rand_pos: Union[torch.Tensor, np.ndarray],
+                                        tmp_path: Path) -> None:
+    """
+    Test that normalization statistics are stored per subject, and that normalizing with cached statistics gives the
+    same result as computing them.
+    """
+    config = SegmentationModelBase(norm_method=norm_method, tail=tail3, sharpen=sharpen, trim_percentiles=(1, 99),
+                                   should_validate=False)
+    expected = photometric_normalization.PhotometricNormalization(config).transform(image_rand_pos, mask_half)
+    cache_folder = tmp_path / "statistics"
+    config.normalization_statistics_folder = cache_folder
+    # Samples that are not loaded from files have no key, and their statistics are not cached.
+    sample = Sample(image=image_rand_pos, mask=mask_half, labels=np.zeros((1,) + shape), metadata=DummyPatientMetadata)
+    normalizer = photometric_normalization.PhotometricNormalization(config)
+    assert normalizer.get_statistics_key(sample) is None
+    assert np.array_equal(normalizer(sample).image, expected)
+    assert not cache_folder.exists()
+    metadata = PatientMetadata(patient_id=DummyPatientMetadata.patient_id, source_files_key="0123")
+    sample = sample.clone_with_overrides(metadata=metadata)
+    assert np.array_equal(normalizer(sample).image, expected)
+    cache_files = list(cache_folder.glob("*.json"))
+    assert [f.name for f in cache_files] == [f"{normalizer.get_statistics_key(sample)}.json"]
+    assert cache_files[0].name.startswith(f"{DummyPatientMetadata.patient_id}_")
+    # A new normalizer, as in a different data loader worker or at inference, reads the statistics from the file.
+    normalizer = photometric_normalization.PhotometricNormalization(config)
+
+    def fail(*args: Any) -> None:
+        raise ValueError("Statistics should not be computed again")
+
+    normalizer.compute_statistics = fail  # type: ignore
+    assert np.array_equal(normalizer(sample).image, expected)
+    # Different source files give a different key
+    other_sample = sample.clone_with_overrides(metadata=PatientMetadata(patient_id=metadata.patient_id,
+                                                                        source_files_key="4567"))
+    assert normalizer.get_statistics_key(other_sample) != normalizer.get_statistics_key(sample)
+
+
+def test_normalization_statistics_cache_simple_norm(image_rand_pos: Union[torch.Tensor, np.ndarray],
+                                                    tmp_path: Path) -> None:
+    """
+    Test that statistics for SimpleNorm are not cached, because they are cheap to compute.
+    """
+    config = SegmentationModelBase(norm_method=PhotometricNormalizationMethod.SimpleNorm,
+                                   normalization_statistics_folder=tmp_path / "statistics", should_validate=False)
+    sample = Sample(image=image_rand_pos, mask=mask_half, labels=np.zeros((1,) + shape), metadata=DummyPatientMetadata)
+    normalizer = photometric_normalization.PhotometricNormalization(config)
+    assert normalizer.statistics_cache is None
+    normalizer(sample)
+    assert not (tmp_path / "statistics").exists()
+
+
+def test_normalization_statistics_cache_in_memory(tmp_path: Path) -> None:
+    """
+    Test that only the most recently used statistics are kept in memory, and that evicted statistics are read back
+    from their files.
+    """
+    cache = photometric_normalization.NormalizationStatisticsCache(tmp_path, max_entries_in_memory=2)
+    for key in ["a", "b", "c"]:
+        cache.put(key, [[ord(key)]])
+    assert list(cache.statistics.keys()) == ["b", "c"]
+    assert cache.get("b") == [[ord("b")]]
+    assert cache.get("a") == [[ord("a")]]
+    assert list(cache.statistics.keys()) == ["b", "a"]
@@ -116,20 +116,21 @@ def test_metrics_file(test_output_dirs: OutputFolderForTests) -> None:
     kidney = "kidney"
     # Ordering for test data: For "liver", patient 2 has the lowest score, sorting should move them first
     # For "kidney", patient 1 has the lowest score and should be first.
-    d.add(p1, liver, 1.0, 1.0, 0.5)
-    d.add(p1, liver, 0.4, 1.0, 0.4)
-    d.add(p2, liver, 0.8, 1.0, 0.3)
-    d.add(p2, kidney, 0.7, 1.0, 0.2)
-    d.add(p3, kidney, 0.4, 1.0, 0.1)
+    d.add(p1, liver, 1.0, 1.0, 0.5, 0.9)
+    d.add(p1, liver, 0.4, 1.0, 0.4, 0.8)
+    d.add(p2, liver, 0.8, 1.0, 0.3, 0.7)
+    d.add(p2, kidney, 0.7, 1.0, 0.2, 0.6)
+    d.add(p3, kidney, 0.4, 1.0, 0.1, 0.5)
     metrics_file = new_file("metrics_file.csv")
     d.to_csv(Path(metrics_file))
     # Sorting should be first by structure name alphabetically, then Dice with lowest scores first.
-    assert_file_contains_string(metrics_file, "Patient,Structure,Dice,HausdorffDistance_mm,MeanDistance_mm\n"
-                                              "Patient3,kidney,0.400,1.000,0.100\n"
-                                              "Patient2,kidney,0.700,1.000,0.200\n"
-                                              "Patient1,liver,0.400,1.000,0.400\n"
-                                              "Patient2,liver,0.800,1.000,0.300\n"
-                                              "Patient1,liver,1.000,1.000,0.500\n")
+    assert_file_contains_string(metrics_file,
+                                "Patient,Structure,Dice,HausdorffDistance_mm,HausdorffDistance95_mm,MeanDistance_mm\n"
+                                "Patient3,kidney,0.400,1.000,0.500,0.100\n"
+                                "Patient2,kidney,0.700,1.000,0.600,0.200\n"
+                                "Patient1,liver,0.400,1.000,0.800,0.400\n"
+                                "Patient2,liver,0.800,1.000,0.700,0.300\n"
+                                "Patient1,liver,1.000,1.000,0.900,0.500\n")
     aggregates_file = new_file(METRICS_AGGREGATES_FILE)
     d.save_aggregates_to_csv(Path(aggregates_file))
     # Sorting should be first by structure name alphabetically, then Dice with lowest scores first.
@@ -4,14 +4,20 @@
 #  ------------------------------------------------------------------------------------------
 from datetime import datetime
 from pathlib import Path
-from typing import Tuple, Union
+from typing import Any, Tuple, Union
+from unittest import mock
 
+import h5py
 import numpy as np
 import pytest
+from skimage.transform import resize
 
 from InnerEye.Common.fixed_paths_for_tests import full_ml_test_data_path
+from InnerEye.Common.type_annotations import TupleInt3
 from InnerEye.ML.utils.hdf5_util import HDF5Object
-from InnerEye.ML.utils.io_util import is_hdf5_file_path
+from InnerEye.ML.utils.image_util import get_center_crop
+from InnerEye.ML.utils.io_util import ImageAndSegmentations, _get_resize_and_crop_slices, is_hdf5_file_path, \
+    load_image_in_known_formats, load_images_and_stack
 
 n_classes = 11
 root = full_ml_test_data_path()
@@ -89,3 +95,68 @@ def test_is_hdf5_file(input: Tuple[str, bool]) -> None:
     file, expected = input
     assert is_hdf5_file_path(file) == expected
     assert is_hdf5_file_path(Path(file)) == expected
+
+
+def create_hdf5_file(path: Path, volume: np.ndarray, segmentation: np.ndarray) -> None:
+    """
+    Writes an HDF5 file in the layout that HDF5Object reads, with volume and segmentation given as N x H x W.
+    """
+    with h5py.File(str(path), 'w') as hdf5_file:
+        hdf5_file.create_dataset("id", data="0001")
+        hdf5_file.create_dataset("acquisition_date", data=datetime(2018, 7, 10).isoformat())
+        hdf5_file.create_dataset("volume", data=volume[:, None])
+        hdf5_file.create_dataset("segmentation", data=segmentation[:, None])
+
+
+@pytest.mark.parametrize("center_crop_size", [(2, 3, 4), (5, 6, 7), (4, 6, 8)])
+def test_load_hdf5_center_crop(tmp_path: Path, center_crop_size: TupleInt3) -> None:
+    """
+    Test that reading the center crop from an HDF5 file gives the same as cropping the whole image, and that the
+    whole image is read if the crop is larger than the image.
+    """
+    hdf5_path = tmp_path / "patient.h5"
+    volume = np.random.RandomState(0).rand(5, 6, 7).astype(np.float32)
+    segmentation = (volume > 0.5).astype(np.uint8)
+    create_hdf5_file(hdf5_path, volume, segmentation)
+    cropped = HDF5Object.from_file(hdf5_path, load_segmentation=True, center_crop_size=center_crop_size)
+    if center_crop_size == (4, 6, 8):
+        expected_volume, expected_segmentation = volume, segmentation
+    else:
+        expected_volume = get_center_crop(volume, center_crop_size)
+        expected_segmentation = get_center_crop(segmentation, center_crop_size)
+    assert np.array_equal(cropped.volume, expected_volume)
+    assert cropped.segmentation is not None
+    assert np.array_equal(cropped.segmentation, expected_segmentation)
+    # Without resizing, load_images_and_stack reads only the crop
+    stacked = load_images_and_stack([hdf5_path], load_segmentation=True, center_crop_size=(2, 3, 4))
+    assert np.array_equal(stacked.images[0].numpy(), get_center_crop(volume, (2, 3, 4)))
+    assert np.array_equal(stacked.segmentations[0].numpy(), get_center_crop(segmentation, (2, 3, 4)))
+
+
+def test_load_hdf5_resize_and_center_crop(tmp_path: Path) -> None:
+    """
+    Test that load_images_and_stack reads only the region of an HDF5 image that the center crop of the resized image
+    depends on, and that this gives the same as resizing the whole image and then cropping.
+    """
+    hdf5_path = tmp_path / "patient.h5"
+    volume = np.random.RandomState(0).rand(40, 36, 30).astype(np.float32)
+    create_hdf5_file(hdf5_path, volume, (volume > 0.5).astype(np.uint8))
+    image_size, center_crop_size = (20, 12, 10), (8, 6, 4)
+    expected = get_center_crop(resize(volume, image_size, anti_aliasing=True), center_crop_size)
+    loaded_shapes = []
+
+    def load(*args: Any, **kwargs: Any) -> ImageAndSegmentations:
+        result = load_image_in_known_formats(*args, **kwargs)
+        loaded_shapes.append(result.images.shape)
+        return result
+
+    with mock.patch("InnerEye.ML.utils.io_util.load_image_in_known_formats", side_effect=load):
+        stacked = load_images_and_stack([hdf5_path], load_segmentation=False, center_crop_size=center_crop_size,
+                                        image_size=image_size)
+    input_slices = _get_resize_and_crop_slices(volume.shape, image_size, center_crop_size)[0]  # type: ignore
+    assert loaded_shapes == [volume[input_slices].shape]
+    assert np.prod(loaded_shapes[0]) < volume.size
+    assert np.allclose(stacked.images[0].numpy(), expected, atol=1e-6)
+    hdf5_object = HDF5Object.from_file(hdf5_path, load_segmentation=False,
+                                       get_slices=lambda shape: (slice(10, 30), slice(None), slice(3, 6)))
+    assert np.array_equal(hdf5_object.volume, volume[10:30, :, 3:6])
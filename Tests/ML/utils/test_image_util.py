@@ -62,6 +62,31 @@ def test_pad_images_for_training(image_size: TupleInt3) -> None:
     assert np.all(padded_image[..., 8:4, 8:4, 8:4] == expected_pad_value)
 
 
+def test_sliding_window_helpers() -> None:
+    """
+    Test that sliding window padding, start coordinates and coverage are consistent with each other.
+    """
+    image_shape = (7, 9, 10)
+    patch_shape = (3, 4, 5)
+    stride = (2, 4, 3)
+    padding = image_util.get_sliding_window_padding(image_shape, patch_shape, stride)
+    # Z is already tiled completely, Y needs 3 voxels of padding, X needs 1 voxel
+    assert padding == ((0, 0), (1, 2), (0, 1))
+    padded_shape = tuple(s + before + after for s, (before, after) in zip(image_shape, padding))
+    starts = image_util.get_sliding_window_starts(padded_shape, patch_shape, stride)  # type: ignore
+    assert len(starts) == 3 * 3 * 3
+    assert starts[0] == (0, 0, 0)
+    assert starts[1] == (0, 0, 3)
+    assert starts[-1] == (4, 8, 6)
+    expected_coverage = np.zeros(padded_shape)
+    for start in starts:
+        expected_coverage[tuple(slice(s, s + p) for s, p in zip(start, patch_shape))] += 1
+    coverage = image_util.get_sliding_window_coverage(padded_shape, patch_shape, stride)  # type: ignore
+    assert coverage.dtype == np.float32
+    assert np.array_equal(coverage, expected_coverage)
+    assert np.all(coverage > 0)
+
+
 @pytest.mark.parametrize("image", [None, np.random.uniform((4, 4, 4)), np.random.uniform((1, 4, 4, 4))])
 @pytest.mark.parametrize("crop_shape", [None, (8, 8, 8)])
 def test_get_center_crop_invalid(image: Any, crop_shape: Any) -> None:
@@ -5,7 +5,7 @@
 import os
 from pathlib import Path
 import shutil
-from typing import Any, Optional, Tuple
+from typing import Any, Callable, Optional, Tuple
 from unittest import mock
 import zipfile
 
@@ -20,10 +20,12 @@ from skimage.transform import resize
 
 from InnerEye.Common.fixed_paths_for_tests import full_ml_test_data_path
 from InnerEye.Common.output_directories import OutputFolderForTests
+from InnerEye.Common.type_annotations import TupleInt3
 from InnerEye.ML.config import PhotometricNormalizationMethod, SegmentationModelBase
 from InnerEye.ML.dataset.sample import PatientDatasetSource, PatientMetadata
 from InnerEye.ML.utils import io_util
 from InnerEye.ML.utils.dataset_util import DatasetExample, store_and_upload_example
+from InnerEye.ML.utils.image_util import get_center_crop
 from InnerEye.ML.utils.io_util import ImageAndSegmentations, ImageHeader, PhotometricInterpretation, \
     is_dicom_file_path, is_nifti_file_path, is_numpy_file_path, load_dicom_image, load_image_in_known_formats, \
     load_images_and_stack, load_numpy_image, reverse_tuple_float3, load_dicom_series_and_save
@@ -101,6 +103,20 @@ def test_load_images_from_dataset_source(
                                             check_exclusive)
 
 
+def test_get_source_files_key(tmp_path: Path) -> None:
+    """
+    Test that the key of the source files of a sample changes when a file or the HDF5 dataset changes.
+    """
+    file = tmp_path / "image.npy"
+    np.save(file, np.zeros((2, 3)))
+    key = io_util.get_source_files_key([file])
+    assert io_util.get_source_files_key([str(file)]) == key
+    assert io_util.get_source_files_key([f"{file}|volume|0"]) != key
+    assert io_util.get_source_files_key([file, file]) != key
+    np.save(file, np.zeros((2, 4)))
+    assert io_util.get_source_files_key([file]) != key
+
+
 def _test_load_images_from_channels(
         metadata: Any,
         image_channel: Any,
@@ -119,6 +135,7 @@ def _test_load_images_from_channels(
         ),
         check_exclusive=check_exclusive
     )
+    assert sample.metadata.source_files_key is not None
     if image_channel:
         image_with_header = io_util.load_image(image_channel)
         assert list(sample.image.shape) == [2] + list(image_with_header.image.shape)
@@ -618,6 +635,62 @@ def test_load_images_and_stack_with_resize_only_float(test_output_dirs: OutputFo
                               image_size=image_size)
 
 
+@pytest.mark.parametrize(["input_shape", "image_size", "center_crop_size"],
+                         [((40, 36, 30), (20, 12, 10), (8, 6, 4)),
+                          ((40, 36, 30), (40, 36, 30), (8, 7, 30)),
+                          ((30, 36, 31), (20, 9, 31), (20, 3, 5)),
+                          ((16, 16, 16), (8, 8, 8), (8, 8, 8)),
+                          ((1, 60, 48), (1, 20, 12), (1, 19, 3))])
+def test_load_images_and_stack_crops_before_resize(input_shape: TupleInt3, image_size: TupleInt3,
+                                                   center_crop_size: TupleInt3) -> None:
+    """
+    Test that cropping the image region that the center crop depends on, before resizing, gives the same result as
+    resizing the whole image and then cropping.
+    """
+    image = np.random.RandomState(0).rand(*input_shape).astype(np.float32)
+    expected = get_center_crop(resize(image, image_size, anti_aliasing=True), center_crop_size)
+    with mock.patch("InnerEye.ML.utils.io_util.load_image_in_known_formats",
+                    return_value=ImageAndSegmentations(image, None)):
+        stacked = load_images_and_stack([Path("doesnotmatter")], load_segmentation=False,
+                                        center_crop_size=center_crop_size, image_size=image_size)
+    assert stacked.images.shape == (1,) + center_crop_size
+    assert np.allclose(stacked.images[0].numpy(), expected, atol=1e-6)
+
+
+@pytest.mark.parametrize("num_threads", [1, 4])
+def test_load_images_and_stack_concurrently(num_threads: int) -> None:
+    """
+    Test that channels are stacked in the order of the files, when they are loaded concurrently, and that all
+    channels must have the same shape.
+    """
+    arrays = {f"file{i}": np.full((3, 4, 5), i, dtype=np.float32) for i in range(6)}
+
+    def load(file: Path, load_segmentation: bool, center_crop_size: Optional[TupleInt3],
+             get_slices: Optional[Callable]) -> ImageAndSegmentations:
+        return ImageAndSegmentations(arrays[file.name], arrays[file.name].astype(np.uint8))
+
+    files = [Path(name) for name in arrays]
+    with mock.patch("InnerEye.ML.utils.io_util.load_image_in_known_formats", side_effect=load):
+        stacked = load_images_and_stack(files, load_segmentation=True, num_threads=num_threads)
+        assert torch.equal(stacked.images, torch.from_numpy(np.stack(list(arrays.values()))))
+        assert stacked.segmentations.dtype == torch.uint8
+        assert torch.equal(stacked.segmentations, stacked.images.to(torch.uint8))
+        arrays["file5"] = np.zeros((3, 4, 6), dtype=np.float32)
+        with pytest.raises(ValueError) as ex:
+            load_images_and_stack(files, load_segmentation=False, num_threads=num_threads)
+        assert "same size and data type" in str(ex)
+
+
+def test_default_image_loading_threads() -> None:
+    """
+    Test that channels are loaded on several threads in the main process, but on a single thread inside data loader
+    workers.
+    """
+    assert io_util.get_default_image_loading_threads() == io_util.DEFAULT_IMAGE_LOADING_THREADS
+    with mock.patch("torch.utils.data.get_worker_info", return_value=mock.MagicMock()):
+        assert io_util.get_default_image_loading_threads() == 1
+
+
 def test_load_dicom_series(test_output_dirs: OutputFolderForTests) -> None:
     """
     Test that a DICOM series can be loaded.
@@ -720,3 +793,31 @@ def test_load_png_images(test_output_dirs: OutputFolderForTests) -> None:
 
     data_rgba = np.random.randint(2**8, size=(300, 200, 4), dtype=np.uint8)
     save_and_reload_image(data_rgba, 'RGBA')
+
+
+def test_store_and_load_memory_mapped_image(tmp_path: Path) -> None:
+    """
+    Test that images that are stored as .npy files with a header are memory mapped when loading, and can be
+    modified without changing the file.
+    """
+    image = np.random.uniform(size=(4, 5, 6)).astype(np.float32)
+    header = ImageHeader(spacing=(3.0, 1.0, 0.5), origin=(1.0, 2.0, 3.0), direction=(0, 1, 0, 1, 0, 0, 0, 0, 1))
+    path = io_util.store_image_as_numpy(image, header, tmp_path / "image.npy")
+    assert io_util.get_numpy_header_path(path).is_file()
+    loaded = io_util.load_image(path, image_type=np.float32)
+    assert isinstance(loaded.image, np.memmap)
+    assert np.array_equal(loaded.image, image)
+    assert loaded.header == header
+    loaded.image[0] = 0
+    assert np.array_equal(np.load(path), image)
+    # Loading in a different data type converts the image
+    loaded_as_float = io_util.load_image(path, image_type=float)
+    assert loaded_as_float.image.dtype == float
+    assert not isinstance(loaded_as_float.image, np.memmap)
+    # Without the header file, the image is loaded in full, with a unit header
+    io_util.get_numpy_header_path(path).unlink()
+    loaded = io_util.load_image(path, image_type=np.float32)
+    assert not isinstance(loaded.image, np.memmap)
+    assert loaded.header.spacing == (1, 1, 1)
+    with pytest.raises(ValueError):
+        io_util.store_image_as_numpy(image[0], header, tmp_path / "image2d.npy")
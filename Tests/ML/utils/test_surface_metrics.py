@@ -0,0 +1,138 @@
+#  ------------------------------------------------------------------------------------------
+#  Copyright (c) Microsoft Corporation. All rights reserved.
+#  Licensed under the MIT License (MIT). See LICENSE in the repo root for license information.
+#  ------------------------------------------------------------------------------------------
+import math
+
+import SimpleITK as sitk
+import numpy as np
+import pytest
+
+from InnerEye.Common.type_annotations import TupleFloat3, TupleInt3
+from InnerEye.ML.utils.io_util import reverse_tuple_float3
+from InnerEye.ML.utils.surface_metrics import SegmentationMetrics, compute_segmentation_metrics, \
+    compute_segmentation_metrics_per_class, get_bounding_box, get_contour, get_union_bounding_box
+from Tests.ML.benchmarks.benchmark_util import surface_distance
+
+
+def random_ellipsoid(shape: TupleInt3, random_state: np.random.RandomState) -> np.ndarray:
+    """
+    Creates a binary ellipsoid at a random position, which may be cut off at the image boundary.
+    """
+    center = [random_state.uniform(-2, size + 2) for size in shape]
+    radii = [random_state.uniform(1, size / 2) for size in shape]
+    distance = sum(((axis - c) / r) ** 2 for axis, c, r in zip(np.indices(shape), center, radii))
+    return (distance <= 1).astype(np.uint8)
+
+
+def simpleitk_metrics(prediction: np.ndarray, ground_truth: np.ndarray,
+                      voxel_spacing: TupleFloat3) -> SegmentationMetrics:
+    """
+    Computes the metrics on the full image with the SimpleITK filters.
+    """
+    images = []
+    for array in [prediction, ground_truth]:
+        image = sitk.GetImageFromArray(array.astype(np.uint8))
+        image.SetSpacing(sitk.VectorDouble(reverse_tuple_float3(voxel_spacing)))
+        images.append(image)
+    overlap_measures_filter = sitk.LabelOverlapMeasuresImageFilter()
+    overlap_measures_filter.Execute(*images)
+    hausdorff_distance_filter = sitk.HausdorffDistanceImageFilter()
+    hausdorff_distance_filter.Execute(*images)
+    return SegmentationMetrics(dice=overlap_measures_filter.GetDiceCoefficient(),
+                               hausdorff_distance_mm=hausdorff_distance_filter.GetHausdorffDistance(),
+                               hausdorff_distance_95_mm=math.nan,
+                               mean_surface_distance_mm=surface_distance(*images))
+
+
+@pytest.mark.parametrize("seed", [0, 1, 2])
+def test_segmentation_metrics_match_simpleitk(seed: int) -> None:
+    """
+    Test that the metrics computed on cropped structures match the SimpleITK filters on the full image.
+    """
+    random_state = np.random.RandomState(seed)
+    for _ in range(10):
+        shape: TupleInt3 = tuple(random_state.randint(3, 20, size=3))  # type: ignore
+        voxel_spacing: TupleFloat3 = tuple(random_state.uniform(0.5, 3, size=3))  # type: ignore
+        segmentation = np.zeros(shape, dtype=np.int64)
+        ground_truth = np.zeros((3,) + shape)
+        for class_index in [1, 2]:
+            segmentation[random_ellipsoid(shape, random_state) == 1] = class_index
+            ground_truth[class_index] = random_ellipsoid(shape, random_state)
+        actual = compute_segmentation_metrics_per_class(segmentation, ground_truth, [1, 2], voxel_spacing)
+        for class_index in [1, 2]:
+            prediction = segmentation == class_index
+            if not np.any(prediction) or not np.any(ground_truth[class_index]):
+                continue
+            expected = simpleitk_metrics(prediction, ground_truth[class_index], voxel_spacing)
+            assert actual[class_index].dice == pytest.approx(expected.dice, abs=1e-10)
+            assert actual[class_index].hausdorff_distance_mm == pytest.approx(expected.hausdorff_distance_mm,
+                                                                              rel=1e-5)
+            assert actual[class_index].mean_surface_distance_mm == pytest.approx(expected.mean_surface_distance_mm,
+                                                                                 rel=1e-5)
+            assert 0 <= actual[class_index].hausdorff_distance_95_mm <= actual[class_index].hausdorff_distance_mm
+
+
+def test_segmentation_metrics_empty() -> None:
+    empty = np.zeros((4, 5, 6))
+    structure = np.zeros((4, 5, 6))
+    structure[1:3, 2:4, 1:5] = 1
+    both_empty = compute_segmentation_metrics(empty, empty, (1, 1, 1))
+    assert all(math.isnan(value) for value in vars(both_empty).values())
+    for prediction, ground_truth in [(empty, structure), (structure, empty)]:
+        metrics = compute_segmentation_metrics(prediction, ground_truth, (1, 1, 1))
+        assert metrics.dice == 0
+        assert metrics.hausdorff_distance_mm == math.inf
+        assert metrics.hausdorff_distance_95_mm == math.inf
+        assert metrics.mean_surface_distance_mm == math.inf
+    identical = compute_segmentation_metrics(structure, structure, (1, 2, 3))
+    assert identical == SegmentationMetrics(dice=1.0, hausdorff_distance_mm=0.0, hausdorff_distance_95_mm=0.0,
+                                            mean_surface_distance_mm=0.0)
+    per_class = compute_segmentation_metrics_per_class(empty.astype(int), np.stack([1 - empty, empty]), [1], (1, 1, 1))
+    assert math.isnan(per_class[1].dice)
+
+
+def test_segmentation_metrics_non_binary() -> None:
+    """
+    Test that masks with values other than 0 and 1 are rejected, rather than silently binarized.
+    """
+    structure = np.zeros((4, 5, 6))
+    structure[1:3, 2:4, 1:5] = 1
+    with pytest.raises(ValueError) as ex:
+        compute_segmentation_metrics(structure * 2, structure, (1, 1, 1))
+    assert "Predictions values should be 0 or 1" in str(ex)
+    with pytest.raises(ValueError) as ex:
+        compute_segmentation_metrics(structure, structure * 0.5, (1, 1, 1))
+    assert "Ground truth values should be 0 or 1" in str(ex)
+
+
+def test_bounding_box() -> None:
+    mask = np.zeros((5, 6, 7))
+    assert get_bounding_box(mask) is None
+    mask[1:3, 0:2, 4:7] = 1
+    box = get_bounding_box(mask)
+    assert box == (slice(1, 3), slice(0, 2), slice(4, 7))
+    assert get_union_bounding_box(box, None, mask.shape) == (slice(0, 4), slice(0, 3), slice(3, 7))
+    assert get_union_bounding_box(box, (slice(4, 5), slice(5, 6), slice(0, 1)), mask.shape, margin=0) == \
+           (slice(1, 5), slice(0, 6), slice(0, 7))
+    with pytest.raises(ValueError):
+        get_union_bounding_box(None, None, mask.shape)
+
+
+def test_get_contour() -> None:
+    """
+    Test that the contour contains the mask voxels that touch the background, and the voxels at the image boundary
+    only if the boundary counts as background.
+    """
+    mask = np.zeros((1, 4, 5), dtype=np.uint8)
+    mask[0, 0:3, 0:4] = 1
+    expected = np.array([[[0, 0, 0, 1, 0],
+                          [0, 0, 0, 1, 0],
+                          [1, 1, 1, 1, 0],
+                          [0, 0, 0, 0, 0]]], dtype=bool)
+    assert np.array_equal(get_contour(mask, connectivity=1), expected)
+    expected_with_boundary = mask.astype(bool)
+    expected_with_boundary[0, 1, 1:3] = False
+    assert np.array_equal(get_contour(mask[0], connectivity=1, boundary_is_background=True), expected_with_boundary[0])
+    assert np.array_equal(get_contour(mask, connectivity=1, boundary_is_background=True),
+                          mask.astype(bool))
@@ -0,0 +1,50 @@
+#  ------------------------------------------------------------------------------------------
+#  Copyright (c) Microsoft Corporation. All rights reserved.
+#  Licensed under the MIT License (MIT). See LICENSE in the repo root for license information.
+#  ------------------------------------------------------------------------------------------
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from InnerEye.ML.common import DATASET_CSV_FILE_NAME
+from InnerEye.ML.utils.image_util import ImageHeader
+from InnerEye.ML.utils.io_util import load_image, store_as_nifti
+from InnerEye.Scripts.convert_dataset_to_numpy import ConvertDatasetConfig, convert_dataset
+
+
+def test_convert_dataset_to_numpy(tmp_path: Path) -> None:
+    """
+    Test that converting a dataset to .npy files gives the same images and headers when loading.
+    """
+    dataset_folder = tmp_path / "dataset"
+    (dataset_folder / "1").mkdir(parents=True)
+    header = ImageHeader(spacing=(2.0, 1.0, 0.5), origin=(1.0, 2.0, 3.0), direction=(1, 0, 0, 0, 1, 0, 0, 0, 1))
+    image = np.random.randint(-1000, 1000, size=(3, 4, 5)).astype(np.int16)
+    labels = (np.random.uniform(size=(3, 4, 5)) > 0.5).astype(np.uint8)
+    store_as_nifti(image, header, dataset_folder / "1" / "ct.nii.gz", image_type=np.int16)
+    store_as_nifti(labels, header, dataset_folder / "1" / "heart.nii.gz", image_type=np.uint8)
+    (dataset_folder / "1" / "notes.txt").write_text("foo")
+    pd.DataFrame({"subject": ["1", "1", "1"],
+                  "filePath": ["1/ct.nii.gz", "1/heart.nii.gz", "1/notes.txt"],
+                  "channel": ["ct", "heart", "notes"]}).to_csv(dataset_folder / DATASET_CSV_FILE_NAME, index=False)
+    output_folder = tmp_path / "converted"
+    config = ConvertDatasetConfig(dataset_folder=dataset_folder, output_folder=output_folder, image_channels=["ct"],
+                                  num_workers=1)
+    dataframe = convert_dataset(config)
+    assert list(dataframe["filePath"]) == ["1/ct.npy", "1/heart.npy", "1/notes.txt"]
+    assert pd.read_csv(output_folder / DATASET_CSV_FILE_NAME, dtype=str).equals(dataframe)
+    for file, expected, dtype in [("ct", image, np.float32), ("heart", labels, np.uint8)]:
+        original = load_image(dataset_folder / "1" / f"{file}.nii.gz", image_type=dtype)
+        converted = load_image(output_folder / "1" / f"{file}.npy", image_type=dtype)
+        assert isinstance(converted.image, np.memmap)
+        assert np.array_equal(converted.image, expected)
+        assert np.array_equal(converted.image, original.image)
+        assert converted.header == original.header
+    assert (output_folder / "1" / "notes.txt").read_text() == "foo"
+    # Channels that are not images must be binary
+    with pytest.raises(ValueError) as ex:
+        convert_dataset(ConvertDatasetConfig(dataset_folder=dataset_folder, output_folder=output_folder,
+                                             image_channels=["heart"], num_workers=1))
+    assert "is not in image_channels, but is not binary" in str(ex)
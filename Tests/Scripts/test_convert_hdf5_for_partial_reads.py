@@ -0,0 +1,73 @@
+#  ------------------------------------------------------------------------------------------
+#  Copyright (c) Microsoft Corporation. All rights reserved.
+#  Licensed under the MIT License (MIT). See LICENSE in the repo root for license information.
+#  ------------------------------------------------------------------------------------------
+from pathlib import Path
+from unittest import mock
+
+import h5py
+import numpy as np
+import pytest
+
+from InnerEye.ML.utils.hdf5_util import HDF5Object
+from InnerEye.Scripts.convert_hdf5_for_partial_reads import ConvertHDF5Config, convert_dataset, get_chunk_shape
+from Tests.ML.utils.test_hdf5_util import create_hdf5_file
+
+
+def test_get_chunk_shape() -> None:
+    assert get_chunk_shape((100, 1, 20, 200), 32) == (32, 1, 20, 32)
+    assert get_chunk_shape((10, 40, 50), 32) == (10, 32, 32)
+    assert get_chunk_shape((), 32) is None
+    assert get_chunk_shape((3, 4), 32) is None
+
+
+def test_convert_hdf5_for_partial_reads(tmp_path: Path) -> None:
+    """
+    Test that converting HDF5 files keeps all values, chunks and compresses the images, and copies other files.
+    """
+    dataset_folder = tmp_path / "dataset"
+    (dataset_folder / "1").mkdir(parents=True)
+    volume = np.random.RandomState(0).rand(40, 36, 50).astype(np.float32)
+    segmentation = (volume > 0.5).astype(np.uint8)
+    create_hdf5_file(dataset_folder / "1" / "patient.h5", volume, segmentation)
+    (dataset_folder / "dataset.csv").write_text("subject,filePath\n1,1/patient.h5\n")
+    output_folder = tmp_path / "converted"
+    files = convert_dataset(ConvertHDF5Config(dataset_folder=dataset_folder, output_folder=output_folder,
+                                              chunk_size=16, num_workers=1))
+    assert files == [Path("1/patient.h5"), Path("dataset.csv")]
+    assert (output_folder / "dataset.csv").read_text() == (dataset_folder / "dataset.csv").read_text()
+    with h5py.File(str(dataset_folder / "1" / "patient.h5"), 'r') as original, \
+            h5py.File(str(output_folder / "1" / "patient.h5"), 'r') as converted:
+        assert set(converted.keys()) == set(original.keys())
+        for name in original:
+            assert np.array_equal(converted[name][()], original[name][()])
+            assert converted[name].dtype == original[name].dtype
+        for name in ["volume", "segmentation"]:
+            assert converted[name].chunks == (16, 1, 16, 16)
+            assert converted[name].compression == "lzf"
+    original_object = HDF5Object.from_file(dataset_folder / "1" / "patient.h5", load_segmentation=True)
+    converted_object = HDF5Object.from_file(output_folder / "1" / "patient.h5", load_segmentation=True,
+                                            center_crop_size=(8, 10, 12))
+    assert np.array_equal(converted_object.volume, original_object.volume[16:24, 13:23, 19:31])
+    assert converted_object.segmentation is not None
+    assert np.array_equal(converted_object.segmentation, segmentation[16:24, 13:23, 19:31])
+    with pytest.raises(ValueError) as ex:
+        ConvertHDF5Config(dataset_folder=dataset_folder, output_folder=output_folder, compression="zstd")
+    assert "compression must be one of" in str(ex)
+
+
+def test_convert_hdf5_compressed_files(tmp_path: Path) -> None:
+    """
+    Test that compressed HDF5 files are copied unchanged, with a warning.
+    """
+    dataset_folder = tmp_path / "dataset"
+    dataset_folder.mkdir()
+    (dataset_folder / "patient.h5.gz").write_bytes(b"compressed")
+    output_folder = tmp_path / "converted"
+    with mock.patch("logging.warning") as warning:
+        files = convert_dataset(ConvertHDF5Config(dataset_folder=dataset_folder, output_folder=output_folder,
+                                                  num_workers=1))
+    assert files == [Path("patient.h5.gz")]
+    assert (output_folder / "patient.h5.gz").read_bytes() == b"compressed"
+    warning.assert_called_once()
+    assert "1 compressed HDF5 files are copied without conversion" in warning.call_args[0][0]